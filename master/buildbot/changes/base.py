@@ -13,10 +13,12 @@
 #
 # Copyright Buildbot Team Members
 
+import random
+
 from zope.interface import implements
 from twisted.application import service
-from twisted.internet import defer, task, reactor
-from twisted.python import log
+from twisted.internet import defer, reactor
+from twisted.python import log, failure
 
 from buildbot.interfaces import IChangeSource
 from buildbot import util
@@ -30,17 +32,164 @@ class ChangeSource(service.Service, util.ComparableMixin):
     def describe(self):
         pass
 
+class PollStats(object):
+    """
+    I keep statistics about the polls of one L{PollingChangeSource}: how
+    many there have been, how many failed or found changes, how long they
+    took, and how long they waited for a free slot in the L{PollScheduler}.
+    Durations are in seconds.
+    """
+
+    def __init__(self):
+        self.polls = 0
+        self.failures = 0
+        self.activePolls = 0 # polls which found changes
+        self.lastDuration = None
+        self.minDuration = None
+        self.maxDuration = None
+        self.totalDuration = 0
+        self.lastWait = None
+        self.maxWait = None
+
+    def pollFinished(self, duration, wait, failed, active):
+        self.polls += 1
+        if failed:
+            self.failures += 1
+        if active:
+            self.activePolls += 1
+        self.lastDuration = duration
+        if self.polls == 1:
+            self.minDuration = self.maxDuration = duration
+            self.maxWait = wait
+        else:
+            self.minDuration = min(duration, self.minDuration)
+            self.maxDuration = max(duration, self.maxDuration)
+            self.maxWait = max(wait, self.maxWait)
+        self.totalDuration += duration
+        self.lastWait = wait
+
+    def getMeanDuration(self):
+        if not self.polls:
+            return None
+        return self.totalDuration / self.polls
+
+    def __str__(self):
+        if not self.polls:
+            return "no polls"
+        return ("%d polls (%d failed, %d with changes), duration "
+                "last %.2fs mean %.2fs max %.2fs, max wait %.2fs"
+                % (self.polls, self.failures, self.activePolls,
+                   self.lastDuration, self.getMeanDuration(),
+                   self.maxDuration, self.maxWait))
+
+class PollScheduler(object):
+    """
+    I run the polls of all of a master's L{PollingChangeSource}s, so that
+    no more than C{maxConcurrentPolls} of them run at once; the others wait
+    their turn, in order.  C{maxConcurrentPolls} is set from
+    C{c['maxConcurrentPolls']}, and None means no limit.
+
+    A poll which is still running after C{slotTimeout} seconds (a hung
+    subprocess, say) is logged and gives up its slot, so that it does not
+    hold up the polls of other sources; its own source still waits for it
+    to finish before polling again.
+    """
+
+    slotTimeout = 600
+
+    def __init__(self, maxConcurrentPolls=10):
+        self.maxConcurrentPolls = maxConcurrentPolls
+        self.active = 0
+        self.waiting = []
+        self.random = random.Random()
+
+    def setMaxConcurrentPolls(self, maxConcurrentPolls):
+        self.maxConcurrentPolls = maxConcurrentPolls
+        self._startWaiting()
+
+    def jitter(self, interval, fraction):
+        """
+        Return C{interval}, moved at random by up to C{fraction} of itself
+        either way, so that pollers with the same interval drift apart.
+        """
+        if not fraction:
+            return interval
+        return interval * (1 + self.random.uniform(-fraction, fraction))
+
+    def run(self, fn, source=None):
+        """
+        Call C{fn} when a slot is free, and return a Deferred which fires
+        with its result once it is finished.  C{source} names the poller in
+        log messages.
+        """
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._startWaiting()
+        slot = {}
+        def release():
+            if slot.pop('held', False):
+                self.active -= 1
+                self._startWaiting()
+        def timedOut():
+            del slot['timer']
+            log.msg("poll of %s has run for more than %d seconds; letting "
+                    "other polls run" % (source or fn, self.slotTimeout))
+            release()
+        def call(_):
+            slot['held'] = True
+            if self.slotTimeout:
+                slot['timer'] = reactor.callLater(self.slotTimeout, timedOut)
+            return defer.maybeDeferred(fn)
+        d.addCallback(call)
+        def finished(res):
+            if 'timer' in slot:
+                slot.pop('timer').cancel()
+            release()
+            return res
+        d.addBoth(finished)
+        return d
+
+    def _hasRoom(self):
+        return (self.maxConcurrentPolls is None
+                or self.active < self.maxConcurrentPolls)
+
+    def _startWaiting(self):
+        while self.waiting and self._hasRoom():
+            self.active += 1
+            self.waiting.pop(0).callback(None)
+
 class PollingChangeSource(ChangeSource):
     """
     Utility subclass for ChangeSources that use some kind of periodic polling
     operation.  Subclasses should define C{poll} and set C{self.pollInterval}.
     The rest is taken care of.
+
+    Polls are run by the master's L{PollScheduler}, which limits how many
+    run at once.  Each interval is moved at random by up to C{pollJitter}
+    of itself.  If C{pollMaxInterval} is set, the interval grows by a
+    factor of C{pollBackoff} after each poll which finds no changes, up to
+    C{pollMaxInterval}, and drops back to C{pollInterval} as soon as one
+    does.  Subclasses should add their changes with L{addChange} or
+    L{addChanges}, so that this activity is noticed.  Statistics about the
+    polls are kept in C{self.pollStats}.
     """
 
     pollInterval = 60
     "time (in seconds) between calls to C{poll}"
 
-    _loop = None
+    pollMaxInterval = None
+    "longest time (in seconds) between calls to C{poll} for a quiet source"
+
+    pollBackoff = 2
+    "factor by which the interval grows after a poll without changes"
+
+    pollJitter = 0.1
+    "fraction of the interval by which each interval is moved at random"
+
+    _call = None
+    _currentInterval = None
+    _foundChanges = False
+    pollStats = None
 
     def poll(self):
         """
@@ -49,22 +198,89 @@ class PollingChangeSource(ChangeSource):
         method will be called again after C{pollInterval} seconds.
         """
 
+    def addChange(self, **kwargs):
+        """
+        Add a change to the master, noting that this poll found changes.
+        Returns the master's Deferred.
+        """
+        self._foundChanges = True
+        return self.master.addChange(**kwargs)
+
+    def addChanges(self, changes):
+        """
+        Add a list of changes (dictionaries of L{addChange} arguments) to
+        the master, noting that this poll found changes.  Returns the
+        master's Deferred.
+        """
+        if changes:
+            self._foundChanges = True
+        return self.master.addChanges(changes)
+
+    def getPollInterval(self):
+        """
+        Return the current time (in seconds) between polls, before jitter.
+        """
+        return self._currentInterval or self.pollInterval
+
     def startService(self):
         ChangeSource.startService(self)
-        def do_poll():
-            d = defer.maybeDeferred(self.poll)
-            d.addErrback(log.err, 'while polling for changes')
-            return d
+        if self.pollStats is None:
+            self.pollStats = PollStats()
+        self._currentInterval = self.pollInterval
 
         # delay starting the loop until the reactor is running, and do not
         # run it immediately - if services are still starting up, they may
         # miss an initial flood of changes
-        def start_loop():
-            self._loop = task.LoopingCall(do_poll)
-            self._loop.start(self.pollInterval, now=False)
-        reactor.callWhenRunning(start_loop)
+        reactor.callWhenRunning(self._scheduleNextPoll)
 
     def stopService(self):
-        if self._loop:
-            self._loop.stop()
+        if self._call:
+            self._call.cancel()
+            self._call = None
         return ChangeSource.stopService(self)
+
+    def _scheduleNextPoll(self):
+        # a poll which was running when the service was stopped and started
+        # again finds the new loop already scheduled
+        if not self.running or self._call:
+            return
+        delay = self._getScheduler().jitter(self.getPollInterval(),
+                                            self.pollJitter)
+        self._call = reactor.callLater(delay, self._doPoll)
+
+    def _getScheduler(self):
+        return self.master.pollScheduler
+
+    def _doPoll(self):
+        self._call = None
+        queued = reactor.seconds()
+        timing = {}
+        def do_poll():
+            # the service may have been stopped while this poll waited
+            if not self.running:
+                return
+            timing['started'] = reactor.seconds()
+            self._foundChanges = False
+            return self.poll()
+        d = self._getScheduler().run(do_poll, self)
+        def finished(res):
+            if 'started' not in timing:
+                return
+            now = reactor.seconds()
+            started = timing['started']
+            failed = isinstance(res, failure.Failure)
+            self.pollStats.pollFinished(now - started, started - queued,
+                                        failed, self._foundChanges)
+            self._adjustInterval()
+            if failed:
+                log.err(res, 'while polling for changes')
+            self._scheduleNextPoll()
+        d.addBoth(finished)
+
+    def _adjustInterval(self):
+        if self._foundChanges or not self.pollMaxInterval:
+            self._currentInterval = self.pollInterval
+        else:
+            self._currentInterval = min(
+                    self._currentInterval * self.pollBackoff,
+                    max(self.pollMaxInterval, self.pollInterval))
@@ -202,11 +202,12 @@ class BonsaiParser:
 
 
 class BonsaiPoller(base.PollingChangeSource):
-    compare_attrs = ["bonsaiURL", "pollInterval", "tree",
+    compare_attrs = ["bonsaiURL", "pollInterval", "pollMaxInterval", "tree",
                      "module", "branch", "cvsroot"]
 
     def __init__(self, bonsaiURL, module, branch, tree="default",
-                 cvsroot="/cvsroot", pollInterval=30, project=''):
+                 cvsroot="/cvsroot", pollInterval=30, project='',
+                 pollMaxInterval=None):
         self.bonsaiURL = bonsaiURL
         self.module = module
         self.branch = branch
@@ -214,6 +215,7 @@ class BonsaiPoller(base.PollingChangeSource):
         self.cvsroot = cvsroot
         self.repository = module != 'all' and module or ''
         self.pollInterval = pollInterval
+        self.pollMaxInterval = pollMaxInterval
         self.lastChange = time.time()
         self.lastPoll = time.time()
 
@@ -268,10 +270,10 @@ class BonsaiPoller(base.PollingChangeSource):
                      for file in cinode.files]
             self.lastChange = self.lastPoll
             w = defer.waitForDeferred(
-                    self.master.addChange(who = cinode.who,
-                               files = files,
-                               comments = cinode.log,
-                               when = cinode.date,
-                               branch = self.branch))
+                    self.addChange(who = cinode.who,
+                                   files = files,
+                                   comments = cinode.log,
+                                   when = cinode.date,
+                                   branch = self.branch))
             yield w
             w.getResult()
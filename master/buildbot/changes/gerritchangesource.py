@@ -13,7 +13,10 @@
 #
 # Copyright Buildbot Team Members
 
-from twisted.internet import reactor
+import os
+from collections import deque
+
+from twisted.internet import reactor, utils
 
 from buildbot.changes import base
 from buildbot.util import json
@@ -24,7 +27,11 @@ from twisted.internet.protocol import ProcessProtocol
 
 class GerritChangeSource(base.ChangeSource):
     """This source will maintain a connection to gerrit ssh server
-    that will provide us gerrit events in json format."""
+    that will provide us gerrit events in json format.
+
+    Events are queued and added to the database in batches.  When the
+    connection is restored, the patch sets uploaded while it was down are
+    found with 'gerrit query'."""
 
     compare_attrs = ["gerritserver", "gerritport"]
 
@@ -40,6 +47,27 @@ class GerritChangeSource(base.ChangeSource):
     STREAM_BACKOFF_MAX = 60
     "(seconds) maximum time to wait before retrying a failed connection"
 
+    BATCH_SIZE = 100
+    "maximum number of changes added to the database at once"
+
+    FLUSH_RETRY_MIN = 1
+    "(seconds) time to wait before retrying a batch which could not be added"
+
+    FLUSH_RETRY_MAX = 300
+    "(seconds) maximum time to wait before retrying a batch, on repeated failures"
+
+    CATCHUP_SLACK = 60
+    "(seconds) how far before the last event the catch-up query looks, to allow for clock skew"
+
+    CATCHUP_MAX_AGE = 7*24*3600
+    "(seconds) the catch-up query looks no further back than this"
+
+    CATCHUP_LIMIT = 500
+    "maximum number of changes returned by the catch-up query"
+
+    SEEN_EVENTS = 1000
+    "number of recent events remembered, so that the catch-up query does not add them again"
+
     def __init__(self, gerritserver, username, gerritport=29418, identity_file=None):
         """
         @type  gerritserver: string
@@ -63,13 +91,29 @@ class GerritChangeSource(base.ChangeSource):
         self.identity_file = identity_file
         self.process = None
         self.streamProcessTimeout = self.STREAM_BACKOFF_MIN
+        self.lastStreamProcessStart = None
+        self.reconnect = None # DelayedCall to restart the stream
+
+        # (timestamp or None, chdict) pairs waiting to be added to the database
+        self.pendingChanges = []
+        self.flushing = False
+        self.flushWaiters = []
+        self.flushRetryDelay = self.FLUSH_RETRY_MIN
+        self.flushRetry = None # DelayedCall to retry a failed batch
+
+        # the time of the latest event known to have been handled
+        self.lastEventTime = None
+        self.catchingUp = False
+        self.caughtUpTo = None # start time of the last stream caught up on
+        self.seenEvents = deque()
+        self.seenEventKeys = set()
+        self._objectid = None
 
     class LocalPP(ProcessProtocol):
         def __init__(self, change_source):
             self.change_source = change_source
             self.data = ""
 
-        @defer.deferredGenerator
         def outReceived(self, data):
             """Do line buffering."""
             self.data += data
@@ -77,10 +121,13 @@ class GerritChangeSource(base.ChangeSource):
             self.data = lines.pop(-1) # last line is either empty or incomplete
             for line in lines:
                 log.msg("gerrit: %s" % (line,))
-                d = self.change_source.lineReceived(line)
-                wfd = defer.waitForDeferred(d)
-                yield wfd
-                wfd.getResult()
+                self.change_source.eventReceived(
+                        self.change_source.parseLine(line))
+            # add everything in this chunk of output together, unless a
+            # batch is already being added, in which case it will be next
+            if not self.change_source.flushing:
+                d = self.change_source.flushChanges()
+                d.addErrback(log.err, 'error adding changes from GerritChangeSource')
 
         def errReceived(self, data):
             log.msg("gerrit stderr: %s" % (data,))
@@ -88,13 +135,24 @@ class GerritChangeSource(base.ChangeSource):
         def processEnded(self, status_object):
             self.change_source.streamProcessStopped()
 
-    def lineReceived(self, line):
+    def parseLine(self, line):
         try:
-            event = json.loads(line)
+            return json.loads(line)
         except ValueError:
             log.msg("bad json line: %s" % (line,))
-            return defer.succeed(None)
+            return None
 
+    def lineReceived(self, line):
+        """Handle a line of 'gerrit stream-events' output.  Returns a
+        Deferred which fires when the change it describes, if any, has been
+        added."""
+        self.eventReceived(self.parseLine(line))
+        return self.flushChanges()
+
+    def eventReceived(self, event):
+        """Queue a change for C{event}, a dictionary from 'gerrit
+        stream-events', if it is a kind we build and has not been seen
+        already."""
         if type(event) == type({}) and "type" in event and event["type"] in ["patchset-created", "ref-updated"]:
             # flatten the event dictionary, for easy access with WithProperties
             def flatten(event, base, d):
@@ -120,6 +178,8 @@ class GerritChangeSource(base.ChangeSource):
                         files=["unknown"],
                         category=event["type"],
                         properties=properties)
+                when = (event.get("eventCreatedOn")
+                        or event["patchSet"].get("createdOn"))
             elif event["type"] == "ref-updated":
                 ref = event["refUpdate"]
                 chdict = dict(
@@ -131,28 +191,188 @@ class GerritChangeSource(base.ChangeSource):
                         files=["unknown"],
                         category=event["type"],
                         properties=properties)
+                when = event.get("eventCreatedOn")
             else:
-                return defer.succeed(None) # this shouldn't happen anyway
-
-            d = self.master.addChange(**chdict)
-            # eat failures..
-            d.addErrback(log.err, 'error adding change from GerritChangeSource')
+                return # this shouldn't happen anyway
+
+            key = (chdict["category"], chdict["project"], chdict["branch"],
+                   chdict["revision"])
+            if key in self.seenEventKeys:
+                return
+            self.seenEventKeys.add(key)
+            self.seenEvents.append(key)
+            if len(self.seenEvents) > self.SEEN_EVENTS:
+                self.seenEventKeys.discard(self.seenEvents.popleft())
+
+            self.pendingChanges.append((when, chdict))
+
+    def flushChanges(self):
+        """Add the queued changes to the database, at most C{BATCH_SIZE} at a
+        time.  A batch which cannot be added is queued again, and retried
+        after a growing delay.  Returns a Deferred which fires when the queue
+        is empty."""
+        d = defer.Deferred()
+        self.flushWaiters.append(d)
+        if not self.flushing:
+            self._flushNext()
+        return d
+
+    def _flushNext(self):
+        self.flushRetry = None
+        if not self.pendingChanges:
+            self.flushing = False
+            waiters, self.flushWaiters = self.flushWaiters, []
+            for d in waiters:
+                d.callback(None)
+            return
+        self.flushing = True
+        batch = self.pendingChanges[:self.BATCH_SIZE]
+        del self.pendingChanges[:self.BATCH_SIZE]
+        d = self.master.addChanges([ chdict for when, chdict in batch ])
+        def added(_):
+            self.flushRetryDelay = self.FLUSH_RETRY_MIN
+            # events without a timestamp from gerrit do not move the
+            # catch-up point, since our clock may be ahead of gerrit's
+            whens = [ when for when, chdict in batch if when is not None ]
+            if not whens:
+                return
+            d = self._setLastEventTime(max(whens))
+            d.addErrback(log.err, 'error saving GerritChangeSource state')
+            return d
+        def failed(why):
+            log.err(why, 'error adding changes from GerritChangeSource')
+            # the catch-up point stays put, and the batch goes back at the
+            # head of the queue
+            self.pendingChanges[:0] = batch
+            log.msg("GerritChangeSource: retrying %d changes after %ds"
+                    % (len(batch), self.flushRetryDelay))
+            self.flushRetry = reactor.callLater(self.flushRetryDelay,
+                                                self._flushNext)
+            self.flushRetryDelay = min(self.flushRetryDelay * 2,
+                                       self.FLUSH_RETRY_MAX)
+        d.addCallbacks(added, failed)
+        def flushed(_):
+            if not self.flushRetry:
+                self._flushNext()
+        d.addCallback(flushed)
+
+    def _setLastEventTime(self, when):
+        if self.lastEventTime is not None and when <= self.lastEventTime:
+            return defer.succeed(None)
+        self.lastEventTime = when
+        if self._objectid is None:
+            return defer.succeed(None)
+        return self.master.db.state.setState(self._objectid,
+                                             'last_event_time', when)
+
+    def loadState(self):
+        d = self.master.db.state.getObjectId(
+                "%s@%s:%d" % (self.username, self.gerritserver, self.gerritport),
+                'buildbot.changes.gerritchangesource.GerritChangeSource')
+        def getState(objectid):
+            self._objectid = objectid
+            return self.master.db.state.getState(objectid, 'last_event_time',
+                                                 None)
+        d.addCallback(getState)
+        def setLastEventTime(when):
+            if when is not None and (self.lastEventTime is None
+                                     or when > self.lastEventTime):
+                self.lastEventTime = when
+        d.addCallback(setLastEventTime)
+        return d
+
+    def getSshArgs(self):
+        args = [ self.username+"@"+self.gerritserver,"-p", str(self.gerritport)]
+        if self.identity_file is not None:
+          args = args + [ '-i', self.identity_file ]
+        return args
+
+    def getProcessOutput(self, args):
+        # this exists so we can override it during the unit tests
+        return utils.getProcessOutput("ssh", args, env=os.environ)
+
+    def catchUp(self):
+        """Add changes for the patch sets uploaded since the last event,
+        while the stream was not connected.  Returns a Deferred which fires
+        with True if nothing can have been missed."""
+        if self.lastEventTime is None:
+            return defer.succeed(True)
+        if self.catchingUp:
+            return defer.succeed(False)
+        since = self.lastEventTime
+        age = int(util.now() - since) + self.CATCHUP_SLACK
+        if age > self.CATCHUP_MAX_AGE:
+            log.msg("GerritChangeSource: last event was %ds ago; only "
+                    "catching up on the last %ds" % (age, self.CATCHUP_MAX_AGE))
+            age = self.CATCHUP_MAX_AGE
+        log.msg("GerritChangeSource: catching up on changes from the last %ds"
+                % age)
+        self.catchingUp = True
+        d = self.getProcessOutput(self.getSshArgs() +
+                [ "gerrit", "query", "--format=JSON", "--patch-sets",
+                  "NOT", "age:%ds" % age, "limit:%d" % self.CATCHUP_LIMIT ])
+        def queue(output):
+            events = self.parseQuery(output, since)
+            log.msg("GerritChangeSource: found %d missed patch sets"
+                    % len(events))
+            for event in events:
+                self.eventReceived(event)
+            d = self.flushChanges()
+            d.addCallback(lambda _ : True)
             return d
+        d.addCallback(queue)
+        def done(res):
+            self.catchingUp = False
+            return res
+        d.addBoth(done)
+        return d
+
+    def parseQuery(self, output, since):
+        """Turn the output of 'gerrit query --patch-sets' into
+        patchset-created events for the patch sets created at or after
+        C{since}, oldest first."""
+        events = []
+        for line in output.splitlines():
+            change = self.parseLine(line)
+            if type(change) != type({}) or "patchSets" not in change:
+                continue # e.g., the stats line at the end
+            eventChange = dict([ (k, v) for k, v in change.items()
+                                 if k not in ("patchSets", "currentPatchSet") ])
+            for patchSet in change["patchSets"]:
+                created = patchSet.get("createdOn", 0)
+                if created < since:
+                    continue
+                event = dict(type="patchset-created", change=eventChange,
+                             patchSet=patchSet)
+                if "uploader" in patchSet:
+                    event["uploader"] = patchSet["uploader"]
+                events.append((created, event))
+        events.sort(key=lambda e : e[0])
+        return [ patchSetEvent for createdOn, patchSetEvent in events ]
 
     def streamProcessStopped(self):
         self.process = None
 
         # if the service is stopped, don't try to restart
-        if not self.parent:
+        if not self.parent or not self.running:
             log.msg("service is not running; not reconnecting")
             return
 
+        # if this stream's catch-up worked, every event since it started has
+        # been seen, so the next catch-up need look no further back (allowing
+        # for the difference between our clock and gerrit's)
+        if self.caughtUpTo == self.lastStreamProcessStart:
+            since = self.lastStreamProcessStart - self.CATCHUP_SLACK
+            if self.lastEventTime is None or self.lastEventTime < since:
+                self.lastEventTime = since
+
         now = util.now()
         if now - self.lastStreamProcessStart < self.STREAM_GOOD_CONNECTION_TIME:
             # bad startup; start the stream process again after a timeout, and then
             # increase the timeout
             log.msg("'gerrit stream-events' failed; restarting after %ds" % round(self.streamProcessTimeout))
-            reactor.callLater(self.streamProcessTimeout, self.startStreamProcess)
+            self.reconnect = reactor.callLater(self.streamProcessTimeout,
+                                               self.startStreamProcess)
             self.streamProcessTimeout *= self.STREAM_BACKOFF_EXPONENT
             if self.streamProcessTimeout > self.STREAM_BACKOFF_MAX:
                 self.streamProcessTimeout = self.STREAM_BACKOFF_MAX
@@ -164,21 +384,40 @@ class GerritChangeSource(base.ChangeSource):
 
     def startStreamProcess(self):
         log.msg("starting 'gerrit stream-events'")
+        self.reconnect = None
         self.lastStreamProcessStart = util.now()
-        args = [ self.username+"@"+self.gerritserver,"-p", str(self.gerritport)]
-        if self.identity_file is not None:
-          args = args + [ '-i', self.identity_file ]
         self.process = reactor.spawnProcess(self.LocalPP(self), "ssh",
-          [ "ssh" ] + args + [ "gerrit", "stream-events" ])
+          [ "ssh" ] + self.getSshArgs() + [ "gerrit", "stream-events" ])
+        # find anything missed while the stream was down; events seen on the
+        # new stream as well are only added once
+        started = self.lastStreamProcessStart
+        d = self.catchUp()
+        def caughtUp(ok):
+            if ok:
+                self.caughtUpTo = started
+        d.addCallback(caughtUp)
+        d.addErrback(log.err, 'error catching up in GerritChangeSource')
 
     def startService(self):
-        self.startStreamProcess()
+        base.ChangeSource.startService(self)
+        d = self.loadState()
+        d.addErrback(log.err, 'error loading GerritChangeSource state')
+        def start(_):
+            if self.running:
+                self.startStreamProcess()
+        d.addCallback(start)
 
     def stopService(self):
+        if self.reconnect and self.reconnect.active():
+            self.reconnect.cancel()
+        self.reconnect = None
+        if self.flushRetry:
+            # the queue is kept, and flushed with the next events
+            self.flushRetry.cancel()
+            self.flushRetry = None
+            self.flushing = False
         if self.process:
             self.process.signalProcess("KILL")
-        # TODO: if this occurs while the process is restarting, some exceptions may
-        # be logged, although things will settle down normally
         return base.ChangeSource.stopService(self)
 
     def describe(self):
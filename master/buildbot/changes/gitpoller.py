@@ -16,25 +16,116 @@
 import time
 import tempfile
 import os
-from twisted.python import log
-from twisted.internet import defer, utils
+import fnmatch
+from twisted.python import log, failure
+from twisted.internet import defer, utils, protocol, reactor, error
 
 from buildbot.util import deferredLocked
 from buildbot.changes import base
 
+class GitLogParser(object):
+    """
+    I parse the output of C{git log --name-only} with my C{format}
+    incrementally, as it arrives, into a dictionary for each commit, with
+    keys 'revision', 'when', 'who', 'comments' and 'files'.
+    """
+
+    # each commit starts with \x01, and its fields are separated by \x00;
+    # the files it touched (from --name-only) follow the last field
+    format = r'--format=%x01%H%x00%ct%x00%aE%x00%s%n%b%x00'
+
+    def __init__(self):
+        self.partial = [] # pieces of the commit being received
+
+    def feed(self, data):
+        """Parse C{data}, returning a list of the commits it completes."""
+        if '\x01' not in data:
+            self.partial.append(data)
+            return []
+        records = data.split('\x01')
+        self.partial.append(records[0])
+        records[0] = ''.join(self.partial)
+        self.partial = [ records.pop() ]
+        return [ self._parse(r) for r in records if r ]
+
+    def finish(self):
+        """Parse the last commit, returning a list of it, if any."""
+        record = ''.join(self.partial)
+        self.partial = []
+        if record:
+            return [ self._parse(record) ]
+        return []
+
+    def _parse(self, record):
+        fields = record.split('\x00', 4)
+        if len(fields) != 5 or not fields[2].strip():
+            raise EnvironmentError('could not parse git log output %r'
+                                   % record[:200])
+        revision, timestamp, who, comments, files = fields
+        return dict(revision=revision.strip(),
+                    when=float(timestamp),
+                    who=who.strip(),
+                    comments=comments.strip(),
+                    files=[ f for f in files.splitlines() if f ])
+
+class GitLogProtocol(protocol.ProcessProtocol):
+    """
+    I feed the output of a C{git log} process to a L{GitLogParser} as it
+    arrives, and fire C{self.deferred} with the list of commits when the
+    process ends.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.commits = []
+        self.failure = None
+        self.stderr = []
+        self.deferred = defer.Deferred()
+
+    def outReceived(self, data):
+        if self.failure:
+            return
+        try:
+            self.commits.extend(self.parser.feed(data))
+        except:
+            self.failure = failure.Failure()
+
+    def errReceived(self, data):
+        self.stderr.append(data)
+
+    def processEnded(self, reason):
+        if not reason.check(error.ProcessDone):
+            self.deferred.errback(EnvironmentError('git log failed (%s): %s'
+                    % (reason.getErrorMessage(), ''.join(self.stderr))))
+            return
+        if not self.failure:
+            try:
+                self.commits.extend(self.parser.finish())
+            except:
+                self.failure = failure.Failure()
+        if self.failure:
+            self.deferred.errback(self.failure)
+        else:
+            self.deferred.callback(self.commits)
+
 class GitPoller(base.PollingChangeSource):
     """This source will poll a remote git repo for changes and submit
     them to the change master."""
     
-    compare_attrs = ["repourl", "branch", "workdir",
-                     "pollInterval", "gitbin", "usetimestamps",
+    compare_attrs = ["repourl", "branch", "branches", "workdir",
+                     "pollInterval", "pollMaxInterval", "gitbin",
+                     "usetimestamps",
                      "category", "project"]
+
+    # new changes are added to the database in batches of this many
+    changeBatchSize = 100
                      
     def __init__(self, repourl, branch='master', 
                  workdir=None, pollInterval=10*60, 
                  gitbin='git', usetimestamps=True,
                  category=None, project=None,
-                 pollinterval=-2, fetch_refspec=None):
+                 pollinterval=-2, fetch_refspec=None, branches=None,
+                 pollMaxInterval=None):
         # for backward compatibility; the parameter used to be spelled with 'i'
         if pollinterval != -2:
             pollInterval = pollinterval
@@ -42,7 +133,9 @@ class GitPoller(base.PollingChangeSource):
 
         self.repourl = repourl
         self.branch = branch
+        self.branches = branches
         self.pollInterval = pollInterval
+        self.pollMaxInterval = pollMaxInterval
         self.fetch_refspec = fetch_refspec
         self.lastChange = time.time()
         self.lastPoll = time.time()
@@ -53,6 +146,8 @@ class GitPoller(base.PollingChangeSource):
         self.project = project
         self.changeCount = 0
         self.commitInfo  = {}
+        self.lastPollDuration = None
+        self._objectid = None
         self.initLock = defer.DeferredLock()
         
         if self.workdir == None:
@@ -69,7 +164,11 @@ class GitPoller(base.PollingChangeSource):
         # initialize the repository we'll use to get changes; note that
         # startService is not an event-driven method, so this method will
         # instead acquire self.initLock immediately when it is called.
-        if not os.path.exists(self.workdir + r'/.git'):
+        if self.branches:
+            initialized = os.path.exists(os.path.join(self.workdir, 'objects'))
+        else:
+            initialized = os.path.exists(self.workdir + r'/.git')
+        if not initialized:
             d = self.initRepository()
             d.addErrback(log.err, 'while initializing GitPoller repository')
         else:
@@ -88,6 +187,21 @@ class GitPoller(base.PollingChangeSource):
                 os.makedirs(dirpath)
         d.addCallback(make_dir)
 
+        if self.branches:
+            # branches are fetched straight into a bare repository as they
+            # move, so there is nothing more to set up
+            def git_init_bare(_):
+                log.msg('gitpoller: initializing bare repository for %s'
+                        % self.repourl)
+                d = utils.getProcessOutputAndValue(self.gitbin,
+                        ['init', '--bare', self.workdir],
+                        env=dict(PATH=os.environ['PATH']))
+                d.addCallback(self._convert_nonzero_to_failure)
+                d.addErrback(self._stop_on_failure)
+                return d
+            d.addCallback(git_init_bare)
+            return d
+
         def git_init(_):
             log.msg('gitpoller: initializing working dir from %s' % self.repourl)
             d = utils.getProcessOutputAndValue(self.gitbin,
@@ -149,66 +263,31 @@ class GitPoller(base.PollingChangeSource):
         status = ""
         if not self.master:
             status = "[STOPPED - check log]"
-        str = 'GitPoller watching the remote git repository %s, branch: %s %s' \
-                % (self.repourl, self.branch, status)
+        if self.branches:
+            branches = 'branches: %s' % ', '.join(self.branches)
+        else:
+            branches = 'branch: %s' % self.branch
+        str = 'GitPoller watching the remote git repository %s, %s %s' \
+                % (self.repourl, branches, status)
         return str
 
     @deferredLocked('initLock')
     def poll(self):
-        d = self._get_changes()
-        d.addCallback(self._process_changes)
-        d.addErrback(self._process_changes_failure)
-        d.addCallback(self._catch_up)
-        d.addErrback(self._catch_up_failure)
-        return d
-
-    def _get_commit_comments(self, rev):
-        args = ['log', rev, '--no-walk', r'--format=%s%n%b']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            stripped_output = git_output.strip()
-            if len(stripped_output) == 0:
-                raise EnvironmentError('could not get commit comment for rev')
-            return stripped_output
-        d.addCallback(process)
-        return d
-
-    def _get_commit_timestamp(self, rev):
-        # unix timestamp
-        args = ['log', rev, '--no-walk', r'--format=%ct']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            stripped_output = git_output.strip()
-            if self.usetimestamps:
-                try:
-                    stamp = float(stripped_output)
-                except Exception, e:
-                        log.msg('gitpoller: caught exception converting output \'%s\' to timestamp' % stripped_output)
-                        raise e
-                return stamp
-            else:
-                return None
-        d.addCallback(process)
-        return d
-
-    def _get_commit_files(self, rev):
-        args = ['log', rev, '--name-only', '--no-walk', r'--format=%n']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            fileList = git_output.split()
-            return fileList
-        d.addCallback(process)
-        return d
-            
-    def _get_commit_name(self, rev):
-        args = ['log', rev, '--no-walk', r'--format=%aE']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            stripped_output = git_output.strip()
-            if len(stripped_output) == 0:
-                raise EnvironmentError('could not get commit name for rev')
-            return stripped_output
-        d.addCallback(process)
+        started = time.time()
+        if self.branches:
+            d = self._poll_branches()
+            d.addErrback(self._process_changes_failure)
+        else:
+            d = self._get_changes()
+            d.addCallback(self._process_changes)
+            d.addErrback(self._process_changes_failure)
+            d.addCallback(self._catch_up)
+            d.addErrback(self._catch_up_failure)
+        def done(_):
+            self.lastPollDuration = time.time() - started
+            log.msg('gitpoller: poll of %s took %.2fs, %d changes'
+                    % (self.repourl, self.lastPollDuration, self.changeCount))
+        d.addCallback(done)
         return d
 
     def _get_changes(self):
@@ -230,60 +309,182 @@ class GitPoller(base.PollingChangeSource):
 
         return d
 
+    def _get_commits(self, revRange):
+        """Get the commits in C{revRange}, oldest first, as dictionaries (see
+        L{GitLogParser}), from a single C{git log} process."""
+        parser = GitLogParser()
+        proto = GitLogProtocol(parser)
+        args = ['log', '--reverse', '--name-only', parser.format, revRange]
+        reactor.spawnProcess(proto, self.gitbin, [self.gitbin] + args,
+                             path=self.workdir,
+                             env=dict(PATH=os.environ['PATH']))
+        return proto.deferred
+
     @defer.deferredGenerator
     def _process_changes(self, unused_output):
-        # get the change list
-        revListArgs = ['log', '%s..origin/%s' % (self.branch, self.branch), r'--format=%H']
+        # get the metadata of all of the new commits at once
         self.changeCount = 0
-        d = utils.getProcessOutput(self.gitbin, revListArgs, path=self.workdir,
-                                   env=dict(PATH=os.environ['PATH']), errortoo=False )
+        d = self._get_commits('%s..origin/%s' % (self.branch, self.branch))
         wfd = defer.waitForDeferred(d)
         yield wfd
-        results = wfd.getResult()
-        
-        # process oldest change first
-        revList = results.split()
-        if not revList:
+        commits = wfd.getResult()
+
+        wfd = defer.waitForDeferred(self._add_commits(commits, self.branch))
+        yield wfd
+        wfd.getResult()
+
+    @defer.deferredGenerator
+    def _add_commits(self, commits, branch):
+        # add changes for the given commits, oldest first, in batches
+        if not commits:
+            return
+        self.changeCount += len(commits)
+        log.msg('gitpoller: processing %d changes on %s: %s in "%s"'
+                % (len(commits), branch, [ c['revision'] for c in commits ],
+                   self.workdir) )
+
+        for i in range(0, len(commits), self.changeBatchSize):
+            changes = []
+            for commit in commits[i:i+self.changeBatchSize]:
+                if not self.usetimestamps:
+                    commit['when'] = None
+                changes.append(dict(commit,
+                       branch=branch,
+                       category=self.category,
+                       project=self.project,
+                       repository=self.repourl))
+            d = self.addChanges(changes)
+            wfd = defer.waitForDeferred(d)
+            yield wfd
+            wfd.getResult()
+
+    def _tracks(self, branch):
+        # is this one of the branches we were asked to watch?
+        for pattern in self.branches:
+            if fnmatch.fnmatchcase(branch, pattern):
+                return True
+        return False
+
+    def _git(self, args):
+        d = utils.getProcessOutputAndValue(self.gitbin, args,
+                path=self.workdir, env=dict(PATH=os.environ['PATH']))
+        d.addCallback(self._convert_nonzero_to_failure)
+        d.addCallback(lambda (stdout, stderr, code) : stdout)
+        return d
+
+    def _parse_heads(self, output):
+        # parse ls-remote or for-each-ref output into { branch : sha }
+        heads = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) != 2 or not fields[1].startswith('refs/heads/'):
+                continue
+            branch = fields[1][len('refs/heads/'):]
+            if self._tracks(branch):
+                heads[branch] = fields[0]
+        return heads
+
+    def _getObjectId(self):
+        if self._objectid is None:
+            d = self.master.db.state.getObjectId(self.repourl,
+                                    'buildbot.changes.gitpoller.GitPoller')
+            def keep(objectid):
+                self._objectid = objectid
+                return objectid
+            d.addCallback(keep)
+            return d
+        return defer.succeed(self._objectid)
+
+    def _headsStateName(self):
+        # pollers watching different branches of one repository keep their
+        # heads apart, so that neither writes back the other's stale heads
+        return 'heads %s' % ' '.join(self.branches)
+
+    @defer.deferredGenerator
+    def _poll_branches(self):
+        """Poll all of the branches in C{self.branches}: find which of them
+        have moved with C{git ls-remote}, fetch just those with a single
+        C{git fetch}, and add changes for the new commits on each.  The
+        heads seen last time are kept in the database, so they survive a
+        restart of the master; a branch whose changes could not be added
+        keeps its old head, so that they are tried again next time."""
+        self.changeCount = 0
+        log.msg('gitpoller: polling git repo at %s' % self.repourl)
+        self.lastPoll = time.time()
+
+        wfd = defer.waitForDeferred(
+                self._git(['ls-remote', '--heads', self.repourl]))
+        yield wfd
+        remoteHeads = self._parse_heads(wfd.getResult())
+
+        wfd = defer.waitForDeferred(self._getObjectId())
+        yield wfd
+        objectid = wfd.getResult()
+        wfd = defer.waitForDeferred(self.master.db.state.getState(objectid,
+                                            self._headsStateName(), {}))
+        yield wfd
+        lastHeads = dict([ (b, sha) for b, sha in wfd.getResult().items()
+                           if self._tracks(b) ])
+
+        moved = sorted([ b for b in remoteHeads
+                         if remoteHeads[b] != lastHeads.get(b) ])
+        gone = [ b for b in lastHeads if b not in remoteHeads ]
+        if not moved and not gone:
             return
 
-        revList.reverse()
-        self.changeCount = len(revList)
-            
-        log.msg('gitpoller: processing %d changes: %s in "%s"'
-                % (self.changeCount, revList, self.workdir) )
-
-        for rev in revList:
-            dl = defer.DeferredList([
-                self._get_commit_timestamp(rev),
-                self._get_commit_name(rev),
-                self._get_commit_files(rev),
-                self._get_commit_comments(rev),
-            ], consumeErrors=True)
-
-            wfd = defer.waitForDeferred(dl)
+        heads = remoteHeads
+        if moved:
+            # fetch everything that moved at once, then use the heads that
+            # were actually fetched, in case the branches moved again since
+            args = ['fetch', self.repourl]
+            args.extend([ '+refs/heads/%s:refs/heads/%s' % (b, b)
+                          for b in moved ])
+            wfd = defer.waitForDeferred(self._git(args))
+            yield wfd
+            wfd.getResult()
+
+            wfd = defer.waitForDeferred(self._git(['for-each-ref',
+                    '--format=%(objectname) %(refname)', 'refs/heads/']))
             yield wfd
-            results = wfd.getResult()
-
-            # check for failures
-            failures = [ r[1] for r in results if not r[0] ]
-            if failures:
-                # just fail on the first error; they're probably all related!
-                raise failures[0]
-
-            timestamp, name, files, comments = [ r[1] for r in results ]
-            d = self.master.addChange(
-                   who=name,
-                   revision=rev,
-                   files=files,
-                   comments=comments,
-                   when=timestamp,
-                   branch=self.branch,
-                   category=self.category,
-                   project=self.project,
-                   repository=self.repourl)
+            fetchedHeads = self._parse_heads(wfd.getResult())
+            heads = dict(remoteHeads)
+            for b in moved:
+                if b in fetchedHeads:
+                    heads[b] = fetchedHeads[b]
+
+        newHeads = dict(lastHeads)
+        for branch in moved:
+            if branch not in lastHeads:
+                # as when a poller starts, the history of a new branch is
+                # not reported
+                log.msg('gitpoller: new branch %s at %s'
+                        % (branch, heads[branch]))
+                newHeads[branch] = heads[branch]
+                continue
+            d = self._get_commits('%s..%s' % (lastHeads[branch], heads[branch]))
             wfd = defer.waitForDeferred(d)
             yield wfd
-            results = wfd.getResult()
+            try:
+                commits = wfd.getResult()
+            except:
+                log.err(None, 'gitpoller: while getting changes on %s' % branch)
+                continue
+            wfd = defer.waitForDeferred(self._add_commits(commits, branch))
+            yield wfd
+            try:
+                wfd.getResult()
+            except:
+                log.err(None, 'gitpoller: while adding changes on %s' % branch)
+                continue
+            newHeads[branch] = heads[branch]
+
+        for branch in gone:
+            log.msg('gitpoller: branch %s was deleted' % branch)
+            del newHeads[branch]
+        wfd = defer.waitForDeferred(self.master.db.state.setState(objectid,
+                                            self._headsStateName(), newHeads))
+        yield wfd
+        wfd.getResult()
 
     def _process_changes_failure(self, f):
         log.msg('gitpoller: repo poll failed')
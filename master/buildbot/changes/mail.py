@@ -25,17 +25,29 @@ from email.Iterators import body_line_iterator
 
 from zope.interface import implements
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from buildbot import util
 from buildbot.interfaces import IChangeSource
 from buildbot.util.maildir import MaildirService
 
+# time.strptime imports _strptime on first use, which is not thread-safe; the
+# messages are parsed in threads
+time.strptime('2000', '%Y')
+
 class MaildirSource(MaildirService, util.ComparableMixin):
-    """Generic base class for Maildir-based change sources"""
+    """Generic base class for Maildir-based change sources.
+
+    New messages are handled C{batchSize} at a time: they are parsed in
+    threads, at most C{parseThreads} at once, and then the changes they
+    describe are added to the database together, and the messages moved to
+    cur/."""
     implements(IChangeSource)
 
     compare_attrs = ["basedir", "pollinterval", "prefix"]
 
+    batchSize = 100
+    parseThreads = 4
+
     def __init__(self, maildir, prefix=None, category='', repository=''):
         MaildirService.__init__(self, maildir)
         self.prefix = prefix
@@ -49,24 +61,57 @@ class MaildirSource(MaildirService, util.ComparableMixin):
         return "%s watching maildir '%s'" % (self.__class__.__name__, self.basedir)
 
     def messageReceived(self, filename):
-        path = os.path.join(self.basedir, "new", filename)
-        d = defer.succeed(None)
-        def parse_file(_):
-            return self.parse_file(open(path, "r"), self.prefix)
-        d.addCallback(parse_file)
-
-        def add_change(chdict):
-            if chdict:
-                return self.master.addChange(**chdict)
-            else:
-                log.msg("no change found in maildir file '%s'" % filename)
-        d.addCallback(add_change)
-
-        def move_file(_):
-            os.rename(path, os.path.join(self.basedir, "cur", filename))
-        d.addCallback(move_file)
-
-        return d
+        return self.messagesReceived([ filename ])
+
+    @defer.deferredGenerator
+    def messagesReceived(self, filenames):
+        filenames = list(filenames)
+        sem = defer.DeferredSemaphore(self.parseThreads)
+        while filenames:
+            batch = filenames[:self.batchSize]
+            del filenames[:self.batchSize]
+
+            # parse the messages in threads, keeping their order
+            dl = [ sem.run(threads.deferToThread, self.parse_message, f)
+                   for f in batch ]
+            wfd = defer.waitForDeferred(
+                    defer.DeferredList(dl, consumeErrors=True))
+            yield wfd
+            results = wfd.getResult()
+
+            parsed = []
+            chdicts = []
+            for filename, (ok, chdict) in zip(batch, results):
+                if not ok:
+                    # leave it in new/, where it will be tried again when
+                    # the buildmaster restarts
+                    log.msg("while reading '%s' from maildir '%s':"
+                            % (filename, self.basedir))
+                    log.err(chdict)
+                    continue
+                parsed.append(filename)
+                if chdict:
+                    chdicts.append(chdict)
+                else:
+                    log.msg("no change found in maildir file '%s'" % filename)
+
+            if chdicts:
+                wfd = defer.waitForDeferred(self.master.addChanges(chdicts))
+                yield wfd
+                wfd.getResult()
+
+            for filename in parsed:
+                os.rename(os.path.join(self.basedir, "new", filename),
+                          os.path.join(self.basedir, "cur", filename))
+
+    def parse_message(self, filename):
+        """Parse the message in new/ called C{filename}, returning a change
+        dictionary or None.  This is run in a thread."""
+        f = open(os.path.join(self.basedir, "new", filename), "r")
+        try:
+            return self.parse_file(f, self.prefix)
+        finally:
+            f.close()
 
     def parse_file(self, fd, prefix=None):
         m = message_from_file(fd)
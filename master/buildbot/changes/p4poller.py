@@ -45,7 +45,7 @@ class P4Source(base.PollingChangeSource, util.ComparableMixin):
     them to the change master."""
 
     compare_attrs = ["p4port", "p4user", "p4passwd", "p4base",
-                     "p4bin", "pollInterval"]
+                     "p4bin", "pollInterval", "pollMaxInterval"]
 
     env_vars = ["P4CLIENT", "P4PORT", "P4PASSWD", "P4USER",
                 "P4CHARSET"]
@@ -64,7 +64,8 @@ class P4Source(base.PollingChangeSource, util.ComparableMixin):
     def __init__(self, p4port=None, p4user=None, p4passwd=None,
                  p4base='//', p4bin='p4',
                  split_file=lambda branchfile: (None, branchfile),
-                 pollInterval=60 * 10, histmax=None, pollinterval=-2):
+                 pollInterval=60 * 10, histmax=None, pollinterval=-2,
+                 pollMaxInterval=None):
         # for backward compatibility; the parameter used to be spelled with 'i'
         if pollinterval != -2:
             pollInterval = pollinterval
@@ -76,6 +77,7 @@ class P4Source(base.PollingChangeSource, util.ComparableMixin):
         self.p4bin = p4bin
         self.split_file = split_file
         self.pollInterval = pollInterval
+        self.pollMaxInterval = pollMaxInterval
 
     def describe(self):
         return "p4source %s %s" % (self.p4port, self.p4base)
@@ -172,7 +174,7 @@ class P4Source(base.PollingChangeSource, util.ComparableMixin):
                         branch_files[branch] = [file]
 
             for branch in branch_files:
-                d = self.master.addChange(
+                d = self.addChange(
                        who=who,
                        files=branch_files[branch],
                        comments=comments,
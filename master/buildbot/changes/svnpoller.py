@@ -25,6 +25,7 @@ from buildbot import util
 from buildbot.changes import base
 
 import xml.dom.minidom
+import xml.parsers.expat
 import os, urllib
 
 # these split_file_* functions are available for use as values to the
@@ -44,26 +45,87 @@ def split_file_branches(path):
         return None
 
 
+class SVNLogParser(object):
+    """
+    I parse the XML output of C{svn log --xml --verbose} incrementally, with
+    expat, into a dictionary for each <logentry>, with keys 'revision' (a
+    string), 'author', 'msg' and 'paths' (a list of (action, path) tuples).
+    Unlike a DOM, only the entry being parsed is held in memory.
+    """
+
+    def __init__(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+        self.entries = []
+        self.entry = None
+        self.text = None
+        self.action = None
+
+    def feed(self, data):
+        """Parse C{data}, returning a list of the log entries it completes."""
+        self.parser.Parse(data, False)
+        entries, self.entries = self.entries, []
+        return entries
+
+    def close(self):
+        """Finish parsing, returning a list of any remaining log entries."""
+        self.parser.Parse('', True)
+        entries, self.entries = self.entries, []
+        return entries
+
+    def _start(self, name, attrs):
+        if name == 'logentry':
+            self.entry = dict(revision=attrs.get('revision'), paths=[])
+        elif self.entry is not None and name in ('author', 'msg', 'path'):
+            self.text = []
+            if name == 'path':
+                self.action = attrs.get('action')
+
+    def _data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def _end(self, name):
+        if self.entry is None:
+            return
+        if name == 'logentry':
+            self.entries.append(self.entry)
+            self.entry = None
+        elif name in ('author', 'msg'):
+            self.entry[name] = ''.join(self.text)
+        elif name == 'path':
+            self.entry['paths'].append((self.action, ''.join(self.text)))
+        self.text = None
+
+
 class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
     """
     Poll a Subversion repository for changes and submit them to the change
     master.
+
+    The last revision seen is kept in the database, and each poll asks only
+    for the revisions since, C{histmax} at a time, so that after downtime
+    the poller catches up in bounded pages.
     """
 
     compare_attrs = ["svnurl", "split_file",
                      "svnuser", "svnpasswd",
-                     "pollInterval", "histmax",
+                     "pollInterval", "pollMaxInterval", "histmax",
                      "svnbin", "category", "cachepath"]
 
     parent = None # filled in when we're added
     last_change = None
     loop = None
+    _objectid = None
 
     def __init__(self, svnurl, split_file=None,
                  svnuser=None, svnpasswd=None,
                  pollInterval=10*60, histmax=100,
                  svnbin='svn', revlinktmpl='', category=None, 
-                 project='', cachepath=None, pollinterval=-2):
+                 project='', cachepath=None, pollinterval=-2,
+                 pollMaxInterval=None):
         # for backward compatibility; the parameter used to be spelled with 'i'
         if pollinterval != -2:
             pollInterval = pollinterval
@@ -82,6 +144,7 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
 
         self.svnbin = svnbin
         self.pollInterval = pollInterval
+        self.pollMaxInterval = pollMaxInterval
         self.histmax = histmax
         self._prefix = None
         self.category = category
@@ -151,15 +214,58 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
                 self._prefix = prefix
             d.addCallback(set_prefix)
 
-        d.addCallback(self.get_logs)
-        d.addCallback(self.parse_logs)
-        d.addCallback(self.get_new_logentries)
-        d.addCallback(self.create_changes)
-        d.addCallback(self.submit_changes)
+        if self._objectid is None:
+            d.addCallback(lambda _ : self.get_last_change())
+
+        d.addCallback(lambda _ : self.poll_pages())
         d.addCallback(self.finished_ok)
         d.addErrback(log.err, 'error in SVNPoller while polling') # eat errors
         return d
 
+    def get_last_change(self):
+        # get the last revision seen from the database; it takes precedence
+        # over the cachepath, if both are used
+        d = self.master.db.state.getObjectId(self.svnurl,
+                                    'buildbot.changes.svnpoller.SVNPoller')
+        def get_state(objectid):
+            self._objectid = objectid
+            return self.master.db.state.getState(objectid, 'last_rev', None)
+        d.addCallback(get_state)
+        def set_last_change(last_rev):
+            if last_rev is not None:
+                log.msg("SVNPoller(%s) setting last_change to %s from the "
+                        "database" % (self.svnurl, last_rev))
+                self.last_change = last_rev
+        d.addCallback(set_last_change)
+        return d
+
+    @defer.deferredGenerator
+    def poll_pages(self):
+        # get, and submit, a page of new revisions at a time until there are
+        # no more, saving our place after each
+        while True:
+            wfd = defer.waitForDeferred(self.get_logs(None))
+            yield wfd
+            logentries = self.parse_logs(wfd.getResult())
+            new_logentries = self.get_new_logentries(logentries)
+            changes = self.create_changes(new_logentries)
+
+            wfd = defer.waitForDeferred(self.submit_changes(changes))
+            yield wfd
+            wfd.getResult()
+
+            wfd = defer.waitForDeferred(self.master.db.state.setState(
+                                self._objectid, 'last_rev', self.last_change))
+            yield wfd
+            wfd.getResult()
+
+            # a full page (which includes last_change itself) means there
+            # may be more
+            if not new_logentries or len(logentries) <= self.histmax:
+                break
+            log.msg("SVNPoller(%s) caught up to r%s; getting more"
+                    % (self.svnurl, self.last_change))
+
     def getProcessOutput(self, args):
         # this exists so we can override it during the unit tests
         d = utils.getProcessOutput(self.svnbin, args, self.environ)
@@ -207,62 +313,62 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
             args.extend(["--username=%s" % self.svnuser])
         if self.svnpasswd:
             args.extend(["--password=%s" % self.svnpasswd])
-        args.extend(["--limit=%d" % (self.histmax), self.svnurl])
+        if self.last_change is None:
+            # the first time, we only want to know where to start
+            args.append("--limit=1")
+        else:
+            # the revisions since last_change (and last_change itself, since
+            # asking for revisions after HEAD is an error), a page at a time
+            args.extend(["-r", "%d:HEAD" % self.last_change,
+                         "--limit=%d" % (self.histmax + 1)])
+        args.append(self.svnurl)
         d = self.getProcessOutput(args)
         return d
 
     def parse_logs(self, output):
-        # parse the XML output, return a list of <logentry> nodes
+        # parse the XML output, return a list of log entries (see
+        # SVNLogParser)
+        parser = SVNLogParser()
         try:
-            doc = xml.dom.minidom.parseString(output)
+            logentries = parser.feed(output)
+            logentries.extend(parser.close())
         except xml.parsers.expat.ExpatError:
             log.msg("SVNPoller.parse_logs: ExpatError in '%s'" % output)
             raise
-        logentries = doc.getElementsByTagName("logentry")
         return logentries
 
 
     def get_new_logentries(self, logentries):
         last_change = old_last_change = self.last_change
 
-        # given a list of logentries, calculate new_last_change, and
-        # new_logentries, where new_logentries contains only the ones after
-        # last_change
+        # given a list of logentries, in any order, calculate new_last_change,
+        # and new_logentries, where new_logentries contains only the ones
+        # after last_change, oldest first
 
-        new_last_change = None
+        logentries = sorted(logentries, key=lambda e : int(e['revision']))
+        new_last_change = last_change
         new_logentries = []
         if logentries:
-            new_last_change = int(logentries[0].getAttribute("revision"))
+            new_last_change = int(logentries[-1]['revision'])
 
             if last_change is None:
                 # if this is the first time we've been run, ignore any changes
                 # that occurred before now. This prevents a build at every
                 # startup.
                 log.msg('svnPoller: starting at change %s' % new_last_change)
-            elif last_change == new_last_change:
+            elif last_change >= new_last_change:
                 # an unmodified repository will hit this case
                 log.msg('svnPoller: no changes')
+                new_last_change = last_change
             else:
-                for el in logentries:
-                    if last_change == int(el.getAttribute("revision")):
-                        break
-                    new_logentries.append(el)
-                new_logentries.reverse() # return oldest first
+                new_logentries = [ e for e in logentries
+                                   if int(e['revision']) > last_change ]
 
         self.last_change = new_last_change
         log.msg('svnPoller: _process_changes %s .. %s' %
                 (old_last_change, new_last_change))
         return new_logentries
 
-
-    def _get_text(self, element, tag_name):
-        try:
-            child_nodes = element.getElementsByTagName(tag_name)[0].childNodes
-            text = "".join([t.data for t in child_nodes])
-        except:
-            text = "<unknown>"
-        return text
-
     def _transform_path(self, path):
         assert path.startswith(self._prefix), \
                 ("filepath '%s' should start with prefix '%s'" %
@@ -278,7 +384,7 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
         changes = []
 
         for el in new_logentries:
-            revision = str(el.getAttribute("revision"))
+            revision = str(el['revision'])
 
             revlink=''
 
@@ -287,23 +393,19 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
                     revlink = self.revlinktmpl % urllib.quote_plus(revision)
 
             log.msg("Adding change revision %s" % (revision,))
-            author   = self._get_text(el, "author")
-            comments = self._get_text(el, "msg")
+            author   = el.get("author", "<unknown>")
+            comments = el.get("msg", "<unknown>")
             # there is a "date" field, but it provides localtime in the
             # repository's timezone, whereas we care about buildmaster's
             # localtime (since this will get used to position the boxes on
             # the Waterfall display, etc). So ignore the date field, and
             # addChange will fill in with the current time
             branches = {}
-            try:
-                pathlist = el.getElementsByTagName("paths")[0]
-            except IndexError: # weird, we got an empty revision
+            if not el['paths']: # weird, we got an empty revision
                 log.msg("ignoring commit with no paths")
                 continue
 
-            for p in pathlist.getElementsByTagName("path"):
-                action = p.getAttribute("action")
-                path = "".join([t.data for t in p.childNodes])
+            for action, path in el['paths']:
                 # the rest of buildbot is certaily not yet ready to handle
                 # unicode filenames, because they get put in RemoteCommands
                 # which get sent via PB to the buildslave, and PB doesn't
@@ -346,12 +448,10 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
 
         return changes
 
-    @defer.deferredGenerator
     def submit_changes(self, changes):
-        for chdict in changes:
-            wfd = defer.waitForDeferred(self.master.addChange(**chdict))
-            yield wfd
-            wfd.getResult()
+        if not changes:
+            return defer.succeed([])
+        return self.addChanges(changes)
 
     def finished_ok(self, res):
         if self.cachepath:
@@ -20,6 +20,7 @@ Support for changes in the database
 from buildbot.util import json
 import sqlalchemy as sa
 from twisted.python import log
+from twisted.internet import defer
 from buildbot.changes.changes import Change
 from buildbot.db import base
 from buildbot import util
@@ -91,8 +92,6 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
 
         # then add it to the database and update its '.number'
         def thd(conn):
-            assert change.number is None
-
             # note that in a read-uncommitted database like SQLite this
             # transaction does not buy atomicitiy - other database users may
             # still come across a change without its links, files, properties,
@@ -100,41 +99,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             # all in the database, but beware.
 
             transaction = conn.begin()
-
-            ins = self.db.model.changes.insert()
-            r = conn.execute(ins, dict(
-                author=change.who,
-                comments=change.comments,
-                is_dir=change.isdir,
-                branch=change.branch,
-                revision=change.revision,
-                revlink=change.revlink,
-                when_timestamp=change.when,
-                category=change.category,
-                repository=change.repository,
-                project=change.project))
-            change.number = r.inserted_primary_key[0]
-            if change.links:
-                ins = self.db.model.change_links.insert()
-                conn.execute(ins, [
-                    dict(changeid=change.number, link=l)
-                        for l in change.links
-                    ])
-            if change.files:
-                ins = self.db.model.change_files.insert()
-                conn.execute(ins, [
-                    dict(changeid=change.number, filename=f)
-                        for f in change.files
-                    ])
-            if change.properties:
-                ins = self.db.model.change_properties.insert()
-                conn.execute(ins, [
-                    dict(changeid=change.number,
-                        property_name=k,
-                        property_value=json.dumps(v))
-                    for k,v,s in change.properties.asList()
-                ])
-
+            self._addChange_thd(conn, change)
             transaction.commit()
 
             return change
@@ -145,6 +110,70 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
         d.addCallback(lambda _ : change)
         return d
 
+    def addChanges(self, changes):
+        """Add several Changes to the database at once, in a single
+        transaction; this is much faster than calling L{addChange} for each,
+        when a change source finds many changes in one go.
+
+        @param changes: a list of dictionaries, each containing the keyword
+        arguments to L{addChange} for one change
+
+        @returns: a list of L{buildbot.changes.changes.Change} instances, in
+        the same order, via a deferred
+        """
+        changes = [ Change(**kwargs) for kwargs in changes ]
+        if not changes:
+            return defer.succeed([])
+
+        def thd(conn):
+            transaction = conn.begin()
+            for change in changes:
+                self._addChange_thd(conn, change)
+            transaction.commit()
+            return changes
+        d = self.db.pool.do(thd)
+        d.addCallback(lambda _ : self._prune_changes(changes[-1].number))
+        d.addCallback(lambda _ : changes)
+        return d
+
+    def _addChange_thd(self, conn, change):
+        # insert a Change and its ancillary data, and set its '.number'
+        assert change.number is None
+
+        ins = self.db.model.changes.insert()
+        r = conn.execute(ins, dict(
+            author=change.who,
+            comments=change.comments,
+            is_dir=change.isdir,
+            branch=change.branch,
+            revision=change.revision,
+            revlink=change.revlink,
+            when_timestamp=change.when,
+            category=change.category,
+            repository=change.repository,
+            project=change.project))
+        change.number = r.inserted_primary_key[0]
+        if change.links:
+            ins = self.db.model.change_links.insert()
+            conn.execute(ins, [
+                dict(changeid=change.number, link=l)
+                    for l in change.links
+                ])
+        if change.files:
+            ins = self.db.model.change_files.insert()
+            conn.execute(ins, [
+                dict(changeid=change.number, filename=f)
+                    for f in change.files
+                ])
+        if change.properties:
+            ins = self.db.model.change_properties.insert()
+            conn.execute(ins, [
+                dict(changeid=change.number,
+                    property_name=k,
+                    property_value=json.dumps(v))
+                for k,v,s in change.properties.asList()
+            ])
+
     def getChangeInstance(self, changeid):
         """
         Get a L{buildbot.changes.changes.Change} instance for the given changeid,
@@ -755,6 +755,13 @@ class IStatusLog(Interface):
         log has already finished, this deferred will fire right away. The
         callback is given this IStatusLog instance as an argument."""
 
+    def getRemoteFile():
+        """Return None, or a dictionary describing a logfile which was kept on
+        the buildslave rather than copied into this log.  It has keys
+        'slavename', 'workdir' and 'filename' saying where the file is,
+        'size' and 'sha1' describing its contents when the step finished, and
+        'copied', true if the contents were also copied into this log."""
+
     def subscribe(receiver, catchup):
         """Register an IStatusReceiver to receive chunks (with logChunk) as
         data is added to the Log. If you use this, you will also want to use
@@ -823,6 +830,18 @@ class IStatusLog(Interface):
         0 for stdout, 1 for stderr, 2 for header. (note that stderr is merged
         into stdout if PTYs are in use)."""
 
+    def getChunksInRange(offset, length, channels=[]):
+        """Return a list of (channel, text) tuples covering C{length} bytes
+        of the log text, starting at C{offset}. Offsets count only the text
+        of chunks in the given channels (all chunks, if C{channels} is
+        empty)."""
+
+    def getTailChunks(numLines, channels=[]):
+        """Return a list of (channel, text) tuples covering the last
+        C{numLines} lines of the log text in the given channels (all chunks,
+        if C{channels} is empty). This is much cheaper than reading the whole
+        log when only its end is wanted."""
+
 class IStatusLogConsumer(Interface):
     """I am an object which can be passed to IStatusLog.subscribeConsumer().
     I represent a target for writing the contents of an IStatusLog. This
@@ -31,6 +31,7 @@ from buildbot.util import safeTranslate, subscription
 from buildbot.process.builder import Builder
 from buildbot.status.builder import Status
 from buildbot.changes.manager import ChangeManager
+from buildbot.changes.base import PollScheduler
 from buildbot import interfaces, locks
 from buildbot.process.properties import Properties
 from buildbot.config import BuilderConfig
@@ -77,6 +78,9 @@ class BuildMaster(service.MultiService):
         self.change_svc = ChangeManager()
         self.change_svc.setServiceParent(self)
 
+        self.pollScheduler = PollScheduler()
+        "L{buildbot.changes.base.PollScheduler} running all change polls"
+
         try:
             hostname = os.uname()[1] # only on unix
         except AttributeError:
@@ -209,6 +213,7 @@ class BuildMaster(service.MultiService):
                           "logHorizon", "buildHorizon", "changeHorizon",
                           "logMaxSize", "logMaxTailSize", "logCompressionMethod",
                           "db_url", "multiMaster", "db_poll_interval",
+                          "maxConcurrentPolls",
                           )
             for k in config.keys():
                 if k not in known_keys:
@@ -266,6 +271,13 @@ class BuildMaster(service.MultiService):
 
                 multiMaster = config.get("multiMaster", False)
 
+                maxConcurrentPolls = config.get("maxConcurrentPolls", 10)
+                if maxConcurrentPolls is not None and not \
+                        (isinstance(maxConcurrentPolls, int)
+                         and maxConcurrentPolls > 0):
+                    raise ValueError("maxConcurrentPolls needs to be None "
+                                     "or a positive int")
+
             except KeyError:
                 log.msg("config dictionary is missing a required parameter")
                 log.msg("leaving old configuration in place")
@@ -455,6 +467,7 @@ class BuildMaster(service.MultiService):
 
             self.buildCacheSize = buildCacheSize
             self.changeCacheSize = changeCacheSize
+            self.pollScheduler.setMaxConcurrentPolls(maxConcurrentPolls)
             self.eventHorizon = eventHorizon
             self.logHorizon = logHorizon
             self.buildHorizon = buildHorizon
@@ -726,6 +739,21 @@ class BuildMaster(service.MultiService):
         d.addCallback(notify)
         return d
 
+    def addChanges(self, changes):
+        """Add several changes to the buildmaster at once, and act on them.
+        Interface is identical to
+        L{buildbot.db.changes.ChangesConnectorComponent.addChanges}, but also
+        triggers schedulers to examine the changes, in order."""
+        d = self.db.changes.addChanges(changes)
+        def notify(changes):
+            log.msg("added %d changes to database" % len(changes))
+            if not self.db_poll_interval:
+                for change in changes:
+                    self._change_subs.deliver(change)
+            return changes
+        d.addCallback(notify)
+        return d
+
     def subscribeToChanges(self, callback):
         """
         Request that C{callback} be called with each Change object added to the
@@ -72,6 +72,9 @@ class Builder(pb.Referenceable, service.MultiService):
 
     expectations = None # this is created the first time we get a good build
     CHOOSE_SLAVES_RANDOMLY = True # disabled for determinism during tests
+    # how long a slave that refused a build for lack of disk space is offered
+    # no more builds; it has already waited a minute or so for space
+    LOW_DISK_SPACE_REST = 10*60
 
     def __init__(self, setup, builder_status):
         """
@@ -614,6 +617,13 @@ class Builder(pb.Referenceable, service.MultiService):
         # put the build back on the buildable list
         log.msg("I tried to tell the slave that the build %s started, but "
                 "remote_startBuild failed: %s" % (build, why))
+        # offer the request to other slaves, rather than straight back to one
+        # which is short of disk space
+        if (isinstance(why, Failure)
+                and why.check('buildslave.bot.LowDiskSpace')):
+            log.msg("%s is short of disk space; offering it no builds for %d "
+                    "seconds" % (sb, self.LOW_DISK_SPACE_REST))
+            sb.rest(self.LOW_DISK_SPACE_REST)
         # release the slave. This will queue a call to maybeStartBuild, which
         # will fire after other notifyOnDisconnect handlers have marked the
         # slave as disconnected (so we don't try to use it again).
@@ -14,7 +14,7 @@
 # Copyright Buildbot Team Members
 
 
-import re
+import re, zlib
 
 from zope.interface import implements
 from twisted.internet import reactor, defer, error
@@ -62,6 +62,18 @@ class RemoteCommand(pb.Referenceable):
     commandCounter = [0] # we use a list as a poor man's singleton
     active = False
 
+    # slaves new enough to send batches of updates (see remote_updates) may
+    # have this many bytes of updates unacknowledged at once
+    updateCredit = 1024*1024
+
+    # updates whose values are output to append to a log; consecutive
+    # entries for the same log in a batch are joined before processing
+    outputUpdates = ('stdout', 'stderr', 'header')
+
+    # compression methods which the slave may use for output updates; see
+    # LoggedRemoteCommand
+    compressUpdates = ()
+
     def __init__(self, remote_command, args):
         """
         @type  remote_command: string
@@ -118,6 +130,14 @@ class RemoteCommand(pb.Referenceable):
             properties = self.step.build.getProperties()
             cmd_args["logfiles"] = properties.render(cmd_args["logfiles"])
 
+        # ask slaves that can do it to batch (and compress) their updates
+        if not self.step.slaveVersionIsOlderThan(self.remote_command, "2.16"):
+            cmd_args = cmd_args.copy()
+            cmd_args["batchUpdates"] = { 'credit' : self.updateCredit }
+            if (self.compressUpdates and not
+                self.step.slaveVersionIsOlderThan(self.remote_command, "2.17")):
+                cmd_args["compressUpdates"] = list(self.compressUpdates)
+
         # This method only initiates the remote command.
         # We will receive remote_update messages as the command runs.
         # We will get a single remote_complete when it finishes.
@@ -183,6 +203,62 @@ class RemoteCommand(pb.Referenceable):
                 max_updatenum = num
         return max_updatenum
 
+    def remote_updates(self, entries):
+        """
+        I am called by the slave's L{buildbot.slave.bot.SlaveBuilder}
+        instead of L{remote_update} when the slave supports batched updates,
+        with the updates that have accumulated since its last call.
+
+        @type  entries: list of [key, value]
+        @param entries: updates, in order.  C{[key, value]} stands for the
+                        update C{{key: value}}, except that C{['status',
+                        update]} carries a whole update dictionary.
+        @returns: the number of bytes of updates the slave may send before
+                  this call is acknowledged
+        """
+        self.buildslave.messageReceivedFromSlave()
+        try:
+            if self.active: # ignore late updates
+                self.remoteUpdates(entries)
+        except:
+            # log failure, terminate build, let slave retire the updates
+            self._finished(Failure())
+        return self.updateCredit
+
+    def remoteUpdates(self, entries):
+        """Process a batch of updates, as given to L{remote_updates}.  This
+        joins consecutive output for the same log, and passes the result to
+        L{remoteUpdate} one update at a time."""
+        output = None # [key, logname, chunks] of the output being joined
+        for key, value in entries:
+            if key == 'log':
+                logname, data = value
+            elif key in self.outputUpdates:
+                logname, data = None, value
+            else:
+                logname = data = None
+            if output and data is not None and output[:2] == [key, logname]:
+                output[2].append(data)
+                continue
+            if output:
+                self._remoteOutput(*output)
+                output = None
+            if data is not None:
+                output = [key, logname, [data]]
+            elif key == 'status':
+                self.remoteUpdate(value)
+            else:
+                self.remoteUpdate({key : value})
+        if output:
+            self._remoteOutput(*output)
+
+    def _remoteOutput(self, key, logname, chunks):
+        data = ''.join(chunks)
+        if key == 'log':
+            self.remoteUpdate({'log' : (logname, data)})
+        else:
+            self.remoteUpdate({key : data})
+
     def remoteUpdate(self, update):
         raise NotImplementedError("You must implement this in a subclass")
 
@@ -258,6 +334,23 @@ class LoggedRemoteCommand(RemoteCommand):
     Unless you tell me otherwise, when my command completes I will close all
     the LogFiles that I know about.
 
+    Slaves which support it compress large output updates, as C{{'compressed':
+    (key, logname, data)}} with C{data} compressed by zlib, and C{logname}
+    None unless C{key} is 'log'.  I count the bytes of output received and
+    logged, and add them to the step's C{log_bytes_wire} and
+    C{log_bytes_logged} statistics when the command completes.  Slaves also
+    describe how they buffered the output in a C{'buffering'} update, which
+    I record in the C{output_rate}, C{output_flushes}, C{output_size} and
+    C{output_interval} statistics.  When the output was filtered on the slave
+    (see L{RemoteShellCommand}), I record the slave's counters as statistics
+    of the same names, and the numbers of lines in C{filter_lines} and
+    C{filter_lines_sent}.
+
+    Logfiles which the slave keeps rather than sending (see
+    L{LoggingBuildStep}) are described by an C{'onDemandLogs'} update, which I
+    collect in C{onDemandLogs}, a dictionary mapping each logfile name to a
+    dictionary with keys 'filename', 'size' and 'sha1'.
+
     @ivar logs: maps logname to a LogFile instance
     @ivar _closeWhenFinished: maps logname to a boolean. If true, this
                               LogFile will be closed when the RemoteCommand
@@ -268,11 +361,15 @@ class LoggedRemoteCommand(RemoteCommand):
 
     rc = None
     debug = False
+    compressUpdates = ('zlib',)
 
     def __init__(self, *args, **kwargs):
         self.logs = {}
         self.delayedLogs = {}
         self._closeWhenFinished = {}
+        self.bytesOnWire = 0
+        self.bytesLogged = 0
+        self.onDemandLogs = {}
         RemoteCommand.__init__(self, *args, **kwargs)
 
     def __repr__(self):
@@ -348,7 +445,30 @@ class LoggedRemoteCommand(RemoteCommand):
         else:
             log.msg("%s.addToLog: no such log %s" % (self, logname))
 
+    def _decompress(self, compressed):
+        key, logname, data = compressed
+        self.bytesOnWire += len(data)
+        data = zlib.decompress(data)
+        if key == 'log':
+            return { 'log' : (logname, data) }
+        return { key : data }
+
+    def _countOutput(self, update):
+        nbytes = 0
+        for key in self.outputUpdates:
+            if key in update:
+                nbytes += len(update[key])
+        if 'log' in update:
+            nbytes += len(update['log'][1])
+        self.bytesLogged += nbytes
+        return nbytes
+
     def remoteUpdate(self, update):
+        if update.has_key('compressed'):
+            update = self._decompress(update['compressed'])
+            self._countOutput(update)
+        else:
+            self.bytesOnWire += self._countOutput(update)
         if self.debug:
             for k,v in update.items():
                 log.msg("Update[%s]: %s" % (k,v))
@@ -369,6 +489,14 @@ class LoggedRemoteCommand(RemoteCommand):
             rc = self.rc = update['rc']
             log.msg("%s rc=%s" % (self, rc))
             self.addHeader("program finished with exit code %d\n" % rc)
+        if update.has_key('buffering') and self.step:
+            ss = self.step.step_status
+            for k, v in update['buffering'].items():
+                ss.setStatistic('output_' + k, v)
+        if update.has_key('filter'):
+            self._filterStats(update['filter'])
+        if update.has_key('onDemandLogs'):
+            self.onDemandLogs.update(update['onDemandLogs'])
 
         for k in update:
             if k not in ('stdout', 'stderr', 'header', 'rc'):
@@ -376,7 +504,26 @@ class LoggedRemoteCommand(RemoteCommand):
                     self.updates[k] = []
                 self.updates[k].append(update[k])
 
+    def _filterStats(self, stats):
+        msg = "output filtered on the slave: sent %d of %d lines" % (
+                stats['linesSent'], stats['lines'])
+        if stats.get('kept'):
+            msg += "; complete output kept in %s" % stats['kept']
+        self.addHeader("\n" + msg + "\n")
+        if self.step:
+            ss = self.step.step_status
+            for name, count in stats['counts'].items():
+                ss.setStatistic(name, count)
+            ss.setStatistic('filter_lines', stats['lines'])
+            ss.setStatistic('filter_lines_sent', stats['linesSent'])
+
     def remoteComplete(self, maybeFailure):
+        if self.bytesLogged and self.step:
+            ss = self.step.step_status
+            ss.setStatistic('log_bytes_wire',
+                    ss.getStatistic('log_bytes_wire', 0) + self.bytesOnWire)
+            ss.setStatistic('log_bytes_logged',
+                    ss.getStatistic('log_bytes_logged', 0) + self.bytesLogged)
         for name,loog in self.logs.items():
             if self._closeWhenFinished[name]:
                 if maybeFailure:
@@ -464,7 +611,7 @@ class RemoteShellCommand(LoggedRemoteCommand):
     def __init__(self, workdir, command, env=None,
                  want_stdout=1, want_stderr=1,
                  timeout=20*60, maxTime=None, logfiles={},
-                 usePTY="slave-config", logEnviron=True):
+                 usePTY="slave-config", logEnviron=True, logFilter=None):
         """
         @type  workdir: string
         @param workdir: directory where the command ought to run,
@@ -510,6 +657,15 @@ class RemoteShellCommand(LoggedRemoteCommand):
         @param maxTime: tell the remote that if the command fails to complete
                         in this number of seconds, the command should be
                         killed.  Use None to disable maxTime.
+
+        @type  logFilter: dict
+        @param logFilter: rules for filtering stdout and stderr on the slave,
+                          so that only matching lines and a bounded context
+                          are sent: 'patterns' (a list of regular
+                          expressions), 'context', 'head' and 'tail' (numbers
+                          of lines), 'counters' (a dict of names to regular
+                          expressions, whose matches are counted) and 'keep'
+                          (a workdir-relative file for the complete output).
         """
 
         self.command = command # stash .command, set it later
@@ -528,6 +684,8 @@ class RemoteShellCommand(LoggedRemoteCommand):
                 'usePTY': usePTY,
                 'logEnviron': logEnviron,
                 }
+        if logFilter:
+            args['logFilter'] = logFilter
         LoggedRemoteCommand.__init__(self, "shell", args)
 
     def start(self):
@@ -1044,15 +1202,17 @@ class LoggingBuildStep(BuildStep):
     progressMetrics = ('output',)
     logfiles = {}
 
-    parms = BuildStep.parms + ['logfiles', 'lazylogfiles', 'log_eval_func']
+    parms = BuildStep.parms + ['logfiles', 'lazylogfiles', 'log_eval_func',
+                               'copyOnDemandLogs']
     cmd = None
 
     def __init__(self, logfiles={}, lazylogfiles=False, log_eval_func=None,
-                 *args, **kwargs):
+                 copyOnDemandLogs='failure', *args, **kwargs):
         BuildStep.__init__(self, *args, **kwargs)
         self.addFactoryArguments(logfiles=logfiles,
                                  lazylogfiles=lazylogfiles,
-                                 log_eval_func=log_eval_func)
+                                 log_eval_func=log_eval_func,
+                                 copyOnDemandLogs=copyOnDemandLogs)
 
         if logfiles:
             assert type(logfiles) is type({}), \
@@ -1065,6 +1225,10 @@ class LoggingBuildStep(BuildStep):
         self.lazylogfiles = lazylogfiles
         assert not log_eval_func or callable(log_eval_func)
         self.log_eval_func = log_eval_func
+        assert copyOnDemandLogs in ('failure', 'always', 'never'), \
+            "copyOnDemandLogs must be 'failure', 'always' or 'never'"
+        self.copyOnDemandLogs = copyOnDemandLogs
+        self.onDemandLogs = {}
         self.addLogObserver('stdio', OutputProgressObserver("output"))
 
     def addLogFile(self, logname, filename):
@@ -1104,12 +1268,17 @@ class LoggingBuildStep(BuildStep):
             self.setStatus(cmd, results)
             return results
         d.addCallback(_gotResults) # returns results
+        d.addCallback(self.finishOnDemandLogs, cmd) # returns results
         d.addCallbacks(self.finished, self.checkDisconnect)
         d.addErrback(self.failed)
 
     def setupLogfiles(self, cmd, logfiles):
         """Set up any additional logfiles= logs.
 
+        Logfiles given as a dictionary with a true 'onDemand' value are kept
+        on slaves which support it: the slave only describes them when the
+        command finishes, and they are handled by L{finishOnDemandLogs}.
+
         @param cmd: the LoggedRemoteCommand to add additional logs to.
 
         @param logfiles: a dict of tuples (logname,remotefilename)
@@ -1118,7 +1287,11 @@ class LoggingBuildStep(BuildStep):
                          ignored)
         """
         for logname,remotefilename in logfiles.items():
-            if self.lazylogfiles:
+            if (type(remotefilename) == dict and
+                    remotefilename.get('onDemand') and
+                    not self.slaveVersionIsOlderThan("shell", "2.19")):
+                self.onDemandLogs[logname] = self.addLog(logname)
+            elif self.lazylogfiles:
                 # Ask LoggedRemoteCommand to watch a logfile, but only add
                 # it when/if we see any data.
                 #
@@ -1133,6 +1306,45 @@ class LoggingBuildStep(BuildStep):
                 # and tell the LoggedRemoteCommand to feed it
                 cmd.useLog(newlog, True)
 
+    def finishOnDemandLogs(self, results, cmd):
+        """Note where each logfile kept on the slave can be found, in its
+        log, and copy the contents into the log if the step failed (or
+        always, or never, according to C{copyOnDemandLogs}).  Returns a
+        Deferred which fires with C{results}."""
+        copy = (self.copyOnDemandLogs == 'always' or
+                (self.copyOnDemandLogs == 'failure' and
+                 results in (FAILURE, EXCEPTION)))
+        d = defer.succeed(None)
+        for logname, loog in self.onDemandLogs.items():
+            info = cmd.onDemandLogs.get(logname)
+            if not info:
+                loog.addHeader("the logfile was not found on the slave\n")
+                loog.finish()
+                continue
+            remoteFile = dict(info, slavename=self.getSlaveName(),
+                              workdir=cmd.args['workdir'],
+                              copied=copy and info['size'] > 0)
+            loog.setRemoteFile(remoteFile)
+            loog.addHeader("kept on slave %s as %s (%d bytes, sha1 %s)\n"
+                           % (remoteFile['slavename'], info['filename'],
+                              info['size'], info['sha1']))
+            if remoteFile['copied']:
+                d.addCallback(lambda _, logname=logname, loog=loog,
+                              remoteFile=remoteFile:
+                              self._copyOnDemandLog(logname, loog, remoteFile))
+            else:
+                loog.finish()
+        d.addCallback(lambda _ : results)
+        return d
+
+    def _copyOnDemandLog(self, logname, loog, remoteFile):
+        cmd = LoggedRemoteCommand('readFile',
+                                  { 'workdir' : remoteFile['workdir'],
+                                    'filename' : remoteFile['filename'],
+                                    'logname' : logname })
+        cmd.useLog(loog, True)
+        return self.runCommand(cmd)
+
     def interrupt(self, reason):
         # TODO: consider adding an INTERRUPTED or STOPPED status to use
         # instead of FAILURE, might make the text a bit more clear.
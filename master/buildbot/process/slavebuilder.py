@@ -14,7 +14,7 @@
 # Copyright Buildbot Team Members
 
 from twisted.spread import pb
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.python import log
 
 (ATTACHING, # slave attached, still checking hostinfo/etc
@@ -38,6 +38,7 @@ class AbstractSlaveBuilder(pb.Referenceable):
         self.slave = None
         self.builder_name = None
         self.locks = None
+        self.restTimer = None
 
     def __repr__(self):
         r = ["<", self.__class__.__name__]
@@ -63,6 +64,10 @@ class AbstractSlaveBuilder(pb.Referenceable):
         if self.isBusy():
             return False
 
+        # nor is it while resting, after the slave refused a build
+        if self.restTimer:
+            return False
+
         # otherwise, check in with the BuildSlave
         if self.slave:
             return self.slave.canStartBuild()
@@ -73,6 +78,15 @@ class AbstractSlaveBuilder(pb.Referenceable):
     def isBusy(self):
         return self.state not in (IDLE, LATENT)
 
+    def rest(self, delay):
+        """Offer no builds to this slave for the next C{delay} seconds"""
+        if self.restTimer:
+            self.restTimer.cancel()
+        def wake():
+            self.restTimer = None
+            self.builder.triggerNewBuildCheck()
+        self.restTimer = reactor.callLater(delay, wake)
+
     def buildStarted(self):
         self.state = BUILDING
 
@@ -176,6 +190,9 @@ class AbstractSlaveBuilder(pb.Referenceable):
         self.slave = None
         self.remote = None
         self.remoteCommands = None
+        if self.restTimer:
+            self.restTimer.cancel()
+            self.restTimer = None
 
 
 class Ping:
@@ -258,6 +258,7 @@ class LogFile:
     filename = None # relative to the Builder's basedir
     openfile = None
     compressMethod = "bz2"
+    remoteFile = None # see getRemoteFile
 
     def __init__(self, parent, name, logfilename):
         """
@@ -301,6 +302,12 @@ class LogFile:
     def getStep(self):
         return self.step
 
+    def getRemoteFile(self):
+        return self.remoteFile
+
+    def setRemoteFile(self, remoteFile):
+        self.remoteFile = remoteFile
+
     def isFinished(self):
         return self.finished
     def waitUntilFinished(self):
@@ -403,6 +410,197 @@ class LogFile:
             else:
                 yield leftover
 
+    def _scanEntries(self, f):
+        # yield (channel, offset, length) for each entry in the log file,
+        # where offset is the file offset of the entry's text.  Only the
+        # netstring headers are read; the text itself is skipped, and the
+        # file is never read backward, which is very slow for compressed
+        # logs.
+        pos = 0
+        f.seek(0)
+        while True:
+            if f.tell() != pos:
+                f.seek(pos)
+            size = ''
+            c = f.read(1)
+            while c.isdigit():
+                size += c
+                c = f.read(1)
+            channel = f.read(1)
+            if c != ':' or not size or not channel:
+                return # EOF
+            size = int(size)
+            textoffset = pos + len(str(size)) + 2
+            yield (int(channel), textoffset, size - 1)
+            pos = textoffset + size # skip text and comma
+
+    def _parseEntries(self, data, base, end):
+        # find a run of complete entries in data (which starts at file
+        # offset base) that ends exactly at file offset end, and return it
+        # as a list of (channel, offset, length, entryoffset), or None.
+        # Headers can only be recognized by checking that a run of entries
+        # parsed from them lines up with the end, so try every position that
+        # looks like the start of an entry.
+        candidates = [ m.start() + 1 for m in
+                       re.finditer(r',(?=\d+:\d)', data) ]
+        if base == 0:
+            candidates.insert(0, 0)
+        for start in candidates:
+            entries = []
+            pos = start
+            while pos < len(data):
+                m = re.match(r'(\d+):(\d)', data[pos:pos+16])
+                if not m:
+                    break
+                size = int(m.group(1))
+                textstart = pos + m.end()
+                nextpos = textstart + size
+                if nextpos > len(data) or data[nextpos-1] != ',':
+                    break
+                entries.append((int(m.group(2)), base + textstart,
+                                size - 1, base + pos))
+                pos = nextpos
+            if entries and base + pos == end:
+                return entries
+        return None
+
+    def _scanEntriesBackward(self, f, end):
+        # like _scanEntries, but last entry first, reading only the tail of
+        # the file.  This requires a seekable, uncompressed file.
+        blocksize = 4 * self.chunkSize
+        while end > 0:
+            start = max(0, end - blocksize)
+            f.seek(start)
+            entries = self._parseEntries(f.read(end - start), start, end)
+            if entries and start > 0:
+                # the first run might begin in the middle of an entry that
+                # happens to look like a header, so don't trust it
+                entries = entries[1:]
+            if not entries:
+                if start == 0:
+                    log.msg("LogFile %s: cannot parse log file" %
+                            self.getFilename())
+                    return
+                blocksize *= 2
+                continue
+            for channel, offset, length, entryoffset in reversed(entries):
+                yield (channel, offset, length)
+            end = entries[0][3]
+
+    def _getSeekableFile(self):
+        # return the log file, or None if it is compressed
+        if self.openfile:
+            return self.openfile
+        try:
+            return open(self.getFilename(), "r")
+        except IOError:
+            return None
+
+    def getChunksInRange(self, offset, length, channels=[]):
+        """Return a list of (channel, text) tuples holding C{length} bytes of
+        the log, starting C{offset} bytes into it, counting only chunks in
+        C{channels} (or all chunks if C{channels} is empty).  The file is
+        skipped through using the chunk headers, so text before the range is
+        never read."""
+        chunks = []
+        pos = 0 # position in the logical (filtered) text
+        stop = offset + length
+
+        f = self.getFile()
+        for channel, textoffset, textlength in self._scanEntries(f):
+            if pos >= stop:
+                break
+            if channels and channel not in channels:
+                continue
+            if pos + textlength > offset:
+                skip = max(offset - pos, 0)
+                f.seek(textoffset + skip)
+                chunks.append((channel,
+                    f.read(min(textlength - skip, stop - pos - skip))))
+            pos += textlength
+        del f
+
+        for channel, text in self.runEntries:
+            if pos >= stop:
+                break
+            if channels and channel not in channels:
+                continue
+            if pos + len(text) > offset:
+                skip = max(offset - pos, 0)
+                chunks.append((channel, text[skip:stop - pos]))
+            pos += len(text)
+        return chunks
+
+    def getTailChunks(self, numLines, channels=[]):
+        """Return a list of (channel, text) tuples holding the last
+        C{numLines} lines of the log, counting only chunks in C{channels} (or
+        all chunks if C{channels} is empty).  For uncompressed logs, only the
+        end of the file is read."""
+        tail = [] # (channel, text), last first
+        newlines = [0]
+        def want():
+            # we need one more newline than lines if the text ends in one
+            need = numLines
+            if tail and tail[0][1].endswith('\n'):
+                need += 1
+            return newlines[0] < need
+        def add(channel, text):
+            if text and (not channels or channel in channels):
+                tail.append((channel, text))
+                newlines[0] += text.count('\n')
+
+        for channel, text in reversed(self.runEntries):
+            if not want():
+                break
+            add(channel, text)
+
+        if want():
+            f = self._getSeekableFile()
+            if f:
+                f.seek(0, 2)
+                entries = self._scanEntriesBackward(f, f.tell())
+                for channel, textoffset, textlength in entries:
+                    if channels and channel not in channels:
+                        continue
+                    f.seek(textoffset)
+                    add(channel, f.read(textlength))
+                    if not want():
+                        break
+            else:
+                # compressed logs can't be read backward; read them forward,
+                # but only keep what's needed
+                f = self.getFile()
+                older = []
+                lines = 0
+                for channel, textoffset, textlength in self._scanEntries(f):
+                    if channels and channel not in channels:
+                        continue
+                    f.seek(textoffset)
+                    text = f.read(textlength)
+                    older.append((channel, text))
+                    lines += text.count('\n')
+                    while older and lines - older[0][1].count('\n') > numLines:
+                        lines -= older.pop(0)[1].count('\n')
+                for channel, text in reversed(older):
+                    if not want():
+                        break
+                    add(channel, text)
+            del f
+
+        tail.reverse()
+
+        # trim the first chunk to the requested number of lines
+        excess = newlines[0] - numLines
+        if tail and tail[-1][1].endswith('\n'):
+            excess -= 1
+        if excess >= 0 and tail:
+            channel, text = tail[0]
+            cut = -1
+            for i in range(excess + 1):
+                cut = text.index('\n', cut + 1)
+            tail[0] = (channel, text[cut+1:])
+        return tail
+
     def readlines(self, channel=STDOUT):
         """Return an iterator that produces newline-terminated lines,
         excluding header chunks."""
@@ -622,6 +820,8 @@ class HTMLLogFile:
         return self.name # set in BuildStepStatus.addLog
     def getStep(self):
         return self.step
+    def getRemoteFile(self):
+        return None
 
     def isFinished(self):
         return True
@@ -634,7 +834,15 @@ class HTMLLogFile:
         return self.html # looks kinda like text
     def getTextWithHeaders(self):
         return self.html
-    def getChunks(self):
+    def getChunks(self, channels=[], onlyText=False):
+        if channels and STDERR not in channels:
+            return []
+        if onlyText:
+            return [self.html]
+        return [(STDERR, self.html)]
+    def getChunksInRange(self, offset, length, channels=[]):
+        return [(STDERR, self.html[offset:offset+length])]
+    def getTailChunks(self, numLines, channels=[]):
         return [(STDERR, self.html)]
 
     def subscribe(self, receiver, catchup):
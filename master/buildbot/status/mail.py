@@ -20,13 +20,16 @@ from email.Message import Message
 from email.Utils import formatdate
 from email.MIMEText import MIMEText
 from email.MIMEMultipart import MIMEMultipart
+from email.MIMEMessage import MIMEMessage
 from StringIO import StringIO
 import urllib
 
 from zope.interface import implements
-from twisted.internet import defer, reactor
-from twisted.mail.smtp import ESMTPSenderFactory
-from twisted.python import log as twlog
+from twisted.internet import defer, reactor, error
+from twisted.mail.smtp import ESMTPSender, ESMTPSenderFactory, Address, \
+     SMTPClient, SMTPDeliveryError, SMTPConnectError
+from twisted.mail.smtp import SUCCESS as SMTP_SUCCESS
+from twisted.python import log as twlog, failure
 
 have_ssl = True
 try:
@@ -37,7 +40,7 @@ except ImportError:
 
 from buildbot import interfaces, util
 from buildbot.status import base
-from buildbot.status.builder import FAILURE, SUCCESS, Results
+from buildbot.status.builder import FAILURE, SUCCESS, Results, STDOUT, STDERR
 
 VALID_EMAIL = re.compile("[a-zA-Z0-9\.\_\%\-\+]+@[a-zA-Z0-9\.\_\%\-]+.[a-zA-Z]{2,6}")
 
@@ -127,6 +130,100 @@ def defaultMessage(mode, name, build, results, master_status):
     text += "\n"
     return { 'body' : text, 'type' : 'plain' }
 
+class QueuedMail:
+    def __init__(self, data, recipients):
+        self.data = data
+        self.recipients = recipients
+        self.deferred = defer.Deferred()
+
+class BatchESMTPSender(ESMTPSender):
+    """An ESMTP client which delivers all of the messages in its factory's
+    queue over a single connection, including any that are added to the
+    queue while the connection is open."""
+
+    def getMailFrom(self):
+        if self.factory.queue:
+            return str(self.factory.fromEmail)
+        # nothing left to send: we will QUIT, and must not reconnect
+        self.factory.sendFinished = 1
+        return None
+
+    def getMailTo(self):
+        return self.factory.queue[0].recipients
+
+    def getMailData(self):
+        return StringIO(self.factory.queue[0].data)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        mail = self.factory.queue.pop(0)
+        if code not in SMTP_SUCCESS:
+            errlog = []
+            for addr, acode, aresp in addresses:
+                if acode not in SMTP_SUCCESS:
+                    errlog.append("%s: %03d %s" % (addr, acode, aresp))
+            errlog.append(log.str())
+            mail.deferred.errback(SMTPDeliveryError(code, resp,
+                                            '\n'.join(errlog), addresses))
+        else:
+            mail.deferred.callback((numOk, addresses))
+
+    def sendError(self, exc):
+        SMTPClient.sendError(self, exc)
+        # connection-level problems are retried by the factory, unless they
+        # are not going to get any better (e.g., authentication failures)
+        if not exc.retry and not (400 <= exc.code < 500):
+            self.factory.failQueue(exc)
+
+class BatchESMTPSenderFactory(ESMTPSenderFactory):
+    """I deliver a queue of L{QueuedMail} instances over one SMTP connection,
+    and fire C{self.done} when that connection is finished with.  Messages
+    still in the queue at that point, because of repeated connection errors,
+    have been errbacked."""
+
+    protocol = BatchESMTPSender
+
+    def __init__(self, username, password, fromEmail, queue, retries=5,
+                 timeout=None, contextFactory=None, heloFallback=False,
+                 requireAuthentication=True, requireTransportSecurity=True):
+        self.fromEmail = Address(fromEmail)
+        self.queue = queue
+        self.nEmails = 1
+        self.sendFinished = 0
+        self.retries = -retries
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        self._contextFactory = contextFactory
+        self._heloFallback = heloFallback
+        self._requireAuthentication = requireAuthentication
+        self._requireTransportSecurity = requireTransportSecurity
+        self.done = defer.Deferred()
+
+    def failQueue(self, exc):
+        self.sendFinished = 1
+        queue = self.queue[:]
+        del self.queue[:]
+        for mail in queue:
+            mail.deferred.errback(exc)
+
+    def _processConnectionError(self, connector, err):
+        if self.queue and self.sendFinished <= 0:
+            if self.retries < 0:
+                twlog.msg("SMTP Client retrying server. Retry: %s"
+                          % -self.retries)
+                connector.connect()
+                self.retries += 1
+                return
+            # If we were unable to communicate with the SMTP server a
+            # ConnectionDone will be returned. We want a more clear error
+            # message for debugging
+            if err.check(error.ConnectionDone):
+                err.value = SMTPConnectError(-1, "Unable to connect to server.")
+            self.failQueue(err.value)
+        if not self.done.called:
+            self.done.callback(None)
+
+
 class MailNotifier(base.StatusReceiverMultiService):
     """This is a status notifier which sends email to a list of recipients
     upon the completion of each build. It can be configured to only send out
@@ -141,6 +238,12 @@ class MailNotifier(base.StatusReceiverMultiService):
     To get a simple one-message-per-build (say, for a mailing list), use
     sendToInterestedUsers=False, extraRecipients=['listaddr@example.org']
 
+    Messages are queued and delivered over a single SMTP connection for as
+    long as there are messages waiting. With digestInterval set, messages
+    for each recipient are held for that many seconds and then sent together
+    as a single digest, so that one bad commit breaking many builders does
+    not flood everybody's mailbox.
+
     Each MailNotifier sends mail to a single set of recipients. To send
     different kinds of mail to different recipients, use multiple
     MailNotifiers.
@@ -151,7 +254,8 @@ class MailNotifier(base.StatusReceiverMultiService):
     compare_attrs = ["extraRecipients", "lookup", "fromaddr", "mode",
                      "categories", "builders", "addLogs", "relayhost",
                      "subject", "sendToInterestedUsers", "customMesg",
-                     "messageFormatter", "extraHeaders"]
+                     "messageFormatter", "extraHeaders", "digestInterval",
+                     "maxLogSize"]
 
     possible_modes = ('all', 'failing', 'problem', 'change', 'passing', 'warnings')
 
@@ -162,7 +266,8 @@ class MailNotifier(base.StatusReceiverMultiService):
                  sendToInterestedUsers=True, customMesg=None,
                  messageFormatter=defaultMessage, extraHeaders=None,
                  addPatch=True, useTls=False, 
-                 smtpUser=None, smtpPassword=None, smtpPort=25):
+                 smtpUser=None, smtpPassword=None, smtpPort=25,
+                 digestInterval=None, maxLogSize=None):
         """
         @type  fromaddr: string
         @param fromaddr: the email address to be used in the 'From' header.
@@ -271,6 +376,17 @@ class MailNotifier(base.StatusReceiverMultiService):
         @type smtpPort: int
         @param smtpPort: The port that will be used when connecting to the
                          relayhost. Defaults to 25.
+
+        @type digestInterval: int
+        @param digestInterval: if set, hold the messages for each recipient
+                               for this many seconds after the first one,
+                               and then send them all as a single digest.
+                               Defaults to None (send each message at once).
+
+        @type maxLogSize: int
+        @param maxLogSize: the maximum number of bytes of each log to attach
+                           when addLogs is set; only the end of longer logs
+                           is attached.  Defaults to None (no limit).
         """
 
         base.StatusReceiverMultiService.__init__(self)
@@ -304,7 +420,12 @@ class MailNotifier(base.StatusReceiverMultiService):
         self.smtpUser = smtpUser
         self.smtpPassword = smtpPassword
         self.smtpPort = smtpPort
+        self.digestInterval = digestInterval
+        self.maxLogSize = maxLogSize
         self.watched = []
+        self.outbox = [] # QueuedMail instances waiting for delivery
+        self.sender = None # the BatchESMTPSenderFactory delivering them
+        self.digests = {} # recipient : (DelayedCall, [ (msg, Deferred) ])
         self.master_status = None
 
         # you should either limit on builders or categories, not both
@@ -330,6 +451,12 @@ class MailNotifier(base.StatusReceiverMultiService):
         self.master_status.unsubscribe(self)
         for w in self.watched:
             w.unsubscribe(self)
+        # don't sit on pending digests until the next reconfig
+        for recipient in self.digests.keys():
+            timer = self.digests[recipient][0]
+            if timer.active():
+                timer.cancel()
+            self.sendDigest(recipient)
         return base.StatusReceiverMultiService.disownServiceParent(self)
 
     def builderAdded(self, name, builder):
@@ -460,7 +587,7 @@ class MailNotifier(base.StatusReceiverMultiService):
                 name = "%s.%s" % (log.getStep().getName(),
                                   log.getName())
                 if self._shouldAttachLog(log.getName()) or self._shouldAttachLog(name):
-                    a = MIMEText(log.getText().encode(ENCODING), 
+                    a = MIMEText(self._getLogText(log).encode(ENCODING),
                                  _charset=ENCODING)
                     a.add_header('Content-Disposition', "attachment",
                                  filename=name)
@@ -518,6 +645,29 @@ class MailNotifier(base.StatusReceiverMultiService):
             return self.addLogs
         return logname in self.addLogs
 
+    def _getLogText(self, log):
+        # stream the log rather than reading it all at once, keeping only
+        # the last maxLogSize bytes: that is where the failure will be
+        chunks = []
+        size = dropped = 0
+        for chunk in log.getChunks([STDOUT, STDERR], onlyText=True):
+            chunks.append(chunk)
+            size += len(chunk)
+            if self.maxLogSize is None:
+                continue
+            while size - len(chunks[0]) >= self.maxLogSize:
+                size -= len(chunks[0])
+                dropped += len(chunks.pop(0))
+            if size > self.maxLogSize:
+                excess = size - self.maxLogSize
+                chunks[0] = chunks[0][excess:]
+                size -= excess
+                dropped += excess
+        text = "".join(chunks)
+        if dropped:
+            text = "[%d bytes truncated]\n%s" % (dropped, text)
+        return text
+
     def _gotRecipients(self, res, rlist, m):
         to_recipients = set()
         cc_recipients = set()
@@ -544,15 +694,69 @@ class MailNotifier(base.StatusReceiverMultiService):
         else:
             to_recipients.update(self.extraRecipients)
 
+        if self.digestInterval:
+            return defer.DeferredList([ self.addToDigest(m, recipient)
+                        for recipient in sorted(to_recipients | cc_recipients) ])
+
         m['To'] = ", ".join(sorted(to_recipients))
         if cc_recipients:
             m['CC'] = ", ".join(sorted(cc_recipients))
 
         return self.sendMessage(m, list(to_recipients | cc_recipients))
 
+    def addToDigest(self, m, recipient):
+        """Hold message C{m} for C{recipient} until the digest window for
+        that recipient closes.  Returns a Deferred that fires when the
+        message (or the digest containing it) has been sent."""
+        d = defer.Deferred()
+        if recipient not in self.digests:
+            timer = reactor.callLater(self.digestInterval,
+                                      self.sendDigest, recipient)
+            self.digests[recipient] = (timer, [])
+        self.digests[recipient][1].append((m, d))
+        return d
+
+    def sendDigest(self, recipient):
+        timer, entries = self.digests.pop(recipient)
+        # the same message may be in several recipients' digests
+        for msg, _ in entries:
+            del msg['To']
+        if len(entries) == 1:
+            m = entries[0][0]
+        else:
+            m = self.createDigest([ e[0] for e in entries ])
+        m['To'] = recipient
+        d = self.sendMessage(m, [recipient])
+        def fire(res):
+            for _, ed in entries:
+                if isinstance(res, failure.Failure):
+                    ed.errback(res)
+                else:
+                    ed.callback(res)
+        d.addBoth(fire)
+
+    def createDigest(self, messages):
+        """Create a MIME digest with each of C{messages} as a part."""
+        m = MIMEMultipart('digest')
+        m.preamble = "This is a digest of %d buildbot messages.\n" \
+                % len(messages)
+        m['Date'] = formatdate(localtime=True)
+        m['Subject'] = "buildbot: %d messages from %s" \
+                % (len(messages), self.master_status.getProjectName())
+        m['From'] = self.fromaddr
+        for msg in messages:
+            m.attach(MIMEMessage(msg))
+        return m
+
     def sendmail(self, s, recipients):
-        result = defer.Deferred()
-        
+        mail = QueuedMail(s, recipients)
+        self.outbox.append(mail)
+        if not self.sender:
+            self._startSender()
+        # otherwise, the open connection will pick it up
+        return mail.deferred
+
+    def _startSender(self):
         if have_ssl and self.useTls:
             client_factory = ssl.ClientContextFactory()
             client_factory.method = SSLv3_METHOD
@@ -563,17 +767,23 @@ class MailNotifier(base.StatusReceiverMultiService):
             useAuth = True
         else:
             useAuth = False
-        
-        sender_factory = ESMTPSenderFactory(
+
+        # the sender delivers everything in the outbox, including anything
+        # added to it while its connection is still open
+        self.sender = BatchESMTPSenderFactory(
             self.smtpUser, self.smtpPassword,
-            self.fromaddr, recipients, StringIO(s),
-            result, contextFactory=client_factory,
+            self.fromaddr, self.outbox, contextFactory=client_factory,
             requireTransportSecurity=self.useTls,
             requireAuthentication=useAuth)
 
-        reactor.connectTCP(self.relayhost, self.smtpPort, sender_factory)
-        
-        return result
+        def senderDone(_):
+            self.sender = None
+            if self.outbox:
+                # queued after the sender had decided to QUIT
+                self._startSender()
+        self.sender.done.addCallback(senderDone)
+
+        reactor.connectTCP(self.relayhost, self.smtpPort, self.sender)
 
     def sendMessage(self, m, recipients):
         s = m.as_string()
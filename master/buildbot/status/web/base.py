@@ -22,6 +22,7 @@ from twisted.internet import defer
 from twisted.web import resource, static, server
 from twisted.python import log
 from buildbot.status import builder
+from buildbot.status.base import StatusReceiver
 from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, SKIPPED, EXCEPTION, RETRY
 from buildbot import version, util
 from buildbot.process.properties import Properties
@@ -171,6 +172,63 @@ class Box:
         return props    
     
     
+class FragmentCache(StatusReceiver):
+    """I remember HTML fragments (and other display values) rendered for
+    finished builds and steps, which cannot change anymore, so that pages
+    showing them over and over do not have to render them each time.
+
+    Keys must include everything the fragment depends on besides the build
+    itself, such as the relative path to the root of the site.
+
+    When a builder is added or removed (for example, by a reconfig), its
+    build history may change, so the fragments cached for it are
+    invalidated.  Invalidated fragments are never returned again, and age
+    out of the cache like any others."""
+
+    def __init__(self, max_size=2000):
+        self.cache = util.LRUCache(max_size)
+        self.generations = {} # builderName : generation
+        self.status = None
+
+    def startWatching(self, status):
+        self.status = status
+        status.subscribe(self)
+
+    def stopWatching(self):
+        if self.status:
+            self.status.unsubscribe(self)
+            self.status = None
+
+    def get(self, builderName, key, render):
+        key = (builderName, self.generations.get(builderName, 0)) + key
+        value = self.cache.get(key)
+        if value is None:
+            value = render()
+            self.cache.add(key, value)
+        return value
+
+    def invalidate(self, builderName):
+        self.generations[builderName] = \
+                self.generations.get(builderName, 0) + 1
+
+    # IStatusReceiver
+
+    def builderAdded(self, builderName, builder):
+        self.invalidate(builderName)
+
+    def builderRemoved(self, builderName):
+        self.invalidate(builderName)
+
+def getFragment(req, builderName, key, isFinished, render):
+    """Return the fragment for C{key} for a build of C{builderName},
+    rendering it with C{render} if necessary.  Fragments are only cached if
+    C{isFinished} is true."""
+    if not isFinished:
+        return render()
+    cache = req.site.buildbot_service.fragmentCache
+    return cache.get(builderName, (path_to_root(req),) + key, render)
+
+
 class ContextMixin(object):
     def getContext(self, request):
         status = self.getStatus(request)
@@ -383,6 +441,14 @@ class BuildLineMixin:
         '''
         Collect the data needed for each line display
         '''
+        key = ('line', build.getNumber(), self.LINE_TIME_FORMAT,
+               include_builder)
+        values = getFragment(req, build.getBuilder().getName(), key,
+                             build.isFinished(),
+                lambda : self._get_line_values(req, build, include_builder))
+        return values.copy()
+
+    def _get_line_values(self, req, build, include_builder):
         builder_name = build.getBuilder().getName()
         results = build.getResults()
         text = build.getText()
@@ -546,6 +612,25 @@ def _revlinkmacros(replace, templates):
     return (id, short)
         
 
+def memoizedfilter(fn, max_size=1000):
+    '''Wrap a filter taking (value, repository-or-project) so that its results
+       are remembered.  The same revisions and change comments are rendered
+       over and over again by the various pages, so this saves running the
+       link regexes and macros each time.'''
+    cache = util.LRUCache(max_size)
+    def filter(value, arg):
+        key = (value, arg)
+        try:
+            result = cache.get(key)
+        except TypeError: # unhashable
+            return fn(value, arg)
+        if result is None:
+            result = fn(value, arg)
+            cache.add(key, result)
+        return result
+    return filter
+
+
 def shortrevfilter(replace, templates):
     ''' Returns a function which shortens the revisison string 
         to 12-chars (chosen as this is the Mercurial short-id length) 
@@ -559,6 +644,7 @@ def shortrevfilter(replace, templates):
     
     url_f = _revlinkcfg(replace, templates)  
         
+    @memoizedfilter
     def filter(rev, repo):
         if not rev:
             return u''
@@ -601,6 +687,7 @@ def revlinkfilter(replace, templates):
 
     url_f = _revlinkcfg(replace, templates)
   
+    @memoizedfilter
     def filter(rev, repo):
         if not rev:
             return u''
@@ -679,22 +766,25 @@ def changelinkfilter(changelink):
         return lambda text, project: jinja2.escape(text)
 
     elif isinstance(changelink, dict):
+        project_filters = dict([ (project, replace_from_tuple(t))
+                                 for project, t in changelink.iteritems()
+                                 if t ])
+
+        @memoizedfilter
         def dict_filter(text, project):
-            # TODO: Optimize and cache return value from replace_from_tuple so
-            #       we only compile regex once per project, not per view
-            
-            t = changelink.get(project)
-            if t:
-                return replace_from_tuple(t)(text, project)
+            f = project_filters.get(project)
+            if f:
+                return f(text, project)
             else:
                 return cgi.escape(text)
             
         return dict_filter
         
     elif isinstance(changelink, tuple):
-        return replace_from_tuple(changelink)
+        return memoizedfilter(replace_from_tuple(changelink))
             
     elif callable(changelink):
+        @memoizedfilter
         def callable_filter(text, project):
             text = jinja2.escape(text)
             return changelink(text, project)
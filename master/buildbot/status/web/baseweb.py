@@ -15,6 +15,7 @@
 
 
 import os, weakref
+import jinja2
 
 from zope.interface import implements
 from twisted.python import log
@@ -25,7 +26,7 @@ from twisted.web.util import Redirect
 
 from buildbot.interfaces import IStatusReceiver
 
-from buildbot.status.web.base import StaticFile, createJinjaEnv
+from buildbot.status.web.base import StaticFile, createJinjaEnv, FragmentCache
 from buildbot.status.web.feeds import Rss20StatusResource, \
      Atom10StatusResource
 from buildbot.status.web.waterfall import WaterfallStatusResource
@@ -42,6 +43,7 @@ from buildbot.status.web.authz import Authz
 from buildbot.status.web.auth import AuthFailResource
 from buildbot.status.web.root import RootPage
 from buildbot.status.web.change_hook import ChangeHookResource
+from buildbot.status.web.buildindex import BuildIndex
 
 # this class contains the WebStatus class.  Basic utilities are in base.py,
 # and specific pages are each in their own module.
@@ -322,6 +324,10 @@ class WebStatus(service.MultiService):
         self.templates = createJinjaEnv(revlink, changecommentlink,
                                         repositories, projects)
 
+        # summaries of finished builds, shared by the console and grid views
+        self.buildIndex = BuildIndex()
+        self.fragmentCache = FragmentCache()
+
         # keep track of cached connections so we can break them when we shut
         # down. See ticket #102 for more details.
         self.channels = weakref.WeakKeyDictionary()
@@ -413,6 +419,14 @@ class WebStatus(service.MultiService):
         # each page.
         self.site.buildbot_service = self
 
+        # compiled templates are cached on disk, so that they do not have to
+        # be compiled again each time the master starts
+        cachedir = os.path.join(self.master.basedir, "template_cache")
+        if not os.path.isdir(cachedir):
+            os.mkdir(cachedir)
+        self.templates.bytecode_cache = \
+            jinja2.FileSystemBytecodeCache(os.path.abspath(cachedir))
+
         if self.http_port is not None:
             s = strports.service(self.http_port, self.site)
             s.setServiceParent(self)
@@ -447,6 +461,8 @@ class WebStatus(service.MultiService):
             root.putChild(name, child_resource)
 
         status = self.getStatus()
+        self.buildIndex.startIndexing(status)
+        self.fragmentCache.startWatching(status)
         if "rss" in self.provide_feeds:
             root.putChild("rss", Rss20StatusResource(status))
         if "atom" in self.provide_feeds:
@@ -471,6 +487,8 @@ class WebStatus(service.MultiService):
                 log.msg("WebStatus.stopService: error while disconnecting"
                         " leftover clients")
                 log.err()
+        self.buildIndex.stopIndexing()
+        self.fragmentCache.stopWatching()
         return service.MultiService.stopService(self)
 
     def getStatus(self):
@@ -0,0 +1,326 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import re, bisect
+
+from buildbot.status import builder
+from buildbot.status.base import StatusReceiver
+
+_stripHtml = re.compile(r'<.*?>')
+
+class ANYBRANCH: pass # a flag value, used below
+
+def getSourceStampKey(ss):
+    """Given two source stamps, we want to assign them to the same row if
+    they are the same version of code, even if they differ in minor detail.
+
+    This function returns an appropriate comparison key for that.
+    """
+    return (ss.branch, ss.revision, ss.patch)
+
+class BuildSummary(object):
+    """A small digest of a build, holding everything the console view needs
+    to render a box for it.  Once a finished build is summarized, it never
+    has to be loaded from disk again for display purposes."""
+
+    def __init__(self, builderName, build):
+        self.builderName = builderName
+        self.number = build.getNumber()
+        self.results = build.getResults()
+        self.text = build.getText()
+        self.when = build.getTimes()[0]
+        self.isFinished = build.isFinished()
+        self.eta = build.getETA()
+        self.changes = tuple(build.getChanges() or ())
+        self.got_revision = self._getProperty(build, "got_revision")
+        self.revision = self._getProperty(build, "revision")
+        self.failure = self._getFailure(build)
+        self.sourceStamp = build.getSourceStamp(absolute=True)
+        self.sourceStampKey = getSourceStampKey(self.sourceStamp)
+
+    def _getProperty(self, build, name):
+        try:
+            return build.getProperty(name)
+        except KeyError:
+            return None
+
+    def _getFailure(self, build):
+        # only the last failing step is interesting to the console, and only
+        # for builds that actually produced logs
+        if not build.getLogs():
+            return None
+        failure = None
+        for step in build.getSteps():
+            (result, reason) = step.getResults()
+            if result == builder.FAILURE:
+                failure = dict(
+                    stepname=step.getName(),
+                    status=_stripHtml.sub('', ' '.join(step.getText())),
+                    reason=reason,
+                    lognames=[ l.getName() for l in step.getLogs() ])
+        return failure
+
+    def getResults(self):
+        return self.results
+
+    def getNumber(self):
+        return self.number
+
+    def getText(self):
+        return self.text
+
+    def getETA(self):
+        return self.eta
+
+    def getTimes(self):
+        return (self.when, None)
+
+    def getChanges(self):
+        return self.changes
+
+    def getSourceStamp(self, absolute=False):
+        return self.sourceStamp
+
+
+class _BuilderIndex(object):
+    # per-builder state: summaries of finished builds, newest first
+
+    def __init__(self):
+        self.summaries = []
+        self.seeded = False
+        self.exhausted = False
+
+
+class _StampEntry(object):
+    # a row (or column) of the grid: a sourcestamp, the earliest time a build
+    # of it started, and the newest finished build of it on each builder,
+    # out of all of the indexed builds of it
+
+    def __init__(self, key, sourceStamp, start):
+        self.key = key
+        self.sourceStamp = sourceStamp
+        self.start = start
+        self.builds = {}
+        self.summaries = []
+
+
+class BuildIndex(StatusReceiver):
+    """I maintain an index of summaries of finished builds for each builder,
+    so that the console view does not have to walk (and unpickle) build
+    history on every request.
+
+    The index for a builder is seeded lazily from its history the first time
+    it is queried, and kept up to date afterward by subscribing to
+    C{buildFinished} events.  At most C{maxBuilds} summaries are kept per
+    builder.
+
+    The same summaries are also indexed by sourcestamp, per branch and in
+    order of the earliest build start, for the grid views."""
+
+    maxBuilds = 200
+
+    def __init__(self, maxBuilds=None):
+        if maxBuilds is not None:
+            self.maxBuilds = maxBuilds
+        self.builders = {}
+        self.status = None
+        self._resetStamps()
+
+    def _resetStamps(self):
+        self.stamps = {} # key : _StampEntry
+        # sorted lists of (start, key), by branch and for all branches
+        self.stampOrder = { ANYBRANCH : [] }
+
+    def startIndexing(self, status):
+        self.status = status
+        status.subscribe(self)
+
+    def stopIndexing(self):
+        if self.status:
+            self.status.unsubscribe(self)
+            self.status = None
+        self.builders = {}
+        self._resetStamps()
+
+    # IStatusReceiver
+
+    def builderAdded(self, builderName, builder):
+        return self # subscribe to buildFinished
+
+    def builderRemoved(self, builderName):
+        idx = self.builders.pop(builderName, None)
+        if idx:
+            for summary in idx.summaries:
+                self._unindexStamp(summary)
+
+    def buildFinished(self, builderName, build, results):
+        idx = self.builders.get(builderName)
+        if not idx or not idx.seeded:
+            return # will be picked up when the builder is seeded
+        # builds can finish out of order, so find the right spot
+        number = build.getNumber()
+        pos = 0
+        for pos, s in enumerate(idx.summaries):
+            if s.number == number:
+                return
+            if s.number < number:
+                break
+        else:
+            pos = len(idx.summaries)
+            if idx.summaries and not idx.exhausted:
+                return # older than anything we've indexed; seed it later
+        summary = BuildSummary(builderName, build)
+        idx.summaries.insert(pos, summary)
+        self._indexStamp(summary)
+        self._prune(idx)
+
+    # queries
+
+    def getBuilds(self, builder_status, numBuilds):
+        """Return up to C{numBuilds} L{BuildSummary} instances for the
+        finished builds of the given builder, newest first."""
+        builderName = builder_status.getName()
+        numBuilds = min(numBuilds, self.maxBuilds)
+        idx = self.builders.setdefault(builderName, _BuilderIndex())
+
+        if not idx.seeded:
+            idx.seeded = True
+            build = builder_status.getBuild(-1)
+            # HACK: Work around #601, the head build may be None if it is
+            # locked.
+            if build is None:
+                build = builder_status.getBuild(-2)
+            self._extend(idx, builderName, build, numBuilds)
+        elif len(idx.summaries) < numBuilds and not idx.exhausted:
+            build = None
+            if idx.summaries and idx.summaries[-1].number > 0:
+                build = builder_status.getBuild(idx.summaries[-1].number - 1)
+            self._extend(idx, builderName, build, numBuilds)
+
+        return idx.summaries[:numBuilds]
+
+    def getSourceStamps(self, builders, branch, numStamps):
+        """Return the C{numStamps} sourcestamps most recently built on any of
+        the given builders, newest first, restricted to C{branch} unless it is
+        C{ANYBRANCH}.  The result is a list of objects with attributes
+        C{key}, C{sourceStamp}, C{start} (the earliest start time of any
+        build of the sourcestamp) and C{builds}, a dictionary mapping builder
+        names to L{BuildSummary} instances.
+
+        Each builder's history is indexed at least C{numStamps} builds deep,
+        and deeper (up to C{maxBuilds}) if that does not turn up enough
+        sourcestamps on C{branch}.  After that, the cost of a call is
+        proportional to the number of sourcestamps returned, not to the depth
+        of history."""
+        names = set([ b.getName() for b in builders ])
+        depth = numStamps
+        while 1:
+            for b in builders:
+                self.getBuilds(b, depth)
+            stamps = self._findStamps(names, branch, numStamps)
+            if len(stamps) >= numStamps or depth >= self.maxBuilds:
+                return stamps
+            # the builders' histories are indexed too shallowly to fill the
+            # page, probably because most builds are on other branches
+            for b in builders:
+                if not self.builders[b.getName()].exhausted:
+                    break
+            else:
+                return stamps
+            depth = min(depth * 2, self.maxBuilds)
+
+    def _findStamps(self, names, branch, numStamps):
+        stamps = []
+        for start, key in reversed(self.stampOrder.get(branch, [])):
+            e = self.stamps[key]
+            if not names.intersection(e.builds):
+                continue
+            stamps.append(e)
+            if len(stamps) >= numStamps:
+                break
+        return stamps
+
+    def _extend(self, idx, builderName, build, numBuilds):
+        while build and len(idx.summaries) < numBuilds:
+            if build.isFinished():
+                summary = BuildSummary(builderName, build)
+                idx.summaries.append(summary)
+                self._indexStamp(summary)
+            build = build.getPreviousBuild()
+        if not build:
+            idx.exhausted = True
+
+    def _prune(self, idx):
+        if len(idx.summaries) > self.maxBuilds:
+            for summary in idx.summaries[self.maxBuilds:]:
+                self._unindexStamp(summary)
+            del idx.summaries[self.maxBuilds:]
+            idx.exhausted = False
+
+    def _indexStamp(self, summary):
+        if not summary.when:
+            return # never started
+        key = summary.sourceStampKey
+        e = self.stamps.get(key)
+        if not e:
+            e = self.stamps[key] = _StampEntry(key, summary.sourceStamp,
+                                               summary.when)
+            self._orderStamp(e, bisect.insort)
+        elif summary.when < e.start:
+            self._orderStamp(e, self._removeOrder)
+            e.start = summary.when
+            self._orderStamp(e, bisect.insort)
+
+        e.summaries.append(summary)
+        name = summary.builderName
+        if name not in e.builds or e.builds[name].number < summary.number:
+            e.builds[name] = summary
+
+    def _unindexStamp(self, summary):
+        e = self.stamps.get(summary.sourceStampKey)
+        if not e or summary not in e.summaries:
+            return
+        e.summaries = [ s for s in e.summaries if s is not summary ]
+        if not e.summaries:
+            self._orderStamp(e, self._removeOrder)
+            del self.stamps[e.key]
+            return
+
+        name = summary.builderName
+        if e.builds.get(name) is summary:
+            # fall back to the next newest build on that builder, if any
+            del e.builds[name]
+            for s in e.summaries:
+                if s.builderName == name and (name not in e.builds
+                                    or e.builds[name].number < s.number):
+                    e.builds[name] = s
+
+        start = min([ s.when for s in e.summaries ])
+        if start != e.start:
+            self._orderStamp(e, self._removeOrder)
+            e.start = start
+            self._orderStamp(e, bisect.insort)
+
+    def _orderStamp(self, e, fn):
+        branch = e.sourceStamp.branch
+        fn(self.stampOrder.setdefault(branch, []), (e.start, e.key))
+        fn(self.stampOrder[ANYBRANCH], (e.start, e.key))
+        if not self.stampOrder[branch]:
+            del self.stampOrder[branch]
+
+    def _removeOrder(self, order, item):
+        i = bisect.bisect_left(order, item)
+        if i < len(order) and order[i] == item:
+            del order[i]
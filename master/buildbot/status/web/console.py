@@ -15,12 +15,12 @@
 
 import time
 import operator
-import re
 import urllib
 from twisted.internet import defer
 from buildbot import util
 from buildbot.status import builder
 from buildbot.status.web.base import HtmlResource
+from buildbot.status.web.buildindex import BuildSummary
 
 class DoesNotPassFilter(Exception): pass # Used for filtering revs
 
@@ -79,12 +79,11 @@ class DevBuild:
         self.revision = revision
         self.results =  build.getResults()
         self.number = build.getNumber()
-        self.isFinished = build.isFinished()
+        self.isFinished = build.isFinished
         self.text = build.getText()
         self.eta = build.getETA()
         self.details = details
         self.when = build.getTimes()[0]
-        self.source = build.getSourceStamp()
 
 
 class ConsoleStatusResource(HtmlResource):
@@ -187,35 +186,37 @@ class ConsoleStatusResource(HtmlResource):
     def getBuildDetails(self, request, builderName, build):
         """Returns an HTML list of failures for a given build."""
         details = {}
-        if not build.getLogs():
+        failure = build.failure
+        if not failure:
             return details
-        
-        for step in build.getSteps():
-            (result, reason) = step.getResults()
-            if result == builder.FAILURE:
-                name = step.getName()
-
-                # Remove html tags from the error text.
-                stripHtml = re.compile(r'<.*?>')
-                strippedDetails = stripHtml.sub('', ' '.join(step.getText()))
-                
-                details['buildername'] = builderName
-                details['status'] = strippedDetails
-                details['reason'] = reason
-                logs = details['logs'] = []
-
-                if step.getLogs():
-                    for log in step.getLogs():
-                        logname = log.getName()
-                        logurl = request.childLink(
-                          "../builders/%s/builds/%s/steps/%s/logs/%s" % 
-                            (urllib.quote(builderName),
-                             build.getNumber(),
-                             urllib.quote(name),
-                             urllib.quote(logname)))
-                        logs.append(dict(url=logurl, name=logname))
+
+        name = failure['stepname']
+        details['buildername'] = builderName
+        details['status'] = failure['status']
+        details['reason'] = failure['reason']
+        logs = details['logs'] = []
+        for logname in failure['lognames']:
+            logurl = request.childLink(
+              "../builders/%s/builds/%s/steps/%s/logs/%s" % 
+                (urllib.quote(builderName),
+                 build.getNumber(),
+                 urllib.quote(name),
+                 urllib.quote(logname)))
+            logs.append(dict(url=logurl, name=logname))
         return details
 
+    def getBuildSummaries(self, request, builder, builderName, numBuilds):
+        """Return summaries of the most recent C{numBuilds} builds of this
+        builder, newest first.  Finished builds come from the build index,
+        so that their status does not need to be loaded from disk; builds
+        still in progress are summarized on the fly."""
+        buildIndex = request.site.buildbot_service.buildIndex
+        summaries = [ BuildSummary(builderName, b)
+                      for b in builder.getCurrentBuilds() ]
+        summaries.extend(buildIndex.getBuilds(builder, numBuilds))
+        summaries.sort(key=operator.attrgetter('number'), reverse=True)
+        return summaries[:numBuilds]
+
     def getBuildsForRevision(self, request, builder, builderName, lastRevision,
                              numBuilds, debugInfo):
         """Return the list of all the builds for a given builder that we will
@@ -226,30 +227,22 @@ class ConsoleStatusResource(HtmlResource):
         revision = lastRevision 
 
         builds = []
-        build = self.getHeadBuild(builder)
-        number = 0
-        while build and number < numBuilds:
+        for build in self.getBuildSummaries(request, builder, builderName,
+                                            numBuilds):
             debugInfo["builds_scanned"] += 1
-            number += 1
 
             # Get the last revision in this build.
             # We first try "got_revision", but if it does not work, then
             # we try "revision".
-            got_rev = -1
-            try:
-                got_rev = build.getProperty("got_revision")
-                if not self.comparator.isValidRevision(got_rev):
-                    got_rev = -1
-            except KeyError:
-                pass
-
-            try:
-                if got_rev == -1:
-                    got_rev = build.getProperty("revision")
-                if not self.comparator.isValidRevision(got_rev):
+            got_rev = build.got_revision
+            if got_rev is None or not self.comparator.isValidRevision(got_rev):
+                got_rev = -1
+
+            if got_rev == -1:
+                got_rev = build.revision
+                if got_rev is None or \
+                        not self.comparator.isValidRevision(got_rev):
                     got_rev = -1
-            except:
-                pass
 
             # We ignore all builds that don't have last revisions.
             # TODO(nsylvain): If the build is over, maybe it was a problem
@@ -267,8 +260,6 @@ class ConsoleStatusResource(HtmlResource):
                     devBuild, current_revision):
                     break
 
-            build = build.getPreviousBuild()
-
         return builds
 
     def getChangeForBuild(self, build, revision):
@@ -15,11 +15,13 @@
 
 from __future__ import generators
 
-from buildbot.status.web.base import HtmlResource
-from buildbot.status.web.base import build_get_class, path_to_builder, path_to_build
-from buildbot.sourcestamp import SourceStamp
+import urllib
 
-class ANYBRANCH: pass # a flag value, used below
+from buildbot.status import builder as builderstatus
+from buildbot.status.web.base import HtmlResource
+from buildbot.status.web.base import path_to_root, path_to_builder
+from buildbot.status.web.buildindex import ANYBRANCH, BuildSummary
+from buildbot.status.web import buildindex
 
 class GridStatusMixin(object):
     def getTitle(self, request):
@@ -42,10 +44,12 @@ class GridStatusMixin(object):
         return None
 
     def build_cxt(self, request, build):
+        """Build the template context for one cell, given a L{BuildSummary}
+        from the build index (or for a build in progress)."""
         if not build:
             return {}
 
-        if build.isFinished():
+        if build.isFinished:
             # get the text and annotate the first line with a link
             text = build.getText()
             if not text: text = [ "(no information)" ]
@@ -53,13 +57,18 @@ class GridStatusMixin(object):
         else:
             text = [ 'building' ]
 
-        name = build.getBuilder().getName()
+        name = build.builderName
 
         cxt = {}
         cxt['name'] = name
-        cxt['url'] = path_to_build(request, build)
+        cxt['url'] = (path_to_root(request) +
+                      "builders/%s/builds/%d" % (urllib.quote(name, safe=''),
+                                                 build.getNumber()))
         cxt['text'] = text
-        cxt['class'] = build_get_class(build)
+        if build.getResults() is None:
+            cxt['class'] = "running"
+        else:
+            cxt['class'] = builderstatus.Results[build.getResults()]
         return cxt
 
     def builder_cxt(self, request, builder):
@@ -91,65 +100,80 @@ class GridStatusMixin(object):
         return cxt
 
     def getSourceStampKey(self, ss):
-        """Given two source stamps, we want to assign them to the same row if
-        they are the same version of code, even if they differ in minor detail.
-
-        This function returns an appropriate comparison key for that.
-        """
-        return (ss.branch, ss.revision, ss.patch)
-
-    def getRecentBuilds(self, builder, numBuilds, branch):
-        """
-        get a list of most recent builds on given builder
-        """
-        build = builder.getBuild(-1)
-        num = 0
-        while build and num < numBuilds:
-            start = build.getTimes()[0]
-            ss = build.getSourceStamp(absolute=True)
-
-            okay_build = True
-
-            # skip un-started builds
-            if not start:
-                okay_build = False
-
-            # skip non-matching branches
-            if branch != ANYBRANCH and ss.branch != branch:
-                okay_build = False
-
-            if okay_build:
-                num += 1
-                yield build
-
-            build = build.getPreviousBuild()
-        return
-
-    def getRecentSourcestamps(self, status, numBuilds, categories, branch):
-        """
-        get a list of the most recent NUMBUILDS SourceStamp tuples, sorted
-        by the earliest start we've seen for them
-        """
-        # TODO: use baseweb's getLastNBuilds?
-        sourcestamps = { } # { ss-tuple : earliest time }
-        for bn in status.getBuilderNames():
+        return buildindex.getSourceStampKey(ss)
+
+    def get_page_args(self, request, widthArg):
+        """Return (offset, width) for the requested page of sourcestamps"""
+        try:
+            width = int(request.args.get(widthArg, [5])[0])
+            offset = int(request.args.get("offset", [0])[0])
+        except ValueError:
+            width, offset = 5, 0
+        return max(offset, 0), max(width, 1)
+
+    def page_link(self, request, offset):
+        args = dict(request.args)
+        args['offset'] = [str(offset)]
+        return "?" + urllib.urlencode(sorted(args.items()), doseq=True)
+
+    def get_builders(self, status, categories):
+        """Return the status of the builders to show, sorted by name"""
+        builders = []
+        for bn in sorted(status.getBuilderNames()):
             builder = status.getBuilder(bn)
             if categories and builder.category not in categories:
                 continue
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
-                ss = build.getSourceStamp(absolute=True)
-                key= self.getSourceStampKey(ss)
-                start = build.getTimes()[0]
-                if key not in sourcestamps or sourcestamps[key][1] > start:
-                    sourcestamps[key] = (ss, start)
+            builders.append(builder)
+        return builders
 
-        # now sort those and take the NUMBUILDS most recent
-        sourcestamps = sourcestamps.values()
-        sourcestamps.sort(lambda x, y: cmp(x[1], y[1]))
-        sourcestamps = map(lambda tup : tup[0], sourcestamps)
-        sourcestamps = sourcestamps[-numBuilds:]
+    def getRecentSourcestamps(self, request, builders, offset, width, branch):
+        """
+        Get the page of C{width} sourcestamps that comes C{offset} stamps
+        before the most recent one, oldest first, sorted by the earliest start
+        we've seen for them.  Each is returned as a tuple (ss, builds), where
+        builds maps builder names to the newest build of that sourcestamp.
 
-        return sourcestamps
+        Finished builds come from the build index; builds in progress are
+        merged in on the fly.
+        """
+        buildIndex = request.site.buildbot_service.buildIndex
+        stamps = {} # key : [ ss, earliest start, builds ]
+        for e in buildIndex.getSourceStamps(builders, branch, offset + width):
+            stamps[e.key] = [ e.sourceStamp, e.start, dict(e.builds) ]
+
+        for builder in builders:
+            bn = builder.getName()
+            for build in builder.getCurrentBuilds():
+                summary = BuildSummary(bn, build)
+                # skip un-started builds
+                if not summary.when:
+                    continue
+                # skip non-matching branches
+                ss = summary.sourceStamp
+                if branch != ANYBRANCH and ss.branch != branch:
+                    continue
+                key = self.getSourceStampKey(ss)
+                st = stamps.setdefault(key, [ ss, summary.when, {} ])
+                st[1] = min(st[1], summary.when)
+                if bn not in st[2] or st[2][bn].number < summary.number:
+                    st[2][bn] = summary
+
+        # now sort those and take the requested page
+        stamps = stamps.values()
+        stamps.sort(key=lambda st : st[1])
+        if offset:
+            stamps = stamps[:-offset]
+        stamps = stamps[-width:]
+
+        return [ (e[0], e[2]) for e in stamps ]
+
+    def page_cxt(self, request, offset, width, numStamps):
+        cxt = { 'offset': offset, 'width': width }
+        if numStamps == width:
+            cxt['older_url'] = self.page_link(request, offset + width)
+        if offset:
+            cxt['newer_url'] = self.page_link(request, max(offset - width, 0))
+        return cxt
 
 class GridStatusResource(HtmlResource, GridStatusMixin):
     # TODO: docs
@@ -162,46 +186,33 @@ class GridStatusResource(HtmlResource, GridStatusMixin):
         """
 
         # get url parameters
-        numBuilds = int(request.args.get("width", [5])[0])
+        offset, width = self.get_page_args(request, "width")
         categories = request.args.get("category", [])
         branch = request.args.get("branch", [ANYBRANCH])[0]
         if branch == 'trunk': branch = None
 
         # and the data we want to render
         status = self.getStatus(request)
-        stamps = self.getRecentSourcestamps(status, numBuilds, categories, branch)
+        builders = self.get_builders(status, categories)
+        stamps = self.getRecentSourcestamps(request, builders, offset, width,
+                                            branch)
 
         cxt['refresh'] = self.get_reload_time(request)
 
         cxt.update({'categories': categories,
                     'branch': branch,
                     'ANYBRANCH': ANYBRANCH,
-                    'stamps': map(SourceStamp.asDict, stamps)
+                    'stamps': [ ss.asDict() for ss, builds in stamps ],
                    })
-        
-        sortedBuilderNames = status.getBuilderNames()[:]
-        sortedBuilderNames.sort()
-        
-        cxt['builders'] = []
-
-        for bn in sortedBuilderNames:
-            builds = [None] * len(stamps)
+        cxt.update(self.page_cxt(request, offset, width, len(stamps)))
 
-            builder = status.getBuilder(bn)
-            if categories and builder.category not in categories:
-                continue
-
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
-                ss = build.getSourceStamp(absolute=True)
-                key= self.getSourceStampKey(ss)
-                for i in range(len(stamps)):
-                    if key == self.getSourceStampKey(stamps[i]) and builds[i] is None:
-                        builds[i] = build
+        cxt['builders'] = []
 
+        for builder in builders:
+            bn = builder.getName()
             b = self.builder_cxt(request, builder)
-            b['builds'] = []
-            for build in builds:
-                b['builds'].append(self.build_cxt(request, build))
+            b['builds'] = [ self.build_cxt(request, builds.get(bn))
+                            for ss, builds in stamps ]
             cxt['builders'].append(b)
 
         template = request.site.buildbot_service.templates.get_template("grid.html")
@@ -220,7 +231,10 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
         """
 
         # get url parameters
-        numBuilds = int(request.args.get("length", [5])[0])
+        if "width" in request.args:
+            offset, width = self.get_page_args(request, "width")
+        else:
+            offset, width = self.get_page_args(request, "length")
         categories = request.args.get("category", [])
         branch = request.args.get("branch", [ANYBRANCH])[0]
         if branch == 'trunk': branch = None
@@ -233,40 +247,28 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
 
         # and the data we want to render
         status = self.getStatus(request)
-        stamps = self.getRecentSourcestamps(status, numBuilds, categories, branch)
+        builders = self.get_builders(status, categories)
+        stamps = self.getRecentSourcestamps(request, builders, offset, width,
+                                            branch)
 
         cxt.update({'categories': categories,
                     'branch': branch,
                     'ANYBRANCH': ANYBRANCH,
-                    'stamps': map(SourceStamp.asDict, stamps),
+                    'stamps': [ ss.asDict() for ss, builds in stamps ],
                     })
+        cxt.update(self.page_cxt(request, offset, width, len(stamps)))
 
-        sortedBuilderNames = status.getBuilderNames()[:]
-        sortedBuilderNames.sort()
-        
-        cxt['sorted_builder_names'] = sortedBuilderNames
+        cxt['sorted_builder_names'] = sorted(status.getBuilderNames())
         cxt['builder_builds'] = builder_builds = []
-        cxt['builders'] = builders = []
+        cxt['builders'] = [ self.builder_cxt(request, b) for b in builders ]
         cxt['range'] = range(len(stamps))
         if rev_order == "desc":
             cxt['range'].reverse()
         
-        for bn in sortedBuilderNames:
-            builds = [None] * len(stamps)
-
-            builder = status.getBuilder(bn)
-            if categories and builder.category not in categories:
-                continue
-
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
-                ss = build.getSourceStamp(absolute=True)
-                key = self.getSourceStampKey(ss)
-                for i in range(len(stamps)):
-                    if key == self.getSourceStampKey(stamps[i]) and builds[i] is None:
-                        builds[i] = build
-
-            builders.append(self.builder_cxt(request, builder))
-            builder_builds.append(map(lambda b: self.build_cxt(request, b), builds))
+        for builder in builders:
+            bn = builder.getName()
+            builder_builds.append([ self.build_cxt(request, builds.get(bn))
+                                    for ss, builds in stamps ])
 
         template = request.site.buildbot_service.templates.get_template('grid_transposed.html')
         data = template.render(**cxt)
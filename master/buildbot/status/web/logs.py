@@ -14,8 +14,11 @@
 # Copyright Buildbot Team Members
 
 
+import re, zlib
+
 from zope.interface import implements
-from twisted.python import components
+from twisted.internet import defer
+from twisted.python import components, log
 from twisted.spread import pb
 from twisted.web import server
 from twisted.web.resource import Resource
@@ -39,9 +42,7 @@ class ChunkConsumer:
     def writeChunk(self, chunk):
         formatted = self.textlog.content([chunk])
         try:
-            if isinstance(formatted, unicode):
-                formatted = formatted.encode('utf-8')
-            self.original.write(formatted)
+            self.textlog.write(formatted)
         except pb.DeadReferenceError:
             self.producing.stopProducing()
     def finish(self):
@@ -56,6 +57,12 @@ class TextLog(Resource):
 
     asText = False
     subscribed = False
+    compressor = None
+
+    # logfiles kept on the slave are fetched in pieces of this size
+    remoteReadLength = 256*1024
+    # and their tail is looked for in this much of the end of the file
+    remoteTailLength = 256*1024
 
     def __init__(self, original):
         Resource.__init__(self)
@@ -103,19 +110,278 @@ class TextLog(Resource):
         self._setContentType(req)
         self.req = req
 
-        if not self.asText:
+        if self.asText:
+            req.setHeader("accept-ranges", "bytes")
+            # byte ranges are over the uncompressed log, so a partial
+            # response must not be compressed
+            if not req.getHeader("range"):
+                self._setupCompression(req)
+        else:
             self.template = req.site.buildbot_service.templates.get_template("logs.html")                
             
             data = self.template.module.page_header(
                     title = "Log File contents",
                     texturl = req.childLink("text"),
                     path_to_root = path_to_root(req))
-            data = data.encode('utf-8')                   
-            req.write(data)
+            self.write(data)
+
+        remoteFile = self.original.getRemoteFile()
+        if remoteFile and not remoteFile['copied']:
+            self._renderRemote(req, remoteFile)
+            return server.NOT_DONE_YET
+
+        chunks = self._getPartialChunks(req)
+        if chunks is not None:
+            # a part of the log was requested; it is small enough to write
+            # all at once
+            self.write(self.content(chunks))
+            self.finished()
+            return server.NOT_DONE_YET
 
         self.original.subscribeConsumer(ChunkConsumer(req, self))
         return server.NOT_DONE_YET
 
+    def _getChannels(self):
+        if self.asText:
+            return [builder.STDOUT, builder.STDERR]
+        return []
+
+    def _getPartialChunks(self, req):
+        """Handle requests for only a part of the log, using the C{tail},
+        C{offset} and C{length} arguments or (for text) an HTTP Range header.
+        Returns a list of chunks, or None if the whole log is wanted."""
+        channels = self._getChannels()
+        try:
+            if "tail" in req.args:
+                numLines = int(req.args["tail"][0])
+                return self.original.getTailChunks(max(numLines, 0), channels)
+            if "offset" in req.args or "length" in req.args:
+                offset = int(req.args.get("offset", [0])[0])
+                length = int(req.args.get("length", [self.original.length])[0])
+                return self.original.getChunksInRange(max(offset, 0),
+                                                      max(length, 0), channels)
+        except ValueError:
+            return None
+
+        rangeHeader = req.getHeader("range")
+        if rangeHeader and self.asText:
+            return self._getRangeChunks(req, rangeHeader, channels)
+        return None
+
+    def _getRangeChunks(self, req, rangeHeader, channels):
+        # only a single byte range is supported; otherwise, the Range header
+        # is ignored and the whole log is sent, as HTTP allows
+        mo = re.match(r'^bytes=(\d*)-(\d*)$', rangeHeader.strip())
+        if not mo or mo.groups() == ('', ''):
+            return None
+        first, last = mo.groups()
+        # ranges are only served for the text of stdout and stderr
+        total = self.original.nonHeaderLength
+        if first:
+            first = int(first)
+            if last:
+                length = int(last) - first + 1
+            else:
+                length = self.original.length
+            if length <= 0:
+                return None
+            chunks = self.original.getChunksInRange(first, length, channels)
+        else:
+            # a suffix range: the last N bytes
+            suffix = int(last)
+            first = max(total - suffix, 0)
+            chunks = self.original.getChunksInRange(first, suffix, channels)
+
+        size = sum([ len(text) for channel, text in chunks ])
+        if not size:
+            req.setResponseCode(416) # requested range not satisfiable
+            req.setHeader("content-range", "bytes */%d" % total)
+            return []
+        req.setResponseCode(206) # partial content
+        req.setHeader("content-range",
+                      "bytes %d-%d/*" % (first, first + size - 1))
+        return chunks
+
+    def _renderRemote(self, req, remoteFile):
+        """Send the contents of a logfile which was kept on the slave, by
+        reading it from the slave in pieces.  Partial requests are handled as
+        for other logs, but relative to the file on the slave.  Slaves which
+        can hash files are first asked whether the file is still the one the
+        build left, since a later build may have overwritten it."""
+        sb = self._findSlaveBuilder(req, remoteFile)
+        if not sb:
+            self._writeNote("this log is kept on slave %s, which is not "
+                            "connected\n" % remoteFile['slavename'])
+            self.finished()
+            return
+
+        version = sb.getSlaveCommandVersion('readFile')
+        if map(int, version.split(".")) < [2, 22]:
+            self._sendRemote(req, sb, remoteFile)
+            return
+        d = sb.remote.callRemote("hashFile", remoteFile['workdir'],
+                                 remoteFile['filename'])
+        def check(current):
+            if current != { 'size' : remoteFile['size'],
+                            'sha1' : remoteFile['sha1'] }:
+                self._writeNote("this log has been overwritten or removed on "
+                                "slave %s since the build, and is no longer "
+                                "available\n" % remoteFile['slavename'])
+                self.finished()
+                return
+            self._sendRemote(req, sb, remoteFile)
+        def failed(f):
+            log.msg("error checking logfile on slave %s"
+                    % remoteFile['slavename'])
+            log.err(f)
+            self._writeNote("error reading this log from slave %s\n"
+                            % remoteFile['slavename'])
+            self.finished()
+        d.addCallbacks(check, failed)
+        d.addErrback(log.err)
+
+    def _sendRemote(self, req, sb, remoteFile):
+        size = remoteFile['size']
+        numLines = None
+        offset, length = 0, size
+        try:
+            if "tail" in req.args:
+                numLines = max(int(req.args["tail"][0]), 0)
+                offset = max(size - self.remoteTailLength, 0)
+                length = size - offset
+            elif "offset" in req.args or "length" in req.args:
+                offset = max(int(req.args.get("offset", [0])[0]), 0)
+                length = max(int(req.args.get("length", [size])[0]), 0)
+            elif req.getHeader("range") and self.asText:
+                offset, length = self._getRemoteRange(req,
+                                            req.getHeader("range"), size)
+            else:
+                # the whole log: the headers kept on the master come first
+                self.write(self.content(self.original.getChunks(
+                                                    self._getChannels())))
+        except ValueError:
+            pass
+        length = max(min(length, size - offset), 0)
+
+        if numLines is None:
+            write = lambda data: self.write(
+                                    self.content([(builder.STDOUT, data)]))
+        else:
+            tail = []
+            write = tail.append
+        d = self._readRemote(sb, remoteFile, offset, length, write)
+        def wrote(_):
+            if numLines is not None:
+                lines = ''.join(tail).splitlines(True)
+                if offset > 0:
+                    lines = lines[1:] # probably a partial line
+                data = ''
+                if numLines:
+                    data = ''.join(lines[-numLines:])
+                self.write(self.content([(builder.STDOUT, data)]))
+        def failed(f):
+            log.msg("error reading logfile from slave %s"
+                    % remoteFile['slavename'])
+            log.err(f)
+            self._writeNote("error reading this log from slave %s\n"
+                            % remoteFile['slavename'])
+        d.addCallbacks(wrote, failed)
+        d.addCallback(lambda _ : self.finished())
+        d.addErrback(log.err)
+
+    def _getRemoteRange(self, req, rangeHeader, size):
+        # like _getRangeChunks, for a file of known size
+        mo = re.match(r'^bytes=(\d*)-(\d*)$', rangeHeader.strip())
+        if not mo or mo.groups() == ('', ''):
+            return 0, size
+        first, last = mo.groups()
+        if first:
+            first = int(first)
+            if last:
+                last = min(int(last), size - 1)
+            else:
+                last = size - 1
+        else:
+            first = max(size - int(last), 0)
+            last = size - 1
+        if first > last:
+            req.setResponseCode(416) # requested range not satisfiable
+            req.setHeader("content-range", "bytes */%d" % size)
+            return 0, 0
+        req.setResponseCode(206) # partial content
+        req.setHeader("content-range", "bytes %d-%d/%d" % (first, last, size))
+        return first, last - first + 1
+
+    def _findSlaveBuilder(self, req, remoteFile):
+        # find the connected SlaveBuilder for the slave which kept the file
+        try:
+            status = req.site.buildbot_service.getStatus()
+            builderName = self.original.getStep().getBuild().getBuilder().getName()
+            bldr = status.botmaster.builders[builderName]
+        except (AttributeError, KeyError):
+            return None
+        for sb in bldr.slaves:
+            if (sb.slave and sb.slave.slavename == remoteFile['slavename']
+                    and sb.remote and sb.getSlaveCommandVersion('readFile')):
+                return sb
+        return None
+
+    def _readRemote(self, sb, remoteFile, offset, length, write):
+        # read the range in pieces, writing each as it arrives; fires when
+        # all of it has been written or the file turns out to be shorter
+        d = defer.Deferred()
+        def readNext(_=None):
+            remaining = offset + length - state['offset']
+            if remaining <= 0 or not self.req:
+                d.callback(None)
+                return
+            rd = sb.remote.callRemote("readFile", remoteFile['workdir'],
+                                      remoteFile['filename'], state['offset'],
+                                      min(remaining, self.remoteReadLength))
+            rd.addCallback(gotData)
+            rd.addErrback(d.errback)
+        def gotData(data):
+            if not data:
+                d.callback(None)
+                return
+            state['offset'] += len(data)
+            write(data)
+            readNext()
+        state = { 'offset' : offset }
+        readNext()
+        return d
+
+    def _writeNote(self, text):
+        if self.asText:
+            self.write(text)
+        else:
+            self.write(self.content([(builder.HEADER, text)]))
+
+    def _setupCompression(self, req):
+        # compress text logs on the way out, if the client is willing.  For
+        # logs still in progress, flush after every write so the client sees
+        # output as it arrives.
+        self.compressor = None
+        accept = req.getHeader("accept-encoding") or ''
+        if 'gzip' not in [ e.split(';')[0].strip() for e in accept.split(',') ]:
+            return
+        req.setHeader("content-encoding", "gzip")
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+        if self.original.isFinished():
+            self.flushMode = zlib.Z_NO_FLUSH
+        else:
+            self.flushMode = zlib.Z_SYNC_FLUSH
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self.compressor:
+            data = self.compressor.compress(data)
+            data += self.compressor.flush(self.flushMode)
+        if data:
+            self.req.write(data)
+
     def _setContentType(self, req):
         if self.asText:
             req.setHeader("content-type", "text/plain; charset=utf-8")
@@ -128,8 +394,9 @@ class TextLog(Resource):
         try:
             if not self.asText:
                 data = self.template.module.page_footer()
-                data = data.encode('utf-8')
-                self.req.write(data)
+                self.write(data)
+            if self.compressor:
+                self.req.write(self.compressor.flush(zlib.Z_FINISH))
             self.req.finish()
         except pb.DeadReferenceError:
             pass
@@ -139,6 +406,7 @@ class TextLog(Resource):
         
         # release template
         self.template = None
+        self.compressor = None
 
 components.registerAdapter(TextLog, interfaces.IStatusLog, IHTMLLog)
 
@@ -165,9 +433,9 @@ class LogsResource(HtmlResource):
         self.step_status = step_status
 
     def getChild(self, path, req):
-        for log in self.step_status.getLogs():
-            if path == log.getName():
-                if log.hasContents():
-                    return IHTMLLog(interfaces.IStatusLog(log))
+        for loog in self.step_status.getLogs():
+            if path == loog.getName():
+                if loog.hasContents():
+                    return IHTMLLog(interfaces.IStatusLog(loog))
                 return NoResource("Empty Log '%s'" % path)
         return HtmlResource.getChild(self, path, req)
@@ -26,7 +26,7 @@ from buildbot.status import builder
 
 from buildbot.status.web.base import Box, HtmlResource, IBox, ICurrentBox, \
      ITopBox, build_get_class, path_to_build, path_to_step, path_to_root, \
-     map_branches
+     map_branches, getFragment
 
 
 def earlier(old, new):
@@ -145,6 +145,13 @@ class BuildBox(components.Adapter):
     implements(IBox)
 
     def getBox(self, req):
+        b = self.original
+        key = ('buildbox', b.getNumber())
+        text, class_ = getFragment(req, b.getBuilder().getName(), key,
+                                   b.isFinished(), lambda : self.render(req))
+        return Box([text], class_="BuildStep " + class_)
+
+    def render(self, req):
         b = self.original
         number = b.getNumber()
         url = path_to_build(req, b)
@@ -156,13 +163,21 @@ class BuildBox(components.Adapter):
             # the steps have been pruned, so there won't be any indication
             # of whether it succeeded or failed.
             class_ = build_get_class(b)
-        return Box([text], class_="BuildStep " + class_)
+        return text, class_
 components.registerAdapter(BuildBox, builder.BuildStatus, IBox)
 
 class StepBox(components.Adapter):
     implements(IBox)
 
     def getBox(self, req):
+        step = self.original
+        build = step.getBuild()
+        key = ('stepbox', build.getNumber(), step.getName())
+        text, class_ = getFragment(req, build.getBuilder().getName(), key,
+                                   step.isFinished(), lambda : self.render(req))
+        return Box(text, class_=class_)
+
+    def render(self, req):
         urlbase = path_to_step(req, self.original)
         text = self.original.getText()
         if text is None:
@@ -188,7 +203,7 @@ class StepBox(components.Adapter):
         text = template.module.step_box(**cxt)
         
         class_ = "BuildStep " + build_get_class(self.original)
-        return Box(text, class_=class_)
+        return text, class_
 components.registerAdapter(StepBox, builder.BuildStepStatus, IBox)
 
 
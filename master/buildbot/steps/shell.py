@@ -237,6 +237,12 @@ class ShellCommand(LoggingBuildStep):
             if self.slaveVersionIsOlderThan("svn", "2.7"):
                 warnings.append("NOTE: slave does not allow master to override usePTY\n")
 
+        # filtering output on the slave needs a recent slave; older ones send
+        # everything
+        if kwargs.get('logFilter') and self.slaveVersionIsOlderThan("shell", "2.18"):
+            warnings.append("NOTE: slave cannot filter output; sending all of it\n")
+            del kwargs['logFilter']
+
         cmd = RemoteShellCommand(**kwargs)
         self.setupEnvironment(cmd)
         self.checkForOldSlaveAndLogfiles()
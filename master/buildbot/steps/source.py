@@ -39,7 +39,7 @@ class Source(LoggingBuildStep):
     branch = None # the default branch, should be set in __init__
 
     def __init__(self, workdir=None, mode='update', alwaysUseLatest=False,
-                 timeout=20*60, retry=None, **kwargs):
+                 timeout=20*60, retry=None, copyMethod=None, **kwargs):
         """
         @type  workdir: string
         @param workdir: local directory (relative to the Builder's root)
@@ -121,6 +121,15 @@ class Source(LoggingBuildStep):
                       failures that could be handled by simply retrying a
                       couple times.
 
+        @type  copyMethod: string (or None)
+        @param copyMethod: how mode 'copy' copies the source tree: 'reflink'
+                           (copy-on-write clones, on filesystems which
+                           support them), 'rsync' (update the previous
+                           workdir in place), 'hardlink' (only safe when
+                           the build never modifies a source file in
+                           place), 'cp', or 'auto'.  The default lets the
+                           slave pick the fastest which works.
+
         """
 
         LoggingBuildStep.__init__(self, **kwargs)
@@ -129,9 +138,12 @@ class Source(LoggingBuildStep):
                                  alwaysUseLatest=alwaysUseLatest,
                                  timeout=timeout,
                                  retry=retry,
+                                 copyMethod=copyMethod,
                                  )
 
         assert mode in ("update", "copy", "clobber", "export")
+        assert copyMethod in (None, 'auto', 'reflink', 'rsync', 'hardlink',
+                              'cp')
         if retry:
             delay, repeats = retry
             assert isinstance(repeats, int)
@@ -141,6 +153,8 @@ class Source(LoggingBuildStep):
                      'retry': retry,
                      'patch': None, # set during .start
                      }
+        if copyMethod:
+            self.args['copy_method'] = copyMethod
         # This will get added to args later, after properties are rendered
         self.workdir = workdir
 
@@ -254,6 +268,10 @@ class Source(LoggingBuildStep):
             got_revision = cmd.updates["got_revision"][-1]
             if got_revision is not None:
                 self.setProperty("got_revision", str(got_revision), "Source")
+        if cmd.updates.has_key("copy"):
+            copy = cmd.updates["copy"][-1]
+            self.step_status.setStatistic('copy_time', copy['elapsed'])
+            self.step_status.setStatistic('copy_method', copy['method'])
 
 
 
@@ -791,6 +809,7 @@ class Git(Source):
                  reference=None,
                  shallow=False,
                  progress=False,
+                 sparse_paths=None,
                  **kwargs):
         """
         @type  repourl: string
@@ -809,13 +828,22 @@ class Git(Source):
         @param reference: The path to a reference repository to obtain
                           objects from, if any.
 
-        @type  shallow: boolean
-        @param shallow: Use a shallow or clone, if possible
+        @type  shallow: boolean or integer
+        @param shallow: Fetch only the most recent commits: one if True,
+                        or the given number.  If the revision to build is
+                        older, the slave fetches more history until it
+                        finds it.  Needs a 2.20 slave to build a specific
+                        revision or fetch more than one commit.
 
         @type  progress: boolean
         @param progress: Pass the --progress option when fetching. This
                          can solve long fetches getting killed due to
                          lack of output, but requires Git 1.7.2+.
+
+        @type  sparse_paths: list of strings
+        @param sparse_paths: Check out only these paths, written in the
+                             form of .git/info/sparse-checkout (so 'doc/'
+                             is the doc directory).  Needs a 2.20 slave.
         """
         Source.__init__(self, **kwargs)
         self.repourl = repourl
@@ -826,6 +854,7 @@ class Git(Source):
                                  reference=reference,
                                  shallow=shallow,
                                  progress=progress,
+                                 sparse_paths=sparse_paths,
                                  )
         self.args.update({'branch': branch,
                           'submodules': submodules,
@@ -833,6 +862,7 @@ class Git(Source):
                           'reference': reference,
                           'shallow': shallow,
                           'progress': progress,
+                          'sparse_paths': sparse_paths,
                           })
 
     def computeSourceRevision(self, changes):
@@ -868,9 +898,35 @@ class Git(Source):
         if not slavever:
             raise BuildSlaveTooOldError("slave is too old, does not know "
                                         "about git")
+        shallow = self.args['shallow']
+        if self.slaveVersionIsOlderThan("git", "2.20"):
+            if self.args['sparse_paths'] is not None:
+                m = ("This buildslave (%s) does not support sparse git "
+                     "checkouts.  Refusing to build. Please upgrade the "
+                     "buildslave." % (self.build.slavename,))
+                raise BuildSlaveTooOldError(m)
+            if shallow not in (False, None, True):
+                m = ("This buildslave (%s) does not support a shallow git "
+                     "depth.  Refusing to build. Please upgrade the "
+                     "buildslave." % (self.build.slavename,))
+                raise BuildSlaveTooOldError(m)
+            del self.args['sparse_paths']
         cmd = LoggedRemoteCommand("git", self.args)
         self.startCommand(cmd)
 
+    def commandComplete(self, cmd):
+        Source.commandComplete(self, cmd)
+        if cmd.updates.has_key("fetch"):
+            # how long fetching took, and how much history it needed, so
+            # that shallow and full fetches can be compared
+            fetch = cmd.updates["fetch"][-1]
+            ss = self.step_status
+            ss.setStatistic('git_fetch_time', fetch['elapsed'])
+            ss.setStatistic('git_fetch_count', fetch['fetches'])
+            if fetch['depth'] is not None:
+                ss.setStatistic('git_fetch_depth', fetch['depth'])
+                ss.setStatistic('git_fetch_deepened', fetch['deepened'])
+
 
 class Repo(Source):
     """Check out a source tree from a repo repository described by manifest."""
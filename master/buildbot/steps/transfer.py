@@ -14,22 +14,61 @@
 # Copyright Buildbot Team Members
 
 
-import os.path, tarfile, tempfile
+import os.path, glob, re, shutil, tarfile, tempfile, threading, time
 try:
     from cStringIO import StringIO
     assert StringIO
 except ImportError:
     from StringIO import StringIO
-from twisted.internet import reactor
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from twisted.internet import reactor, defer, threads
 from twisted.spread import pb
-from twisted.python import log
+from twisted.python import log, failure
 from buildbot.process.buildstep import RemoteCommand, BuildStep
 from buildbot.process.buildstep import SUCCESS, FAILURE, SKIPPED
 from buildbot.interfaces import BuildSlaveTooOldError
 from buildbot.util import json
+from buildbot import util
 
 
-class _FileWriter(pb.Referenceable):
+class _TransferStats:
+    """
+    Mixin for the master-side transfer helpers, keeping track of the number
+    of bytes transferred and how long that took
+    """
+
+    bytes = 0
+    started = None
+    ended = None
+
+    def _count(self, nbytes):
+        if self.started is None:
+            self.started = util.now()
+        self.bytes += nbytes
+        self.ended = util.now()
+
+    def getThroughput(self):
+        """Return the average number of bytes per second, or None if nothing
+        was transferred"""
+        if self.started is None:
+            return None
+        elapsed = self.ended - self.started
+        if elapsed <= 0:
+            return None
+        return self.bytes / elapsed
+
+def _formatRate(rate):
+    for unit in ('B', 'kB', 'MB'):
+        if rate < 1024:
+            return "%.1f %s/s" % (rate, unit)
+        rate /= 1024.0
+    return "%.1f GB/s" % rate
+
+
+class _FileWriter(pb.Referenceable, _TransferStats):
     """
     Helper class that acts as a file-object with write access
     """
@@ -55,6 +94,7 @@ class _FileWriter(pb.Referenceable):
         @type  data: C{string}
         @param data: String of data to write
         """
+        self._count(len(data))
         if self.remaining is not None:
             if len(data) > self.remaining:
                 data = data[:self.remaining]
@@ -123,45 +163,526 @@ def _extractall(self, path=".", members=None):
             else:
                 self._dbg(1, "tarfile: %s" % e)
 
-class _DirectoryWriter(_FileWriter):
+class _ExtractAborted(Exception):
+    pass
+
+class _DirectoryWriter(pb.Referenceable, _TransferStats):
     """
-    A DirectoryWriter is implemented as a FileWriter, with an added post-processing
-    step to unpack the archive, once the transfer has completed.
+    Helper class that unpacks a tar archive into a directory as it is being
+    written, in a thread, rather than saving the archive to a temporary file
+    and unpacking it at the end.  When more than C{maxBuffered} bytes are
+    waiting for the thread, writes are not acknowledged until it catches up.
     """
 
+    maxBuffered = 1024*1024
+
     def __init__(self, destroot, maxsize, compress, mode):
         self.destroot = destroot
+        self.remaining = maxsize
         self.compress = compress
+        self.mode = mode # unused: files keep the mode they have in the archive
 
-        self.fd, self.tarname = tempfile.mkstemp()
-        os.close(self.fd)
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.buffered = 0
+        self.eof = False
+        self.aborted = False
+        self.waiting = [] # Deferreds for writes waiting on the buffer
+        self.extracted = defer.Deferred()
+        self.started = False
+        self.done = False
 
-        _FileWriter.__init__(self, self.tarname, maxsize, mode)
+    def _startExtracting(self):
+        self.started = True
+        reactor.callInThread(self._extract)
+
+    # the reactor thread
+
+    def remote_write(self, data):
+        """
+        Called from remote slave to write L{data} to the archive, within
+        boundaries of L{maxsize}
+
+        @type  data: C{string}
+        @param data: String of data to write
+        """
+        self._count(len(data))
+        if self.done:
+            return # the extraction failed, or the archive has ended
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        if not self.started:
+            self._startExtracting()
+
+        self.cond.acquire()
+        try:
+            self.chunks.append(data)
+            self.buffered += len(data)
+            self.cond.notify()
+            if self.buffered > self.maxBuffered:
+                d = defer.Deferred()
+                self.waiting.append(d)
+                return d
+        finally:
+            self.cond.release()
+
+    def _drained(self):
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
 
     def remote_unpack(self):
         """
-        Called by remote slave to state that no more data will be transfered
+        Called by remote slave to state that no more data will be transfered.
+        The result fires when the archive has been unpacked.
         """
-        # Make sure remote_close is called, otherwise atomic rename wont happen
-        self.remote_close()
+        if not self.started:
+            self._startExtracting()
+        self.cond.acquire()
+        try:
+            self.eof = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return self.extracted
+
+    def remote_close(self):
+        # slaves call unpack instead, but just in case
+        return self.remote_unpack()
+
+    def _finished(self, result):
+        self.done = True
+        self._drained()
+        self.extracted.callback(result)
+
+    def _failed(self, why):
+        self.done = True
+        self._drained()
+        self.extracted.errback(why)
+
+    # the extracting thread
 
+    def read(self, size):
+        self.cond.acquire()
+        try:
+            while not self.chunks and not self.eof and not self.aborted:
+                self.cond.wait()
+            if self.aborted:
+                raise _ExtractAborted()
+            if not self.chunks:
+                return ''
+            data = self.chunks.pop(0)
+            if len(data) > size:
+                self.chunks.insert(0, data[size:])
+                data = data[:size]
+            self.buffered -= len(data)
+            if self.waiting and self.buffered <= self.maxBuffered / 2:
+                reactor.callFromThread(self._drained)
+            return data
+        finally:
+            self.cond.release()
+
+    def _extract(self):
         # Map configured compression to a TarFile setting
         if self.compress == 'bz2':
             mode='r|bz2'
         elif self.compress == 'gz':
             mode='r|gz'
         else:
-            mode = 'r'
+            mode = 'r|'
 
         # Support old python
         if not hasattr(tarfile.TarFile, 'extractall'):
             tarfile.TarFile.extractall = _extractall
 
-        # Unpack archive and clean up after self
-        archive = tarfile.open(name=self.tarname, mode=mode)
-        archive.extractall(path=self.destroot)
-        archive.close()
-        os.remove(self.tarname)
+        try:
+            archive = tarfile.open(mode=mode, fileobj=self)
+            archive.extractall(path=self.destroot)
+            archive.close()
+            # drain anything after the end of the archive, so the writer does
+            # not wait forever
+            while self.read(16*1024):
+                pass
+        except _ExtractAborted:
+            return
+        except:
+            reactor.callFromThread(self._failed, failure.Failure())
+        else:
+            reactor.callFromThread(self._finished, None)
+
+    def abort(self):
+        """
+        Stop the extracting thread, if the slave went away before unpacking
+        """
+        self.cond.acquire()
+        try:
+            self.aborted = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+
+class ContentStore:
+    """
+    A directory of file contents, named by their SHA-1, from which uploads
+    are assembled by hard-linking.  Contents are stored read-only; a copy
+    with another read-only mode is made (once) when a file is wanted with
+    that mode.  Files wanted with a writable mode are copied rather than
+    linked, so that modifying them in place cannot change the store.
+
+    The same store can be shared by any number of steps and builders, as
+    long as it is on the same filesystem as their C{masterdest}s;
+    otherwise, files are copied out of the store rather than linked.
+
+    With C{maxSize} (in bytes) or C{maxAge} (in seconds), the store is
+    pruned after each upload, at most once every C{pruneInterval} seconds:
+    contents not used for C{maxAge} are removed, and then the least recently
+    used ones until the store is no bigger than C{maxSize}.  Uploaded files
+    keep their content, since they are links to (or copies of) the store's.
+    """
+
+    def __init__(self, basedir, maxSize=None, maxAge=None, pruneInterval=600):
+        self.basedir = os.path.abspath(os.path.expanduser(basedir))
+        self.tmpdir = os.path.join(self.basedir, 'tmp')
+        if not os.path.isdir(self.tmpdir):
+            os.makedirs(self.tmpdir)
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.pruneInterval = pruneInterval
+        self.lastPrune = None
+        self.pruneLock = threading.Lock()
+
+    def getPath(self, digest, mode=None):
+        path = os.path.join(self.basedir, digest[:2], digest[2:])
+        if mode is not None:
+            path = '%s-%04o' % (path, mode)
+        return path
+
+    def has(self, digest):
+        return os.path.exists(self.getPath(digest))
+
+    def use(self, digest):
+        """Mark the content with the given hash as used now, so it is pruned
+        last; returns False if the store does not hold it"""
+        # the main copy is never linked out of the store, so its mtime is
+        # free to record when it was last used
+        try:
+            os.utime(self.getPath(digest), None)
+        except OSError:
+            return False
+        return True
+
+    def newFile(self):
+        """Return a (file object, name) pair for a temporary file, to be
+        added with L{add} once it is complete"""
+        fd, tmpname = tempfile.mkstemp(dir=self.tmpdir)
+        return os.fdopen(fd, 'wb'), tmpname
+
+    def add(self, tmpname, digest):
+        path = self.getPath(digest)
+        if os.path.exists(path):
+            os.unlink(tmpname) # another upload got here first
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        os.chmod(tmpname, 0444)
+        os.rename(tmpname, path)
+
+    def link(self, digest, mode, dest):
+        """Make C{dest} a file with the given content and mode"""
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        if mode & 0222:
+            self._copy(self.getPath(digest), mode, dest)
+            return
+        src = self.getPath(digest, mode)
+        if not os.path.exists(src):
+            fd, tmpname = tempfile.mkstemp(dir=self.tmpdir)
+            os.close(fd)
+            self._copy(self.getPath(digest), mode, tmpname)
+            os.rename(tmpname, src)
+        try:
+            os.link(src, dest)
+        except (OSError, AttributeError):
+            # another filesystem, or no hard links at all
+            self._copy(src, mode, dest)
+
+    def _copy(self, src, mode, dest):
+        shutil.copyfile(src, dest)
+        os.chmod(dest, mode)
+
+    def maybePrune(self):
+        """Prune the store if it has limits and was not pruned recently, and
+        no other thread is pruning it already"""
+        if self.maxSize is None and self.maxAge is None:
+            return
+        now = time.time()
+        if self.lastPrune is not None and \
+                now - self.lastPrune < self.pruneInterval:
+            return
+        if not self.pruneLock.acquire(False):
+            return
+        try:
+            self.lastPrune = now
+            self.prune(now)
+        finally:
+            self.pruneLock.release()
+
+    def prune(self, now=None):
+        """Remove contents older than C{maxAge}, then the least recently
+        used ones until the store fits in C{maxSize}"""
+        if now is None:
+            now = time.time()
+        # digest -> [ last use, total size, paths ]
+        contents = {}
+        for prefix in os.listdir(self.basedir):
+            dirname = os.path.join(self.basedir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(dirname):
+                continue
+            for name in os.listdir(dirname):
+                path = os.path.join(dirname, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # pruned by someone else
+                digest = prefix + name.split('-')[0]
+                entry = contents.setdefault(digest, [ 0, 0, [] ])
+                if '-' not in name:
+                    entry[0] = st.st_mtime
+                entry[1] += st.st_size
+                entry[2].append(path)
+
+        total = sum([ c[1] for c in contents.values() ])
+        byAge = contents.values()
+        byAge.sort()
+        for lastUse, size, paths in byAge:
+            expired = self.maxAge is not None and now - lastUse > self.maxAge
+            tooBig = self.maxSize is not None and total > self.maxSize
+            if not expired and not tooBig:
+                break
+            # the main copy goes first, so the content is not found in the
+            # store any more while its other modes are removed
+            paths.sort(key=len)
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+class _ContentWriter(pb.Referenceable, _TransferStats):
+    """
+    Helper class that receives a manifest of the files to upload, asks for
+    the contents that are not in the L{ContentStore} yet, and finally links
+    the result into place.  See
+    L{buildslave.commands.transfer.SlaveContentUploadCommand} for the
+    slave's side of the protocol.
+    """
+
+    _digest_re = re.compile(r'^[0-9a-f]{40}$')
+
+    def __init__(self, dest, store, maxsize, mode):
+        self.dest = os.path.abspath(dest)
+        self.store = store
+        self.remaining = maxsize
+        self.mode = mode
+
+        self.entries = []
+        self.requested = set()
+        self.symlinks = set() # paths of symlinks in the manifest
+        self.parents = set() # paths with entries under them
+        self.fp = None
+        self.tmpname = None
+        self.digest = None
+        self.hash = None
+        self.filesSent = 0
+        self.filesDeduplicated = 0
+        self.bytesDeduplicated = 0
+
+    def _checkPath(self, relpath):
+        # the slave does not get to write outside of dest
+        if not relpath:
+            return self.dest
+        parts = relpath.split('/')
+        if relpath.startswith('/') or '..' in parts or '\\' in relpath:
+            raise ValueError("invalid path %r in manifest" % (relpath,))
+        return os.path.join(self.dest, *parts)
+
+    def _checkParents(self, entry):
+        # nothing may be written through a symlink from the manifest, or a
+        # link to, say, /etc followed by a file under it would write there
+        relpath = entry[1]
+        parts = relpath.split('/')
+        for i in range(1, len(parts)):
+            if '/'.join(parts[:i]) in self.symlinks:
+                raise ValueError("path %r in manifest is under a symlink"
+                                 % (relpath,))
+        if entry[0] == 'l':
+            if not relpath or relpath in self.parents:
+                raise ValueError("invalid symlink %r in manifest"
+                                 % (relpath,))
+            self.symlinks.add(relpath)
+        for i in range(1, len(parts)):
+            self.parents.add('/'.join(parts[:i]))
+
+    def _checkRealPath(self, path):
+        # and, in case dest already holds symlinks (say, from an earlier
+        # upload), nothing is written anywhere they lead outside of it
+        root = os.path.realpath(self.dest)
+        real = os.path.realpath(path)
+        if real != root and not real.startswith(root + os.sep):
+            raise ValueError("%s is outside of %s" % (path, self.dest))
+
+    def remote_manifest(self, entries):
+        """
+        Called from remote slave with a batch of manifest entries.  Returns
+        the hashes of the contents that should be sent.
+        """
+        needed = []
+        for entry in entries:
+            self._checkPath(entry[1])
+            self._checkParents(entry)
+            if entry[0] == 'f':
+                digest = entry[2]
+                if not self._digest_re.match(digest):
+                    raise ValueError("invalid hash %r in manifest" % (digest,))
+                if digest in self.requested or self.store.use(digest):
+                    self.filesDeduplicated += 1
+                    self.bytesDeduplicated += entry[3]
+                else:
+                    self.requested.add(digest)
+                    needed.append(digest)
+            elif entry[0] not in ('d', 'l'):
+                raise ValueError("invalid manifest entry %r" % (entry,))
+            self.entries.append(entry)
+        return needed
+
+    def remote_open(self, digest):
+        """
+        Called from remote slave before sending the content with the given
+        hash
+        """
+        if digest not in self.requested:
+            raise ValueError("content %r was not requested" % (digest,))
+        self.fp, self.tmpname = self.store.newFile()
+        self.digest = digest
+        self.hash = sha1()
+
+    def remote_write(self, data):
+        """
+        Called from remote slave to write L{data} to the current file,
+        within boundaries of L{maxsize}
+        """
+        self._count(len(data))
+        if self.fp is None:
+            return
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        self.fp.write(data)
+        self.hash.update(data)
+
+    def remote_finish(self):
+        """
+        Called from remote slave at the end of the current file; adds it to
+        the store if its content matches its hash
+        """
+        self.fp.close()
+        self.fp = None
+        tmpname, self.tmpname = self.tmpname, None
+        if self.hash.hexdigest() != self.digest:
+            os.unlink(tmpname)
+            raise ValueError("content %s was truncated or changed during "
+                             "the upload" % self.digest)
+        self.store.add(tmpname, self.digest)
+        self.filesSent += 1
+
+    def remote_close(self):
+        """
+        Called by remote slave once all of the contents have been sent.
+        Assembles the result in a thread.
+        """
+        return threads.deferToThread(self._assemble)
+
+    def _assemble(self):
+        directories = []
+        symlinks = []
+        for entry in self.entries:
+            path = self._checkPath(entry[1])
+            if entry[0] == 'd':
+                self._checkRealPath(path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, entry[2]))
+                continue
+            dirname = os.path.dirname(path)
+            if path != self.dest:
+                self._checkRealPath(dirname)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            if entry[0] == 'l':
+                symlinks.append((path, entry[2]))
+            else:
+                mode = self.mode
+                if mode is None:
+                    mode = entry[4]
+                self.store.link(entry[2], mode, path)
+        # symlinks are made once everything else is in place, so nothing is
+        # ever written through one
+        for path, target in symlinks:
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(target, path)
+        # like tar, set directory modes last, in case they are read-only
+        directories.reverse()
+        for path, mode in directories:
+            os.chmod(path, mode)
+        self.store.maybePrune()
+
+    def remote_abort(self):
+        """
+        Called by remote slave when the upload fails
+        """
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        if self.tmpname and os.path.exists(self.tmpname):
+            os.unlink(self.tmpname)
+        self.tmpname = None
+        self.entries = []
+
+    abort = remote_abort
+
+
+def _addWindowArgs(step, command, args):
+    """
+    Add the arguments for a pipelined transfer to C{args}, if the slave's
+    C{command} understands them.  Older slaves transfer one block at a time.
+    """
+    if step.window > 1 and not step.slaveVersionIsOlderThan(command, "2.13"):
+        args['window'] = step.window
+        args['maxblocksize'] = max(step.maxBlocksize, step.blocksize)
+
+def _reportThroughput(step, transfer):
+    """
+    Add the throughput of C{transfer} to C{step}'s statistics and text
+    """
+    step.step_status.setStatistic('bytes_transferred', transfer.bytes)
+    rate = transfer.getThroughput()
+    if rate is not None:
+        step.step_status.setStatistic('throughput', rate)
+        step.step_status.setText(step.transferText + [_formatRate(rate)])
+    if isinstance(transfer, _ContentWriter):
+        step.step_status.setStatistic('files_deduplicated',
+                                      transfer.filesDeduplicated)
+        step.step_status.setStatistic('bytes_deduplicated',
+                                      transfer.bytesDeduplicated)
+        step.step_status.setText(step.step_status.getText() +
+            ['%d files sent, %d reused' % (transfer.filesSent,
+                                           transfer.filesDeduplicated)])
 
 
 class StatusRemoteCommand(RemoteCommand):
@@ -188,6 +709,8 @@ class _TransferBuildStep(BuildStep):
     haltOnFailure = True
     flunkOnFailure = True
 
+    transfer = None
+
     def setDefaultWorkdir(self, workdir):
         if self.workdir is None:
             self.workdir = workdir
@@ -214,6 +737,8 @@ class _TransferBuildStep(BuildStep):
             return BuildStep.finished(self, SKIPPED)
         if self.cmd.stderr != '':
             self.addCompleteLog('stderr', self.cmd.stderr)
+        if self.transfer:
+            _reportThroughput(self, self.transfer)
 
         if self.cmd.rc is None or self.cmd.rc == 0:
             return BuildStep.finished(self, SUCCESS)
@@ -235,6 +760,13 @@ class FileUpload(_TransferBuildStep):
     - ['mode']       file access mode for the resulting master-side file.
                      The default (=None) is to leave it up to the umask of
                      the buildmaster process.
+    - ['window']     number of blocks to keep in flight, default 8
+    - ['maxBlocksize'] the size blocks may grow to as the transfer proceeds,
+                     default 256k
+    - ['contentStore'] a L{ContentStore} on the master, or its directory;
+                     when given, the file is only sent if the store does not
+                     already hold its content, and masterdest is a hard link
+                     into the store if its mode is read-only
 
     """
 
@@ -242,6 +774,7 @@ class FileUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 window=8, maxBlocksize=256*1024, contentStore=None,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
@@ -250,6 +783,9 @@ class FileUpload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 window=window,
+                                 maxBlocksize=maxBlocksize,
+                                 contentStore=contentStore,
                                  )
 
         self.slavesrc = slavesrc
@@ -259,6 +795,9 @@ class FileUpload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.window = window
+        self.maxBlocksize = maxBlocksize
+        self.contentStore = contentStore
 
     def start(self):
         version = self.slaveVersion("uploadFile")
@@ -278,10 +817,21 @@ class FileUpload(_TransferBuildStep):
         log.msg("FileUpload started, from slave %r to master %r"
                 % (source, masterdest))
 
-        self.step_status.setText(['uploading', os.path.basename(source)])
+        self.transferText = ['uploading', os.path.basename(source)]
+        self.step_status.setText(self.transferText)
 
         # we use maxsize to limit the amount of data on both sides
-        fileWriter = _FileWriter(masterdest, self.maxsize, self.mode)
+        command = 'uploadFile'
+        if self.contentStore and self.slaveVersion('uploadContent'):
+            command = 'uploadContent'
+            store = self.contentStore
+            if not isinstance(store, ContentStore):
+                store = ContentStore(store)
+            fileWriter = _ContentWriter(masterdest, store, self.maxsize,
+                                        self.mode)
+        else:
+            fileWriter = _FileWriter(masterdest, self.maxsize, self.mode)
+        self.transfer = fileWriter
 
         # default arguments
         args = {
@@ -291,8 +841,9 @@ class FileUpload(_TransferBuildStep):
             'maxsize': self.maxsize,
             'blocksize': self.blocksize,
             }
+        _addWindowArgs(self, command, args)
 
-        self.cmd = StatusRemoteCommand('uploadFile', args)
+        self.cmd = StatusRemoteCommand(command, args)
         d = self.runCommand(self.cmd)
         d.addCallback(self.finished).addErrback(self.failed)
 
@@ -311,14 +862,25 @@ class DirectoryUpload(BuildStep):
                      whole directory
     - ['blocksize']  maximum size of each block being transfered
     - ['compress']   compression type to use: one of [None, 'gz', 'bz2']
+    - ['window']     number of blocks to keep in flight, default 8
+    - ['maxBlocksize'] the size blocks may grow to as the transfer proceeds,
+                     default 256k
+    - ['contentStore'] a L{ContentStore} on the master, or its directory;
+                     when given, only files whose content the store does not
+                     already hold are sent (uncompressed), and read-only
+                     files in masterdest are hard links into the store
 
     """
 
     name = 'upload'
 
+    transfer = None
+
     def __init__(self, slavesrc, masterdest,
                  workdir="build", maxsize=None, blocksize=16*1024,
-                 compress=None, **buildstep_kwargs):
+                 compress=None, window=8, maxBlocksize=256*1024,
+                 contentStore=None,
+                 **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
                                  masterdest=masterdest,
@@ -326,6 +888,9 @@ class DirectoryUpload(BuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  compress=compress,
+                                 window=window,
+                                 maxBlocksize=maxBlocksize,
+                                 contentStore=contentStore,
                                  )
 
         self.slavesrc = slavesrc
@@ -335,6 +900,9 @@ class DirectoryUpload(BuildStep):
         self.blocksize = blocksize
         assert compress in (None, 'gz', 'bz2')
         self.compress = compress
+        self.window = window
+        self.maxBlocksize = maxBlocksize
+        self.contentStore = contentStore
 
     def start(self):
         version = self.slaveVersion("uploadDirectory")
@@ -354,10 +922,21 @@ class DirectoryUpload(BuildStep):
         log.msg("DirectoryUpload started, from slave %r to master %r"
                 % (source, masterdest))
 
-        self.step_status.setText(['uploading', os.path.basename(source)])
+        self.transferText = ['uploading', os.path.basename(source)]
+        self.step_status.setText(self.transferText)
         
         # we use maxsize to limit the amount of data on both sides
-        dirWriter = _DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
+        if self.contentStore and self.slaveVersion('uploadContent'):
+            command = 'uploadContent'
+            store = self.contentStore
+            if not isinstance(store, ContentStore):
+                store = ContentStore(store)
+            dirWriter = _ContentWriter(masterdest, store, self.maxsize, None)
+        else:
+            command = 'uploadDirectory'
+            dirWriter = _DirectoryWriter(masterdest, self.maxsize,
+                                         self.compress, 0600)
+        self.transfer = dirWriter
 
         # default arguments
         args = {
@@ -366,11 +945,17 @@ class DirectoryUpload(BuildStep):
             'writer': dirWriter,
             'maxsize': self.maxsize,
             'blocksize': self.blocksize,
-            'compress': self.compress
             }
+        if command == 'uploadDirectory':
+            args['compress'] = self.compress
+        _addWindowArgs(self, command, args)
 
-        self.cmd = StatusRemoteCommand('uploadDirectory', args)
+        self.cmd = StatusRemoteCommand(command, args)
         d = self.runCommand(self.cmd)
+        def abort(res):
+            dirWriter.abort() # no-op, unless the slave went away
+            return res
+        d.addBoth(abort)
         d.addCallback(self.finished).addErrback(self.failed)
 
     def finished(self, result):
@@ -381,6 +966,8 @@ class DirectoryUpload(BuildStep):
             return BuildStep.finished(self, SKIPPED)
         if self.cmd.stderr != '':
             self.addCompleteLog('stderr', self.cmd.stderr)
+        if self.transfer:
+            _reportThroughput(self, self.transfer)
 
         if self.cmd.rc is None or self.cmd.rc == 0:
             return BuildStep.finished(self, SUCCESS)
@@ -389,7 +976,7 @@ class DirectoryUpload(BuildStep):
 
 
 
-class _FileReader(pb.Referenceable):
+class _FileReader(pb.Referenceable, _TransferStats):
     """
     Helper class that acts as a file-object with read access
     """
@@ -411,6 +998,7 @@ class _FileReader(pb.Referenceable):
             return ''
 
         data = self.fp.read(maxlength)
+        self._count(len(data))
         return data
 
     def remote_close(self):
@@ -442,12 +1030,16 @@ class FileDownload(_TransferBuildStep):
                    the buildslave account, or 0755 to be world-executable.
                    The default (=None) is to leave it up to the umask of
                    the buildslave process.
+     ['window']    number of blocks to keep in flight, default 8
+     ['maxBlocksize'] the size blocks may grow to as the transfer proceeds,
+                   default 256k
 
     """
     name = 'download'
 
     def __init__(self, mastersrc, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 window=8, maxBlocksize=256*1024,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(mastersrc=mastersrc,
@@ -456,6 +1048,8 @@ class FileDownload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 window=window,
+                                 maxBlocksize=maxBlocksize,
                                  )
 
         self.mastersrc = mastersrc
@@ -465,6 +1059,8 @@ class FileDownload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.window = window
+        self.maxBlocksize = maxBlocksize
 
     def start(self):
         properties = self.build.getProperties()
@@ -481,8 +1077,8 @@ class FileDownload(_TransferBuildStep):
         log.msg("FileDownload started, from master %r to slave %r" %
                 (source, slavedest))
 
-        self.step_status.setText(['downloading', "to",
-                                  os.path.basename(slavedest)])
+        self.transferText = ['downloading', "to", os.path.basename(slavedest)]
+        self.step_status.setText(self.transferText)
 
         # setup structures for reading the file
         try:
@@ -496,6 +1092,7 @@ class FileDownload(_TransferBuildStep):
             reactor.callLater(0, BuildStep.finished, self, FAILURE)
             return
         fileReader = _FileReader(fp)
+        self.transfer = fileReader
 
         # default arguments
         args = {
@@ -506,6 +1103,7 @@ class FileDownload(_TransferBuildStep):
             'workdir': self._getWorkdir(),
             'mode': self.mode,
             }
+        _addWindowArgs(self, 'downloadFile', args)
 
         self.cmd = StatusRemoteCommand('downloadFile', args)
         d = self.runCommand(self.cmd)
@@ -531,11 +1129,15 @@ class StringDownload(_TransferBuildStep):
                    the buildslave account, or 0755 to be world-executable.
                    The default (=None) is to leave it up to the umask of
                    the buildslave process.
+     ['window']    number of blocks to keep in flight, default 8
+     ['maxBlocksize'] the size blocks may grow to as the transfer proceeds,
+                   default 256k
     """
     name = 'string_download'
 
     def __init__(self, s, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 window=8, maxBlocksize=256*1024,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(s=s,
@@ -544,6 +1146,8 @@ class StringDownload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 window=window,
+                                 maxBlocksize=maxBlocksize,
                                  )
 
         self.s = s
@@ -553,6 +1157,8 @@ class StringDownload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.window = window
+        self.maxBlocksize = maxBlocksize
 
     def start(self):
         properties = self.build.getProperties()
@@ -567,12 +1173,13 @@ class StringDownload(_TransferBuildStep):
         slavedest = properties.render(self.slavedest)
         log.msg("StringDownload started, from master to slave %r" % slavedest)
 
-        self.step_status.setText(['downloading', "to",
-                                  os.path.basename(slavedest)])
+        self.transferText = ['downloading', "to", os.path.basename(slavedest)]
+        self.step_status.setText(self.transferText)
 
         # setup structures for reading the file
         fp = StringIO(properties.render(self.s))
         fileReader = _FileReader(fp)
+        self.transfer = fileReader
 
         # default arguments
         args = {
@@ -583,6 +1190,7 @@ class StringDownload(_TransferBuildStep):
             'workdir': self._getWorkdir(),
             'mode': self.mode,
             }
+        _addWindowArgs(self, 'downloadFile', args)
 
         self.cmd = StatusRemoteCommand('downloadFile', args)
         d = self.runCommand(self.cmd)
@@ -628,3 +1236,329 @@ class JSONPropertiesDownload(StringDownload):
                     ),
                 )
         return self.super_class.start(self)
+
+
+class _MultipleTransfer(_TransferStats):
+    """
+    Mixin for the helpers of the multiple-file transfer steps, which hand
+    the slave a writer or reader for each file in turn, and total their
+    statistics
+    """
+
+    def _checkName(self, name):
+        # the slave only gets to name files in the destination directory
+        if (not name or name in ('.', '..') or os.path.basename(name) != name
+                or '/' in name or '\\' in name):
+            raise ValueError("invalid file name %r" % (name,))
+
+    def _addTransfer(self, transfer):
+        self.transfers.append(transfer)
+        return transfer
+
+    def update(self):
+        """Total up the statistics of the transfers so far"""
+        started = [ t.started for t in self.transfers if t.started ]
+        if started:
+            self.started = min(started)
+            self.ended = max([ t.ended for t in self.transfers if t.ended ])
+        self.bytes = sum([ t.bytes for t in self.transfers ])
+
+
+class _MultipleFileWriter(pb.Referenceable, _MultipleTransfer):
+    """
+    Helper class that creates a L{_FileWriter} for each file the slave
+    uploads into C{destdir}
+    """
+
+    def __init__(self, destdir, maxsize, mode):
+        self.destdir = destdir
+        self.maxsize = maxsize
+        self.mode = mode
+        self.transfers = []
+
+    def remote_open(self, name):
+        """
+        Called from remote slave to start uploading the file C{name}
+        """
+        self._checkName(name)
+        return self._addTransfer(_FileWriter(os.path.join(self.destdir, name),
+                                             self.maxsize, self.mode))
+
+
+class _MultipleFileReader(pb.Referenceable, _MultipleTransfer):
+    """
+    Helper class that creates a L{_FileReader} for each file the slave
+    downloads
+    """
+
+    def __init__(self, sources):
+        self.sources = sources # name : path
+        self.transfers = []
+
+    def remote_open(self, name):
+        """
+        Called from remote slave to start downloading the file C{name}
+        """
+        self._checkName(name)
+        return self._addTransfer(_FileReader(open(self.sources[name], 'rb')))
+
+
+class _MultipleTransferCommand(StatusRemoteCommand):
+    """
+    Passes the per-file updates of a multiple-file transfer on to its step
+    """
+
+    def remoteUpdate(self, update):
+        if 'file' in update:
+            # the 'rc' here is for the one file, not the command
+            self.step.fileTransferred(update['file'], update.get('rc'))
+            return
+        if 'files' in update:
+            self.step.transferStarted(update['files'])
+        StatusRemoteCommand.remoteUpdate(self, update)
+
+
+class _MultipleTransferStep(_TransferBuildStep):
+    """
+    Base class for MultipleFileUpload and MultipleFileDownload, which run
+    one slave command to transfer several files, up to C{concurrency} of
+    them at a time.  Progress is tracked in files and bytes.
+    """
+
+    progressMetrics = ('files', 'bytes')
+
+    command = None
+    files = ()
+    filesDone = 0
+    filesFailed = 0
+
+    def _startTransfer(self, args):
+        version = self.slaveVersion(self.command)
+        if not version:
+            m = "slave is too old, does not know about %s" % self.command
+            raise BuildSlaveTooOldError(m)
+        args['concurrency'] = self.concurrency
+        if self.window > 1:
+            args['window'] = self.window
+            args['maxblocksize'] = max(self.maxBlocksize, self.blocksize)
+        self.cmd = _MultipleTransferCommand(self.command, args)
+        d = self.runCommand(self.cmd)
+        d.addCallback(self.finished).addErrback(self.failed)
+
+    def transferStarted(self, files):
+        self.files = files
+        self._updateText()
+
+    def fileTransferred(self, name, rc):
+        self.filesDone += 1
+        if rc:
+            self.filesFailed += 1
+        self.transfer.update()
+        self.setProgress('files', self.filesDone)
+        self.setProgress('bytes', self.transfer.bytes)
+        self.step_status.setStatistic('files_transferred', self.filesDone)
+        self.step_status.setStatistic('bytes_transferred', self.transfer.bytes)
+        self._updateText()
+
+    def _updateText(self):
+        text = self.transferText + ['%d/%d files' % (self.filesDone,
+                                                     len(self.files))]
+        if self.filesFailed:
+            text.append('%d failed' % self.filesFailed)
+        self.step_status.setText(text)
+
+    def finished(self, result):
+        if self.transfer:
+            self.transfer.update()
+            self.transferText = self.transferText + ['%d files'
+                                                     % self.filesDone]
+        return _TransferBuildStep.finished(self, result)
+
+
+class MultipleFileUpload(_MultipleTransferStep):
+    """
+    Build step to transfer several files from the slave to a directory on
+    the master, in one slave command.
+
+    arguments:
+
+    - ['slavesrcs']  list of glob patterns matching the files to upload,
+                     expanded on the slave relative to workdir.  Each
+                     pattern must match at least one file.
+    - ['masterdest'] directory at master to upload into; each file keeps
+                     its base name
+    - ['workdir']    string with slave working directory relative to builder
+                     base dir, default 'build'
+    - ['maxsize']    maximum size of each file, default None (=unlimited)
+    - ['blocksize']  maximum size of each block being transfered
+    - ['mode']       file access mode for the resulting master-side files.
+                     The default (=None) is to leave it up to the umask of
+                     the buildmaster process.
+    - ['concurrency'] number of files to transfer at once, default 4
+    - ['window']     number of blocks to keep in flight per file, default 8
+    - ['maxBlocksize'] the size blocks may grow to as the transfer proceeds,
+                     default 256k
+
+    """
+
+    name = 'upload'
+    command = 'uploadFiles'
+
+    def __init__(self, slavesrcs, masterdest,
+                 workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 concurrency=4, window=8, maxBlocksize=256*1024,
+                 **buildstep_kwargs):
+        BuildStep.__init__(self, **buildstep_kwargs)
+        self.addFactoryArguments(slavesrcs=slavesrcs,
+                                 masterdest=masterdest,
+                                 workdir=workdir,
+                                 maxsize=maxsize,
+                                 blocksize=blocksize,
+                                 mode=mode,
+                                 concurrency=concurrency,
+                                 window=window,
+                                 maxBlocksize=maxBlocksize,
+                                 )
+
+        if isinstance(slavesrcs, str):
+            slavesrcs = [ slavesrcs ]
+        self.slavesrcs = slavesrcs
+        self.masterdest = masterdest
+        self.workdir = workdir
+        self.maxsize = maxsize
+        self.blocksize = blocksize
+        assert isinstance(mode, (int, type(None)))
+        self.mode = mode
+        self.concurrency = concurrency
+        self.window = window
+        self.maxBlocksize = maxBlocksize
+
+    def start(self):
+        properties = self.build.getProperties()
+
+        sources = [ properties.render(s) for s in self.slavesrcs ]
+        masterdest = properties.render(self.masterdest)
+        # we rely upon the fact that the buildmaster runs chdir'ed into its
+        # basedir to make sure that relative paths in masterdest are expanded
+        # properly.
+        masterdest = os.path.expanduser(masterdest)
+        log.msg("MultipleFileUpload started, from slave %r to master %r"
+                % (sources, masterdest))
+
+        self.transferText = ['uploading']
+        self.step_status.setText(self.transferText)
+
+        self.transfer = _MultipleFileWriter(masterdest, self.maxsize,
+                                            self.mode)
+        self._startTransfer({
+            'slavesrcs': sources,
+            'workdir': self._getWorkdir(),
+            'writer': self.transfer,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            })
+
+
+class MultipleFileDownload(_MultipleTransferStep):
+    """
+    Download several files from the buildmaster to a directory on the
+    buildslave, in one slave command.
+
+    Arguments::
+
+     ['mastersrcs'] list of glob patterns matching the files to download,
+                    relative to the buildmaster's basedir.  Each pattern
+                    must match at least one file.
+     ['slavedest']  directory at slave to download into; each file keeps its
+                    base name
+     ['workdir']    string with slave working directory relative to builder
+                    base dir, default 'build'
+     ['maxsize']    maximum size of each file, default None (=unlimited)
+     ['blocksize']  maximum size of each block being transfered
+     ['mode']       access permissions of the resulting buildslave-side
+                    files, as for FileDownload
+     ['concurrency'] number of files to transfer at once, default 4
+     ['window']     number of blocks to keep in flight per file, default 8
+     ['maxBlocksize'] the size blocks may grow to as the transfer proceeds,
+                    default 256k
+
+    """
+
+    name = 'download'
+    command = 'downloadFiles'
+
+    def __init__(self, mastersrcs, slavedest,
+                 workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 concurrency=4, window=8, maxBlocksize=256*1024,
+                 **buildstep_kwargs):
+        BuildStep.__init__(self, **buildstep_kwargs)
+        self.addFactoryArguments(mastersrcs=mastersrcs,
+                                 slavedest=slavedest,
+                                 workdir=workdir,
+                                 maxsize=maxsize,
+                                 blocksize=blocksize,
+                                 mode=mode,
+                                 concurrency=concurrency,
+                                 window=window,
+                                 maxBlocksize=maxBlocksize,
+                                 )
+
+        if isinstance(mastersrcs, str):
+            mastersrcs = [ mastersrcs ]
+        self.mastersrcs = mastersrcs
+        self.slavedest = slavedest
+        self.workdir = workdir
+        self.maxsize = maxsize
+        self.blocksize = blocksize
+        assert isinstance(mode, (int, type(None)))
+        self.mode = mode
+        self.concurrency = concurrency
+        self.window = window
+        self.maxBlocksize = maxBlocksize
+
+    def start(self):
+        properties = self.build.getProperties()
+
+        slavedest = properties.render(self.slavedest)
+        self.transferText = ['downloading', 'to', os.path.basename(slavedest)]
+        self.step_status.setText(self.transferText)
+
+        # we are currently in the buildmaster's basedir, so any non-absolute
+        # paths will be interpreted relative to that
+        sources = {}
+        names = []
+        errors = []
+        for pattern in self.mastersrcs:
+            pattern = os.path.expanduser(properties.render(pattern))
+            paths = [ p for p in glob.glob(pattern) if os.path.isfile(p) ]
+            if not paths:
+                errors.append('No files match %r at master' % pattern)
+            for path in sorted(paths):
+                name = os.path.basename(path)
+                if name in sources:
+                    if sources[name] != path:
+                        errors.append('%r and %r would both be downloaded '
+                                      'as %r' % (sources[name], path, name))
+                    continue
+                sources[name] = path
+                names.append(name)
+        log.msg("MultipleFileDownload started, from master %r to slave %r" %
+                (names, slavedest))
+
+        if errors:
+            self.addCompleteLog('stderr', '\n'.join(errors))
+            # TODO: once BuildStep.start() gets rewritten to use
+            # maybeDeferred, just re-raise the exception here.
+            reactor.callLater(0, BuildStep.finished, self, FAILURE)
+            return
+
+        self.transfer = _MultipleFileReader(sources)
+        self._startTransfer({
+            'slavedest': slavedest,
+            'files': names,
+            'reader': self.transfer,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            'workdir': self._getWorkdir(),
+            'mode': self.mode,
+            })
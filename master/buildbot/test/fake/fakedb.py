@@ -550,7 +550,7 @@ class FakeStateComponent(FakeDBComponent):
             json_value = self.states[objectid][name]
         except KeyError:
             if default is not object:
-                return default
+                return defer.succeed(default)
             raise
         return defer.succeed(json.loads(json_value))
 
@@ -20,7 +20,7 @@ from buildbot.changes import base
 
 class TestPollingChangeSource(changesource.ChangeSourceMixin, unittest.TestCase):
     class Subclass(base.PollingChangeSource):
-        pass
+        pollJitter = 0
 
     def setUp(self):
         # patch in a Clock so we can manipulate the reactor's time
@@ -79,3 +79,184 @@ class TestPollingChangeSource(changesource.ChangeSourceMixin, unittest.TestCase)
         d.addCallback(check)
         reactor.callWhenRunning(d.callback, None)
         return d
+
+    def pollTimes(self, secs, poll=None):
+        # start the change source, run the clock for secs seconds, and return
+        # a deferred firing with the times at which poll() was called
+        loops = []
+        def default_poll():
+            loops.append(self.clock.seconds())
+        self.changesource.poll = poll or default_poll
+        self.startChangeSource()
+
+        d = defer.Deferred()
+        d.addCallback(self.runClockFor, secs)
+        d.addCallback(lambda _ : loops)
+        reactor.callWhenRunning(d.callback, None)
+        return d
+
+    def test_backoff(self):
+        self.changesource.pollInterval = 5
+        self.changesource.pollMaxInterval = 20
+        d = self.pollTimes(60)
+        def check(loops):
+            # 5, then doubling up to 20
+            self.assertEqual(loops, [5.0, 15.0, 35.0, 55.0])
+            self.assertEqual(self.changesource.getPollInterval(), 20)
+        d.addCallback(check)
+        return d
+
+    def test_speedup_after_changes(self):
+        self.changesource.pollInterval = 5
+        self.changesource.pollMaxInterval = 20
+        loops = []
+        def poll():
+            loops.append(self.clock.seconds())
+            if len(loops) == 3:
+                return self.changesource.addChange(who='me', files=[],
+                                                   comments='x')
+        d = self.pollTimes(50, poll)
+        def check(_):
+            self.assertEqual(loops, [5.0, 15.0, 35.0, 40.0, 50.0])
+            self.assertEqual(len(self.changes_added), 1)
+            self.assertEqual(self.changesource.pollStats.activePolls, 1)
+        d.addCallback(check)
+        return d
+
+    def test_jitter(self):
+        self.changesource.pollInterval = 10
+        self.changesource.pollJitter = 0.5
+        self.master.pollScheduler.random.seed(1)
+        d = self.pollTimes(100)
+        def check(loops):
+            gaps = [ b - a for a, b in zip([0] + loops, loops) ]
+            for gap in gaps:
+                self.failUnless(5 <= gap <= 16, gaps) # clock ticks by 1s
+            self.assertNotEqual(gaps, [10.0] * len(gaps))
+        d.addCallback(check)
+        return d
+
+    @compat.usesFlushLoggedErrors
+    def test_stats(self):
+        self.changesource.pollInterval = 5
+        polls = []
+        def poll():
+            polls.append(None)
+            if len(polls) == 2:
+                raise RuntimeError("oh noes")
+            d = defer.Deferred()
+            reactor.callLater(2, d.callback, None)
+            return d
+        d = self.pollTimes(20, poll)
+        def check(_):
+            stats = self.changesource.pollStats
+            self.assertEqual((stats.polls, stats.failures, stats.activePolls),
+                             (3, 1, 0))
+            self.assertEqual((stats.minDuration, stats.maxDuration),
+                             (0, 2))
+            self.assertEqual(stats.lastWait, 0)
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        d.addCallback(check)
+        return d
+
+    def test_stopped_while_waiting(self):
+        # a poll queued behind a busy scheduler does not run once the source
+        # has been stopped
+        self.master.pollScheduler.setMaxConcurrentPolls(1)
+        blocker = defer.Deferred()
+        self.master.pollScheduler.run(lambda : blocker)
+        polls = []
+        self.changesource.pollInterval = 5
+        d = self.pollTimes(6, lambda : polls.append(None))
+        def stop(_):
+            self.assertEqual(len(self.master.pollScheduler.waiting), 1)
+            return self.changesource.stopService()
+        d.addCallback(stop)
+        def check(_):
+            blocker.callback(None)
+            self.assertEqual(polls, [])
+            self.assertEqual(self.changesource.pollStats.polls, 0)
+        d.addCallback(check)
+        return d
+
+class TestPollScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.scheduler = base.PollScheduler(maxConcurrentPolls=2)
+        self.running = []
+        self.finished = []
+
+    def poll(self, name):
+        d = defer.Deferred()
+        self.running.append((name, d))
+        return d
+
+    def runPoll(self, name):
+        d = self.scheduler.run(lambda : self.poll(name))
+        d.addCallback(self.finished.append)
+        return d
+
+    def finish(self, name):
+        for n, d in self.running:
+            if n == name:
+                self.running.remove((n, d))
+                d.callback(name)
+                return
+
+    def names(self):
+        return [ n for n, d in self.running ]
+
+    def test_limit(self):
+        for name in 'abcd':
+            self.runPoll(name)
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.finish('b')
+        self.assertEqual(self.names(), ['a', 'c'])
+        self.finish('a')
+        self.finish('c')
+        self.assertEqual(self.names(), ['d'])
+        self.finish('d')
+        self.assertEqual(self.finished, ['b', 'a', 'c', 'd'])
+        self.assertEqual(self.scheduler.active, 0)
+
+    def test_failure_releases(self):
+        d = self.scheduler.run(lambda : 1/0)
+        self.assertFailure(d, ZeroDivisionError)
+        self.assertEqual(self.scheduler.active, 0)
+        return d
+
+    def test_raise_limit(self):
+        for name in 'abc':
+            self.runPoll(name)
+        self.scheduler.setMaxConcurrentPolls(None)
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+
+    def test_slotTimeout(self):
+        for name in 'abc':
+            self.runPoll(name)
+        self.clock.advance(599)
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.clock.advance(1)
+        # the hung polls let the next one run, but are still waited for
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+        self.assertEqual(self.scheduler.active, 1)
+        self.finish('c')
+        self.finish('a')
+        self.finish('b')
+        self.assertEqual(self.finished, ['c', 'a', 'b'])
+        self.assertEqual(self.scheduler.active, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_finish_cancels_timeout(self):
+        self.runPoll('a')
+        self.finish('a')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(600)
+        self.assertEqual(self.scheduler.active, 0)
+
+    def test_jitter(self):
+        self.assertEqual(self.scheduler.jitter(10, 0), 10)
+        for i in range(20):
+            self.failUnless(8 <= self.scheduler.jitter(10, 0.2) <= 12)
@@ -13,7 +13,9 @@
 #
 # Copyright Buildbot Team Members
 
+import mock
 from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
 from buildbot.util import json
 from buildbot.test.util import changesource
 from buildbot.changes import gerritchangesource
@@ -67,3 +69,174 @@ class TestGerritChangeSource(changesource.ChangeSourceMixin,
             self.assertEqual(c['properties']['event.change.subject'], 'fix 1234')
         d.addCallback(check)
         return d
+
+    def makeEvent(self, revision, when=None):
+        event = dict(
+            type="patchset-created",
+            change=dict(
+                branch="br",
+                project="pr",
+                owner=dict(name="Dustin", email="dustin@mozilla.com"),
+                url="http://buildbot.net",
+                subject="fix 1234"
+            ),
+            patchSet=dict(revision=revision)
+        )
+        if when is not None:
+            event['patchSet']['createdOn'] = when
+        return event
+
+    def test_batches(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        s.BATCH_SIZE = 2
+        batches = []
+        addChanges = self.master.addChanges
+        def addChangesWrapper(changes):
+            batches.append(len(changes))
+            return addChanges(changes)
+        self.master.addChanges = addChangesWrapper
+        for rev in 'abc':
+            s.eventReceived(self.makeEvent(rev))
+        d = s.flushChanges()
+        def check(_):
+            self.assertEqual(batches, [ 2, 1 ])
+            self.assertEqual([ c['revision'] for c in self.changes_added ],
+                             [ 'a', 'b', 'c' ])
+        d.addCallback(check)
+        return d
+
+    def test_duplicate_events(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        s.eventReceived(self.makeEvent('abc'))
+        s.eventReceived(self.makeEvent('abc'))
+        d = s.flushChanges()
+        def check(_):
+            self.assertEqual(len(self.changes_added), 1)
+        d.addCallback(check)
+        return d
+
+    def test_saves_last_event_time(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        d = s.loadState()
+        def add(_):
+            s.eventReceived(self.makeEvent('abc', when=1000))
+            s.eventReceived(self.makeEvent('def', when=1200))
+            return s.flushChanges()
+        d.addCallback(add)
+        d.addCallback(lambda _ :
+            self.master.db.state.getState(s._objectid, 'last_event_time'))
+        d.addCallback(self.assertEqual, 1200)
+        return d
+
+    def test_addChanges_fails(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        clock = task.Clock()
+        self.patch(reactor, 'callLater', clock.callLater)
+        addChanges = self.master.addChanges
+        failures = [ 2 ]
+        def addChangesWrapper(changes):
+            if failures[0]:
+                failures[0] -= 1
+                return defer.fail(RuntimeError("database is down"))
+            return addChanges(changes)
+        self.master.addChanges = addChangesWrapper
+        flushed = []
+        d = s.loadState()
+        def add(_):
+            s.eventReceived(self.makeEvent('abc', when=1000))
+            s.flushChanges().addCallback(flushed.append)
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+            # nothing was added, so the catch-up point has not moved
+            self.assertEqual(s.lastEventTime, None)
+            self.assertEqual(len(s.pendingChanges), 1)
+            self.assertEqual(flushed, [])
+            clock.advance(s.FLUSH_RETRY_MIN)
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+            self.assertEqual(self.changes_added, [])
+            # the delay grows
+            clock.advance(s.FLUSH_RETRY_MIN)
+            self.assertEqual(self.changes_added, [])
+            clock.advance(s.FLUSH_RETRY_MIN)
+            self.assertEqual([ c['revision'] for c in self.changes_added ],
+                             [ 'abc' ])
+            self.assertEqual(s.lastEventTime, 1000)
+            self.assertEqual(s.flushRetryDelay, s.FLUSH_RETRY_MIN)
+            self.assertEqual(flushed, [ None ])
+        d.addCallback(add)
+        return d
+
+    def test_loadState(self):
+        self.master.db.state.fakeState('someuser@somehost:29418',
+                'buildbot.changes.gerritchangesource.GerritChangeSource',
+                last_event_time=1500)
+        s = self.newChangeSource('somehost', 'someuser')
+        d = s.loadState()
+        def check(_):
+            self.assertEqual(s.lastEventTime, 1500)
+        d.addCallback(check)
+        return d
+
+    def test_catchUp(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        self.patch(gerritchangesource.util, 'now', lambda : 1100)
+        change = self.makeEvent('unused')['change']
+        change['patchSets'] = [ dict(revision='old', createdOn=900),
+                                dict(revision='new2', createdOn=1050),
+                                dict(revision='new1', createdOn=1020) ]
+        output = '\n'.join([ json.dumps(change),
+                json.dumps(dict(type='stats', rowCount=1)) ]) + '\n'
+        queries = []
+        def getProcessOutput(args):
+            queries.append(args)
+            return defer.succeed(output)
+        s.getProcessOutput = getProcessOutput
+        # an event which was seen on the stream is not added again
+        s.eventReceived(self.makeEvent('new2', when=1050))
+        d = s.flushChanges()
+        def catchUp(_):
+            # as if the stream had just reconnected
+            s.lastEventTime = 1000
+            return s.catchUp()
+        d.addCallback(catchUp)
+        def check(ok):
+            self.failUnless(ok)
+            self.assertEqual([ c['revision'] for c in self.changes_added ],
+                             [ 'new2', 'new1' ])
+            self.assertEqual(self.changes_added[1]['properties']
+                                    ['event.patchSet.createdOn'], 1020)
+            self.assertEqual(queries[0][-7:], [ 'gerrit', 'query',
+                '--format=JSON', '--patch-sets', 'NOT', 'age:160s',
+                'limit:500' ])
+        d.addCallback(check)
+        return d
+
+    def test_catchUp_nothing_seen(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        s.getProcessOutput = mock.Mock()
+        d = s.catchUp()
+        def check(ok):
+            self.failUnless(ok)
+            self.failIf(s.getProcessOutput.called)
+        d.addCallback(check)
+        return d
+
+    def test_streamProcessStopped_after_catchUp(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        s.parent = mock.Mock()
+        s.running = True
+        s.startStreamProcess = mock.Mock()
+        self.patch(gerritchangesource.util, 'now', lambda : 5000)
+        s.lastStreamProcessStart = s.caughtUpTo = 1000
+        s.streamProcessStopped()
+        # a good connection, so it restarts at once
+        self.failUnless(s.startStreamProcess.called)
+        self.assertEqual(s.lastEventTime, 1000 - s.CATCHUP_SLACK)
+
+    def test_streamProcessStopped_not_running(self):
+        s = self.newChangeSource('somehost', 'someuser')
+        s.parent = mock.Mock()
+        s.running = False
+        s.startStreamProcess = mock.Mock()
+        s.lastStreamProcessStart = 1000
+        s.streamProcessStopped()
+        self.failIf(s.startStreamProcess.called)
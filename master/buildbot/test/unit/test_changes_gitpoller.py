@@ -14,89 +14,11 @@
 # Copyright Buildbot Team Members
 
 from twisted.trial import unittest
-from twisted.internet import defer
-from exceptions import Exception
+from twisted.internet import defer, error
+from twisted.python import failure
 from buildbot.changes import gitpoller
 from buildbot.test.util import changesource, gpo
-
-class GitOutputParsing(gpo.GetProcessOutputMixin, unittest.TestCase):
-    """Test GitPoller methods for parsing git output"""
-    def setUp(self):
-        self.poller = gitpoller.GitPoller('git@example.com:foo/baz.git')
-        self.setUpGetProcessOutput()
-
-    def tearDown(self):
-        self.tearDownGetProcessOutput()
-        
-    def _perform_git_output_test(self, methodToTest,
-                                 desiredGoodOutput, desiredGoodResult,
-                                 emptyRaisesException=True):
-        dummyRevStr = '12345abcde'
-
-        # make this call to self.patch here so that we raise a SkipTest if it
-        # is not supported
-        self.addGetProcessOutputResult(self.gpoAnyPattern(), '')
-
-        d = defer.succeed(None)
-        def call_empty(_):
-            # we should get an Exception with empty output from git
-            return methodToTest(dummyRevStr)
-        d.addCallback(call_empty)
-    
-        def cb_empty(_):
-            if emptyRaisesException:
-                self.fail("getProcessOutput should have failed on empty output")
-        def eb_empty(f):
-            if not emptyRaisesException:
-                self.fail("getProcessOutput should NOT have failed on empty output")
-        d.addCallbacks(cb_empty, eb_empty)
-
-        # and the method shouldn't supress any exceptions
-        def call_exception(_):
-            # we should get an Exception with empty output from git
-            self.addGetProcessOutputResult(self.gpoAnyPattern(),
-                    lambda b, a, **k: defer.fail(Exception('fake')))
-            return methodToTest(dummyRevStr)
-        d.addCallback(call_exception)
-    
-        def cb_exception(_):
-            self.fail("getProcessOutput should have failed on empty output")
-        def eb_exception(f):
-            pass
-        d.addCallbacks(cb_exception, eb_exception)
-
-        # finally we should get what's expected from good output
-        def call_desired(_):
-            self.addGetProcessOutputResult(self.gpoAnyPattern(),
-                desiredGoodOutput)
-            return methodToTest(dummyRevStr)
-        d.addCallback(call_desired)
-    
-        def cb_desired(r):
-            self.assertEquals(r, desiredGoodResult)
-        d.addCallback(cb_desired)
-        
-    def test_get_commit_name(self):
-        nameStr = 'Sammy Jankis'
-        return self._perform_git_output_test(self.poller._get_commit_name,
-                nameStr, nameStr)
-        
-    def test_get_commit_comments(self):
-        commentStr = 'this is a commit message\n\nthat is multiline'
-        return self._perform_git_output_test(self.poller._get_commit_comments,
-                commentStr, commentStr)
-        
-    def test_get_commit_files(self):
-        filesStr = 'file1\nfile2'
-        return self._perform_git_output_test(self.poller._get_commit_files, filesStr, 
-                                      filesStr.split(), emptyRaisesException=False)    
-        
-    def test_get_commit_timestamp(self):
-        stampStr = '1273258009'
-        return self._perform_git_output_test(self.poller._get_commit_timestamp,
-                stampStr, float(stampStr))
-
-    # _get_changes is tested in TestGitPoller, below
+from buildbot.test.fake import fakedb
 
 class TestGitPoller(gpo.GetProcessOutputMixin,
                     changesource.ChangeSourceMixin,
@@ -124,29 +46,19 @@ class TestGitPoller(gpo.GetProcessOutputMixin,
         self.addGetProcessOutputResult(
                 self.gpoSubcommandPattern('git', 'fetch'),
                 "no interesting output")
-        self.addGetProcessOutputResult(
-                self.gpoSubcommandPattern('git', 'log'),
-                '\n'.join([
-                    '64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a',
-                    '4423cdbcbb89c14e50dd5f4152415afd686c5241']))
         self.addGetProcessOutputAndValueResult(
                 self.gpoSubcommandPattern('git', 'reset'),
                 ('done', '', 0))
 
-        # and patch out the _get_commit_foo methods which were already tested
-        # above
-        def timestamp(rev):
-            return defer.succeed(1273258009.0)
-        self.patch(self.poller, '_get_commit_timestamp', timestamp)
-        def name(rev):
-            return defer.succeed('by:' + rev[:8])
-        self.patch(self.poller, '_get_commit_name', name)
-        def files(rev):
-            return defer.succeed(['/etc/' + rev[:3]])
-        self.patch(self.poller, '_get_commit_files', files)
-        def comments(rev):
-            return defer.succeed('hello!')
-        self.patch(self.poller, '_get_commit_comments', comments)
+        # and patch out _get_commits, which is tested in GitLogParsing, below
+        def get_commits(revRange):
+            self.assertEqual(revRange, 'master..origin/master')
+            return defer.succeed([
+                dict(revision=rev, when=1273258009.0, who='by:' + rev[:8],
+                     comments='hello!', files=['/etc/' + rev[:3]])
+                for rev in [ '4423cdbcbb89c14e50dd5f4152415afd686c5241',
+                             '64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a' ] ])
+        self.patch(self.poller, '_get_commits', get_commits)
 
         # do the poll
         d = self.poller.poll()
@@ -163,6 +75,236 @@ class TestGitPoller(gpo.GetProcessOutputMixin,
             self.assertEqual(self.changes_added[1]['when'], 1273258009.0)
             self.assertEqual(self.changes_added[1]['comments'], 'hello!')
             self.assertEqual(self.changes_added[1]['files'], [ '/etc/64a' ])
+            self.assertEqual(self.poller.changeCount, 2)
+            self.assertNotEqual(self.poller.lastPollDuration, None)
         d.addCallback(check)
 
         return d
+
+    def test_poll_batches(self):
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'fetch'), "")
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'reset'), ('done', '', 0))
+        commits = [ dict(revision='%040d' % i, when=1273258009.0 + i,
+                         who='me', comments='c', files=[])
+                    for i in range(5) ]
+        self.patch(self.poller, '_get_commits',
+                   lambda revRange : defer.succeed(commits))
+        batches = []
+        def addChanges(changes):
+            batches.append([ c['revision'] for c in changes ])
+            return defer.succeed([])
+        self.master.addChanges = addChanges
+        self.poller.changeBatchSize = 2
+        self.poller.usetimestamps = False
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual(batches, [ [ '%040d' % i for i in (0, 1) ],
+                                        [ '%040d' % i for i in (2, 3) ],
+                                        [ '%040d' % 4 ] ])
+            self.assertEqual(commits[0]['when'], None)
+        d.addCallback(check)
+        return d
+
+class GitLogParsing(unittest.TestCase):
+
+    output = ('\x01' '4423cdbcbb89c14e50dd5f4152415afd686c5241\x00'
+              '1273258009\x00sammy@example.com\x00fix the frobnicator\n'
+              '\nwith a longer description\n\x00\n'
+              'master/frob.py\nmaster/file with spaces\n\n'
+              '\x01' '64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a\x00'
+              '1273258010\x00jay@example.com\x00merge\n\x00\n')
+
+    expected = [
+        dict(revision='4423cdbcbb89c14e50dd5f4152415afd686c5241',
+             when=1273258009.0, who='sammy@example.com',
+             comments='fix the frobnicator\n\nwith a longer description',
+             files=['master/frob.py', 'master/file with spaces']),
+        dict(revision='64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a',
+             when=1273258010.0, who='jay@example.com', comments='merge',
+             files=[]) ]
+
+    def test_parse(self):
+        parser = gitpoller.GitLogParser()
+        self.assertEqual(parser.feed(self.output) + parser.finish(),
+                         self.expected)
+
+    def test_parse_pieces(self):
+        # feed the output a few bytes at a time
+        parser = gitpoller.GitLogParser()
+        commits = []
+        for i in range(0, len(self.output), 7):
+            commits.extend(parser.feed(self.output[i:i+7]))
+        self.assertEqual(len(commits), 1)
+        commits.extend(parser.finish())
+        self.assertEqual(commits, self.expected)
+
+    def test_parse_no_author(self):
+        parser = gitpoller.GitLogParser()
+        parser.feed('\x01' + '4' * 40 + '\x001273258009\x00\x00fix\n\x00\n')
+        self.assertRaises(EnvironmentError, parser.finish)
+
+    def test_parse_bad_timestamp(self):
+        parser = gitpoller.GitLogParser()
+        parser.feed('\x01' + '4' * 40 + '\x00soon\x00me@example.com\x00fix\n\x00\n')
+        self.assertRaises(ValueError, parser.finish)
+
+    def test_parse_garbage(self):
+        parser = gitpoller.GitLogParser()
+        parser.feed('\x01garbage\n')
+        self.assertRaises(EnvironmentError, parser.finish)
+
+    def test_protocol(self):
+        proto = gitpoller.GitLogProtocol(gitpoller.GitLogParser())
+        proto.outReceived(self.output[:100])
+        proto.outReceived(self.output[100:])
+        proto.processEnded(failure.Failure(error.ProcessDone(0)))
+        proto.deferred.addCallback(self.assertEqual, self.expected)
+        return proto.deferred
+
+    def test_protocol_failed(self):
+        proto = gitpoller.GitLogProtocol(gitpoller.GitLogParser())
+        proto.errReceived('fatal: bad revision\n')
+        proto.processEnded(failure.Failure(error.ProcessTerminated(128)))
+        return self.assertFailure(proto.deferred, EnvironmentError)
+
+class TestGitPollerBranches(gpo.GetProcessOutputMixin,
+                            changesource.ChangeSourceMixin,
+                            unittest.TestCase):
+
+    lsRemote = ('1111111111111111111111111111111111111111\tHEAD\n'
+                '1111111111111111111111111111111111111111\trefs/heads/master\n'
+                '2222222222222222222222222222222222222222\trefs/heads/release/1.0\n'
+                '3333333333333333333333333333333333333333\trefs/heads/release/2.0\n'
+                '4444444444444444444444444444444444444444\trefs/heads/feature\n')
+
+    stateName = 'heads master release/*'
+
+    def setUp(self):
+        self.setUpGetProcessOutput()
+        d = self.setUpChangeSource()
+        def create_poller(_):
+            self.poller = gitpoller.GitPoller('git@example.com:foo/baz.git',
+                    branches=['master', 'release/*'], workdir='/tmp/gp')
+            self.master.db = fakedb.FakeDBConnector(self)
+            self.poller.master = self.master
+            self.objectid = self.master.db.state.fakeState(
+                    'git@example.com:foo/baz.git',
+                    'buildbot.changes.gitpoller.GitPoller',
+                    **{ self.stateName : {'master' : '1' * 40,
+                        'release/1.0' : '0' * 40, 'release/0.9' : '9' * 40},
+                        # another poller's heads
+                        'heads other' : {'other' : '5' * 40} })
+        d.addCallback(create_poller)
+        return d
+
+    def tearDown(self):
+        self.tearDownGetProcessOutput()
+        return self.tearDownChangeSource()
+
+    def test_describe(self):
+        self.assertSubstring("branches: master, release/*",
+                             self.poller.describe())
+
+    def expectFetch(self):
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'ls-remote'),
+                (self.lsRemote, '', 0))
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'fetch'), ('', '', 0))
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'for-each-ref'),
+                ('2222222222222222222222222222222222222222 refs/heads/release/1.0\n'
+                 '3333333333333333333333333333333333333333 refs/heads/release/2.0\n',
+                 '', 0))
+
+    def test_poll(self):
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'ls-remote'),
+                (self.lsRemote, '', 0))
+        def fetch(bin, args, **kwargs):
+            # only the moved branches are fetched
+            self.assertEqual(args, ['fetch', 'git@example.com:foo/baz.git',
+                    '+refs/heads/release/1.0:refs/heads/release/1.0',
+                    '+refs/heads/release/2.0:refs/heads/release/2.0'])
+            return ('', '', 0)
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'fetch'), fetch)
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'for-each-ref'),
+                ('2222222222222222222222222222222222222222 refs/heads/release/1.0\n'
+                 '3333333333333333333333333333333333333333 refs/heads/release/2.0\n',
+                 '', 0))
+        ranges = []
+        def get_commits(revRange):
+            ranges.append(revRange)
+            return defer.succeed([ dict(revision='2' * 40, when=1273258009.0,
+                        who='me', comments='release', files=['VERSION']) ])
+        self.patch(self.poller, '_get_commits', get_commits)
+
+        d = self.poller.poll()
+        def check(_):
+            # the new branch release/2.0 is recorded, but its history is not
+            # reported
+            self.assertEqual(ranges, [ '0' * 40 + '..' + '2' * 40 ])
+            self.assertEqual([ (c['branch'], c['revision'])
+                               for c in self.changes_added ],
+                             [ ('release/1.0', '2' * 40) ])
+            # release/0.9 has gone; the other poller's heads are untouched
+            self.master.db.state.assertState(self.objectid,
+                    **{ self.stateName : {'master' : '1' * 40,
+                        'release/1.0' : '2' * 40, 'release/2.0' : '3' * 40},
+                        'heads other' : {'other' : '5' * 40} })
+        d.addCallback(check)
+        return d
+
+    def test_poll_log_fails(self):
+        # e.g. the old head is missing from a recreated workdir
+        self.expectFetch()
+        self.patch(self.poller, '_get_commits',
+                lambda revRange : defer.fail(EnvironmentError('bad revision')))
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual(len(self.flushLoggedErrors(EnvironmentError)), 1)
+            self.assertEqual(self.changes_added, [])
+            # release/1.0 keeps its old head, so its changes are tried again
+            self.master.db.state.assertState(self.objectid,
+                    **{ self.stateName : {'master' : '1' * 40,
+                        'release/1.0' : '0' * 40, 'release/2.0' : '3' * 40} })
+        d.addCallback(check)
+        return d
+
+    def test_poll_addChanges_fails(self):
+        self.expectFetch()
+        self.patch(self.poller, '_get_commits',
+                lambda revRange : defer.succeed([ dict(revision='2' * 40,
+                    when=1273258009.0, who='me', comments='release',
+                    files=['VERSION']) ]))
+        self.master.addChanges = \
+                lambda changes : defer.fail(RuntimeError('database is down'))
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+            self.master.db.state.assertState(self.objectid,
+                    **{ self.stateName : {'master' : '1' * 40,
+                        'release/1.0' : '0' * 40, 'release/2.0' : '3' * 40} })
+        d.addCallback(check)
+        return d
+
+    def test_poll_nothing_moved(self):
+        self.master.db.state.states[self.objectid] = {}
+        self.master.db.state.fakeState('git@example.com:foo/baz.git',
+                'buildbot.changes.gitpoller.GitPoller',
+                **{ self.stateName : {'master' : '1' * 40,
+                    'release/1.0' : '2' * 40, 'release/2.0' : '3' * 40} })
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'ls-remote'),
+                (self.lsRemote, '', 0))
+        # any other git command would fail
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual(self.changes_added, [])
+            self.assertEqual(self.poller.changeCount, 0)
+        d.addCallback(check)
+        return d
@@ -73,3 +73,37 @@ class TestMaildirSource(changesource.ChangeSourceMixin, dirs.DirsMixin,
             self.assertEqual(self.changes_added[0]['fake_chdict'], 1)
         d.addCallback(check)
         return d
+
+    def test_messagesReceived_batches(self):
+        self.populateMaildir()
+        for name in ('msg1', 'msg2', 'bad'):
+            open(os.path.join(self.maildir, "new", name), "w").write(
+                    "Subject: %s\n\nthis is a test" % name)
+        mds = mail.MaildirSource(self.maildir)
+        mds.batchSize = 2
+        self.attachChangeSource(mds)
+
+        def parse(message, prefix):
+            if message['subject'] == 'bad':
+                raise ValueError("unparseable")
+            if message['subject'] == 'test':
+                return None # not a change
+            return dict(subject=message['subject'])
+        mds.parse = parse
+        batches = []
+        addChanges = self.master.addChanges
+        def addChangesWrapper(changes):
+            batches.append([ c['subject'] for c in changes ])
+            return addChanges(changes)
+        self.master.addChanges = addChangesWrapper
+
+        d = mds.messagesReceived(['bad', 'msg1', 'msg2', 'newmsg'])
+        def check(_):
+            self.assertEqual(batches, [ [ 'msg1' ], [ 'msg2' ] ])
+            self.assertMailProcessed()
+            # the message which could not be parsed is left in new/
+            self.assertTrue(os.path.exists(
+                    os.path.join(self.maildir, "new", "bad")))
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        d.addCallback(check)
+        return d
@@ -14,7 +14,6 @@
 # Copyright Buildbot Team Members
 
 import os
-import xml.dom.minidom
 from twisted.internet import defer
 from twisted.trial import unittest
 from buildbot.test.util import changesource, gpo, compat
@@ -232,10 +231,10 @@ def make_changes_output(maxrevision):
     output = changes_output_template % ("".join(logs))
     return output
 
-def make_logentry_elements(maxrevision):
-    "return the corresponding logentry elements for the given revisions"
-    doc = xml.dom.minidom.parseString(make_changes_output(maxrevision))
-    return doc.getElementsByTagName("logentry")
+def make_logentries(maxrevision):
+    "return the corresponding parsed log entries for the given revisions"
+    parser = svnpoller.SVNLogParser()
+    return parser.feed(make_changes_output(maxrevision)) + parser.close()
 
 def split_file(path):
     pieces = path.split("/")
@@ -311,12 +310,26 @@ class TestSVNPoller(gpo.GetProcessOutputMixin,
         s = self.attachSVNPoller('file:///foo')
         output = make_changes_output(4)
         entries = s.parse_logs(output)
-        # no need for elaborate assertions here; this is minidom's logic
         self.assertEqual(len(entries), 4)
+        self.assertEqual(entries[0], dict(revision='4', author='warner',
+                    msg='revised_to_2',
+                    paths=[('M', '/sample/trunk/version.c')]))
+
+    def test_log_parsing_pieces(self):
+        # feed the output a few bytes at a time
+        output = make_changes_output(6)
+        parser = svnpoller.SVNLogParser()
+        entries = []
+        for i in range(0, len(output), 11):
+            entries.extend(parser.feed(output[i:i+11]))
+        entries.extend(parser.close())
+        self.assertEqual(entries, make_logentries(6))
+        self.assertEqual([ e['revision'] for e in entries ],
+                         [ '6', '5', '4', '3', '2', '1' ])
 
     def test_get_new_logentries(self):
         s = self.attachSVNPoller('file:///foo')
-        entries = make_logentry_elements(4)
+        entries = make_logentries(4)
 
         s.last_change = 4
         new = s.get_new_logentries(entries)
@@ -345,7 +358,7 @@ class TestSVNPoller(gpo.GetProcessOutputMixin,
         s = self.attachSVNPoller(base, split_file=split_file)
         s._prefix = "sample"
 
-        logentries = dict(zip(xrange(1, 7), reversed(make_logentry_elements(6))))
+        logentries = dict(zip(xrange(1, 7), reversed(make_logentries(6))))
         changes = s.create_changes(reversed([ logentries[3], logentries[2] ]))
         self.failUnlessEqual(len(changes), 2)
         # note that parsing occurs in reverse
@@ -438,6 +451,32 @@ class TestSVNPoller(gpo.GetProcessOutputMixin,
 
         return d
 
+    def test_poll_pages(self):
+        s = self.attachSVNPoller(sample_base, split_file=split_file,
+                                 histmax=2)
+        objectid = self.master.db.state.fakeState(sample_base,
+                'buildbot.changes.svnpoller.SVNPoller', last_rev=1)
+        self.add_svn_command_result('info', sample_info_output)
+        logArgs = []
+        def log_output(revisions):
+            def result(bin, args, **kwargs):
+                logArgs.append(args[args.index('-r') + 1:-1])
+                return changes_output_template % ''.join(
+                        [ sample_logentries[r-1] for r in revisions ])
+            return result
+        # svn lists an ascending range in ascending order
+        self.add_svn_command_result('log', log_output([1, 2, 3]))
+        self.add_svn_command_result('log', log_output([3, 4]))
+        d = s.poll()
+        def check(_):
+            self.assertEqual(logArgs, [ [ '1:HEAD', '--limit=3' ],
+                                        [ '3:HEAD', '--limit=3' ] ])
+            self.assertEqual([ c['revision'] for c in self.changes_added ],
+                             [ '2', '3', '4' ])
+            self.master.db.state.assertState(objectid, last_rev=4)
+        d.addCallback(check)
+        return d
+
     def test_cachepath_empty(self):
         cachepath = os.path.abspath('revcache')
         if os.path.exists(cachepath):
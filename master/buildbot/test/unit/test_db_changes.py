@@ -264,6 +264,35 @@ class TestChangesConnectorComponent(
         d.addCallback(check_change_properties)
         return d
 
+    def test_addChanges(self):
+        d = self.db.changes.addChanges([
+            dict(who=u'dustin', files=[u'a.txt'], comments=u'one',
+                 revision=u'1', when=266738400),
+            dict(who=u'warner', files=[u'b.txt', u'c.txt'], comments=u'two',
+                 revision=u'2', when=266738401, branch=u'br',
+                 properties={u'platform': u'linux'}) ])
+        def check(changes):
+            self.assertEqual([ (c.number, c.who, c.revision) for c in changes ],
+                             [ (1, 'dustin', '1'), (2, 'warner', '2') ])
+            def thd(conn):
+                r = conn.execute(sa.select([self.db.model.changes.c.changeid,
+                                            self.db.model.changes.c.branch]))
+                self.assertEqual(sorted(map(tuple, r.fetchall())),
+                                 [ (1, None), (2, 'br') ])
+                r = conn.execute(sa.select(
+                        [self.db.model.change_files.c.filename],
+                        whereclause=self.db.model.change_files.c.changeid == 2))
+                self.assertEqual(sorted([ row.filename for row in r ]),
+                                 [ 'b.txt', 'c.txt' ])
+            return self.db.pool.do(thd)
+        d.addCallback(check)
+        return d
+
+    def test_addChanges_empty(self):
+        d = self.db.changes.addChanges([])
+        d.addCallback(self.assertEqual, [])
+        return d
+
     def test_prune_changes(self):
         self.db.changes.changeHorizon = 1
 
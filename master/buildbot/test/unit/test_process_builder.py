@@ -0,0 +1,89 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.spread import pb
+
+from buildbot.process import builder, slavebuilder
+
+from mock import Mock
+
+class LowDiskSpace(pb.Error):
+    pass
+# the master only knows the slave's exceptions by name
+LowDiskSpace.__module__ = 'buildslave.bot'
+
+class TestStartBuildFailed(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(slavebuilder, 'reactor', self.clock)
+
+        self.bldr = builder.Builder(dict(name='bldr', slavename='slv',
+                                         builddir='bdir', slavebuilddir='sbdir',
+                                         factory=Mock()), Mock())
+        self.bldr.botmaster = Mock()
+        self.bldr.db = Mock()
+        self.bldr.db.resubmit_buildrequests.return_value = defer.succeed(None)
+
+        self.sb = slavebuilder.SlaveBuilder()
+        self.sb.setBuilder(self.bldr)
+        self.sb.slave = Mock()
+        self.sb.slave.canStartBuild.return_value = True
+        self.sb.slave.buildFinished.return_value = defer.succeed(None)
+        self.sb.buildStarted()
+
+        self.build = Mock()
+        self.build.requests = [ Mock() ]
+        self.build.requests[0].id = 13
+        self.bldr.building.append(self.build)
+
+    def checkRequeued(self):
+        self.assertEqual(self.bldr.building, [])
+        self.bldr.db.resubmit_buildrequests.assert_called_with([13])
+        self.assertEqual(self.sb.state, slavebuilder.IDLE)
+
+    def test_lowDiskSpace(self):
+        why = failure.Failure(LowDiskSpace("not enough disk space"))
+        self.bldr._startBuildFailed(why, self.build, self.sb)
+        self.checkRequeued()
+        # the request can go to another slave, but not back to this one
+        self.assertFalse(self.sb.isAvailable())
+        checks = self.bldr.botmaster.triggerNewBuildCheck.call_count
+        self.clock.advance(builder.Builder.LOW_DISK_SPACE_REST - 1)
+        self.assertFalse(self.sb.isAvailable())
+        self.clock.advance(1)
+        self.assertTrue(self.sb.isAvailable())
+        self.assertEqual(self.bldr.botmaster.triggerNewBuildCheck.call_count,
+                         checks + 1)
+
+    def test_otherFailure(self):
+        why = failure.Failure(pb.Error("something else"))
+        self.bldr._startBuildFailed(why, self.build, self.sb)
+        self.checkRequeued()
+        self.assertTrue(self.sb.isAvailable())
+
+    def test_pingFailed(self):
+        self.bldr._startBuildFailed("slave ping failed", self.build, self.sb)
+        self.checkRequeued()
+        self.assertTrue(self.sb.isAvailable())
+
+    def test_detached(self):
+        why = failure.Failure(LowDiskSpace("not enough disk space"))
+        self.bldr._startBuildFailed(why, self.build, self.sb)
+        self.sb.detached()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -14,10 +14,17 @@
 # Copyright Buildbot Team Members
 
 import re
+import zlib
+import mock
+from zope.interface import implements
 
 from twisted.trial import unittest
+from twisted.internet import defer
 
+from buildbot import interfaces
 from buildbot.process.buildstep import LoggingBuildStep, regex_log_evaluator
+from buildbot.process.buildstep import RemoteCommand, LoggedRemoteCommand
+from buildbot.process.buildstep import RemoteShellCommand
 from buildbot.status.builder import FAILURE, SUCCESS, WARNINGS, EXCEPTION
 
 class FakeLogFile:
@@ -87,3 +94,226 @@ class TestLoggingBuildStep(unittest.TestCase):
         lbs = LoggingBuildStep(log_eval_func=eval)
         status = lbs.evaluateCommand(cmd)
         self.assertEqual(status, WARNINGS, "evaluateCommand didn't call log_eval_func or overrode its results")
+
+class RecordingCommand(RemoteCommand):
+    def __init__(self):
+        RemoteCommand.__init__(self, 'shell', {'command' : 'make'})
+        self.buildslave = mock.Mock()
+        self.active = True
+        self.received = []
+
+    def remoteUpdate(self, update):
+        self.received.append(update)
+
+class TestRemoteCommandUpdates(unittest.TestCase):
+
+    def test_remote_updates(self):
+        cmd = RecordingCommand()
+        credit = cmd.remote_updates([
+            ['stdout', 'a'], ['stdout', 'b'], ['stderr', 'c'],
+            ['log', ('x', 'd')], ['log', ('x', 'e')], ['log', ('y', 'f')],
+            ['status', {'rc' : 0, 'elapsed' : 1}], ['header', 'g'],
+            ['stat', (1, 2)] ])
+        self.assertEqual(cmd.received, [
+            {'stdout' : 'ab'}, {'stderr' : 'c'},
+            {'log' : ('x', 'de')}, {'log' : ('y', 'f')},
+            {'rc' : 0, 'elapsed' : 1}, {'header' : 'g'}, {'stat' : (1, 2)} ])
+        self.assertEqual(credit, cmd.updateCredit)
+        self.assertTrue(cmd.buildslave.messageReceivedFromSlave.called)
+
+    def test_remote_updates_inactive(self):
+        cmd = RecordingCommand()
+        cmd.active = False
+        cmd.remote_updates([['stdout', 'late']])
+        self.assertEqual(cmd.received, [])
+
+    def startCommand(self, slaveIsOld):
+        cmd = RecordingCommand()
+        cmd.step = mock.Mock()
+        cmd.step.slaveVersionIsOlderThan.return_value = slaveIsOld
+        cmd.remote = mock.Mock()
+        cmd.commandID = '1'
+        cmd.start()
+        return cmd.remote.callRemote.call_args[0][4]
+
+    def test_start_batchUpdates(self):
+        args = self.startCommand(slaveIsOld=False)
+        self.assertEqual(args, {'command' : 'make',
+                    'batchUpdates' : {'credit' : RemoteCommand.updateCredit}})
+
+    def test_start_oldSlave(self):
+        self.assertEqual(self.startCommand(slaveIsOld=True),
+                         {'command' : 'make'})
+
+class StatisticsStepStatus(object):
+    def __init__(self):
+        self.statistics = {}
+
+    def getStatistic(self, name, default=None):
+        return self.statistics.get(name, default)
+
+    def setStatistic(self, name, value):
+        self.statistics[name] = value
+
+class RecordingLogFile(object):
+    implements(interfaces.ILogFile)
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = []
+        self.finished = False
+
+    def getName(self):
+        return self.name
+
+    def addStdout(self, data):
+        self.chunks.append(('o', data))
+
+    def addStderr(self, data):
+        self.chunks.append(('e', data))
+
+    def addHeader(self, data):
+        self.chunks.append(('h', data))
+
+    def finish(self):
+        self.finished = True
+
+    def setRemoteFile(self, remoteFile):
+        self.remoteFile = remoteFile
+
+class TestLoggedRemoteCommandUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.cmd = LoggedRemoteCommand('shell', {'command' : 'make'})
+        self.cmd.step = mock.Mock()
+        self.cmd.step.step_status = StatisticsStepStatus()
+        self.stdio = RecordingLogFile('stdio')
+        self.cmd.useLog(self.stdio, closeWhenFinished=True)
+        self.other = RecordingLogFile('other')
+        self.cmd.useLog(self.other)
+        self.cmd.updates = {}
+
+    def test_start_compressUpdates(self):
+        self.cmd.step.slaveVersionIsOlderThan.return_value = False
+        self.cmd.remote = mock.Mock()
+        self.cmd.commandID = '1'
+        self.cmd.start()
+        args = self.cmd.remote.callRemote.call_args[0][4]
+        self.assertEqual(args['compressUpdates'], ['zlib'])
+
+    def test_decompress(self):
+        text = 'compiling\n' * 100
+        self.cmd.remoteUpdate({'compressed' :
+                               ('stdout', None, zlib.compress(text))})
+        self.cmd.remoteUpdate({'compressed' :
+                               ('log', 'other', zlib.compress('xyz'))})
+        self.cmd.remoteUpdate({'stderr' : 'oops'})
+        self.assertEqual(self.stdio.chunks, [('o', text), ('e', 'oops')])
+        self.assertEqual(self.other.chunks, [('o', 'xyz')])
+
+        self.cmd.remoteComplete(None)
+        wire = len(zlib.compress(text)) + len(zlib.compress('xyz')) + 4
+        self.assertEqual(self.cmd.step.step_status.statistics, {
+            'log_bytes_wire' : wire,
+            'log_bytes_logged' : len(text) + 7 })
+        self.assertTrue(self.stdio.finished)
+
+    def test_filter(self):
+        self.cmd.remoteUpdate({'filter' : {'counts' : {'failures' : 2},
+                                           'lines' : 1000, 'linesSent' : 12,
+                                           'bytes' : 20000,
+                                           'kept' : 'test.log'}})
+        self.assertEqual(self.stdio.chunks, [('h', "\noutput filtered on the "
+                "slave: sent 12 of 1000 lines; complete output kept in "
+                "test.log\n")])
+        self.assertEqual(self.cmd.step.step_status.statistics, {
+            'failures' : 2, 'filter_lines' : 1000, 'filter_lines_sent' : 12 })
+
+    def test_shell_logFilter(self):
+        cmd = RemoteShellCommand('build', ['make'],
+                                 logFilter={'patterns' : ['^FAIL']})
+        self.assertEqual(cmd.args['logFilter'], {'patterns' : ['^FAIL']})
+        cmd = RemoteShellCommand('build', ['make'])
+        self.assertFalse('logFilter' in cmd.args)
+
+    def test_buffering(self):
+        self.cmd.remoteUpdate({'buffering' : {'rate' : 100.0, 'flushes' : 3,
+                                              'size' : 10, 'interval' : 0.5}})
+        self.assertEqual(self.cmd.step.step_status.statistics, {
+            'output_rate' : 100.0, 'output_flushes' : 3,
+            'output_size' : 10, 'output_interval' : 0.5 })
+
+    def test_onDemandLogs(self):
+        info = {'filename' : 'test.log', 'size' : 10, 'sha1' : 'abc'}
+        self.cmd.remoteUpdate({'onDemandLogs' : {'test' : info}})
+        self.assertEqual(self.cmd.onDemandLogs, {'test' : info})
+
+class TestOnDemandLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.cmd = LoggedRemoteCommand('shell', {'workdir' : 'build'})
+        self.cmd.onDemandLogs = {
+            'test' : {'filename' : 'test.log', 'size' : 10, 'sha1' : 'abc'},
+            'empty' : {'filename' : 'empty.log', 'size' : 0, 'sha1' : 'def'} }
+        self.logs = {}
+        self.commands = []
+
+    def makeStep(self, copyOnDemandLogs='failure'):
+        step = LoggingBuildStep(copyOnDemandLogs=copyOnDemandLogs)
+        step.getSlaveName = lambda : 'slave1'
+        def runCommand(cmd):
+            self.commands.append(cmd)
+            return defer.succeed(None)
+        step.runCommand = runCommand
+        for name in ('test', 'empty', 'missing'):
+            self.logs[name] = step.onDemandLogs[name] = RecordingLogFile(name)
+        return step
+
+    def test_setupLogfiles(self):
+        step = LoggingBuildStep()
+        step.slaveVersionIsOlderThan = lambda cmd, version: False
+        step.addLog = lambda name: RecordingLogFile(name)
+        step.setupLogfiles(self.cmd, {'test' : {'filename' : 'test.log',
+                                                'onDemand' : True}})
+        self.assertEqual(step.onDemandLogs.keys(), ['test'])
+        self.assertEqual(self.cmd.logs, {})
+
+    def test_success(self):
+        d = self.makeStep().finishOnDemandLogs(SUCCESS, self.cmd)
+        def check(results):
+            self.assertEqual(results, SUCCESS)
+            self.assertEqual(self.commands, [])
+            test = self.logs['test']
+            self.assertEqual(test.remoteFile, {'filename' : 'test.log',
+                        'size' : 10, 'sha1' : 'abc', 'slavename' : 'slave1',
+                        'workdir' : 'build', 'copied' : False})
+            self.assertEqual(test.chunks, [('h', "kept on slave slave1 as "
+                        "test.log (10 bytes, sha1 abc)\n")])
+            self.assertTrue(test.finished)
+            self.assertEqual(self.logs['missing'].chunks,
+                        [('h', "the logfile was not found on the slave\n")])
+            self.assertTrue(self.logs['missing'].finished)
+        d.addCallback(check)
+        return d
+
+    def test_failure(self):
+        d = self.makeStep().finishOnDemandLogs(FAILURE, self.cmd)
+        def check(results):
+            self.assertEqual(results, FAILURE)
+            self.assertEqual([ (c.remote_command, c.args) for c in self.commands ],
+                             [ ('readFile', {'workdir' : 'build',
+                                             'filename' : 'test.log',
+                                             'logname' : 'test'}) ])
+            self.assertEqual(self.commands[0].logs, {'test' : self.logs['test']})
+            self.assertTrue(self.logs['test'].remoteFile['copied'])
+            # there is nothing to copy from an empty file
+            self.assertFalse(self.logs['empty'].remoteFile['copied'])
+            self.assertTrue(self.logs['empty'].finished)
+        d.addCallback(check)
+        return d
+
+    def test_never(self):
+        step = self.makeStep(copyOnDemandLogs='never')
+        d = step.finishOnDemandLogs(FAILURE, self.cmd)
+        d.addCallback(lambda _ : self.assertEqual(self.commands, []))
+        return d
@@ -0,0 +1,101 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from buildbot.status import builder
+
+class TestLogFileParts(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        step = mock.Mock()
+        step.build.builder.basedir = self.basedir
+        self.logfile = builder.LogFile(step, 'stdio', 'log')
+        self.logfile.chunkSize = 64 # force lots of small entries
+
+        # lines containing things that look like netstring headers
+        self.lines = [ "line %d,12:0 text\n" % i for i in range(100) ]
+        for i, line in enumerate(self.lines):
+            if i % 10 == 0:
+                self.logfile.addHeader("header %d\n" % i)
+            self.logfile.addStdout(line)
+        self.text = ''.join(self.lines)
+
+    def join(self, chunks):
+        return ''.join([ text for channel, text in chunks ])
+
+    def test_range(self):
+        chunks = self.logfile.getChunksInRange(123, 456,
+                                    [builder.STDOUT, builder.STDERR])
+        self.assertEqual(self.join(chunks), self.text[123:579])
+
+    def test_range_with_headers(self):
+        self.logfile.finish()
+        full = self.logfile.getTextWithHeaders()
+        self.assertEqual(self.join(self.logfile.getChunksInRange(50, 1000)),
+                         full[50:1050])
+
+    def test_range_past_end(self):
+        chunks = self.logfile.getChunksInRange(len(self.text), 100,
+                                    [builder.STDOUT, builder.STDERR])
+        self.assertEqual(chunks, [])
+
+    def test_range_unmerged(self):
+        self.logfile.addStderr("oops")
+        chunks = self.logfile.getChunksInRange(len(self.text) - 4, 100,
+                                    [builder.STDOUT, builder.STDERR])
+        self.assertEqual(chunks[-1], (builder.STDERR, "oops"))
+        self.assertEqual(self.join(chunks), self.text[-4:] + "oops")
+
+    def test_tail(self):
+        chunks = self.logfile.getTailChunks(5,
+                                    [builder.STDOUT, builder.STDERR])
+        self.assertEqual(self.join(chunks), ''.join(self.lines[-5:]))
+
+    def test_tail_partial_line(self):
+        self.logfile.addStdout("no newline")
+        self.logfile.finish()
+        chunks = self.logfile.getTailChunks(3,
+                                    [builder.STDOUT, builder.STDERR])
+        self.assertEqual(self.join(chunks),
+                         ''.join(self.lines[-2:]) + "no newline")
+
+    def test_tail_with_headers(self):
+        self.logfile.finish()
+        full = self.logfile.getTextWithHeaders()
+        self.assertEqual(self.join(self.logfile.getTailChunks(25)),
+                         ''.join(full.splitlines(True)[-25:]))
+
+    def test_tail_whole_log(self):
+        chunks = self.logfile.getTailChunks(1000,
+                                    [builder.STDOUT, builder.STDERR])
+        self.assertEqual(self.join(chunks), self.text)
+
+    def test_tail_compressed(self):
+        self.logfile.finish()
+        d = self.logfile.compressLog()
+        def check(_):
+            self.assertFalse(os.path.exists(self.logfile.getFilename()))
+            chunks = self.logfile.getTailChunks(5,
+                                    [builder.STDOUT, builder.STDERR])
+            self.assertEqual(self.join(chunks), ''.join(self.lines[-5:]))
+            chunks = self.logfile.getChunksInRange(123, 456,
+                                    [builder.STDOUT, builder.STDERR])
+            self.assertEqual(self.join(chunks), self.text[123:579])
+        d.addCallback(check)
+        return d
@@ -16,8 +16,11 @@
 from mock import Mock
 from buildbot.interfaces import ParameterError
 from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test import proto_helpers
 
-from buildbot.status.builder import SUCCESS, FAILURE
+from buildbot.status.builder import SUCCESS, FAILURE, HTMLLogFile
+from buildbot.status import mail
 from buildbot.status.mail import MailNotifier
 
 class FakeLog(object):
@@ -36,6 +39,10 @@ class FakeLog(object):
     def getText(self):
         return self.text
 
+    def getChunks(self, channels=[], onlyText=False):
+        for i in range(0, len(self.text), 10):
+            yield self.text[i:i+10]
+
 
 class TestMailNotifier(unittest.TestCase):
     def test_createEmail_message_without_patch_and_log_contains_unicode(self):
@@ -175,7 +182,134 @@ class TestMailNotifier(unittest.TestCase):
 
         self.assertEqual(None, mn.buildFinished('dummyBuilder', build, FAILURE))
         self.assertEqual(None, mn.buildFinished('dummyBuilder', build2, SUCCESS))
-    pass
+
+    def test_getLogText_unlimited(self):
+        mn = MailNotifier('from@example.org', addLogs=True)
+        text = ''.join([ 'line %d\n' % i for i in range(100) ])
+        self.assertEqual(mn._getLogText(FakeLog(text)), text)
+
+    def test_getLogText_truncated(self):
+        mn = MailNotifier('from@example.org', addLogs=True, maxLogSize=25)
+        text = ''.join([ 'line %d\n' % i for i in range(100) ])
+        self.assertEqual(mn._getLogText(FakeLog(text)),
+                         '[%d bytes truncated]\n' % (len(text) - 25)
+                         + text[-25:])
+
+    def test_getLogText_html(self):
+        mn = MailNotifier('from@example.org', addLogs=True, maxLogSize=10)
+        log = HTMLLogFile(Mock(), 'err.html', None, '<b>exception</b>')
+        self.assertEqual(mn._getLogText(log),
+                         '[6 bytes truncated]\neption</b>')
+
+    def test_createEmail_with_html_log(self):
+        step = Mock()
+        step.getName.return_value = 'step-name'
+        logs = [ HTMLLogFile(step, 'err.html', None, '<b>exception</b>') ]
+        mn = MailNotifier('from@example.org', addLogs=True)
+        m = mn.createEmail(create_msgdict(), 'builder', 'project', FAILURE,
+                           Mock(), None, logs)
+        attachment = m.get_payload()[1]
+        self.assertEqual(attachment.get_filename(), 'step-name.err.html')
+        self.assertEqual(attachment.get_payload(decode=True),
+                         '<b>exception</b>')
+
+    def test_sendmail_reuses_connection(self):
+        connectTCP = Mock()
+        self.patch(mail.reactor, 'connectTCP', connectTCP)
+        mn = MailNotifier('from@example.org')
+        mn.sendmail('message 1', ['a@example.org'])
+        mn.sendmail('message 2', ['b@example.org'])
+        self.assertEqual(connectTCP.call_count, 1)
+        factory = connectTCP.call_args[0][2]
+        self.assertEqual([ m.data for m in factory.queue ],
+                         [ 'message 1', 'message 2' ])
+
+    def test_digest_groups_per_recipient(self):
+        clock = task.Clock()
+        self.patch(mail.reactor, 'callLater', clock.callLater)
+        mn = MailNotifier('from@example.org', digestInterval=60,
+                          extraRecipients=['list@example.org'])
+        mn.master_status = Mock()
+        mn.master_status.getProjectName.return_value = 'proj'
+        sent = []
+        def sendMessage(m, recipients):
+            sent.append((m, recipients))
+            return mail.defer.succeed(None)
+        mn.sendMessage = sendMessage
+
+        build = Mock()
+        dl = []
+        for name in ('b1', 'b2', 'b3'):
+            msg = mn.createEmail(create_msgdict(), name, 'proj', FAILURE,
+                                 build)
+            dl.append(mn._gotRecipients(None, ['dev@example.org'], msg))
+        self.assertEqual(sent, [])
+        clock.advance(60)
+        self.assertEqual(sorted([ r for m, r in sent ]),
+                         [ ['dev@example.org'], ['list@example.org'] ])
+        for m, r in sent:
+            self.assertEqual(m.get_content_type(), 'multipart/digest')
+            self.assertEqual(len(m.get_payload()), 3)
+            self.assertEqual(m['To'], r[0])
+        for d in dl:
+            self.assertTrue(d.called)
+
+
+class TestBatchESMTPSender(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = [ mail.QueuedMail('message 1\n', ['a@example.org']),
+                       mail.QueuedMail('message 2\n', ['b@example.org']) ]
+        self.factory = mail.BatchESMTPSenderFactory(None, None,
+                'from@example.org', self.queue,
+                requireAuthentication=False, requireTransportSecurity=False)
+        self.proto = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def reply(self, line):
+        self.transport.clear()
+        self.proto.dataReceived(line + '\r\n')
+        return self.transport.value()
+
+    def deliver(self):
+        self.assertSubstring('MAIL FROM', self.reply('250 ok'))
+        self.assertSubstring('RCPT TO', self.reply('250 ok'))
+        self.assertSubstring('DATA', self.reply('250 ok'))
+        self.reply('354 go ahead')
+        self.sendData()
+        return self.reply('250 queued')
+
+    def sendData(self):
+        while self.transport.producer:
+            self.transport.producer.resumeProducing()
+
+    def test_two_messages_one_connection(self):
+        results = []
+        for m in self.queue:
+            m.deferred.addCallback(results.append)
+        self.assertSubstring('EHLO', self.reply('220 localhost ESMTP'))
+        self.assertSubstring('RSET', self.deliver())
+        self.assertEqual(len(results), 1)
+        self.assertSubstring('RSET', self.deliver())
+        self.assertEqual(len(results), 2)
+        self.assertSubstring('QUIT', self.reply('250 ok'))
+        self.assertEqual(self.queue, [])
+        self.assertEqual(self.factory.sendFinished, 1)
+
+    def test_failed_delivery(self):
+        errors = []
+        self.queue[0].deferred.addErrback(errors.append)
+        self.reply('220 localhost ESMTP')
+        self.reply('250 ok')
+        self.reply('250 ok')
+        self.reply('250 ok')
+        self.reply('354 go ahead')
+        self.sendData()
+        self.assertSubstring('RSET', self.reply('554 rejected'))
+        self.assertEqual(len(errors), 1)
+        errors[0].trap(mail.SMTPDeliveryError)
+        self.assertEqual(len(self.queue), 1)
 
 def create_msgdict():
     unibody = u'Unicode body with non-ascii (\u00E5\u00E4\u00F6).'
@@ -0,0 +1,99 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from buildbot.status.web import base
+from buildbot.test.fake.web import MockRequest
+
+class TestFragmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = base.FragmentCache()
+        self.renders = []
+
+    def render(self, value):
+        def render():
+            self.renders.append(value)
+            return value
+        return render
+
+    def makeRequest(self, prepath=['waterfall']):
+        req = MockRequest()
+        req.prepath = prepath
+        req.site.buildbot_service.fragmentCache = self.cache
+        return req
+
+    def test_hit(self):
+        self.assertEqual(self.cache.get('b', ('box', 1), self.render('x')), 'x')
+        self.assertEqual(self.cache.get('b', ('box', 1), self.render('y')), 'x')
+        self.assertEqual(self.renders, [ 'x' ])
+
+    def test_keys(self):
+        self.cache.get('b', ('box', 1), self.render('x'))
+        self.assertEqual(self.cache.get('b', ('box', 2), self.render('y')), 'y')
+        self.assertEqual(self.cache.get('c', ('box', 1), self.render('z')), 'z')
+        self.assertEqual(self.renders, [ 'x', 'y', 'z' ])
+
+    def test_invalidate(self):
+        self.cache.get('b', ('box', 1), self.render('x'))
+        self.cache.get('c', ('box', 1), self.render('y'))
+        self.cache.invalidate('b')
+        self.assertEqual(self.cache.get('b', ('box', 1), self.render('z')), 'z')
+        self.assertEqual(self.cache.get('c', ('box', 1), self.render('w')), 'y')
+        self.assertEqual(self.renders, [ 'x', 'y', 'z' ])
+
+    def test_builderAdded_removed(self):
+        self.cache.get('b', ('box', 1), self.render('x'))
+        self.failUnlessEqual(self.cache.builderAdded('b', mock.Mock()), None)
+        self.cache.get('b', ('box', 1), self.render('y'))
+        self.cache.builderRemoved('b')
+        self.cache.get('b', ('box', 1), self.render('z'))
+        self.assertEqual(self.renders, [ 'x', 'y', 'z' ])
+
+    def test_startWatching(self):
+        status = mock.Mock()
+        self.cache.startWatching(status)
+        status.subscribe.assert_called_with(self.cache)
+        self.cache.stopWatching()
+        status.unsubscribe.assert_called_with(self.cache)
+
+    def test_getFragment_finished(self):
+        req = self.makeRequest()
+        self.assertEqual(base.getFragment(req, 'b', ('box', 1), True,
+                                          self.render('x')), 'x')
+        self.assertEqual(base.getFragment(req, 'b', ('box', 1), True,
+                                          self.render('y')), 'x')
+        self.assertEqual(self.renders, [ 'x' ])
+
+    def test_getFragment_unfinished(self):
+        req = self.makeRequest()
+        self.assertEqual(base.getFragment(req, 'b', ('box', 1), False,
+                                          self.render('x')), 'x')
+        self.assertEqual(base.getFragment(req, 'b', ('box', 1), False,
+                                          self.render('y')), 'y')
+        # and nothing was cached for when it finishes
+        self.assertEqual(base.getFragment(req, 'b', ('box', 1), True,
+                                          self.render('z')), 'z')
+        self.assertEqual(self.renders, [ 'x', 'y', 'z' ])
+
+    def test_getFragment_path_to_root(self):
+        # fragments contain relative links, so pages at different depths do
+        # not share them
+        base.getFragment(self.makeRequest(['waterfall']), 'b', ('box', 1),
+                         True, self.render('x'))
+        base.getFragment(self.makeRequest(['builders', 'b']), 'b', ('box', 1),
+                         True, self.render('y'))
+        self.assertEqual(self.renders, [ 'x', 'y' ])
@@ -0,0 +1,283 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from buildbot.status.web import buildindex
+from buildbot.status.builder import SUCCESS, FAILURE
+
+class FakeStep(object):
+    def __init__(self, name, results, lognames=[]):
+        self.name = name
+        self.results = results
+        self.lognames = lognames
+
+    def getName(self):
+        return self.name
+
+    def getResults(self):
+        return (self.results, [self.name])
+
+    def getText(self):
+        return ['<b>%s</b>' % self.name, 'failed']
+
+    def getLogs(self):
+        logs = []
+        for n in self.lognames:
+            l = FakeLog()
+            l.name = n
+            logs.append(l)
+        return logs
+
+class FakeLog(object):
+    def getName(self):
+        return self.name
+
+class FakeSourceStamp(object):
+    def __init__(self, branch, revision):
+        self.branch = branch
+        self.revision = revision
+        self.patch = None
+
+class FakeBuild(object):
+    def __init__(self, builder, number, finished=True, results=SUCCESS,
+                 steps=[], properties={}, branch=None, revision=None,
+                 start=None):
+        self.builder = builder
+        self.number = number
+        self.ss = FakeSourceStamp(branch, revision)
+        if start is None:
+            start = (number + 1) * 10
+        self.start = start
+        self.finished = finished
+        self.results = results
+        self.steps = steps
+        self.properties = properties
+
+    def getNumber(self):
+        return self.number
+
+    def getResults(self):
+        return self.results
+
+    def getText(self):
+        return ['build', str(self.number)]
+
+    def getTimes(self):
+        return (self.start, None)
+
+    def isFinished(self):
+        return self.finished
+
+    def getETA(self):
+        return None
+
+    def getChanges(self):
+        return []
+
+    def getSourceStamp(self, absolute=False):
+        return self.ss
+
+    def getProperty(self, name):
+        return self.properties[name]
+
+    def getLogs(self):
+        return [ l for s in self.steps for l in s.getLogs() ]
+
+    def getSteps(self):
+        return self.steps
+
+    def getPreviousBuild(self):
+        if self.number == 0:
+            return None
+        return self.builder.getBuild(self.number - 1)
+
+class FakeBuilder(object):
+    def __init__(self, name):
+        self.name = name
+        self.builds = []
+        self.loads = 0
+
+    def getName(self):
+        return self.name
+
+    def getBuild(self, number):
+        if number < 0:
+            number += len(self.builds)
+        if number < 0 or number >= len(self.builds):
+            return None
+        self.loads += 1
+        return self.builds[number]
+
+    def addBuild(self, **kwargs):
+        b = FakeBuild(self, len(self.builds), **kwargs)
+        self.builds.append(b)
+        return b
+
+class TestBuildIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = buildindex.BuildIndex(maxBuilds=5)
+        self.builder = FakeBuilder('bldr')
+        self.builder2 = FakeBuilder('bldr2')
+
+    def numbers(self, summaries):
+        return [ s.number for s in summaries ]
+
+    def test_seed_from_history(self):
+        for i in range(8):
+            self.builder.addBuild()
+        self.assertEqual(self.numbers(self.index.getBuilds(self.builder, 3)),
+                         [7, 6, 5])
+        # already-summarized builds are not loaded again
+        loads = self.builder.loads
+        self.assertEqual(self.numbers(self.index.getBuilds(self.builder, 3)),
+                         [7, 6, 5])
+        self.assertEqual(self.builder.loads, loads)
+
+    def test_extend_and_limit(self):
+        for i in range(8):
+            self.builder.addBuild()
+        self.index.getBuilds(self.builder, 2)
+        self.assertEqual(self.numbers(self.index.getBuilds(self.builder, 20)),
+                         [7, 6, 5, 4, 3])
+
+    def test_skips_unfinished(self):
+        self.builder.addBuild()
+        self.builder.addBuild(finished=False)
+        self.assertEqual(self.numbers(self.index.getBuilds(self.builder, 5)),
+                         [0])
+
+    def test_buildFinished(self):
+        self.builder.addBuild()
+        running = self.builder.addBuild(finished=False)
+        self.index.getBuilds(self.builder, 5)
+        b2 = self.builder.addBuild()
+        self.index.buildFinished('bldr', b2, SUCCESS)
+        running.finished = True
+        self.index.buildFinished('bldr', running, SUCCESS)
+        self.index.buildFinished('bldr', running, SUCCESS)
+        self.assertEqual(self.numbers(self.index.getBuilds(self.builder, 5)),
+                         [2, 1, 0])
+
+    def test_buildFinished_unseeded(self):
+        b = self.builder.addBuild()
+        self.index.buildFinished('bldr', b, SUCCESS)
+        self.assertEqual(self.index.builders, {})
+
+    def test_prune(self):
+        for i in range(5):
+            self.builder.addBuild()
+        self.index.getBuilds(self.builder, 5)
+        b = self.builder.addBuild()
+        self.index.buildFinished('bldr', b, SUCCESS)
+        self.assertEqual(self.numbers(self.index.getBuilds(self.builder, 5)),
+                         [5, 4, 3, 2, 1])
+
+    def test_builderRemoved(self):
+        self.builder.addBuild()
+        self.index.getBuilds(self.builder, 5)
+        self.index.builderRemoved('bldr')
+        self.assertEqual(self.index.builders, {})
+
+    def test_summary(self):
+        steps = [ FakeStep('compile', SUCCESS, ['stdio']),
+                  FakeStep('test', FAILURE, ['stdio', 'results']) ]
+        b = self.builder.addBuild(results=FAILURE, steps=steps,
+                                  properties={'got_revision' : '1234'})
+        s = buildindex.BuildSummary('bldr', b)
+        self.assertEqual((s.number, s.results, s.got_revision, s.revision),
+                         (0, FAILURE, '1234', None))
+        self.assertEqual(s.failure, dict(stepname='test', status='test failed',
+                                         reason=['test'],
+                                         lognames=['stdio', 'results']))
+
+    def test_summary_no_logs(self):
+        steps = [ FakeStep('test', FAILURE) ]
+        b = self.builder.addBuild(results=FAILURE, steps=steps)
+        self.assertEqual(buildindex.BuildSummary('bldr', b).failure, None)
+
+    def stamps(self, entries):
+        return [ (e.sourceStamp.branch, e.sourceStamp.revision,
+                  sorted((n, b.number) for n, b in e.builds.items()))
+                 for e in entries ]
+
+    def test_getSourceStamps(self):
+        self.builder.addBuild(revision='1', start=10)
+        self.builder.addBuild(revision='2', start=30)
+        self.builder.addBuild(revision='3', branch='br', start=40)
+        self.builder2.addBuild(revision='2', start=20)
+        self.builder2.addBuild(revision='2', start=50)
+        builders = [ self.builder, self.builder2 ]
+        self.assertEqual(self.stamps(
+            self.index.getSourceStamps(builders, buildindex.ANYBRANCH, 5)),
+            [ ('br', '3', [('bldr', 2)]),
+              (None, '2', [('bldr', 1), ('bldr2', 1)]),
+              (None, '1', [('bldr', 0)]) ])
+        self.assertEqual(self.stamps(
+            self.index.getSourceStamps(builders, None, 1)),
+            [ (None, '2', [('bldr', 1), ('bldr2', 1)]) ])
+        self.assertEqual(self.stamps(
+            self.index.getSourceStamps([ self.builder2 ], 'br', 5)), [])
+
+    def test_getSourceStamps_buildFinished(self):
+        self.builder.addBuild(revision='1')
+        self.index.getSourceStamps([ self.builder ], None, 5)
+        b = self.builder.addBuild(revision='2')
+        self.index.buildFinished('bldr', b, SUCCESS)
+        self.assertEqual(self.stamps(
+            self.index.getSourceStamps([ self.builder ], None, 5)),
+            [ (None, '2', [('bldr', 1)]), (None, '1', [('bldr', 0)]) ])
+
+    def test_getSourceStamps_prune(self):
+        for i in range(6):
+            self.builder.addBuild(revision=str(i))
+        self.index.getSourceStamps([ self.builder ], None, 5)
+        b = self.builder.addBuild(revision='6')
+        self.index.buildFinished('bldr', b, SUCCESS)
+        self.assertEqual([ e.sourceStamp.revision for e in
+            self.index.getSourceStamps([ self.builder ], None, 10) ],
+            [ '6', '5', '4', '3', '2' ])
+        self.assertEqual(len(self.index.stampOrder[buildindex.ANYBRANCH]), 5)
+
+    def test_getSourceStamps_prune_reorders(self):
+        # the oldest build of 'a' is pruned, so 'a' now sorts by its newer
+        # build, ahead of the others
+        self.builder.addBuild(revision='a', start=10)
+        for i in range(4):
+            self.builder.addBuild(revision=str(i), start=20 + i)
+        self.index.getSourceStamps([ self.builder ], None, 5)
+        b = self.builder.addBuild(revision='a', start=60)
+        self.index.buildFinished('bldr', b, SUCCESS)
+        self.assertEqual(self.stamps(
+            self.index.getSourceStamps([ self.builder ], None, 2)),
+            [ (None, 'a', [('bldr', 5)]), (None, '3', [('bldr', 4)]) ])
+        self.assertEqual(self.index.stamps[(None, 'a', None)].start, 60)
+
+    def test_unindex_falls_back(self):
+        self.builder.addBuild(revision='a', start=10)
+        self.builder.addBuild(revision='a', start=20)
+        self.builder2.addBuild(revision='a', start=15)
+        builders = [ self.builder, self.builder2 ]
+        self.index.getSourceStamps(builders, None, 5)
+        e = self.index.stamps[(None, 'a', None)]
+        newest = e.builds['bldr']
+        self.assertEqual(newest.number, 1)
+        self.index._unindexStamp(newest)
+        self.assertEqual(self.stamps([ e ]), [ (None, 'a', [('bldr', 0),
+                                                            ('bldr2', 0)]) ])
+        self.index._unindexStamp(e.builds['bldr'])
+        self.assertEqual(self.stamps([ e ]), [ (None, 'a', [('bldr2', 0)]) ])
+        self.assertEqual(e.start, 15)
+        self.assertEqual(self.index.stampOrder[None], [ (15, e.key) ])
@@ -0,0 +1,139 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import cgi
+from twisted.trial import unittest
+from buildbot.status.web import grid, buildindex
+from buildbot.test.fake.web import MockRequest
+from buildbot.test.unit import test_status_web_buildindex as fakes
+
+class FakeBuilder(fakes.FakeBuilder):
+    def __init__(self, name):
+        fakes.FakeBuilder.__init__(self, name)
+        self.current = []
+
+    def getCurrentBuilds(self):
+        return self.current
+
+class TestGridPaging(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = grid.GridStatusMixin()
+        self.builder = FakeBuilder('bldr')
+        self.builder2 = FakeBuilder('bldr2')
+
+    def makeRequest(self, args={}, maxBuilds=None):
+        req = MockRequest(args)
+        req.site.buildbot_service.buildIndex = \
+                buildindex.BuildIndex(maxBuilds=maxBuilds)
+        return req
+
+    def revisions(self, stamps):
+        return [ ss.revision for ss, builds in stamps ]
+
+    def test_get_page_args(self):
+        req = self.makeRequest({'width' : ['3'], 'offset' : ['6']})
+        self.assertEqual(self.grid.get_page_args(req, 'width'), (6, 3))
+        self.assertEqual(self.grid.get_page_args(req, 'length'), (6, 5))
+
+    def test_get_page_args_bad(self):
+        req = self.makeRequest({'width' : ['x'], 'offset' : ['2']})
+        self.assertEqual(self.grid.get_page_args(req, 'width'), (0, 5))
+        req = self.makeRequest({'width' : ['0'], 'offset' : ['-4']})
+        self.assertEqual(self.grid.get_page_args(req, 'width'), (0, 1))
+
+    def test_page_link(self):
+        req = self.makeRequest({'branch' : ['br'], 'offset' : ['3'],
+                                'category' : ['a', 'b']})
+        link = self.grid.page_link(req, 8)
+        self.assertEqual(cgi.parse_qs(link[1:]),
+                         {'branch' : ['br'], 'offset' : ['8'],
+                          'category' : ['a', 'b']})
+
+    def test_page_cxt(self):
+        req = self.makeRequest({'offset' : ['3']})
+        cxt = self.grid.page_cxt(req, 3, 5, 5)
+        self.assertEqual((cxt['offset'], cxt['width']), (3, 5))
+        self.assertEqual(cgi.parse_qs(cxt['older_url'][1:])['offset'], ['8'])
+        self.assertEqual(cgi.parse_qs(cxt['newer_url'][1:])['offset'], ['0'])
+
+    def test_page_cxt_ends(self):
+        req = self.makeRequest()
+        cxt = self.grid.page_cxt(req, 0, 5, 2)
+        self.failIf('older_url' in cxt)
+        self.failIf('newer_url' in cxt)
+
+    def test_getRecentSourcestamps_offset(self):
+        for i in range(10):
+            self.builder.addBuild(revision=str(i))
+        req = self.makeRequest()
+        builders = [ self.builder ]
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, builders, 0, 3, buildindex.ANYBRANCH)),
+                    [ '7', '8', '9' ])
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, builders, 3, 3, buildindex.ANYBRANCH)),
+                    [ '4', '5', '6' ])
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, builders, 8, 3, buildindex.ANYBRANCH)),
+                    [ '0', '1' ])
+
+    def test_getRecentSourcestamps_branch(self):
+        # builds on 'br' are rare, so the index must look deeper than the
+        # requested page to fill it
+        for i in range(20):
+            if i % 5 == 0:
+                self.builder.addBuild(revision=str(i), branch='br')
+            else:
+                self.builder.addBuild(revision=str(i))
+        req = self.makeRequest()
+        builders = [ self.builder ]
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, builders, 0, 3, 'br')),
+                    [ '5', '10', '15' ])
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, builders, 2, 3, 'br')),
+                    [ '0', '5' ])
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, builders, 0, 2, None)),
+                    [ '18', '19' ])
+
+    def test_getRecentSourcestamps_branch_maxBuilds(self):
+        # but no deeper than maxBuilds
+        for i in range(20):
+            if i % 5 == 0:
+                self.builder.addBuild(revision=str(i), branch='br')
+            else:
+                self.builder.addBuild(revision=str(i))
+        req = self.makeRequest(maxBuilds=8)
+        self.assertEqual(self.revisions(self.grid.getRecentSourcestamps(
+                    req, [ self.builder ], 0, 3, 'br')),
+                    [ '15' ])
+
+    def test_getRecentSourcestamps_current(self):
+        self.builder.addBuild(revision='1')
+        self.builder2.addBuild(revision='1')
+        running = self.builder.addBuild(revision='2', finished=False)
+        self.builder.current = [ running ]
+        other = self.builder2.addBuild(revision='3', branch='br',
+                                       finished=False)
+        self.builder2.current = [ other ]
+        req = self.makeRequest()
+        stamps = self.grid.getRecentSourcestamps(req,
+                [ self.builder, self.builder2 ], 0, 5, None)
+        self.assertEqual(self.revisions(stamps), [ '1', '2' ])
+        self.assertEqual(sorted(stamps[0][1].keys()), [ 'bldr', 'bldr2' ])
+        self.assertEqual(stamps[1][1]['bldr'].number, 1)
+        self.failIf(stamps[1][1]['bldr'].isFinished)
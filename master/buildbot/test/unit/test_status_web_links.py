@@ -237,3 +237,36 @@ class UserFilter(unittest.TestCase):
         
         
         
+
+
+class MemoizedFilter(unittest.TestCase):
+    '''test that filter results are remembered'''
+
+    def setUp(self):
+        self.calls = []
+        def f(value, arg):
+            self.calls.append((value, arg))
+            return '%s-%s' % (value, arg)
+        self.f = wb.memoizedfilter(f, max_size=2)
+
+    def test_memoized(self):
+        self.assertEquals(self.f('a', 'repo'), 'a-repo')
+        self.assertEquals(self.f('a', 'repo'), 'a-repo')
+        self.assertEquals(self.f('a', 'repo2'), 'a-repo2')
+        self.assertEquals(self.calls, [('a', 'repo'), ('a', 'repo2')])
+
+    def test_evicted(self):
+        for v in ['a', 'b', 'c', 'a']:
+            self.f(v, None)
+        self.assertEquals(len(self.calls), 4)
+
+    def test_unhashable(self):
+        self.assertEquals(self.f(['a'], None), "['a']-None")
+        self.assertEquals(self.f(['a'], None), "['a']-None")
+        self.assertEquals(len(self.calls), 2)
+
+    def test_changecomment(self):
+        env = wb.createJinjaEnv(
+            changecommentlink=(r'#(\d+)', r'http://buildbot.net/trac/ticket/\1'))
+        f = env.filters['changecomment']
+        self.assertIdentical(f('fixed #123', None), f('fixed #123', None))
@@ -0,0 +1,218 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import zlib
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from buildbot.status import builder
+from buildbot.status.web import logs
+
+class FakeRequest(object):
+    def __init__(self, args={}, headers={}):
+        self.args = args
+        self.headers = headers
+        self.responseHeaders = {}
+        self.code = 200
+        self.written = []
+        self.finished = False
+
+    def getHeader(self, name):
+        return self.headers.get(name)
+
+    def setHeader(self, name, value):
+        self.responseHeaders[name] = value
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+
+class TestTextLog(unittest.TestCase):
+
+    def setUp(self):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        step = mock.Mock()
+        step.build.builder.basedir = basedir
+        self.logfile = builder.LogFile(step, 'stdio', 'log')
+        self.logfile.addHeader("running\n")
+        self.lines = [ "line %d\n" % i for i in range(50) ]
+        for line in self.lines:
+            self.logfile.addStdout(line)
+        self.logfile.finish()
+
+    def render(self, **kwargs):
+        req = FakeRequest(**kwargs)
+        textlog = logs.TextLog(self.logfile)
+        textlog.asText = True
+        textlog.render_GET(req)
+        self.failUnless(req.finished)
+        return req
+
+    def test_tail(self):
+        req = self.render(args={'tail' : ['3']})
+        self.assertEqual(''.join(req.written), ''.join(self.lines[-3:]))
+
+    def test_offset_length(self):
+        req = self.render(args={'offset' : ['7'], 'length' : ['14']})
+        self.assertEqual(''.join(req.written), ''.join(self.lines)[7:21])
+
+    def test_range(self):
+        req = self.render(headers={'range' : 'bytes=7-20'})
+        self.assertEqual(''.join(req.written), ''.join(self.lines)[7:21])
+        self.assertEqual(req.code, 206)
+        self.assertEqual(req.responseHeaders['content-range'], 'bytes 7-20/*')
+
+    def test_range_suffix(self):
+        req = self.render(headers={'range' : 'bytes=-8'})
+        self.assertEqual(''.join(req.written), ''.join(self.lines[-1:]))
+        self.assertEqual(req.code, 206)
+
+    def test_range_unsatisfiable(self):
+        req = self.render(headers={'range' : 'bytes=100000-'})
+        self.assertEqual(req.code, 416)
+        self.assertEqual(req.responseHeaders['content-range'],
+                         'bytes */%d' % len(''.join(self.lines)))
+
+    def test_gzip(self):
+        req = self.render(args={'tail' : ['2']},
+                          headers={'accept-encoding' : 'deflate, gzip'})
+        self.assertEqual(req.responseHeaders['content-encoding'], 'gzip')
+        data = zlib.decompress(''.join(req.written), 16 + zlib.MAX_WBITS)
+        self.assertEqual(data, ''.join(self.lines[-2:]))
+
+    def test_range_not_gzipped(self):
+        req = self.render(headers={'range' : 'bytes=7-20',
+                                   'accept-encoding' : 'gzip'})
+        self.failIf('content-encoding' in req.responseHeaders)
+        self.assertEqual(''.join(req.written), ''.join(self.lines)[7:21])
+        self.assertEqual(req.code, 206)
+
+class FakeRemote(object):
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def callRemote(self, method, workdir, filename, *args):
+        if method == "hashFile":
+            return defer.succeed({ 'size' : len(self.data),
+                                   'sha1' : sha1(self.data).hexdigest() })
+        assert method == "readFile"
+        offset, length = args
+        self.reads.append((offset, length))
+        return defer.succeed(self.data[offset:offset+length])
+
+class TestRemoteTextLog(unittest.TestCase):
+
+    def setUp(self):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        step = mock.Mock()
+        step.build.builder.basedir = basedir
+        step.getBuild().getBuilder().getName.return_value = 'bldr'
+        self.logfile = builder.LogFile(step, 'test', 'log')
+        self.logfile.addHeader("kept on slave\n")
+        self.logfile.finish()
+        self.text = ''.join([ "line %d\n" % i for i in range(1000) ])
+        self.logfile.setRemoteFile({'slavename' : 'slave1',
+                                    'workdir' : 'build',
+                                    'filename' : 'test.log',
+                                    'size' : len(self.text),
+                                    'sha1' : sha1(self.text).hexdigest(),
+                                    'copied' : False })
+
+        self.remote = FakeRemote(self.text)
+        sb = mock.Mock()
+        sb.slave.slavename = 'slave1'
+        sb.remote = self.remote
+        sb.getSlaveCommandVersion.return_value = '2.22'
+        self.sb = sb
+        self.status = mock.Mock()
+        self.status.botmaster.builders = {'bldr' : mock.Mock()}
+        self.status.botmaster.builders['bldr'].slaves = [ sb ]
+
+    def render(self, **kwargs):
+        req = FakeRequest(**kwargs)
+        req.site = mock.Mock()
+        req.site.buildbot_service.getStatus.return_value = self.status
+        textlog = logs.TextLog(self.logfile)
+        textlog.asText = True
+        textlog.remoteReadLength = 1000
+        textlog.remoteTailLength = 100
+        textlog.render_GET(req)
+        self.failUnless(req.finished)
+        return req
+
+    def test_whole(self):
+        req = self.render()
+        self.assertEqual(''.join(req.written), self.text)
+        self.assertEqual(len(self.remote.reads),
+                         (len(self.text) + 999) / 1000)
+
+    def test_tail(self):
+        req = self.render(args={'tail' : ['3']})
+        self.assertEqual(''.join(req.written),
+                         ''.join(self.text.splitlines(True)[-3:]))
+        self.assertEqual(self.remote.reads, [(len(self.text) - 100, 100)])
+
+    def test_range(self):
+        req = self.render(headers={'range' : 'bytes=7-20'})
+        self.assertEqual(''.join(req.written), self.text[7:21])
+        self.assertEqual(req.code, 206)
+        self.assertEqual(req.responseHeaders['content-range'],
+                         'bytes 7-20/%d' % len(self.text))
+
+    def test_range_not_gzipped(self):
+        req = self.render(headers={'range' : 'bytes=7-20',
+                                   'accept-encoding' : 'gzip'})
+        self.failIf('content-encoding' in req.responseHeaders)
+        self.assertEqual(''.join(req.written), self.text[7:21])
+        self.assertEqual(req.code, 206)
+
+    def test_offset_length(self):
+        req = self.render(args={'offset' : ['1500'], 'length' : ['2000']})
+        self.assertEqual(''.join(req.written), self.text[1500:3500])
+        self.assertEqual(self.remote.reads, [(1500, 1000), (2500, 1000)])
+
+    def test_overwritten(self):
+        self.remote.data = self.text.replace('line 5', 'LINE 5')
+        req = self.render()
+        self.assertEqual(''.join(req.written), "this log has been overwritten "
+                         "or removed on slave slave1 since the build, and is "
+                         "no longer available\n")
+        self.assertEqual(self.remote.reads, [])
+
+    def test_old_slave_unchecked(self):
+        # slaves before 2.22 cannot hash files, so the log is sent unchecked
+        self.sb.getSlaveCommandVersion.return_value = '2.19'
+        self.remote.data = self.text.replace('line 5', 'LINE 5')
+        req = self.render(args={'offset' : ['0'], 'length' : ['100']})
+        self.assertEqual(''.join(req.written), self.remote.data[:100])
+
+    def test_not_connected(self):
+        self.status.botmaster.builders['bldr'].slaves = []
+        req = self.render()
+        self.assertEqual(''.join(req.written), "this log is kept on slave "
+                         "slave1, which is not connected\n")
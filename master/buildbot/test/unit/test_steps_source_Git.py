@@ -0,0 +1,67 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+
+from buildbot.steps.source import Git
+from buildbot.interfaces import BuildSlaveTooOldError
+
+class TestGit(unittest.TestCase):
+
+    def makeStep(self, slavever='2.20', **kwargs):
+        step = Git(repourl='git://example.com/proj.git', **kwargs)
+        step.build = mock.Mock()
+        step.build.getSlaveCommandVersion.return_value = slavever
+        step.build.getProperty.side_effect = KeyError
+        step.build.getSourceStamp().repository = None
+        step.step_status = mock.Mock()
+        step.startCommand = mock.Mock()
+        return step
+
+    def test_shallow_sparse(self):
+        step = self.makeStep(shallow=50, sparse_paths=['doc/'])
+        step.startVC(None, 'abcdef', None)
+        cmd = step.startCommand.call_args[0][0]
+        self.assertEqual((cmd.args['shallow'], cmd.args['sparse_paths'],
+                          cmd.args['revision']), (50, ['doc/'], 'abcdef'))
+
+    def test_old_slave_sparse(self):
+        step = self.makeStep(slavever='2.19', sparse_paths=['doc/'])
+        self.assertRaises(BuildSlaveTooOldError,
+                          lambda : step.startVC(None, None, None))
+
+    def test_old_slave_depth(self):
+        step = self.makeStep(slavever='2.19', shallow=50)
+        self.assertRaises(BuildSlaveTooOldError,
+                          lambda : step.startVC(None, None, None))
+
+    def test_old_slave_shallow(self):
+        step = self.makeStep(slavever='2.19', shallow=True)
+        step.startVC(None, None, None)
+        cmd = step.startCommand.call_args[0][0]
+        self.failIf('sparse_paths' in cmd.args)
+
+    def test_fetch_statistics(self):
+        step = self.makeStep(shallow=True)
+        cmd = mock.Mock()
+        cmd.updates = { 'fetch' : [ dict(fetches=2, elapsed=1.5, depth=10,
+                                          deepened=1) ] }
+        step.commandComplete(cmd)
+        self.assertEqual(sorted(step.step_status.setStatistic.call_args_list),
+                         sorted([ (('git_fetch_time', 1.5), {}),
+                                  (('git_fetch_count', 2), {}),
+                                  (('git_fetch_depth', 10), {}),
+                                  (('git_fetch_deepened', 1), {}) ]))
@@ -13,6 +13,7 @@
 #
 # Copyright Buildbot Team Members
 
+import mock
 from twisted.trial import unittest
 
 from buildbot.steps.source import Source
@@ -74,4 +75,18 @@ class RepoURL(unittest.TestCase):
         func = lambda x: x+"%(foo)s"
         self.assertEquals(s.computeRepositoryURL(func), "testbar")
 
+class CopyMethod(unittest.TestCase):
 
+    def test_args(self):
+        self.assertFalse('copy_method' in Source(mode='copy').args)
+        s = Source(mode='copy', copyMethod='rsync')
+        self.assertEqual(s.args['copy_method'], 'rsync')
+
+    def test_statistics(self):
+        s = Source(mode='copy')
+        s.step_status = mock.Mock()
+        cmd = mock.Mock()
+        cmd.updates = { 'copy' : [ dict(method='reflink', elapsed=1.5) ] }
+        s.commandComplete(cmd)
+        s.step_status.setStatistic.assert_any_call('copy_time', 1.5)
+        s.step_status.setStatistic.assert_any_call('copy_method', 'reflink')
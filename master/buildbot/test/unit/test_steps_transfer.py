@@ -13,15 +13,24 @@
 #
 # Copyright Buildbot Team Members
 
-import tempfile, os
+import tempfile, os, tarfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from cStringIO import StringIO
 from twisted.trial import unittest
+from twisted.internet import defer
 
 from mock import Mock
 
 from buildbot.process.properties import Properties
+from buildbot.status.builder import FAILURE
 from buildbot.util import json
 from buildbot.steps.transfer import StringDownload, JSONStringDownload, JSONPropertiesDownload, \
-    FileUpload
+    FileUpload, _reportThroughput, _DirectoryWriter, _ContentWriter, \
+    ContentStore, MultipleFileUpload, MultipleFileDownload, \
+    _MultipleFileWriter
 
 class TestFileUpload(unittest.TestCase):
     def setUp(self):
@@ -36,7 +45,7 @@ class TestFileUpload(unittest.TestCase):
         s = FileUpload(slavesrc=__file__, masterdest=self.destfile)
         s.build = Mock()
         s.build.getProperties.return_value = Properties()
-        s.build.getSlaveCommandVersion.return_value = 1
+        s.build.getSlaveCommandVersion.return_value = "2.12"
 
         s.step_status = Mock()
         s.buildslave = Mock()
@@ -61,12 +70,110 @@ class TestFileUpload(unittest.TestCase):
         self.assertEquals(open(self.destfile, "rb").read(),
                 open(__file__, "rb").read())
 
+    def startStep(self, slaveVersion, commandName='uploadFile', **kwargs):
+        s = FileUpload(slavesrc=__file__, masterdest=self.destfile, **kwargs)
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.build.getSlaveCommandVersion.return_value = slaveVersion
+
+        s.step_status = Mock()
+        s.buildslave = Mock()
+        s.remote = Mock()
+
+        s.start()
+        for c in s.remote.method_calls:
+            name, command, args = c
+            if command[3] == commandName:
+                return s, command[-1]
+        self.fail("No %s command found" % commandName)
+
+    def testWindow(self):
+        s, kwargs = self.startStep("2.13", window=4, maxBlocksize=65536)
+        self.assertEquals(kwargs['window'], 4)
+        self.assertEquals(kwargs['maxblocksize'], 65536)
+        kwargs['writer'].remote_close()
+
+    def testWindowOldSlave(self):
+        s, kwargs = self.startStep("2.12")
+        self.assert_('window' not in kwargs)
+        self.assert_('maxblocksize' not in kwargs)
+        kwargs['writer'].remote_close()
+
+    def testThroughput(self):
+        s, kwargs = self.startStep("2.13")
+        writer = kwargs['writer']
+        writer.remote_write('x' * 1000)
+        writer.remote_close()
+        writer.started -= 2 # pretend that took two seconds
+        _reportThroughput(s, writer)
+        s.step_status.setStatistic.assert_called_with('throughput',
+                                                      writer.getThroughput())
+        self.assertAlmostEqual(writer.getThroughput(), 500, 0)
+        text = s.step_status.setText.call_args[0][0]
+        self.assertEquals(text[:2], ['uploading', os.path.basename(__file__)])
+        self.assert_(text[2].endswith(' B/s'))
+
+    def testContentStore(self):
+        store = os.path.abspath(self.mktemp())
+        s, kwargs = self.startStep("2.14", commandName='uploadContent',
+                                   contentStore=store)
+        writer = kwargs['writer']
+        self.assert_(isinstance(writer, _ContentWriter))
+        content = open(__file__, "rb").read()
+        digest = sha1(content).hexdigest()
+        self.assertEquals(writer.remote_manifest([('f', '', digest,
+                                                   len(content), 0644)]),
+                          [ digest ])
+        writer.remote_open(digest)
+        writer.remote_write(content)
+        writer.remote_finish()
+        d = writer.remote_close()
+        def check(_):
+            self.assertEquals(open(self.destfile, "rb").read(), content)
+        d.addCallback(check)
+        return d
+
+    def testContentStoreInstance(self):
+        store = ContentStore(os.path.abspath(self.mktemp()))
+        s, kwargs = self.startStep("2.14", commandName='uploadContent',
+                                   contentStore=store)
+        writer = kwargs['writer']
+        self.assertIdentical(writer.store, store)
+        digest = sha1('data').hexdigest()
+        writer.remote_manifest([('f', '', digest, 4, 0644)])
+        writer.remote_open(digest)
+        writer.remote_write('data')
+        writer.remote_finish()
+        d = writer.remote_close()
+        d.addCallback(lambda _ :
+            self.assertTrue(store.has(digest)))
+        return d
+
+    def testContentStoreOldSlave(self):
+        def slaveVersion(command, oldversion=None):
+            if command == 'uploadContent':
+                return oldversion
+            return "2.13"
+        s = FileUpload(slavesrc=__file__, masterdest=self.destfile,
+                       contentStore=self.mktemp())
+        s.slaveVersion = slaveVersion
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.build.getSlaveCommandVersion.return_value = "2.13"
+        s.step_status = Mock()
+        s.buildslave = Mock()
+        s.remote = Mock()
+        s.start()
+        command = s.remote.method_calls[0][1]
+        self.assertEquals(command[3], 'uploadFile')
+        command[-1]['writer'].remote_close()
+
 class TestStringDownload(unittest.TestCase):
     def testBasic(self):
         s = StringDownload("Hello World", "hello.txt")
         s.build = Mock()
         s.build.getProperties.return_value = Properties()
-        s.build.getSlaveCommandVersion.return_value = 1
+        s.build.getSlaveCommandVersion.return_value = "2.12"
 
         s.step_status = Mock()
         s.buildslave = Mock()
@@ -93,7 +200,7 @@ class TestJSONStringDownload(unittest.TestCase):
         s = JSONStringDownload(msg, "hello.json")
         s.build = Mock()
         s.build.getProperties.return_value = Properties()
-        s.build.getSlaveCommandVersion.return_value = 1
+        s.build.getSlaveCommandVersion.return_value = "2.12"
 
         s.step_status = Mock()
         s.buildslave = Mock()
@@ -121,7 +228,7 @@ class TestJSONPropertiesDownload(unittest.TestCase):
         props = Properties()
         props.setProperty('key1', 'value1', 'test')
         s.build.getProperties.return_value = props
-        s.build.getSlaveCommandVersion.return_value = 1
+        s.build.getSlaveCommandVersion.return_value = "2.12"
         ss = Mock()
         ss.asDict.return_value = dict(revision="12345")
         s.build.getSourceStamp.return_value = ss
@@ -144,3 +251,391 @@ class TestJSONPropertiesDownload(unittest.TestCase):
                 break
         else:
             self.assert_(False, "No downloadFile command found")
+
+class TestDirectoryWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.srcdir = os.path.abspath(self.mktemp())
+        os.makedirs(os.path.join(self.srcdir, 'sub'))
+        open(os.path.join(self.srcdir, 'a'), 'wb').write('a' * 100000)
+        open(os.path.join(self.srcdir, 'sub', 'b'), 'wb').write('bb')
+        self.destdir = os.path.abspath(self.mktemp())
+
+    def makeArchive(self, compress):
+        f = StringIO()
+        archive = tarfile.open(mode='w|' + (compress or ''), fileobj=f)
+        archive.add(self.srcdir, '')
+        archive.close()
+        return f.getvalue()
+
+    def transfer(self, compress=None, blocksize=1000):
+        data = self.makeArchive(compress)
+        writer = _DirectoryWriter(self.destdir, None, compress, 0600)
+        writer.maxBuffered = 4000
+        def write(_, offset):
+            if offset >= len(data):
+                return writer.remote_unpack()
+            d = defer.maybeDeferred(writer.remote_write,
+                                    data[offset:offset+blocksize])
+            d.addCallback(write, offset + blocksize)
+            return d
+        d = write(None, 0)
+        def check(_):
+            self.assertEqual(open(os.path.join(self.destdir, 'a')).read(),
+                             'a' * 100000)
+            self.assertEqual(open(os.path.join(self.destdir, 'sub', 'b')).read(),
+                             'bb')
+            self.assertEqual(writer.bytes, len(data))
+        d.addCallback(check)
+        return d
+
+    def test_plain(self):
+        return self.transfer()
+
+    def test_gz(self):
+        return self.transfer('gz')
+
+    def test_bz2(self):
+        return self.transfer('bz2', blocksize=64)
+
+    def test_corrupt(self):
+        writer = _DirectoryWriter(self.destdir, None, 'gz', 0600)
+        writer.remote_write('this is not a tarball' * 100)
+        d = writer.remote_unpack()
+        def check(f):
+            self.assertEqual(writer.remote_write('more'), None)
+        d.addCallbacks(lambda _ : self.fail("should have failed"), check)
+        return d
+
+    def test_abort(self):
+        writer = _DirectoryWriter(self.destdir, None, None, 0600)
+        writer.remote_write(self.makeArchive(None)[:1000])
+        writer.abort()
+        # the thread goes away quietly
+        self.assertFalse(writer.extracted.called)
+
+
+class TestContentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ContentStore(os.path.abspath(self.mktemp()))
+
+    def addContent(self, content, lastUse):
+        fp, tmpname = self.store.newFile()
+        fp.write(content)
+        fp.close()
+        digest = sha1(content).hexdigest()
+        self.store.add(tmpname, digest)
+        os.utime(self.store.getPath(digest), (lastUse, lastUse))
+        return digest
+
+    def test_prune_age(self):
+        old = self.addContent('old', 100)
+        new = self.addContent('new', 900)
+        self.store.link(old, 0444, os.path.abspath(self.mktemp()))
+        self.store.maxAge = 500
+        self.store.prune(now=1000)
+        self.assertFalse(self.store.has(old))
+        self.assertFalse(os.path.exists(self.store.getPath(old, 0444)))
+        self.assertTrue(self.store.has(new))
+
+    def test_prune_size(self):
+        digests = [ self.addContent(c * 10, when) for c, when in
+                    [ ('a', 300), ('b', 100), ('c', 200) ] ]
+        self.store.maxSize = 25
+        self.store.prune(now=1000)
+        self.assertEqual([ self.store.has(d) for d in digests ],
+                         [ True, False, True ])
+        # a use counts as recent
+        self.assertTrue(self.store.use(digests[2]))
+        self.store.maxSize = 15
+        self.store.prune()
+        self.assertEqual([ self.store.has(d) for d in digests ],
+                         [ False, False, True ])
+        self.assertFalse(self.store.use(digests[0]))
+
+    def test_prune_keeps_uploads(self):
+        digest = self.addContent('data', 100)
+        dest = os.path.abspath(self.mktemp())
+        self.store.link(digest, 0444, dest)
+        self.store.maxAge = 0
+        self.store.prune()
+        self.assertFalse(self.store.has(digest))
+        self.assertEqual(open(dest).read(), 'data')
+
+    def test_maybePrune(self):
+        digest = self.addContent('data', 100)
+        self.store.maybePrune() # no limits
+        self.assertTrue(self.store.has(digest))
+        self.store.maxAge = 500
+        self.store.maybePrune()
+        self.assertFalse(self.store.has(digest))
+        # not again until pruneInterval has passed
+        digest = self.addContent('data', 100)
+        self.store.maybePrune()
+        self.assertTrue(self.store.has(digest))
+        self.store.lastPrune -= self.store.pruneInterval
+        self.store.maybePrune()
+        self.assertFalse(self.store.has(digest))
+
+
+class TestContentWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ContentStore(os.path.abspath(self.mktemp()))
+        self.dest = os.path.abspath(self.mktemp())
+
+    def manifest(self, files):
+        entries = [ ('d', 'sub', 0755) ]
+        for path, content in sorted(files.items()):
+            entries.append(('f', path, sha1(content).hexdigest(),
+                            len(content), 0644))
+        return entries
+
+    def upload(self, files, mode=None, dest=None):
+        writer = _ContentWriter(dest or self.dest, self.store, None, mode)
+        contents = dict((sha1(c).hexdigest(), c) for c in files.values())
+        needed = writer.remote_manifest(self.manifest(files))
+        for digest in needed:
+            writer.remote_open(digest)
+            content = contents[digest]
+            writer.remote_write(content[:3])
+            writer.remote_write(content[3:])
+            writer.remote_finish()
+        d = writer.remote_close()
+        d.addCallback(lambda _ : (writer, needed))
+        return d
+
+    def test_dedup(self):
+        files = { 'a' : 'aaaaaa', 'sub/b' : 'bbbbbb', 'sub/c' : 'aaaaaa' }
+        d = self.upload(files, mode=0444)
+        def first((writer, needed)):
+            self.assertEqual(len(needed), 2)
+            for path, content in files.items():
+                self.assertEqual(open(os.path.join(self.dest, path)).read(),
+                                 content)
+            self.assertEqual(writer.filesDeduplicated, 1)
+            files['sub/b'] = 'changed'
+            return self.upload(files, mode=0444, dest=self.dest + '2')
+        d.addCallback(first)
+        def second((writer, needed)):
+            self.assertEqual(needed, [ sha1('changed').hexdigest() ])
+            self.assertEqual(writer.filesDeduplicated, 2)
+            self.assertEqual(writer.bytesDeduplicated, 12)
+            a1 = os.stat(os.path.join(self.dest, 'a'))
+            a2 = os.stat(os.path.join(self.dest + '2', 'sub', 'c'))
+            self.assertEqual((a1.st_dev, a1.st_ino), (a2.st_dev, a2.st_ino))
+        d.addCallback(second)
+        return d
+
+    def test_mode(self):
+        d = self.upload({ 'a' : 'aaa' }, mode=0600)
+        def check(_):
+            path = os.path.join(self.dest, 'a')
+            self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+            # the stored copy stays read-only
+            digest = sha1('aaa').hexdigest()
+            self.assertEqual(os.stat(self.store.getPath(digest)).st_mode
+                             & 0777, 0444)
+        d.addCallback(check)
+        return d
+
+    def test_writable_not_linked(self):
+        d = self.upload({ 'a' : 'aaa' })
+        def check(_):
+            path = os.path.join(self.dest, 'a')
+            self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+            self.assertEqual(os.stat(path).st_nlink, 1)
+            # so changing it does not change the store
+            open(path, 'w').write('changed')
+            digest = sha1('aaa').hexdigest()
+            self.assertEqual(open(self.store.getPath(digest)).read(), 'aaa')
+        d.addCallback(check)
+        return d
+
+    def test_symlinks(self):
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        digest = sha1('data').hexdigest()
+        writer.remote_manifest([('l', 'link', 'sub/file'),
+                                ('d', 'sub', 0755),
+                                ('f', 'sub/file', digest, 4, 0644)])
+        writer.remote_open(digest)
+        writer.remote_write('data')
+        writer.remote_finish()
+        d = writer.remote_close()
+        def check(_):
+            self.assertEqual(os.readlink(os.path.join(self.dest, 'link')),
+                             'sub/file')
+            self.assertEqual(open(os.path.join(self.dest, 'link')).read(),
+                             'data')
+        d.addCallback(check)
+        return d
+
+    def test_under_symlink(self):
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        writer.remote_manifest([('l', 'x', '/etc')])
+        self.assertRaises(ValueError, writer.remote_manifest,
+                          [('f', 'x/passwd', 'a' * 40, 1, 0644)])
+        self.assertRaises(ValueError, writer.remote_manifest,
+                          [('d', 'x/sub', 0755)])
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        writer.remote_manifest([('d', 'x/sub', 0755)])
+        self.assertRaises(ValueError, writer.remote_manifest,
+                          [('l', 'x', '/etc')])
+
+    def test_existing_symlink(self):
+        # a symlink left in dest by an earlier upload is not written through
+        outside = os.path.abspath(self.mktemp())
+        os.makedirs(outside)
+        os.makedirs(self.dest)
+        os.symlink(outside, os.path.join(self.dest, 'x'))
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        digest = sha1('data').hexdigest()
+        writer.remote_manifest([('f', 'x/file', digest, 4, 0644)])
+        writer.remote_open(digest)
+        writer.remote_write('data')
+        writer.remote_finish()
+        d = writer.remote_close()
+        def check(_):
+            self.fail("should have failed")
+        def failed(f):
+            f.trap(ValueError)
+            self.assertEqual(os.listdir(outside), [])
+        d.addCallbacks(check, failed)
+        return d
+
+    def test_single_file(self):
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        digest = sha1('data').hexdigest()
+        self.assertEqual(writer.remote_manifest([('f', '', digest, 4, 0640)]),
+                         [ digest ])
+        writer.remote_open(digest)
+        writer.remote_write('data')
+        writer.remote_finish()
+        d = writer.remote_close()
+        def check(_):
+            self.assertEqual(open(self.dest).read(), 'data')
+            self.assertEqual(os.stat(self.dest).st_mode & 0777, 0640)
+        d.addCallback(check)
+        return d
+
+    def test_bad_content(self):
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        digest = sha1('data').hexdigest()
+        writer.remote_manifest([('f', 'a', digest, 4, 0644)])
+        writer.remote_open(digest)
+        writer.remote_write('dat')
+        self.assertRaises(ValueError, writer.remote_finish)
+        self.failIf(self.store.has(digest))
+        self.assertEqual(os.listdir(self.store.tmpdir), [])
+
+    def test_bad_paths(self):
+        writer = _ContentWriter(self.dest, self.store, None, None)
+        self.assertRaises(ValueError, writer.remote_manifest,
+                          [('d', '../escape', 0755)])
+        self.assertRaises(ValueError, writer.remote_manifest,
+                          [('f', '/etc/passwd', 'a' * 40, 1, 0644)])
+        self.assertRaises(ValueError, writer.remote_manifest,
+                          [('f', 'a', '../../x', 1, 0644)])
+        self.assertRaises(ValueError, writer.remote_open, 'b' * 40)
+
+
+class TestMultipleFileTransfer(unittest.TestCase):
+
+    def startStep(self, step, commandName, slaveVersion="2.15"):
+        step.build = Mock()
+        step.build.getProperties.return_value = Properties()
+        step.build.getSlaveCommandVersion.return_value = slaveVersion
+        step.step_status = Mock()
+        step.buildslave = Mock()
+        step.remote = Mock()
+        step.progress = Mock()
+
+        step.start()
+        for c in step.remote.method_calls:
+            name, command, args = c
+            if command[3] == commandName:
+                return command[-1]
+        self.fail("No %s command found" % commandName)
+
+    def test_upload(self):
+        destdir = os.path.abspath(self.mktemp())
+        s = MultipleFileUpload(slavesrcs=['*.txt', 'dist/*'],
+                               masterdest=destdir, concurrency=3)
+        kwargs = self.startStep(s, 'uploadFiles')
+        self.assertEquals(kwargs['slavesrcs'], ['*.txt', 'dist/*'])
+        self.assertEquals(kwargs['concurrency'], 3)
+        self.assertEquals(kwargs['window'], 8)
+
+        s.cmd.remoteUpdate({'files': ['a.txt', 'b.tgz']})
+        for name in ['a.txt', 'b.tgz']:
+            w = kwargs['writer'].remote_open(name)
+            w.remote_write('data for %s' % name)
+            w.remote_close()
+            s.cmd.remoteUpdate({'file': name, 'rc': 0})
+        s.cmd.remoteUpdate({'rc': 0})
+
+        self.assertEquals(sorted(os.listdir(destdir)), ['a.txt', 'b.tgz'])
+        self.assertEquals(open(os.path.join(destdir, 'b.tgz')).read(),
+                          'data for b.tgz')
+        self.assertEquals(s.cmd.rc, 0)
+        s.progress.setProgress.assert_called_with('bytes', 28)
+        s.step_status.setText.assert_called_with(['uploading', '2/2 files'])
+        s.step_status.setStatistic.assert_called_with('bytes_transferred', 28)
+
+    def test_upload_failed_file(self):
+        s = MultipleFileUpload(slavesrcs='*.txt',
+                               masterdest=os.path.abspath(self.mktemp()))
+        self.startStep(s, 'uploadFiles')
+        s.cmd.remoteUpdate({'files': ['a.txt', 'b.txt']})
+        s.cmd.remoteUpdate({'file': 'a.txt', 'rc': 1})
+        self.assertEquals(s.cmd.rc, None) # only the final update counts
+        s.step_status.setText.assert_called_with(['uploading', '1/2 files',
+                                                  '1 failed'])
+
+    def test_writer_names(self):
+        writer = _MultipleFileWriter(os.path.abspath(self.mktemp()), None,
+                                     None)
+        for name in ['', '..', '../x', 'a/b', 'a\\b', '/etc/passwd']:
+            self.assertRaises(ValueError, writer.remote_open, name)
+
+    def test_old_slave(self):
+        s = MultipleFileUpload(slavesrcs='*.txt', masterdest='x')
+        s.slaveVersion = lambda command, oldversion=None : oldversion
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.step_status = Mock()
+        from buildbot.interfaces import BuildSlaveTooOldError
+        self.assertRaises(BuildSlaveTooOldError, s.start)
+
+    def test_download(self):
+        srcdir = os.path.abspath(self.mktemp())
+        os.makedirs(os.path.join(srcdir, 'more'))
+        for name in ['a.txt', 'b.txt', 'c.dat', os.path.join('more', 'd.txt')]:
+            open(os.path.join(srcdir, name), 'wb').write(name)
+        s = MultipleFileDownload(mastersrcs=[os.path.join(srcdir, '*.txt'),
+                                             os.path.join(srcdir, '*', '*')],
+                                 slavedest='dest', mode=0600)
+        kwargs = self.startStep(s, 'downloadFiles')
+        self.assertEquals(kwargs['files'], ['a.txt', 'b.txt', 'd.txt'])
+        self.assertEquals(kwargs['mode'], 0600)
+        reader = kwargs['reader'].remote_open('d.txt')
+        self.assertEquals(reader.remote_read(100), os.path.join('more', 'd.txt'))
+        reader.remote_close()
+        self.assertRaises(KeyError, kwargs['reader'].remote_open, 'c.dat')
+
+    def test_download_nomatch(self):
+        s = MultipleFileDownload(mastersrcs=[os.path.abspath('nosuch*')],
+                                 slavedest='dest')
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.step_status = Mock()
+        s.addCompleteLog = Mock()
+        s.start()
+        self.assertEquals(s.addCompleteLog.call_args[0][0], 'stderr')
+        self.assert_('No files match' in s.addCompleteLog.call_args[0][1])
+        # the step finishes from a callLater; don't let that run
+        from twisted.internet import reactor
+        for call in reactor.getDelayedCalls():
+            if call.args == (s, FAILURE):
+                call.cancel()
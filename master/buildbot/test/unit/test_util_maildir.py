@@ -63,3 +63,70 @@ class TestMaildirService(dirs.DirsMixin, unittest.TestCase):
             self.assertEqual(messagesReceived, [ 'newmsg' ])
         d.addCallback(check_nonempty)
         return d
+
+    def addMessage(self, name):
+        tmpfile = os.path.join(self.tmpdir, name)
+        open(tmpfile, "w")
+        os.rename(tmpfile, os.path.join(self.newdir, name))
+
+    def test_poll_remembers_files(self):
+        svc = maildir.MaildirService(self.maildir)
+        svc.newdir = self.newdir
+        batches = []
+        svc.messagesReceived = batches.append
+        self.addMessage("2")
+        self.addMessage("1")
+        d = svc.poll()
+        d.addCallback(lambda _ : svc.poll())
+        def check_once(_):
+            self.assertEqual(batches, [ [ "1", "2" ] ])
+            # a message which leaves new/ is forgotten
+            os.rename(os.path.join(self.newdir, "1"),
+                      os.path.join(self.curdir, "1"))
+            self.addMessage("3")
+            return svc.poll()
+        d.addCallback(check_once)
+        def check_forgotten(_):
+            self.assertEqual(batches, [ [ "1", "2" ], [ "3" ] ])
+            self.assertEqual(svc.files, set([ "2", "3" ]))
+        d.addCallback(check_forgotten)
+        return d
+
+    def test_poll_while_polling(self):
+        svc = maildir.MaildirService(self.maildir)
+        svc.newdir = self.newdir
+        batches = []
+        handled = defer.Deferred()
+        def messagesReceived(filenames):
+            batches.append(filenames)
+            if len(batches) == 1:
+                return handled
+        svc.messagesReceived = messagesReceived
+        self.addMessage("1")
+        d = svc.poll()
+        # a notification while the first message is being handled
+        self.addMessage("2")
+        svc.poll()
+        self.assertEqual(batches, [ [ "1" ] ])
+        handled.callback(None)
+        def check(_):
+            self.assertEqual(batches, [ [ "1" ], [ "2" ] ])
+        d.addCallback(check)
+        return d
+
+    def test_inotify(self):
+        if not maildir.inotify:
+            raise unittest.SkipTest("inotify is not available")
+        self.svc = maildir.MaildirService(self.maildir)
+        self.svc.notifyDelay = 0
+        received = defer.Deferred()
+        def messagesReceived(filenames):
+            if filenames and not received.called:
+                received.callback(filenames)
+        self.svc.messagesReceived = messagesReceived
+        self.svc.startService()
+        self.failUnless(self.svc.inotify)
+        self.addMessage("newmsg")
+        received.addCallback(self.assertEqual, [ "newmsg" ])
+        return received
+    test_inotify.timeout = 10
@@ -15,6 +15,8 @@
 
 import mock
 from twisted.internet import defer
+from buildbot.test.fake import fakedb
+from buildbot.changes import base
 
 class ChangeSourceMixin(object):
     """
@@ -23,6 +25,10 @@ class ChangeSourceMixin(object):
      - starting and stopping a ChangeSource service
      - a fake C{self.master.addChange}, which adds its args
        to the list C{self.chagnes_added}
+     - a fake C{self.master.addChanges}, which adds each of its dictionaries
+       to the same list
+     - a fake database, C{self.master.db}
+     - a real L{PollScheduler}, C{self.master.pollScheduler}
     """
 
     changesource = None
@@ -35,8 +41,14 @@ class ChangeSourceMixin(object):
             self.changes_added.append(kwargs)
             change = mock.Mock()
             return defer.succeed(change)
+        def addChanges(changes):
+            self.changes_added.extend(changes)
+            return defer.succeed([ mock.Mock() for c in changes ])
         self.master = mock.Mock()
         self.master.addChange = addChange
+        self.master.addChanges = addChanges
+        self.master.db = fakedb.FakeDBConnector(self)
+        self.master.pollScheduler = base.PollScheduler()
         return defer.succeed(None)
 
     def tearDownChangeSource(self):
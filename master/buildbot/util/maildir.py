@@ -14,28 +14,33 @@
 # Copyright Buildbot Team Members
 
 
-# This is a class which watches a maildir for new messages. It uses the
-# linux dirwatcher API (if available) to look for new files. The
+# This is a class which watches a maildir for new messages. It uses inotify
+# or the linux dirwatcher API (if available) to look for new files. The
 # .messageReceived method is invoked with the filename of the new message,
 # relative to the top of the maildir (so it will look like "new/blahblah").
 
 import os
-from twisted.python import log
+from twisted.python import log, filepath
 from twisted.application import service, internet
 from twisted.internet import reactor, defer
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None # Twisted before 10.0, not Linux, or no ctypes
 dnotify = None
 try:
     import dnotify
 except:
-    log.msg("unable to import dnotify, so Maildir will use polling instead")
+    if not inotify:
+        log.msg("unable to import dnotify, so Maildir will use polling instead")
 
 class NoSuchMaildir(Exception):
     pass
 
 class MaildirService(service.MultiService):
     """I watch a maildir for new messages. I should be placed as the service
-    child of some MultiService instance. When running, I use the linux
-    dirwatcher API (if available) or poll for new files in the 'new'
+    child of some MultiService instance. When running, I use inotify or the
+    linux dirwatcher API (if available) or poll for new files in the 'new'
     subdirectory of my maildir path. When I discover a new message, I invoke
     my .messageReceived() method with the short filename of the new message,
     so the full name of the new file can be obtained with
@@ -43,8 +48,13 @@ class MaildirService(service.MultiService):
     overridden by a subclass to do something useful. I will not move or
     delete the file on my own: the subclass's messageReceived() should
     probably do that.
+
+    A subclass which can handle many messages at once more cheaply than one
+    at a time can override .messagesReceived() instead, which is given all
+    of the messages found by one scan of the maildir.
     """
-    pollinterval = 10  # only used if we don't have DNotify
+    pollinterval = 10  # only used if we have neither INotify nor DNotify
+    notifyDelay = 0.1 # seconds to wait after a notification before scanning
 
     def __init__(self, basedir=None):
         """Create the Maildir watcher. BASEDIR is the maildir directory (the
@@ -54,8 +64,12 @@ class MaildirService(service.MultiService):
         self.basedir = basedir
         "base of the maildir"
         self.newdir = None
-        self.files = []
+        self.files = set() # names in new/ which have been handled
+        self.inotify = None
         self.dnotify = None
+        self.pollCall = None # DelayedCall for a poll after a notification
+        self.polling = False
+        self.pollAgain = False
 
     def setBasedir(self, basedir):
         # some users of MaildirService (scheduler.Try_Jobdir, in particular)
@@ -69,8 +83,23 @@ class MaildirService(service.MultiService):
         self.newdir = os.path.join(self.basedir, "new")
         if not os.path.isdir(self.basedir) or not os.path.isdir(self.newdir):
             raise NoSuchMaildir("invalid maildir '%s'" % self.basedir)
+        if inotify:
+            try:
+                self.inotify = inotify.INotify()
+                # delivery agents move messages into new/ from tmp/, but
+                # some write them there directly
+                self.inotify.watch(filepath.FilePath(self.newdir),
+                        mask=inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE,
+                        callbacks=[self.inotify_callback])
+                self.inotify.startReading()
+            except Exception:
+                log.msg("INotify failed, falling back to dnotify or polling")
+                log.err()
+                if self.inotify:
+                    self.inotify.loseConnection()
+                self.inotify = None
         try:
-            if dnotify:
+            if dnotify and not self.inotify:
                 # we must hold an fd open on the directory, so we can get
                 # notified when it changes.
                 self.dnotify = dnotify.DNotify(self.newdir,
@@ -81,7 +110,7 @@ class MaildirService(service.MultiService):
             # dnotify. OverflowError will occur on some 64-bit machines
             # because of a python bug
             log.msg("DNotify failed, falling back to polling")
-        if not self.dnotify:
+        if not self.inotify and not self.dnotify:
             t = internet.TimerService(self.pollinterval, self.poll)
             t.setServiceParent(self)
         self.poll()
@@ -98,30 +127,72 @@ class MaildirService(service.MultiService):
         # why, and I'd have to hack qmail to investigate further, so it's
         # easier to just wait a second before yanking the message out of new/
 
-        reactor.callLater(0.1, self.poll)
+        self.schedulePoll()
+
+    def inotify_callback(self, watch, path, mask):
+        # a burst of deliveries causes one scan of the maildir
+        self.schedulePoll()
 
+    def schedulePoll(self):
+        if self.pollCall and self.pollCall.active():
+            return
+        self.pollCall = reactor.callLater(self.notifyDelay, self._scheduledPoll)
+
+    def _scheduledPoll(self):
+        self.pollCall = None
+        self.poll()
 
     def stopService(self):
+        if self.pollCall and self.pollCall.active():
+            self.pollCall.cancel()
+        self.pollCall = None
+        if self.inotify:
+            self.inotify.loseConnection()
+            self.inotify = None
         if self.dnotify:
             self.dnotify.remove()
             self.dnotify = None
         return service.MultiService.stopService(self)
 
-    @defer.deferredGenerator
     def poll(self):
+        """Scan new/ and handle the messages which have appeared since the
+        last scan.  If a scan is already handling messages, another is made
+        once it has finished.  Returns a Deferred."""
+        if self.polling:
+            self.pollAgain = True
+            return defer.succeed(None)
         assert self.basedir
-        # see what's new
-        for f in self.files:
-            if not os.path.isfile(os.path.join(self.newdir, f)):
-                self.files.remove(f)
-        newfiles = []
-        for f in os.listdir(self.newdir):
-            if not f in self.files:
-                newfiles.append(f)
-        self.files.extend(newfiles)
-        for n in newfiles:
+        self.polling = True
+        d = self._poll()
+        def done(res):
+            self.polling = False
+            if self.pollAgain:
+                self.pollAgain = False
+                return self.poll()
+            return res
+        d.addBoth(done)
+        return d
+
+    def _poll(self):
+        # see what's new; names which have gone from new/ are forgotten
+        files = set(os.listdir(self.newdir))
+        # maildir names begin with the delivery time
+        newfiles = sorted(files - self.files)
+        self.files = files
+        if not newfiles:
+            return defer.succeed(None)
+        d = defer.maybeDeferred(self.messagesReceived, newfiles)
+        d.addErrback(log.err, "while reading from maildir '%s'" % self.basedir)
+        return d
+
+    @defer.deferredGenerator
+    def messagesReceived(self, filenames):
+        """Process several received messages, in the order given.  By default
+        this calls messageReceived for each.  Returns a Deferred."""
+        for n in filenames:
             try:
-                wfd = defer.waitForDeferred(self.messageReceived(n))
+                wfd = defer.waitForDeferred(
+                        defer.maybeDeferred(self.messageReceived, n))
                 yield wfd
                 wfd.getResult()
             except:
@@ -17,21 +17,176 @@ import os.path
 import socket
 import sys
 import signal
+import zlib
 
 from twisted.spread import pb
 from twisted.python import log
-from twisted.internet import error, reactor, task
+from twisted.internet import defer, error, reactor, task, threads
 from twisted.application import service, internet
 from twisted.cred import credentials
 
 import buildslave
 from buildslave.util import now
 from buildslave.pbutil import ReconnectingPBClientFactory
-from buildslave.commands import registry, base
+from buildslave.gitcache import GitMirrorCache
+from buildslave.trash import Trash
+from buildslave.commands import registry, base, fs
 
 class UnknownCommand(pb.Error):
     pass
 
+class LowDiskSpace(pb.Error):
+    pass
+
+class UpdateQueue:
+    """
+    I send the status updates of one command to a master-side
+    RemoteCommand which understands batches of them, through its
+    C{updates} method.  Updates are queued, and all of those queued are sent
+    in one call (up to C{maxBatchSize} bytes at a time) on the next turn of
+    the reactor, so a command producing lots of little updates makes few
+    calls.  Consecutive output for the same log is joined.
+
+    The master grants a credit: the number of bytes of updates which may be
+    unacknowledged at once.  When that is used up, updates wait in the queue
+    until acknowledgements come back, each of which carries a new credit.
+
+    If C{compress} is true, output of at least C{compressMinSize} bytes is
+    sent compressed with zlib, as a C{{'compressed': (key, logname, data)}}
+    status update, whenever that makes it smaller.
+    """
+
+    # stay well under PB's 640k limit
+    maxBatchSize = 256*1024
+
+    # an update which is not output is counted as this many bytes
+    statusSize = 64
+
+    # output smaller than this is not worth compressing
+    compressMinSize = 512
+
+    outputUpdates = ('stdout', 'stderr', 'header')
+
+    _reactor = reactor
+
+    def __init__(self, remoteStep, credit, activity=None, compress=False):
+        self.remoteStep = remoteStep
+        self.credit = credit
+        self.activity = activity
+        self.compress = compress
+        self.queue = [] # [key, logname, value] entries
+        self.sizes = [] # the size of each entry
+        self.inflight = 0
+        self.flushTimer = None
+        self.flushing = False
+        self.waiters = []
+        self.batchesSent = 0
+        self.updatesSent = 0
+        self.bytesCompressed = 0 # output bytes before and after compression
+        self.bytesSent = 0
+
+    def add(self, update):
+        self.updatesSent += 1
+        key = None
+        if len(update) == 1:
+            key, value = update.items()[0]
+        if key in self.outputUpdates:
+            self._appendOutput(key, None, value)
+        elif key == 'log':
+            self._appendOutput(key, value[0], value[1])
+        else:
+            self.queue.append(['status', None, update])
+            self.sizes.append(self.statusSize)
+        self._schedule()
+
+    def _appendOutput(self, key, logname, data):
+        # output is kept as a list of chunks until it is sent
+        if self.queue:
+            last = self.queue[-1]
+            if (last[:2] == [key, logname] and
+                    self.sizes[-1] + len(data) <= self.maxBatchSize):
+                last[2].append(data)
+                self.sizes[-1] += len(data)
+                return
+        self.queue.append([key, logname, [data]])
+        self.sizes.append(len(data))
+
+    def _makeEntry(self, key, logname, value):
+        if key == 'status':
+            return [key, value]
+        data = ''.join(value)
+        if self.compress and len(data) >= self.compressMinSize:
+            zdata = zlib.compress(data)
+            if len(zdata) < len(data):
+                self.bytesCompressed += len(data)
+                self.bytesSent += len(zdata)
+                return ['status', {'compressed' : (key, logname, zdata)}]
+        if key == 'log':
+            return [key, (logname, data)]
+        return [key, data]
+
+    def _schedule(self):
+        if not self.flushTimer:
+            self.flushTimer = self._reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        if self.flushTimer and self.flushTimer.active():
+            self.flushTimer.cancel()
+        self.flushTimer = None
+        if self.flushing:
+            return # an acknowledgement came back right away; carry on below
+        self.flushing = True
+        while self.queue and self.inflight < self.credit:
+            batch, batchSize = [], 0
+            while self.queue and (not batch or
+                    batchSize + self.sizes[0] <= self.maxBatchSize):
+                batch.append(self._makeEntry(*self.queue.pop(0)))
+                batchSize += self.sizes.pop(0)
+            self.inflight += batchSize
+            self.batchesSent += 1
+            d = self.remoteStep.callRemote("updates", batch)
+            d.addCallbacks(self._acked, self._ackFailed,
+                           callbackArgs=(batchSize,),
+                           errbackArgs=(batchSize,))
+        self.flushing = False
+        if not self.queue:
+            waiters, self.waiters = self.waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _acked(self, credit, size):
+        self.inflight -= size
+        if credit is not None:
+            self.credit = credit
+        if self.activity:
+            self.activity() # update the "last activity" timer
+        self._flush()
+
+    def _ackFailed(self, why, size):
+        log.msg("UpdateQueue._ackFailed")
+        log.err(why) # we don't really care
+        self.inflight -= size
+        if why.check(pb.DeadReferenceError, pb.PBConnectionLost):
+            # nobody is listening any more
+            self.queue, self.sizes = [], []
+        self._flush()
+
+    def describeStats(self):
+        msg = " sent %d updates in %d batches" % (self.updatesSent,
+                                                  self.batchesSent)
+        if self.bytesCompressed:
+            msg += ", compressing %d bytes of output to %d" % (
+                    self.bytesCompressed, self.bytesSent)
+        return msg
+
+    def waitUntilSent(self):
+        """Return a Deferred that fires when every queued update has been
+        sent (though not necessarily acknowledged)"""
+        d = defer.Deferred()
+        self.waiters.append(d)
+        self._schedule()
+        return d
+
 class SlaveBuilder(pb.Referenceable, service.Service):
 
     """This is the local representation of a single Builder: it handles a
@@ -54,9 +209,21 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     # when the step is started
     remoteStep = None
 
+    # .updateQueue is an UpdateQueue for the running command, if the master
+    # asked for batched updates
+    updateQueue = None
+
+    # .gitCache is the slave's GitMirrorCache, if it has one
+    gitCache = None
+
+    # .trash is the slave's Trash, which removes clobbered trees in the
+    # background
+    trash = None
+
     def __init__(self, name):
         #service.Service.__init__(self) # Service has no __init__ method
         self.setName(name)
+        self.fileHashes = {} # path : ((size, mtime), digest), for hashFile
 
     def __repr__(self):
         return "<SlaveBuilder '%s' at %d>" % (self.name, id(self))
@@ -110,9 +277,19 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     # the following are Commands that can be invoked by the master-side
     # Builder
     def remote_startBuild(self):
-        """This is invoked before the first step of any new build is run.  It
-        doesn't do much, but masters call it so it's still here."""
-        pass
+        """This is invoked before the first step of any new build is run.
+        If the slave is short of disk space, even once the trash has been
+        emptied, I refuse the build with L{LowDiskSpace}.  The master then
+        gives it to another slave, and offers this one no builds for a while
+        (older masters offer it again at once)."""
+        if not self.trash:
+            return
+        d = self.trash.waitForSpace()
+        def check(enough):
+            if not enough:
+                raise LowDiskSpace("not enough disk space free on slave")
+        d.addCallback(check)
+        return d
 
     def remote_startCommand(self, stepref, stepId, command, args):
         """
@@ -129,6 +306,10 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             log.msg("leftover command, dropping it")
             self.stopCommand()
 
+        # newer masters ask for updates to be sent in batches
+        batchUpdates = args.pop('batchUpdates', None)
+        compressUpdates = args.pop('compressUpdates', None) or []
+
         try:
             factory = registry.getFactory(command)
         except KeyError:
@@ -138,11 +319,38 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         log.msg(" startCommand:%s [id %s]" % (command,stepId))
         self.remoteStep = stepref
         self.remoteStep.notifyOnDisconnect(self.lostRemoteStep)
+        self.updateQueue = None
+        if batchUpdates:
+            self.updateQueue = UpdateQueue(stepref, batchUpdates['credit'],
+                                           self.activity,
+                                           compress='zlib' in compressUpdates)
         d = self.command.doStart()
         d.addCallback(lambda res: None)
         d.addBoth(self.commandComplete)
         return None
 
+    # the most remote_readFile will return at once; PB's limit is 640k
+    maxReadLength = 256*1024
+
+    def remote_readFile(self, workdir, filename, offset, length):
+        """Return up to C{length} bytes from C{offset} in a file in the given
+        workdir, or an empty string at the end of the file.  Unlike the
+        readFile command, this can be used while a command is running, for
+        example to show a log kept on the slave."""
+        self.activity()
+        length = min(length, self.maxReadLength)
+        return threads.deferToThread(fs.readFileRange, self.basedir,
+                                     workdir, filename, offset, length)
+
+    def remote_hashFile(self, workdir, filename):
+        """Return a dictionary with the C{size} and C{sha1} of a file in the
+        given workdir, or None if there is no such file.  The master uses
+        this to check that a log kept on the slave has not been overwritten
+        by a later build before showing it."""
+        self.activity()
+        return threads.deferToThread(fs.hashFile, self.basedir, workdir,
+                                     filename, self.fileHashes)
+
     def remote_interruptCommand(self, stepId, why):
         """Halt the current step."""
         log.msg("asked to interrupt current command: %s" % why)
@@ -179,6 +387,9 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             # service is running or not. If we aren't running, don't send any
             # status messages.
             return
+        if self.remoteStep and self.updateQueue:
+            self.updateQueue.add(data)
+            return
         # the update[1]=0 comes from the leftover 'updateNum', which the
         # master still expects to receive. Provide it to avoid significant
         # interoperability issues between new slaves and old masters.
@@ -217,11 +428,19 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             log.msg(" but we weren't running, quitting silently")
             return
         if self.remoteStep:
-            self.remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
-            d = self.remoteStep.callRemote("complete", failure)
+            remoteStep = self.remoteStep
+            remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
+            d = defer.succeed(None)
+            if self.updateQueue:
+                # the completion has to follow the last of the updates
+                queue = self.updateQueue
+                d = queue.waitUntilSent()
+                d.addCallback(lambda _ : log.msg(queue.describeStats()))
+            d.addCallback(lambda _ : remoteStep.callRemote("complete", failure))
             d.addCallback(self.ackComplete)
             d.addErrback(self._ackFailed, "sendComplete")
             self.remoteStep = None
+            self.updateQueue = None
 
 
     def remote_shutdown(self):
@@ -235,16 +454,26 @@ class Bot(pb.Referenceable, service.MultiService):
     usePTY = None
     name = "bot"
 
-    def __init__(self, basedir, usePTY, unicode_encoding=None):
+    def __init__(self, basedir, usePTY, unicode_encoding=None, gitCache=None,
+                 trash=None):
         service.MultiService.__init__(self)
         self.basedir = basedir
         self.usePTY = usePTY
         self.unicode_encoding = unicode_encoding or sys.getfilesystemencoding() or 'ascii'
+        self.gitCache = gitCache
+        self.trash = trash
         self.builders = {}
 
     def startService(self):
         assert os.path.isdir(self.basedir)
         service.MultiService.startService(self)
+        if self.trash:
+            self.trash.start()
+
+    def stopService(self):
+        if self.trash:
+            self.trash.stop()
+        return service.MultiService.stopService(self)
 
     def remote_getCommands(self):
         commands = dict([
@@ -256,6 +485,8 @@ class Bot(pb.Referenceable, service.MultiService):
     def remote_setBuilderList(self, wanted):
         retval = {}
         wanted_dirs = ["info"]
+        if self.trash:
+            wanted_dirs.append(os.path.basename(self.trash.basedir))
         for (name, builddir) in wanted:
             wanted_dirs.append(builddir)
             b = self.builders.get(name, None)
@@ -268,6 +499,8 @@ class Bot(pb.Referenceable, service.MultiService):
                 b = SlaveBuilder(name)
                 b.usePTY = self.usePTY
                 b.unicode_encoding = self.unicode_encoding
+                b.gitCache = self.gitCache
+                b.trash = self.trash
                 b.setServiceParent(self)
                 b.setBuilddir(builddir)
                 self.builders[name] = b
@@ -452,11 +685,30 @@ class BotFactory(ReconnectingPBClientFactory):
 class BuildSlave(service.MultiService):
     def __init__(self, buildmaster_host, port, name, passwd, basedir,
                  keepalive, usePTY, keepaliveTimeout=30, umask=None,
-                 maxdelay=300, unicode_encoding=None, allow_shutdown=None):
+                 maxdelay=300, unicode_encoding=None, allow_shutdown=None,
+                 git_cache=None, git_cache_size=None, git_cache_max_age=None,
+                 min_free_space=None):
         log.msg("Creating BuildSlave -- version: %s" % buildslave.version)
         self.recordHostname(basedir)
         service.MultiService.__init__(self)
-        bot = Bot(basedir, usePTY, unicode_encoding=unicode_encoding)
+        gitCache = None
+        if git_cache:
+            # sizes are in megabytes and ages in days
+            if git_cache_size is not None:
+                git_cache_size = git_cache_size * 1024 * 1024
+            if git_cache_max_age is not None:
+                git_cache_max_age = git_cache_max_age * 24 * 3600
+            gitCache = GitMirrorCache(os.path.join(basedir, git_cache),
+                                      maxSize=git_cache_size,
+                                      maxAge=git_cache_max_age)
+        if min_free_space is not None:
+            # in megabytes
+            min_free_space = min_free_space * 1024 * 1024
+        # hidden, so that it cannot be the builddir of a builder
+        trash = Trash(os.path.join(basedir, ".trash"),
+                      minFreeSpace=min_free_space)
+        bot = Bot(basedir, usePTY, unicode_encoding=unicode_encoding,
+                  gitCache=gitCache, trash=trash)
         bot.setServiceParent(self)
         self.bot = bot
         if keepalive == 0:
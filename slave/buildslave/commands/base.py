@@ -17,6 +17,7 @@
 import os
 from base64 import b64encode
 import sys
+import time
 import shutil
 
 from zope.interface import implements
@@ -31,7 +32,7 @@ from buildslave.commands import utils
 # this used to be a CVS $-style "Revision" auto-updated keyword, but since I
 # moved to Darcs as the primary repository, this is updated manually each
 # time this file is changed. The last cvs_ver that was here was 1.51 .
-command_version = "2.12"
+command_version = "2.22"
 
 # version history:
 #  >=1.17: commands are interruptable
@@ -60,6 +61,22 @@ command_version = "2.12"
 #  >= 2.10: CVS can handle 'extra_options' and 'export_options'
 #  >= 2.11: Arch, Bazaar, and Monotone removed
 #  >= 2.12: SlaveShellCommand no longer accepts 'keep_stdin_open'
+#  >= 2.13: uploadFile, uploadDirectory and downloadFile accept 'window' and
+#           'maxblocksize', to pipeline blocks and adapt the block size
+#  >= 2.14: added uploadContent
+#  >= 2.15: added uploadFiles and downloadFiles
+#  >= 2.16: updates are sent in batches, with the 'updates' method, when the
+#           master passes 'batchUpdates' to startCommand
+#  >= 2.17: batched output updates are compressed with zlib when the master
+#           passes 'compressUpdates' to startCommand
+#  >= 2.18: SlaveShellCommand accepts 'logFilter'
+#  >= 2.19: added readFile, and the SlaveBuilder's readFile method;
+#           SlaveShellCommand keeps 'onDemand' logfiles on the slave
+#  >= 2.20: Git accepts a depth as 'shallow', deepening the history when the
+#           revision is older, and 'sparse_paths'; it sends a 'fetch' update
+#  >= 2.21: source commands accept 'copy_method', and send a 'copy' update
+#           for mode 'copy'
+#  >= 2.22: added the SlaveBuilder's hashFile method
 
 class Command:
     implements(ISlaveCommand)
@@ -228,6 +245,14 @@ class SourceBaseCommand(Command):
                         reattempted, up to REPEATS times, after a delay of
                         DELAY seconds. This is intended to deal with slaves
                         that experience transient network failures.
+
+        - ['copy_method']: how mode 'copy' copies the source tree to the
+                        workdir: 'reflink' (copy-on-write clones), 'rsync'
+                        (bring the previous workdir up to date), 'hardlink'
+                        (only safe if the build never modifies a source
+                        file in place), 'cp', or 'auto' (the default), to
+                        pick the fastest of the first two that works on
+                        this filesystem, or else 'cp'.
     """
 
     sourcedata = ""
@@ -246,6 +271,7 @@ class SourceBaseCommand(Command):
         self.timeout = args.get('timeout', 120)
         self.maxTime = args.get('maxTime', None)
         self.retry = args.get('retry')
+        self.copy_method = args.get('copy_method', 'auto')
         self._commandPaths = {}
         # VC-specific subclasses should override this to extract more args.
         # Make sure to upcall!
@@ -287,6 +313,9 @@ class SourceBaseCommand(Command):
         if os.path.exists(old_sd_path) and not os.path.exists(self.sourcedatafile):
             os.rename(old_sd_path, self.sourcedatafile)
 
+        if self.mode == "copy":
+            self.copyMethod = self.chooseCopyMethod()
+
         d = defer.succeed(None)
         self.maybeClobber(d)
         if not (self.sourcedirIsUpdateable() and self.sourcedataMatches()):
@@ -307,7 +336,9 @@ class SourceBaseCommand(Command):
     def maybeClobber(self, d):
         # do we need to clobber anything?
         if self.mode in ("copy", "clobber", "export"):
-            d.addCallback(self.doClobber, self.workdir)
+            # rsync brings the old workdir up to date instead
+            if self.mode != "copy" or self.copyMethod != 'rsync':
+                d.addCallback(self.doClobber, self.workdir)
 
     def interrupt(self):
         self.interrupted = True
@@ -456,25 +487,11 @@ class SourceBaseCommand(Command):
         return res
 
     def doClobber(self, dummy, dirname, chmodDone=False):
-        # TODO: remove the old tree in the background
-##         workdir = os.path.join(self.builder.basedir, self.workdir)
-##         deaddir = self.workdir + ".deleting"
-##         if os.path.isdir(workdir):
-##             try:
-##                 os.rename(workdir, deaddir)
-##                 # might fail if deaddir already exists: previous deletion
-##                 # hasn't finished yet
-##                 # start the deletion in the background
-##                 # TODO: there was a solaris/NetApp/NFS problem where a
-##                 # process that was still running out of the directory we're
-##                 # trying to delete could prevent the rm-rf from working. I
-##                 # think it stalled the rm, but maybe it just died with
-##                 # permission issues. Try to detect this.
-##                 os.commands("rm -rf %s &" % deaddir)
-##             except:
-##                 # fall back to sequential delete-then-checkout
-##                 pass
         d = os.path.join(self.builder.basedir, dirname)
+        # move the old tree aside, to be removed in the background
+        if self.builder.trash and self.builder.trash.moveAside(d):
+            self.sendStatus({'header': "moved %s to the trash\n" % dirname})
+            return defer.succeed(0)
         if runtime.platformType != "posix":
             # if we're running on w32, use rmtree instead. It will block,
             # but hopefully it won't take too long.
@@ -522,33 +539,82 @@ class SourceBaseCommand(Command):
         d.addCallback(lambda dummy: self.doClobber(dummy, dirname, True))
         return d
 
+    copyMethods = ('reflink', 'rsync', 'hardlink', 'cp')
+
+    def chooseCopyMethod(self):
+        if runtime.platformType != "posix":
+            return 'copytree'
+        if self.copy_method in self.copyMethods:
+            return self.copy_method
+        if self.copy_method != 'auto':
+            log.msg("unknown copy_method '%s'; using auto" % self.copy_method)
+        return utils.getCopyMethod(self.builder.basedir)
+
     def doCopy(self, res):
         # now copy tree to workdir
         fromdir = os.path.join(self.builder.basedir, self.srcdir)
         todir = os.path.join(self.builder.basedir, self.workdir)
-        if runtime.platformType != "posix":
+        started = time.time()
+        if self.copyMethod == 'copytree':
             self.sendStatus({'header': "Since we're on a non-POSIX platform, "
             "we're not going to try to execute cp in a subprocess, but instead "
             "use shutil.copytree(), which will block until it is complete.  "
             "fromdir: %s, todir: %s\n" % (fromdir, todir)})
             shutil.copytree(fromdir, todir)
-            return defer.succeed(0)
+            return defer.succeed(self._copyDone(0, started))
 
         if not os.path.exists(os.path.dirname(todir)):
             os.makedirs(os.path.dirname(todir))
-        if os.path.exists(todir):
+        if os.path.exists(todir) and self.copyMethod != 'rsync':
             # I don't think this happens, but just in case..
             log.msg("cp target '%s' already exists -- cp will not do what you think!" % todir)
 
-        command = ['cp', '-R', '-P', '-p', fromdir, todir]
+        if self.copyMethod == 'rsync':
+            # the trailing slashes copy the contents of fromdir
+            command = [self.getCommand('rsync'), '-a', '--delete',
+                       fromdir + os.sep, todir + os.sep]
+        else:
+            command = ['cp', '-R', '-P', '-p']
+            if self.copyMethod == 'reflink':
+                command.append('--reflink=auto')
+            elif self.copyMethod == 'hardlink':
+                command.append('-l')
+            command.extend([fromdir, todir])
         c = runprocess.RunProcess(self.builder, command, self.builder.basedir,
                          sendRC=False, timeout=self.timeout, maxTime=self.maxTime,
                          usePTY=False)
         self.command = c
         d = c.start()
-        d.addCallback(self._abandonOnFailure)
+        if self.copyMethod == 'rsync':
+            d.addCallback(self._rsyncDone, started)
+        else:
+            d.addCallback(self._abandonOnFailure)
+            d.addCallback(self._copyDone, started)
         return d
 
+    def _rsyncDone(self, rc, started):
+        if rc == 0 or self.interrupted:
+            self._abandonOnFailure(rc)
+            return self._copyDone(rc, started)
+        # perhaps the build left something rsync cannot remove; clobber the
+        # workdir and copy it afresh.  That copy reports itself, with its
+        # own method and time.
+        self.sendStatus({'header': "rsync failed; copying afresh\n"})
+        self.copyMethod = 'cp'
+        d = self.doClobber(None, self.workdir)
+        d.addCallback(self.doCopy)
+        return d
+
+    def _copyDone(self, rc, started):
+        if isinstance(rc, int) and rc == 0:
+            elapsed = time.time() - started
+            self.sendStatus({'header': "copied %s to %s with %s in %.1f secs\n"
+                                % (self.srcdir, self.workdir, self.copyMethod,
+                                   elapsed)})
+            self.sendStatus({'copy': dict(method=self.copyMethod,
+                                          elapsed=elapsed)})
+        return rc
+
     def doPatch(self, res):
         patchlevel = self.patch[0]
         diff = self.patch[1]
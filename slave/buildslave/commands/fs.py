@@ -16,8 +16,12 @@
 import os
 import sys
 import shutil
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import runtime, log
 
 from buildslave import runprocess
@@ -77,9 +81,12 @@ class RemoveDirectory(base.Command):
         self.timeout = args.get('timeout', 120)
         self.maxTime = args.get('maxTime', None)
 
-        # TODO: remove the old tree in the background
         self.dir = os.path.join(self.builder.basedir, dirname)
-        if runtime.platformType != "posix":
+        if self.builder.trash and self.builder.trash.moveAside(self.dir):
+            # it will be removed in the background
+            self.sendStatus({'header': "moved %s to the trash\n" % dirname})
+            d = defer.succeed(0)
+        elif runtime.platformType != "posix":
             # if we're running on w32, use rmtree instead. It will block,
             # but hopefully it won't take too long.
             utils.rmdirRecursive(self.dir)
@@ -218,3 +225,118 @@ class StatFile(base.Command):
             self.sendStatus({'rc': 0})
         except:
             self.sendStatus({'rc': 1})
+
+def _getFilePath(basedir, workdir, filename):
+    basedir = os.path.abspath(basedir)
+    path = os.path.abspath(os.path.join(basedir, workdir, filename))
+    if not path.startswith(basedir + os.sep):
+        raise ValueError("%r is outside the builder directory" % filename)
+    return path
+
+def readFileRange(basedir, workdir, filename, offset=0, length=None):
+    """Read up to C{length} bytes (or all of them, if C{length} is None) from
+    C{offset} in a file, given relative to a workdir which is itself relative
+    to the builder directory C{basedir}.  Paths leading outside C{basedir}
+    are refused with a ValueError."""
+    path = _getFilePath(basedir, workdir, filename)
+    f = open(path, "rb")
+    try:
+        f.seek(offset)
+        if length is None:
+            return f.read()
+        return f.read(length)
+    finally:
+        f.close()
+
+def hashFile(basedir, workdir, filename, cache=None):
+    """Return a dictionary with the C{size} and C{sha1} of a file, given as
+    for L{readFileRange}, or None if there is no such file.  If a C{cache}
+    dictionary is given, the digest is remembered there, and the file is
+    only read again if its size or modification time has changed."""
+    path = _getFilePath(basedir, workdir, filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_size, st.st_mtime)
+    if cache is not None and path in cache and cache[path][0] == key:
+        return cache[path][1]
+    h = sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(64*1024)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    result = { 'size' : st.st_size, 'sha1' : h.hexdigest() }
+    if cache is not None:
+        cache[path] = (key, result)
+    return result
+
+class ReadFile(base.Command):
+    """This is a Command which sends (part of) a file on the slave to the
+    master, as the contents of a log.  The args dict contains the following
+    keys:
+
+        - ['workdir'] (required): directory which the filename is relative to,
+                                  itself relative to the builder dir
+        - ['filename'] (required): the file to read
+        - ['logname'] (required): the name of the log to send it to
+        - ['offset']: where to start reading; defaults to 0
+        - ['length']: how many bytes to read; defaults to all of them
+
+    ReadFile creates the following status messages:
+        - {'log': (logname, data)} : for each chunk of the file
+        - {'stderr': message} : if the file cannot be read
+        - {'rc': rc} : 0 if the file was read, 1 otherwise
+    """
+
+    header = "readFile"
+
+    # the file is sent in chunks of this size, one per turn of the reactor
+    chunkSize = 64*1024
+
+    def start(self):
+        args = self.args
+        self.offset = args.get('offset', 0)
+        self.remaining = args.get('length')
+        self.cooperator = task.cooperate(self._readChunks())
+        d = self.cooperator.whenDone()
+        d.addCallbacks(self._finished, self._failed)
+        return d
+
+    def _readChunks(self):
+        args = self.args
+        while not self.interrupted:
+            length = self.chunkSize
+            if self.remaining is not None:
+                length = min(length, self.remaining)
+            if length <= 0:
+                return
+            data = readFileRange(self.builder.basedir, args['workdir'],
+                                 args['filename'], self.offset, length)
+            if not data:
+                return
+            self.sendStatus({'log': (args['logname'], data)})
+            self.offset += len(data)
+            if self.remaining is not None:
+                self.remaining -= len(data)
+            yield None
+
+    def _finished(self, _):
+        if self.interrupted:
+            self.sendStatus({'header': "interrupted\n"})
+            self.sendStatus({'rc': 1})
+        else:
+            self.sendStatus({'rc': 0})
+
+    def _failed(self, why):
+        self.sendStatus({'stderr': "cannot read %s: %s\n"
+                         % (self.args['filename'], why.getErrorMessage())})
+        self.sendStatus({'rc': 1})
+
+    def interrupt(self):
+        self.interrupted = True
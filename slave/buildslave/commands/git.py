@@ -14,6 +14,8 @@
 # Copyright Buildbot Team Members
 
 import os
+import time
+import shutil
 
 from twisted.internet import defer
 
@@ -38,10 +40,32 @@ class Git(SourceBaseCommand):
     ['progress'] (optional):       have git output progress markers,
                                    avoiding timeouts for long fetches;
                                    requires Git 1.7.2 or later.
+    ['shallow'] (optional):        True, or a number of commits: fetch only
+                                   that much history (True meaning 1).  If
+                                   the revision is older, the history is
+                                   deepened until it is found.
+    ['sparse_paths'] (optional):   a list of paths, in the form used by
+                                   .git/info/sparse-checkout; only these
+                                   are checked out.
+
+    The time spent fetching, and the depth fetched, are sent in a 'fetch'
+    update.
+
+    If the buildslave has a git mirror cache (see
+    L{buildslave.gitcache.GitMirrorCache}) and no reference repository is
+    given, the mirror of the repository is updated first, and then used as
+    the reference repository and fetched from.  The mirror is held in use
+    for the whole command, so that it is not evicted meanwhile.
     """
 
     header = "git operation"
 
+    # a shallow fetch missing the wanted revision is deepened this many
+    # times, by a factor of deepenFactor, before fetching all history
+    deepenTimes = 2
+    deepenFactor = 10
+    fullDepth = 2147483647
+
     def setup(self, args):
         SourceBaseCommand.setup(self, args)
         self.repourl = args['repourl']
@@ -53,6 +77,39 @@ class Git(SourceBaseCommand):
         self.ignore_ignores = args.get('ignore_ignores', True)
         self.reference = args.get('reference', None)
         self.gerrit_branch = args.get('gerrit_branch', None)
+        self.mirror = None
+        if self.builder.gitCache and not self.reference:
+            self.mirror = self.builder.gitCache.getMirror(self.repourl)
+        # with a mirror, the whole history is already on this slave
+        shallow = args.get('shallow')
+        self.depth = None
+        if shallow and not self.mirror:
+            if shallow is True:
+                self.depth = 1
+            else:
+                self.depth = int(shallow)
+        # the paths may come as a tuple, and are compared with those read
+        # back from the sparse-checkout file
+        self.sparse_paths = args.get('sparse_paths')
+        if self.sparse_paths is not None:
+            self.sparse_paths = [ path.strip() for path in self.sparse_paths
+                                  if path.strip() ]
+        self.fetchStats = dict(fetches=0, elapsed=0, depth=self.depth,
+                               deepened=0)
+
+    def start(self):
+        if not self.mirror:
+            return SourceBaseCommand.start(self)
+        d = self.builder.gitCache.use(self.mirror)
+        def inUse(release):
+            d = defer.maybeDeferred(SourceBaseCommand.start, self)
+            def done(res):
+                release()
+                return res
+            d.addBoth(done)
+            return d
+        d.addCallback(inUse)
+        return d
 
     def _fullSrcdir(self):
         return os.path.join(self.builder.basedir, self.srcdir)
@@ -62,8 +119,60 @@ class Git(SourceBaseCommand):
             return self.revision
         return self.branch
 
+    def _alternatesFile(self):
+        return os.path.join(self._fullSrcdir(), '.git', 'objects', 'info',
+                            'alternates')
+
+    def _readAlternates(self):
+        try:
+            return open(self._alternatesFile()).read().splitlines()
+        except IOError:
+            return []
+
+    def _addAlternate(self, repository):
+        objects = os.path.join(repository, 'objects')
+        alternates = self._readAlternates()
+        if objects not in alternates:
+            f = open(self._alternatesFile(), 'w')
+            f.write('\n'.join(alternates + [ objects ]) + '\n')
+            f.close()
+
+    def _sparseFile(self):
+        return os.path.join(self._fullSrcdir(), '.git', 'info',
+                            'sparse-checkout')
+
+    def _readSparsePaths(self):
+        try:
+            lines = open(self._sparseFile()).read().splitlines()
+        except IOError:
+            return None
+        return [ line.strip() for line in lines if line.strip() ]
+
+    def _writeSparsePaths(self):
+        if not os.path.isdir(os.path.dirname(self._sparseFile())):
+            os.makedirs(os.path.dirname(self._sparseFile()))
+        f = open(self._sparseFile(), 'w')
+        f.write(''.join([ p + '\n' for p in self.sparse_paths ]))
+        f.close()
+
     def sourcedirIsUpdateable(self):
-        return os.path.isdir(os.path.join(self._fullSrcdir(), ".git"))
+        if not os.path.isdir(os.path.join(self._fullSrcdir(), ".git")):
+            return False
+        # git does not restore the files left out by an old sparse checkout
+        # when the paths change, so start again
+        if self._readSparsePaths() != self.sparse_paths:
+            return False
+        # a checkout whose reference repository (perhaps an evicted mirror)
+        # has gone is missing objects, and cannot be updated
+        for objects in self._readAlternates():
+            if not os.path.isdir(objects):
+                return False
+        return True
+
+    def _fetchUrl(self):
+        if self.mirror:
+            return self.mirror
+        return self.repourl
 
     def _dovccmd(self, command, cb=None, **kwargs):
         git = self.getCommand("git")
@@ -104,7 +213,7 @@ class Git(SourceBaseCommand):
         else:
             return defer.succeed(0)
 
-    def _didHeadCheckout(self, res):
+    def _renameBranch(self, res):
         # Rename branch, so that the repo will have the expected branch name
         # For further information about this, see the commit message
         command = ['branch', '-M', self.branch]
@@ -119,8 +228,34 @@ class Git(SourceBaseCommand):
         # That is not sufficient. git will leave unversioned files and empty
         # directories. Clean them up manually in _didReset.
         command = ['reset', '--hard', head]
+        if self.depth and self.revision:
+            # the revision may be older than the history fetched
+            d = self._dovccmd(command)
+            d.addCallback(self._maybeDeepen)
+            return d
         return self._dovccmd(command, self._didHeadCheckout)
 
+    def _maybeDeepen(self, rc):
+        if rc == 0:
+            return self._didHeadCheckout(rc)
+        if self.depth >= self.fullDepth:
+            raise AbandonChain(rc)
+        if self.fetchStats['deepened'] < self.deepenTimes:
+            self.depth = self.depth * self.deepenFactor
+        else:
+            self.depth = self.fullDepth
+        self.fetchStats['deepened'] += 1
+        self.fetchStats['depth'] = self.depth
+        self.sendStatus({"header": "revision %s was not fetched; "
+                         "fetching more history\n" % self.revision})
+        return self._doFetch(None, self.gerrit_branch or self.branch)
+
+    def _didHeadCheckout(self, res):
+        # the checkout is complete, so report how long fetching took
+        if self.fetchStats['fetches']:
+            self.sendStatus({'fetch': self.fetchStats})
+        return self._renameBranch(res)
+
     def maybeNotDoVCFallback(self, res):
         # If we were unable to find the branch/SHA on the remote,
         # clobbering the repo won't help any, so just abort the chain
@@ -132,7 +267,70 @@ class Git(SourceBaseCommand):
     # if the branch to be checked out has changed.  This, combined
     # with the later "git reset" equates clobbering the repo,
     # but it's much more efficient.
+    def doVC(self, res):
+        if not self.mirror:
+            return SourceBaseCommand.doVC(self, res)
+        d = self._updateMirror()
+        d.addCallback(lambda _ : SourceBaseCommand.doVC(self, res))
+        return d
+
+    def _domirrorcmd(self, command, workdir):
+        git = self.getCommand("git")
+        c = runprocess.RunProcess(self.builder, [git] + command, workdir,
+                         sendRC=False, timeout=self.timeout,
+                         maxTime=self.maxTime, usePTY=False)
+        self.command = c
+        d = c.start()
+        d.addCallback(self._abandonOnFailure)
+        return d
+
+    def _updateMirror(self):
+        cache = self.builder.gitCache
+        d = cache.lock(self.mirror)
+        def locked(release):
+            d = defer.maybeDeferred(self._doUpdateMirror, cache)
+            def unlock(res):
+                release()
+                return res
+            d.addBoth(unlock)
+            return d
+        d.addCallback(locked)
+        def updated(res):
+            cache.maybeEvict(keep=self.mirror)
+            return res
+        d.addCallback(updated)
+        return d
+
+    def _doUpdateMirror(self, cache):
+        progress = []
+        if self.args.get('progress'):
+            progress = ['--progress']
+        if cache.isMirror(self.mirror):
+            self.sendStatus({"header": "updating mirror %s of %s\n"
+                                            % (self.mirror, self.repourl)})
+            d = self._domirrorcmd(['fetch', '--prune', 'origin'] + progress,
+                                  self.mirror)
+        else:
+            # a mirror without its stamp was not completely cloned
+            if os.path.exists(self.mirror):
+                shutil.rmtree(self.mirror)
+            self.sendStatus({"header": "creating mirror %s of %s\n"
+                                            % (self.mirror, self.repourl)})
+            d = self._domirrorcmd(['clone', '--mirror'] + progress +
+                                  [self.repourl, self.mirror],
+                                  cache.basedir)
+            # checkouts borrow the mirror's objects, so it must never prune
+            # them, even once they are unreachable from its own refs
+            d.addCallback(lambda _ :
+                self._domirrorcmd(['config', 'gc.pruneExpire', 'never'],
+                                  self.mirror))
+        d.addCallback(lambda _ : cache.touch(self.mirror))
+        return d
+
     def doVCUpdate(self):
+        if self.mirror:
+            # the checkout may predate the mirror
+            self._addAlternate(self.mirror)
         try:
             # Check to see if our branch has changed
             diffbranch = self.sourcedata != self.readSourcedata()
@@ -148,7 +346,9 @@ class Git(SourceBaseCommand):
     def _doFetch(self, dummy, branch):
         # The plus will make sure the repo is moved to the branch's
         # head even if it is not a simple "fast-forward"
-        command = ['fetch', '-t', self.repourl, '+%s' % branch]
+        command = ['fetch', '-t', self._fetchUrl(), '+%s' % branch]
+        if self.depth:
+            command[1:1] = ['--depth', str(self.depth)]
         # If the 'progress' option is set, tell git fetch to output
         # progress information to the log. This can solve issues with
         # long fetches killed due to lack of output, but only works
@@ -157,7 +357,16 @@ class Git(SourceBaseCommand):
             command.append('--progress')
         self.sendStatus({"header": "fetching branch %s from %s\n"
                                         % (branch, self.repourl)})
-        return self._dovccmd(command, self._didFetch, keepStderr=True)
+        started = time.time()
+        def timed(res):
+            self.fetchStats['fetches'] += 1
+            self.fetchStats['elapsed'] += time.time() - started
+            return res
+        d = self._dovccmd(command, keepStderr=True)
+        d.addCallback(timed)
+        d.addCallback(self._abandonOnFailure)
+        d.addCallback(self._didFetch)
+        return d
 
     def _didClean(self, dummy):
         branch = self.gerrit_branch or self.branch
@@ -179,33 +388,16 @@ class Git(SourceBaseCommand):
         # If we have a reference repository specified, we need to also set that
         # up after the 'git init'.
         if self.reference:
-            git_alts_path = os.path.join(self._fullSrcdir(), '.git', 'objects', 'info', 'alternates')
-            git_alts_file = open(git_alts_path, 'w')
-            git_alts_file.write(os.path.join(self.reference, 'objects'))
-            git_alts_file.close()
+            self._addAlternate(self.reference)
+        if self.sparse_paths is not None:
+            self._writeSparsePaths()
+            return self._dovccmd(['config', 'core.sparseCheckout', 'true'],
+                                 lambda _ : self.doVCUpdate())
         return self.doVCUpdate()
 
     def doVCFull(self):
-        git = self.getCommand("git")
-
-        # If they didn't ask for a specific revision, we can get away with a
-        # shallow clone.
-        if not self.args.get('revision') and self.args.get('shallow'):
-            cmd = [git, 'clone', '--depth', '1']
-            # If we have a reference repository, pass it to the clone command
-            if self.reference:
-                cmd.extend(['--reference', self.reference])
-            cmd.extend([self.repourl, self._fullSrcdir()])
-            c = runprocess.RunProcess(self.builder, cmd, self.builder.basedir,
-                             sendRC=False, timeout=self.timeout,
-                             maxTime=self.maxTime, usePTY=False)
-            self.command = c
-            cmdexec = c.start()
-            cmdexec.addCallback(self._didInit)
-            return cmdexec
-        else:
-            os.makedirs(self._fullSrcdir())
-            return self._dovccmd(['init'], self._didInit)
+        os.makedirs(self._fullSrcdir())
+        return self._dovccmd(['init'], self._didInit)
 
     def parseGotRevision(self):
         command = ['rev-parse', 'HEAD']
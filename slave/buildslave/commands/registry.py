@@ -20,7 +20,10 @@ commandRegistry = {
     "shell" : "buildslave.commands.shell.SlaveShellCommand",
     "uploadFile" : "buildslave.commands.transfer.SlaveFileUploadCommand",
     "uploadDirectory" : "buildslave.commands.transfer.SlaveDirectoryUploadCommand",
+    "uploadContent" : "buildslave.commands.transfer.SlaveContentUploadCommand",
     "downloadFile" : "buildslave.commands.transfer.SlaveFileDownloadCommand",
+    "uploadFiles" : "buildslave.commands.transfer.SlaveMultipleFileUploadCommand",
+    "downloadFiles" : "buildslave.commands.transfer.SlaveMultipleFileDownloadCommand",
     "svn" : "buildslave.commands.svn.SVN",
     "bk" : "buildslave.commands.bk.BK",
     "cvs" : "buildslave.commands.cvs.CVS",
@@ -35,6 +38,7 @@ commandRegistry = {
     "rmdir" : "buildslave.commands.fs.RemoveDirectory",
     "cpdir" : "buildslave.commands.fs.CopyDirectory",
     "stat" : "buildslave.commands.fs.StatFile",
+    "readFile" : "buildslave.commands.fs.ReadFile",
 }
 
 def getFactory(command):
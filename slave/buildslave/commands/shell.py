@@ -46,6 +46,8 @@ class SlaveShellCommand(base.Command):
                         watched just like 'tail -f', and all changes will be
                         written to 'log' status updates.
         - ['logEnviron']: False to not log the environment variables on the slave
+        - ['logFilter']: a dict of rules deciding which lines of stdout and
+                         stderr to send; see L{buildslave.logfilter}
 
     ShellCommand creates the following status messages:
         - {'stdout': data} : when stdout data is available
@@ -53,6 +55,8 @@ class SlaveShellCommand(base.Command):
         - {'header': data} : when headers (command start/stop) are available
         - {'log': (logfile_name, data)} : when log files have new contents
         - {'rc': rc} : when the process has terminated
+        - {'filter': stats} : when the process has terminated, if
+                              'logFilter' was given
     """
 
     def start(self):
@@ -75,6 +79,7 @@ class SlaveShellCommand(base.Command):
                          logfiles=args.get('logfiles', {}),
                          usePTY=args.get('usePTY', "slave-config"),
                          logEnviron=args.get('logEnviron', True),
+                         logFilter=args.get('logFilter'),
                          )
         c._reactor = self._reactor
         self.command = c
@@ -13,15 +13,38 @@
 #
 # Copyright Buildbot Team Members
 
-import os, tarfile, tempfile
+import os, glob, stat, tarfile, time, threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
-from twisted.python import log
-from twisted.internet import defer
+from twisted.python import log, failure
+from twisted.internet import defer, reactor, threads
 
 from buildslave.commands.base import Command
 
 class TransferCommand(Command):
 
+    # with a window larger than one, block sizes adapt to the round-trip
+    # time: acknowledgements faster than fastAck grow the block size (up to
+    # the 'maxblocksize' argument), and those slower than slowAck shrink it
+    # (down to the initial 'blocksize')
+    fastAck = 1.0
+    slowAck = 4.0
+
+    def setupWindow(self, args):
+        self.window = args.get('window', 1)
+        self.minblocksize = self.blocksize
+        self.maxblocksize = max(args.get('maxblocksize', self.blocksize),
+                                self.blocksize)
+
+    def adaptBlocksize(self, elapsed):
+        if elapsed < self.fastAck:
+            self.blocksize = min(self.blocksize * 2, self.maxblocksize)
+        elif elapsed > self.slowAck:
+            self.blocksize = max(self.blocksize / 2, self.minblocksize)
+
     def finished(self, res):
         if self.debug:
             log.msg('finished: stderr=%r, rc=%r' % (self.stderr, self.rc))
@@ -55,6 +78,8 @@ class SlaveFileUploadCommand(TransferCommand):
         - ['writer']:    RemoteReference to a transfer._FileWriter object
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
+        - ['window']:    number of blocks to keep in flight (default 1)
+        - ['maxblocksize']: the size blocks may grow to (default blocksize)
     """
     debug = False
 
@@ -64,6 +89,7 @@ class SlaveFileUploadCommand(TransferCommand):
         self.writer = args['writer']
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
+        self.setupWindow(args)
         self.stderr = None
         self.rc = 0
 
@@ -108,17 +134,55 @@ class SlaveFileUploadCommand(TransferCommand):
         return d
 
     def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._writeBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
+        # keep up to self.window writes outstanding.  PB delivers them in
+        # order, so the master writes the blocks in the order they are read.
+        self._fire_when_done = fire_when_done
+        self._inflight = 0
+        self._eof = False
+        self._failure = None
+        self._filling = False
+        self._fill()
         return None
 
+    def _fill(self):
+        if self._filling:
+            return # we'll get back to the loop below
+        self._filling = True
+        while (not self._eof and self._failure is None
+               and self._inflight < self.window):
+            started = time.time()
+            try:
+                d = self._writeBlock()
+            except:
+                self._failure = failure.Failure()
+                break
+            if d is True:
+                self._eof = True
+                break
+            self._inflight += 1
+            d.addCallbacks(self._blockWritten, self._blockFailed,
+                           callbackArgs=(started,))
+        self._filling = False
+
+        if self._inflight == 0 and self._fire_when_done:
+            if self._failure is not None:
+                self._fire_when_done.errback(self._failure)
+                self._fire_when_done = None
+            elif self._eof:
+                self._fire_when_done.callback(None)
+                self._fire_when_done = None
+
+    def _blockWritten(self, res, started):
+        self._inflight -= 1
+        self.adaptBlocksize(time.time() - started)
+        self._fill()
+
+    def _blockFailed(self, why):
+        self._inflight -= 1
+        if self._failure is None:
+            self._failure = why
+        self._fill()
+
     def _writeBlock(self):
         """Write a block of data to the remote writer"""
 
@@ -155,6 +219,136 @@ class SlaveFileUploadCommand(TransferCommand):
         return d
 
 
+class _Aborted(Exception):
+    pass
+
+class ArchiveStream:
+    """
+    A file-like object which reads as a tar archive of a directory.  The
+    archive is built (and compressed) by a thread while it is being read,
+    rather than written out to a temporary file first.  At most
+    C{maxBuffered} bytes of archive are held in memory: the thread waits
+    for the reader to catch up after that.
+
+    L{read} never blocks.  When it has nothing to return yet, L{available}
+    returns False, and L{waitForData} returns a Deferred that fires when it
+    does.
+    """
+
+    _reactor = reactor
+
+    def __init__(self, path, compress, maxBuffered=1024*1024):
+        self.path = path
+        if compress == 'bz2':
+            self.mode = 'w|bz2'
+        elif compress == 'gz':
+            self.mode = 'w|gz'
+        else:
+            self.mode = 'w|'
+        self.maxBuffered = maxBuffered
+
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.buffered = 0
+        self.done = False # the thread has finished the archive
+        self.failure = None
+        self.closed = False
+        self.aborted = False
+        self.waiters = []
+
+    def start(self):
+        self._reactor.callInThread(self._produce)
+
+    # the archiving thread
+
+    def _produce(self):
+        try:
+            try:
+                archive = tarfile.open(mode=self.mode, fileobj=self)
+                archive.add(self.path, '')
+                archive.close()
+            except _Aborted:
+                pass
+            except:
+                self.failure = failure.Failure()
+        finally:
+            self.cond.acquire()
+            try:
+                self.done = True
+            finally:
+                self.cond.release()
+            self._reactor.callFromThread(self._notify)
+
+    def write(self, data):
+        if not data:
+            return
+        self.cond.acquire()
+        try:
+            while self.buffered >= self.maxBuffered and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                if self.aborted:
+                    return # tarfile flushing on its way out; drop it
+                self.aborted = True
+                raise _Aborted()
+            self.chunks.append(data)
+            self.buffered += len(data)
+        finally:
+            self.cond.release()
+        self._reactor.callFromThread(self._notify)
+
+    # the reactor thread
+
+    def _notify(self):
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def available(self):
+        self.cond.acquire()
+        try:
+            return bool(self.chunks) or self.done
+        finally:
+            self.cond.release()
+
+    def waitForData(self):
+        d = defer.Deferred()
+        if self.available():
+            d.callback(None)
+        else:
+            self.waiters.append(d)
+        return d
+
+    def read(self, length):
+        self.cond.acquire()
+        try:
+            if not self.chunks and self.failure:
+                self.failure.raiseException()
+            data = []
+            size = 0
+            while self.chunks and size < length:
+                chunk = self.chunks.pop(0)
+                if size + len(chunk) > length:
+                    self.chunks.insert(0, chunk[length - size:])
+                    chunk = chunk[:length - size]
+                data.append(chunk)
+                size += len(chunk)
+            self.buffered -= size
+            self.cond.notify()
+            return ''.join(data)
+        finally:
+            self.cond.release()
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.chunks = []
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+
 class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
     """
     Upload a directory from slave to build master
@@ -166,6 +360,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['compress']:  one of [None, 'bz2', 'gz']
+        - ['window']:    number of blocks to keep in flight (default 1)
+        - ['maxblocksize']: the size blocks may grow to (default blocksize)
     """
     debug = False
 
@@ -175,6 +371,7 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         self.writer = args['writer']
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
+        self.setupWindow(args)
         self.compress = args['compress']
         self.stderr = None
         self.rc = 0
@@ -189,22 +386,10 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         if self.debug:
             log.msg("path: %r" % self.path)
 
-        # Create temporary archive
-        fd, self.tarname = tempfile.mkstemp()
-        fileobj = os.fdopen(fd, 'w')
-        if self.compress == 'bz2':
-            mode='w|bz2'
-        elif self.compress == 'gz':
-            mode='w|gz'
-        else:
-            mode = 'w'
-        archive = tarfile.open(name=self.tarname, mode=mode, fileobj=fileobj)
-        archive.add(self.path, '')
-        archive.close()
-        fileobj.close()
-
-        # Transfer it
-        self.fp = open(self.tarname, 'rb')
+        # archive, compress and send concurrently
+        self.fp = ArchiveStream(self.path, self.compress,
+                    maxBuffered=max(self.window * self.maxblocksize, 1024*1024))
+        self.fp.start()
 
         self.sendStatus({'header': "sending %s" % self.path})
 
@@ -220,12 +405,190 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         d.addBoth(self.finished)
         return d
 
+    def _writeBlock(self):
+        if not self.interrupted and not self.fp.available():
+            # the archive has not caught up yet; try again when it has
+            d = self.fp.waitForData()
+            d.addCallback(lambda _ : False)
+            return d
+        return SlaveFileUploadCommand._writeBlock(self)
+
     def finished(self, res):
         self.fp.close()
-        os.remove(self.tarname)
         return TransferCommand.finished(self, res)
 
 
+class SlaveContentUploadCommand(SlaveFileUploadCommand):
+    """
+    Upload a file or a directory from slave to build master, sending only
+    the files whose content the master does not already have.
+
+    The slave first sends a manifest describing every directory and file,
+    with the SHA-1 of each file's content, in batches of at most
+    C{manifestBatch} entries.  The master answers each batch with the
+    hashes it is missing, and the slave then sends the content for each of
+    those, once, before asking the master to assemble the result.
+
+    Arguments:
+
+        - ['workdir']:   base directory to use
+        - ['slavesrc']:  name of the slave-side file or directory to read from
+        - ['writer']:    RemoteReference to a transfer._ContentWriter object
+        - ['maxsize']:   max number of bytes of content to send
+        - ['blocksize']: max size for each data block
+        - ['window']:    number of blocks to keep in flight (default 1)
+        - ['maxblocksize']: the size blocks may grow to (default blocksize)
+
+    Manifest entries are tuples: C{('d', relpath, mode)} for a directory,
+    C{('l', relpath, target)} for a symbolic link, and C{('f', relpath, sha1,
+    size, mode)} for a file.  Paths are relative to C{slavesrc} and use '/'.
+    When C{slavesrc} is a file, the manifest is a single file entry with an
+    empty relpath.
+    """
+    debug = False
+
+    manifestBatch = 1000
+
+    def setup(self, args):
+        SlaveFileUploadCommand.setup(self, args)
+        self.fp = None
+
+    def start(self):
+        if self.debug:
+            log.msg('SlaveContentUploadCommand started')
+
+        self.path = os.path.join(self.builder.basedir,
+                                 self.workdir,
+                                 os.path.expanduser(self.filename))
+        self.sendStatus({'header': "sending %s" % self.path})
+
+        d = threads.deferToThread(self._buildManifest)
+        d.addCallback(self._sendManifest)
+        d.addCallback(self._sendContents)
+        def _close_ok(res):
+            return self.writer.callRemote("close")
+        def _close_err(f):
+            # tell the master to give up, but keep the existing failure
+            d1 = self.writer.callRemote("abort")
+            def eb(f2):
+                log.msg("ignoring error from remote abort():")
+                log.err(f2)
+            d1.addErrback(eb)
+            d1.addBoth(lambda _ : f)
+            return d1
+        d.addCallbacks(_close_ok, _close_err)
+        d.addErrback(self._failed)
+        d.addBoth(self.finished)
+        return d
+
+    def _failed(self, why):
+        log.err(why, "while uploading %s" % self.path)
+        if self.stderr is None:
+            self.stderr = "Cannot upload '%s': %s" % (self.path,
+                                                       why.getErrorMessage())
+        self.rc = 1
+
+    def _hashFile(self, path):
+        h = sha1()
+        size = 0
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                h.update(data)
+                size += len(data)
+        finally:
+            f.close()
+        return h.hexdigest(), size
+
+    def _buildManifest(self):
+        # runs in a thread: hashing a large tree takes a while
+        manifest = []
+        self.sources = {} # sha1 : path of a file with that content
+        def addFile(relpath, path):
+            digest, size = self._hashFile(path)
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            manifest.append(('f', relpath, digest, size, mode))
+            self.sources.setdefault(digest, path)
+
+        if not os.path.isdir(self.path):
+            addFile('', self.path)
+            return manifest
+
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            reldir = dirpath[len(self.path):].lstrip(os.sep)
+            relparts = filter(None, reldir.split(os.sep))
+            dirnames.sort()
+            for name in dirnames[:]:
+                path = os.path.join(dirpath, name)
+                relpath = '/'.join(relparts + [name])
+                if os.path.islink(path):
+                    # like tar, keep symlinks as symlinks
+                    manifest.append(('l', relpath, os.readlink(path)))
+                    dirnames.remove(name)
+                    continue
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+                manifest.append(('d', relpath, mode))
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                relpath = '/'.join(relparts + [name])
+                if os.path.islink(path):
+                    manifest.append(('l', relpath, os.readlink(path)))
+                elif os.path.isfile(path):
+                    addFile(relpath, path)
+                # sockets, fifos and the like are skipped
+        return manifest
+
+    def _sendManifest(self, manifest):
+        # send the manifest in batches small enough for PB, collecting the
+        # hashes the master asks for
+        self.needed = []
+        seen = set()
+        batches = [ manifest[i:i+self.manifestBatch]
+                    for i in range(0, len(manifest), self.manifestBatch) ]
+        d = defer.succeed(None)
+        def gotNeeded(needed):
+            for digest in needed:
+                if digest not in seen:
+                    seen.add(digest)
+                    self.needed.append(digest)
+        for batch in batches:
+            d.addCallback(lambda _, batch=batch :
+                          self.writer.callRemote("manifest", batch))
+            d.addCallback(gotNeeded)
+        return d
+
+    def _sendContents(self, _):
+        if self.debug:
+            log.msg("sending %d of %d distinct files"
+                    % (len(self.needed), len(self.sources)))
+        needed = list(self.needed)
+        def sendNext(_):
+            if not needed or self.interrupted or self.rc:
+                return
+            digest = needed.pop(0)
+            return self._sendContent(digest).addCallback(sendNext)
+        return sendNext(None)
+
+    def _sendContent(self, digest):
+        self.fp = open(self.sources[digest], 'rb')
+        d = self.writer.callRemote("open", digest)
+        def send(_):
+            d1 = defer.Deferred()
+            self._loop(d1)
+            return d1
+        d.addCallback(send)
+        def finish(res):
+            self.fp.close()
+            self.fp = None
+            return res
+        d.addBoth(finish)
+        d.addCallback(lambda _ : self.writer.callRemote("finish"))
+        return d
+
+
 class SlaveFileDownloadCommand(TransferCommand):
     """
     Download a file from master to slave
@@ -237,6 +600,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['mode']:      access mode for the new file
+        - ['window']:    number of blocks to keep in flight (default 1)
+        - ['maxblocksize']: the size blocks may grow to (default blocksize)
     """
     debug = False
 
@@ -246,6 +611,7 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.reader = args['reader']
         self.bytes_remaining = args['maxsize']
         self.blocksize = args['blocksize']
+        self.setupWindow(args)
         self.mode = args['mode']
         self.stderr = None
         self.rc = 0
@@ -297,50 +663,103 @@ class SlaveFileDownloadCommand(TransferCommand):
         return d
 
     def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._readBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
+        # keep up to self.window reads outstanding, and write the blocks out
+        # in the order they were requested
+        self._fire_when_done = fire_when_done
+        self._inflight = 0
+        self._eof = False
+        self._failure = None
+        self._filling = False
+        self._nextRead = self._nextWrite = 0
+        self._blocks = {}
+        self._readEnd = False # a read has come back empty
+        self._fill()
         return None
 
-    def _readBlock(self):
-        """Read a block of data from the remote reader."""
-
+    def _fill(self):
+        if self._filling:
+            return # we'll get back to the loop below
+        self._filling = True
+        while (not self._eof and not self._readEnd
+               and self._failure is None and self._inflight < self.window):
+            length = self._nextLength()
+            if length <= 0:
+                # wait for the outstanding reads to tell us whether there
+                # was anything left
+                if self._inflight == 0:
+                    self._eof = self._noteEnd()
+                break
+            started = time.time()
+            d = self.reader.callRemote('read', length)
+            if self.bytes_remaining is not None:
+                self.bytes_remaining -= length
+            self._inflight += 1
+            d.addCallbacks(self._blockRead, self._blockFailed,
+                           callbackArgs=(self._nextRead, started))
+            self._nextRead += 1
+        self._filling = False
+
+        if self._inflight == 0 and self._fire_when_done:
+            if self._failure is not None:
+                self._fire_when_done.errback(self._failure)
+                self._fire_when_done = None
+            elif self._eof:
+                self._fire_when_done.callback(None)
+                self._fire_when_done = None
+
+    def _nextLength(self):
         if self.interrupted or self.fp is None:
-            if self.debug:
-                log.msg('SlaveFileDownloadCommand._readBlock(): end')
-            return True
-
+            return 0
         length = self.blocksize
         if self.bytes_remaining is not None and length > self.bytes_remaining:
             length = self.bytes_remaining
+        return length
+
+    def _blockRead(self, data, seq, started):
+        self._inflight -= 1
+        self.adaptBlocksize(time.time() - started)
+        self._blocks[seq] = data
+        if not data:
+            self._readEnd = True
+        try:
+            while self._nextWrite in self._blocks:
+                data = self._blocks.pop(self._nextWrite)
+                self._nextWrite += 1
+                if not self._eof and self._writeData(data):
+                    self._eof = True
+        except:
+            if self._failure is None:
+                self._failure = failure.Failure()
+        self._fill()
 
-        if length <= 0:
-            if self.stderr is None:
-                self.stderr = "Maximum filesize reached, truncating file '%s'" \
-                                % self.path
-                self.rc = 1
+    def _blockFailed(self, why):
+        self._inflight -= 1
+        if self._failure is None:
+            self._failure = why
+        self._fill()
+
+    def _noteEnd(self):
+        """Called when no more blocks may be read, but the end of the file has
+        not been seen: note the truncation, unless we were interrupted."""
+
+        if self.interrupted or self.fp is None:
+            if self.debug:
+                log.msg('SlaveFileDownloadCommand._noteEnd(): end')
             return True
-        else:
-            d = self.reader.callRemote('read', length)
-            d.addCallback(self._writeData)
-            return d
+
+        if self.stderr is None:
+            self.stderr = "Maximum filesize reached, truncating file '%s'" \
+                            % self.path
+            self.rc = 1
+        return True
 
     def _writeData(self, data):
         if self.debug:
-            log.msg('SlaveFileDownloadCommand._readBlock(): readlen=%d' %
+            log.msg('SlaveFileDownloadCommand._writeData(): readlen=%d' %
                     len(data))
         if len(data) == 0:
             return True
 
-        if self.bytes_remaining is not None:
-            self.bytes_remaining = self.bytes_remaining - len(data)
-            assert self.bytes_remaining >= 0
         self.fp.write(data)
         return False
 
@@ -349,3 +768,207 @@ class SlaveFileDownloadCommand(TransferCommand):
             self.fp.close()
 
         return TransferCommand.finished(self, res)
+
+
+class _SubBuilder:
+    """
+    Stands in for the SlaveBuilder of each single-file transfer run by a
+    L{SlaveMultipleTransferCommand}, handing their status updates to it
+    """
+
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        self.basedir = command.builder.basedir
+
+    def sendUpdate(self, status):
+        self.command.subUpdate(self.name, status)
+
+
+class SlaveMultipleTransferCommand(TransferCommand):
+    """
+    Base class for commands that transfer several files, running up to
+    'concurrency' single-file transfers at a time within the one command.
+    Each transfer gets its own writer or reader from the master, by calling
+    'open' on the helper passed in the arguments.
+
+    An update {'files': names} announces the files to be transferred, and an
+    update {'file': name, 'rc': rc} follows as each one completes.
+    """
+
+    transferClass = None
+
+    def setup(self, args):
+        self.workdir = args['workdir']
+        self.maxsize = args['maxsize']
+        self.blocksize = args['blocksize']
+        self.window = args.get('window', 1)
+        self.maxblocksize = args.get('maxblocksize', self.blocksize)
+        self.concurrency = max(args.get('concurrency', 1), 1)
+        self.stderr = None
+        self.rc = 0
+        self.errors = []
+        self.transfers = {} # name : running transfer
+        self.results = {} # name : rc
+
+    def makeTransferArgs(self, name, ref):
+        raise NotImplementedError
+
+    def subUpdate(self, name, status):
+        if 'rc' in status:
+            self.results[name] = status['rc']
+        if 'stderr' in status:
+            self.errors.append(status['stderr'])
+
+    def transferFiles(self, helper, names):
+        self.sendStatus({'files': names})
+        sem = defer.DeferredSemaphore(self.concurrency)
+        dl = [ sem.run(self._transferOne, helper, name) for name in names ]
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda _ : None)
+        return d
+
+    def _transferOne(self, helper, name):
+        if self.interrupted:
+            return
+        d = helper.callRemote('open', name)
+        def start(ref):
+            transfer = self.transferClass(_SubBuilder(self, name), self.stepId,
+                                          self.makeTransferArgs(name, ref))
+            self.transfers[name] = transfer
+            return transfer.doStart()
+        d.addCallback(start)
+        def failed(why):
+            log.err(why, "while transferring %s" % name)
+            self.errors.append("Cannot transfer '%s': %s"
+                               % (name, why.getErrorMessage()))
+            self.results[name] = 1
+        d.addErrback(failed)
+        def done(_):
+            self.transfers.pop(name, None)
+            rc = self.results.get(name, 1)
+            if rc and not self.rc:
+                self.rc = rc
+            self.sendStatus({'file': name, 'rc': rc})
+        d.addCallback(done)
+        return d
+
+    def interrupt(self):
+        TransferCommand.interrupt(self)
+        for transfer in self.transfers.values():
+            transfer.doInterrupt()
+
+    def finished(self, res):
+        if self.errors:
+            self.stderr = '\n'.join(self.errors)
+            if not self.rc:
+                self.rc = 1
+        return TransferCommand.finished(self, res)
+
+
+class SlaveMultipleFileUploadCommand(SlaveMultipleTransferCommand):
+    """
+    Upload the files matching any of several glob patterns from slave to
+    build master, into a single directory
+    Arguments:
+
+        - ['workdir']:   base directory to use
+        - ['slavesrcs']: glob patterns for the slave-side files to read,
+                         relative to the workdir
+        - ['writer']:    RemoteReference to a transfer._MultipleFileWriter
+        - ['maxsize']:   max size (in bytes) of each file to write
+        - ['blocksize']: max size for each data block
+        - ['window']:    number of blocks to keep in flight (default 1)
+        - ['maxblocksize']: the size blocks may grow to (default blocksize)
+        - ['concurrency']: number of files to transfer at once (default 1)
+
+    Files are uploaded by their base name.  A pattern matching no files is
+    an error.
+    """
+
+    transferClass = SlaveFileUploadCommand
+
+    def setup(self, args):
+        SlaveMultipleTransferCommand.setup(self, args)
+        self.patterns = args['slavesrcs']
+        self.writer = args['writer']
+
+    def start(self):
+        workdir = os.path.join(self.builder.basedir, self.workdir)
+        self.sources = {} # name : absolute path
+        names = []
+        for pattern in self.patterns:
+            paths = [ p for p in glob.glob(os.path.join(workdir,
+                                            os.path.expanduser(pattern)))
+                      if os.path.isfile(p) ]
+            if not paths:
+                self.errors.append("No files match '%s'" % pattern)
+            for path in sorted(paths):
+                name = os.path.basename(path)
+                if name in self.sources:
+                    if self.sources[name] != path:
+                        self.errors.append("'%s' and '%s' would both be "
+                                "uploaded as '%s'"
+                                % (self.sources[name], path, name))
+                    continue
+                self.sources[name] = path
+                names.append(name)
+
+        d = self.transferFiles(self.writer, names)
+        d.addBoth(self.finished)
+        return d
+
+    def makeTransferArgs(self, name, ref):
+        return {
+            'workdir': self.workdir,
+            'slavesrc': self.sources[name],
+            'writer': ref,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            'window': self.window,
+            'maxblocksize': self.maxblocksize,
+            }
+
+
+class SlaveMultipleFileDownloadCommand(SlaveMultipleTransferCommand):
+    """
+    Download several files from master to a directory on the slave
+    Arguments:
+
+        - ['workdir']:   base directory to use
+        - ['slavedest']: name of the slave-side directory to write into
+        - ['files']:     names of the files to download
+        - ['reader']:    RemoteReference to a transfer._MultipleFileReader
+        - ['maxsize']:   max size (in bytes) of each file to write
+        - ['blocksize']: max size for each data block
+        - ['mode']:      access mode for the new files
+        - ['window']:    number of blocks to keep in flight (default 1)
+        - ['maxblocksize']: the size blocks may grow to (default blocksize)
+        - ['concurrency']: number of files to transfer at once (default 1)
+    """
+
+    transferClass = SlaveFileDownloadCommand
+
+    def setup(self, args):
+        SlaveMultipleTransferCommand.setup(self, args)
+        self.dirname = args['slavedest']
+        self.names = args['files']
+        self.reader = args['reader']
+        self.mode = args['mode']
+
+    def start(self):
+        d = self.transferFiles(self.reader, self.names)
+        d.addBoth(self.finished)
+        return d
+
+    def makeTransferArgs(self, name, ref):
+        return {
+            'workdir': self.workdir,
+            'slavedest': os.path.join(self.dirname, name),
+            'reader': ref,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            'mode': self.mode,
+            'window': self.window,
+            'maxblocksize': self.maxblocksize,
+            }
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import os
+import subprocess
 
 from twisted.python import log
 from twisted.python.procutils import which
@@ -96,3 +97,44 @@ else:
     # use rmtree on POSIX
     import shutil
     rmdirRecursive = shutil.rmtree
+
+# the copy method to use on each filesystem, by device number
+_copyMethods = {}
+
+def getCopyMethod(basedir):
+    """Return the fastest way to copy a tree within the filesystem holding
+    basedir: 'reflink' if cp can make copy-on-write clones there, otherwise
+    'rsync' if it is installed, otherwise 'cp'.  The answer is probed once
+    for each filesystem."""
+    try:
+        dev = os.stat(basedir).st_dev
+    except OSError:
+        return 'cp'
+    if dev not in _copyMethods:
+        _copyMethods[dev] = _probeCopyMethod(basedir)
+        log.msg("copying trees in %s with %s" % (basedir, _copyMethods[dev]))
+    return _copyMethods[dev]
+
+def _probeCopyMethod(basedir):
+    probe = os.path.join(basedir, '.buildbot-copy-probe')
+    devnull = open(os.devnull, 'w')
+    try:
+        try:
+            open(probe, 'w').write('probe')
+            rc = subprocess.call(['cp', '--reflink=always', probe,
+                                  probe + '-copy'],
+                                 stdout=devnull, stderr=devnull)
+            if rc == 0:
+                return 'reflink'
+        except (OSError, IOError):
+            pass
+    finally:
+        devnull.close()
+        for f in (probe, probe + '-copy'):
+            if os.path.exists(f):
+                os.remove(f)
+    try:
+        getCommand('rsync')
+        return 'rsync'
+    except RuntimeError:
+        return 'cp'
@@ -0,0 +1,260 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import re
+import time
+import shutil
+
+try:
+    from hashlib import sha1
+except ImportError:
+    import sha
+    sha1 = sha.new
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no cross-process locking, e.g. on Windows
+
+from twisted.internet import defer, task, reactor, threads
+from twisted.python import log
+
+class GitMirrorCache:
+    """
+    I keep bare mirrors of git repositories, one per repourl, shared by all
+    of the builders on this slave.  The Git command updates the mirror of
+    its repository, then borrows the mirror's objects (through
+    C{objects/info/alternates}) and fetches from it, so that each object is
+    only fetched over the network once per slave.
+
+    A mirror is updated while holding its lock, which is a lock on a file
+    next to it, so that several buildslaves can share one cache directory.
+    Mirrors are evicted when they have not been used for C{maxAge} seconds,
+    and then least-recently-used first while the cache is larger than
+    C{maxSize} bytes.  Either limit may be None.
+
+    Checkouts keep needing a mirror's objects after the Git command is done,
+    so a mirror is never evicted while a Git command holds it with L{use},
+    nor within C{minIdle} seconds of its last use, which leaves the rest of
+    that build (on any builder or buildslave sharing the cache) time to
+    finish.
+    """
+
+    lockRetryInterval = 1
+    minIdle = 6 * 3600
+    stampFile = 'buildslave-last-used'
+
+    def __init__(self, basedir, maxSize=None, maxAge=None):
+        self.basedir = basedir
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.locks = {} # mirror path : DeferredLock
+        self.users = {} # mirror path : number of commands using it
+        self.evicting = False
+
+    def getMirror(self, repourl):
+        """
+        Return the path of the mirror of C{repourl}; it may not exist yet.
+        """
+        name = re.sub(r'[^\w.-]', '_', repourl.rstrip('/').split('/')[-1])
+        if name.endswith('.git'):
+            name = name[:-4]
+        return os.path.join(self.basedir, "%s-%s.git"
+                                % (name, sha1(repourl).hexdigest()[:12]))
+
+    def isMirror(self, path):
+        return os.path.exists(os.path.join(path, self.stampFile))
+
+    def lock(self, mirror):
+        """
+        Lock C{mirror} for updating.  Returns a Deferred which fires with a
+        function to call to release the lock.
+        """
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        if mirror not in self.locks:
+            self.locks[mirror] = defer.DeferredLock()
+        inprocess = self.locks[mirror]
+        d = inprocess.acquire()
+        d.addCallback(lambda _ : self._lockFile(mirror + '.lock'))
+        def locked(f):
+            def release():
+                if f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    f.close()
+                inprocess.release()
+            return release
+        def failed(why):
+            inprocess.release()
+            return why
+        d.addCallbacks(locked, failed)
+        return d
+
+    def use(self, mirror):
+        """
+        Note that C{mirror} is in use, so that it is not evicted.  Several
+        commands, here or in other buildslaves, may use a mirror at once.
+        Returns a Deferred which fires with a function to call once the
+        mirror is no longer needed.
+        """
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        self.users[mirror] = self.users.get(mirror, 0) + 1
+        d = self._lockFile(mirror + '.inuse', fcntl and fcntl.LOCK_SH)
+        def inUse(f):
+            def release():
+                if f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    f.close()
+                self._unuse(mirror)
+            return release
+        def failed(why):
+            self._unuse(mirror)
+            return why
+        d.addCallbacks(inUse, failed)
+        return d
+
+    def _unuse(self, mirror):
+        self.users[mirror] -= 1
+        if not self.users[mirror]:
+            del self.users[mirror]
+
+    def _lockFile(self, path, mode=None):
+        if not fcntl:
+            return defer.succeed(None)
+        if mode is None:
+            mode = fcntl.LOCK_EX
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f.fileno(), mode | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            # another buildslave has it; try again shortly
+            return task.deferLater(reactor, self.lockRetryInterval,
+                                   self._lockFile, path, mode)
+        return defer.succeed(f)
+
+    def touch(self, mirror):
+        """
+        Note that C{mirror} has just been used.
+        """
+        open(os.path.join(mirror, self.stampFile), 'w').close()
+
+    def getLastUse(self, mirror):
+        return os.path.getmtime(os.path.join(mirror, self.stampFile))
+
+    def getSize(self, mirror):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(mirror):
+            for f in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, f)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def maybeEvict(self, keep=None):
+        """
+        Evict old mirrors in a thread if there are limits on the cache,
+        keeping C{keep} whatever its age.  Returns a Deferred.
+        """
+        if self.evicting or (self.maxSize is None and self.maxAge is None):
+            return defer.succeed(None)
+        self.evicting = True
+        d = threads.deferToThread(self.evict, keep)
+        def done(res):
+            self.evicting = False
+            return res
+        d.addBoth(done)
+        d.addErrback(log.err, 'while evicting git mirrors')
+        return d
+
+    def evict(self, keep=None, now=None):
+        """
+        Remove the mirrors which have not been used for C{maxAge}, and then
+        the least recently used ones until the cache fits in C{maxSize}.
+        Mirrors which are locked, in use, used within C{minIdle}, or are
+        C{keep}, are left alone.  Returns the list of mirrors removed.
+        """
+        if now is None:
+            now = time.time()
+        mirrors = []
+        for name in os.listdir(self.basedir):
+            path = os.path.join(self.basedir, name)
+            if path != keep and self.isMirror(path):
+                lastUse = self.getLastUse(path)
+                # a build may still be using a recently updated mirror
+                if self.minIdle and now - lastUse < self.minIdle:
+                    continue
+                mirrors.append((lastUse, path))
+        mirrors.sort()
+
+        removed = []
+        if self.maxSize is not None:
+            total = sum([ self.getSize(os.path.join(self.basedir, name))
+                          for name in os.listdir(self.basedir)
+                          if self.isMirror(os.path.join(self.basedir, name)) ])
+        for lastUse, path in mirrors:
+            tooOld = self.maxAge is not None and now - lastUse > self.maxAge
+            tooBig = self.maxSize is not None and total > self.maxSize
+            if not (tooOld or tooBig):
+                continue
+            size = self.maxSize is not None and self.getSize(path)
+            if self._remove(path):
+                removed.append(path)
+                if self.maxSize is not None:
+                    total -= size
+        return removed
+
+    def _tryLock(self, path):
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        return f
+
+    def _remove(self, path):
+        # take the file locks, without waiting, so that a mirror being
+        # updated or used is not removed from under it
+        if path in self.locks and self.locks[path].locked:
+            return False
+        if self.users.get(path):
+            return False
+        f = inuse = None
+        if fcntl:
+            f = self._tryLock(path + '.lock')
+            if not f:
+                return False
+            inuse = self._tryLock(path + '.inuse')
+            if not inuse:
+                f.close()
+                return False
+        try:
+            log.msg("evicting git mirror %s" % path)
+            # remove the stamp first, so a half-removed mirror is not used
+            os.unlink(os.path.join(path, self.stampFile))
+            shutil.rmtree(path)
+        finally:
+            if f:
+                os.unlink(path + '.lock')
+                f.close()
+            # the in-use file is left in place: a command which opened it
+            # before an unlink would hold a lock nobody else checks
+            if inuse:
+                inuse.close()
+        return True
@@ -0,0 +1,178 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import re
+from collections import deque
+
+class OutputFilter:
+    """
+    I filter the stdout and stderr of a command line by line, so that only
+    the interesting parts of a long log are sent to the master.  The rules
+    come from the master, as the 'logFilter' argument of a shell command:
+
+        - ['patterns']: regular expressions; lines matching any of them are
+                        sent
+        - ['context']: the number of lines to send before and after each
+                       matching line
+        - ['head']: the number of lines to send from the start of the output
+        - ['tail']: the number of lines to send from the end of the output,
+                    leaving out any which come before a line already sent
+        - ['counters']: a dict mapping counter names to regular expressions;
+                        I count the lines matching each of them
+        - ['keep']: a workdir-relative filename to which the complete,
+                    unfiltered output is written
+
+    Wherever lines were left out, I add a header saying how many.  Lines
+    longer than C{maxLineLength} are cut into pieces.
+    """
+
+    maxLineLength = 64*1024
+
+    def __init__(self, workdir, patterns=[], context=0, head=0, tail=0,
+                 counters={}, keep=None):
+        self.workdir = workdir
+        self.pattern = None
+        if patterns:
+            self.pattern = re.compile('|'.join([ '(?:%s)' % p
+                                                 for p in patterns ]))
+        self.context = context
+        self.head = head
+        self.tail = tail
+        self.counters = [ (name, re.compile(regex))
+                          for name, regex in counters.items() ]
+        self.counts = dict([ (name, 0) for name in counters ])
+        self.keep = keep
+        self.keepFile = None
+
+        self.partial = {} # stream : incomplete last line
+        self.recent = deque() # recent lines
+        self.maxRecent = max(context, tail)
+        self.afterContext = 0
+        self.lines = 0
+        self.linesSent = 0
+        self.lastSent = 0 # line number of the last line sent
+        self.bytes = 0
+
+    def _writeKept(self, data):
+        if not self.keep:
+            return
+        if not self.keepFile:
+            path = os.path.join(self.workdir, self.keep)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.keepFile = open(path, 'wb')
+        self.keepFile.write(data)
+
+    def feed(self, stream, data):
+        """
+        Filter C{data}, output of the given stream ('stdout' or 'stderr').
+        Return a list of (stream, text) tuples to send, where C{stream} is
+        'header' for notes about omitted lines.
+        """
+        self.bytes += len(data)
+        self._writeKept(data)
+        out = []
+        data = self.partial.pop(stream, '') + data
+        start = 0
+        while True:
+            end = data.find('\n', start)
+            if end < 0:
+                break
+            self._line(stream, data[start:end+1], out)
+            start = end + 1
+        rest = data[start:]
+        while len(rest) > self.maxLineLength:
+            self._line(stream, rest[:self.maxLineLength], out)
+            rest = rest[self.maxLineLength:]
+        if rest:
+            self.partial[stream] = rest
+        return self._coalesce(out)
+
+    def finish(self):
+        """
+        Filter any incomplete last lines, and add the tail of the output.
+        Return a list of (stream, text) tuples to send.
+        """
+        out = []
+        for stream in sorted(self.partial):
+            self._line(stream, self.partial[stream], out)
+        self.partial = {}
+        self._sendRecent(self.lines - self.tail, out)
+        if self.lastSent < self.lines:
+            self._omitted(self.lines - self.lastSent, out)
+        if self.keepFile:
+            self.keepFile.close()
+            self.keepFile = None
+        return self._coalesce(out)
+
+    def getStats(self):
+        """
+        Return a dictionary describing the filtering, to send to the master
+        in a 'filter' update.
+        """
+        return { 'counts' : self.counts,
+                 'lines' : self.lines,
+                 'linesSent' : self.linesSent,
+                 'bytes' : self.bytes,
+                 'kept' : self.keep }
+
+    def _line(self, stream, line, out):
+        self.lines += 1
+        lineno = self.lines
+        for name, regex in self.counters:
+            if regex.search(line):
+                self.counts[name] += 1
+
+        if lineno <= self.head:
+            self._send(lineno, stream, line, out)
+        elif self.pattern and self.pattern.search(line):
+            self._sendRecent(lineno - self.context - 1, out)
+            self._send(lineno, stream, line, out)
+            self.afterContext = self.context
+        elif self.afterContext:
+            self.afterContext -= 1
+            self._send(lineno, stream, line, out)
+        elif self.maxRecent:
+            self.recent.append((lineno, stream, line))
+            if len(self.recent) > self.maxRecent:
+                self.recent.popleft()
+
+    def _sendRecent(self, after, out):
+        # send the recent lines which come after the given line number, and
+        # have not been sent yet
+        for lineno, stream, line in self.recent:
+            if lineno > after and lineno > self.lastSent:
+                self._send(lineno, stream, line, out)
+
+    def _send(self, lineno, stream, line, out):
+        if lineno > self.lastSent + 1:
+            self._omitted(lineno - self.lastSent - 1, out)
+        self.lastSent = lineno
+        self.linesSent += 1
+        out.append((stream, line))
+
+    def _omitted(self, count, out):
+        out.append(('header', "[%d lines omitted]\n" % count))
+
+    def _coalesce(self, out):
+        # join consecutive text for the same stream
+        result = []
+        for stream, text in out:
+            if result and result[-1][0] == stream:
+                result[-1][1].append(text)
+            else:
+                result.append((stream, [text]))
+        return [ (stream, ''.join(texts)) for stream, texts in result ]
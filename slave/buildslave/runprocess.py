@@ -26,11 +26,20 @@ import subprocess
 import traceback
 import stat
 from collections import deque
-
-from twisted.python import runtime, log
-from twisted.internet import reactor, defer, protocol, task, error
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from twisted.python import runtime, log, filepath
+from twisted.internet import reactor, defer, protocol, task, error, threads
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None # Twisted before 10.0, or no ctypes
 
 from buildslave import util
+from buildslave.logfilter import OutputFilter
 from buildslave.exceptions import AbandonChain
 
 if runtime.platformType == 'posix':
@@ -58,13 +67,127 @@ def shell_quote(cmd_list):
             return pipes.quote(e)
         return " ".join([ quote(e) for e in cmd_list ])
 
+class LogFileNotifier:
+    """
+    I watch the directories containing logfiles with inotify, on behalf of
+    L{LogFileWatcher}s, and have each watcher read its file when the file
+    changes.  Events which arrive together are coalesced, so that a watcher
+    reads once for each batch of events rather than once for each write.
+
+    One instance is shared by all commands on the slave; use
+    L{getLogFileNotifier} to get it.
+    """
+
+    def __init__(self):
+        self.inotify = inotify.INotify()
+        self.watchers = {} # directory FilePath : { basename : set(watchers) }
+        self.pending = set()
+        self.lost = set()
+        self.flushCall = None
+
+    def add(self, watcher):
+        """Start notifying C{watcher} about changes to its logfile.  Raises
+        L{inotify.INotifyError} if the directory containing it cannot be
+        watched, for example because it does not exist yet."""
+        path = filepath.FilePath(watcher.logfile)
+        directory = path.parent()
+        if directory not in self.watchers:
+            self.inotify.watch(directory, callbacks=[self._notify],
+                    mask=(inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE |
+                          inotify.IN_CREATE | inotify.IN_MOVED_TO |
+                          inotify.IN_DELETE | inotify.IN_MOVED_FROM))
+            if not self.watchers:
+                self.inotify.startReading()
+            self.watchers[directory] = {}
+        self.watchers[directory].setdefault(path.basename(), set()).add(watcher)
+
+    def remove(self, watcher):
+        """Stop notifying C{watcher}."""
+        path = filepath.FilePath(watcher.logfile)
+        directory = path.parent()
+        self.pending.discard(watcher)
+        self.lost.discard(watcher)
+        byName = self.watchers.get(directory, {})
+        byName.get(path.basename(), set()).discard(watcher)
+        if not byName.get(path.basename(), True):
+            del byName[path.basename()]
+        if directory in self.watchers and not byName:
+            del self.watchers[directory]
+            try:
+                self.inotify.ignore(directory)
+            except KeyError:
+                pass # the directory was deleted, so is no longer watched
+        if not self.watchers:
+            self.inotify.stopReading()
+        if not (self.pending or self.lost) and self.flushCall:
+            self.flushCall.cancel()
+            self.flushCall = None
+
+    def _notify(self, ignored, path, mask):
+        if path in self.watchers and mask & inotify.IN_DELETE_SELF:
+            # the directory itself has gone, taking the inotify watch with
+            # it: its watchers must go back to polling until it returns.
+            # They are told once INotify has forgotten the watch.
+            for watchers in self.watchers.pop(path).values():
+                self.lost.update(watchers)
+                self.pending.difference_update(watchers)
+            if not self.watchers:
+                self.inotify.stopReading()
+        else:
+            watchers = self.watchers.get(path.parent(), {}).get(path.basename())
+            if not watchers:
+                return
+            self.pending.update(watchers)
+        if not self.flushCall:
+            self.flushCall = reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        self.flushCall = None
+        lost, self.lost = self.lost, set()
+        for w in lost:
+            w.notifierLost()
+        pending, self.pending = self.pending, set()
+        for w in pending:
+            try:
+                w.poll()
+            except:
+                log.err(None, "while reading %s" % w.logfile)
+
+_logFileNotifier = None
+
+def getLogFileNotifier():
+    """
+    Return the L{LogFileNotifier} shared by all L{LogFileWatcher}s, or None if
+    inotify is not available on this slave.
+    """
+    global _logFileNotifier
+    if _logFileNotifier is None:
+        _logFileNotifier = False
+        if inotify:
+            try:
+                _logFileNotifier = LogFileNotifier()
+            except Exception, e:
+                log.msg("inotify is not available (%s); logfiles will be "
+                        "polled" % (e,))
+    return _logFileNotifier or None
+
 class LogFileWatcher:
+    """
+    I send the contents of a logfile to the master as it grows.  Where
+    inotify is available, I read the file when told it has changed, with a
+    slow poll as a safety net; otherwise (or while the directory containing
+    the file does not exist) I poll it every C{POLL_INTERVAL} seconds.
+    """
+
     POLL_INTERVAL = 2
+    NOTIFIED_POLL_INTERVAL = 30
+    MAX_READ = 64*1024
 
     def __init__(self, command, name, logfile, follow=False):
         self.command = command
         self.name = name
         self.logfile = logfile
+        self.notifier = None
 
         log.msg("LogFileWatcher created to watch %s" % logfile)
         # we are created before the ShellCommand starts. If the logfile we're
@@ -81,16 +204,47 @@ class LogFileWatcher:
         self.poller = task.LoopingCall(self.poll)
 
     def start(self):
-        self.poller.start(self.POLL_INTERVAL).addErrback(self._cleanupPoll)
+        self._addToNotifier()
+        self._startPolling()
+
+    def _startPolling(self):
+        if self.notifier:
+            interval = self.NOTIFIED_POLL_INTERVAL
+        else:
+            interval = self.POLL_INTERVAL
+        if self.poller.running:
+            self.poller.stop()
+        self.poller.start(interval).addErrback(self._cleanupPoll)
 
     def _cleanupPoll(self, err):
         log.err(err, msg="Polling error")
         self.poller = None
 
-    def stop(self):
-        self.poll()
+    def _addToNotifier(self):
+        notifier = getLogFileNotifier()
+        if not notifier:
+            return False
+        try:
+            notifier.add(self)
+        except inotify.INotifyError:
+            return False # the directory does not exist (yet)
+        self.notifier = notifier
+        return True
+
+    def notifierLost(self):
+        """The directory containing my logfile was removed; go back to
+        polling until it is created again."""
+        self.notifier = None
         if self.poller is not None:
+            self._startPolling()
+
+    def stop(self):
+        if self.poller is not None and self.poller.running:
             self.poller.stop()
+        if self.notifier:
+            self.notifier.remove(self)
+            self.notifier = None
+        self.poll()
         if self.started:
             self.f.close()
 
@@ -101,6 +255,12 @@ class LogFileWatcher:
         return None
 
     def poll(self):
+        if (not self.notifier and self.poller is not None
+                and self.poller.running and self._addToNotifier()):
+            # the directory has appeared, so wait for notifications now (the
+            # new interval applies from the next poll); the file may have
+            # changed already, so read it anyway
+            self.poller.interval = self.NOTIFIED_POLL_INTERVAL
         if not self.started:
             s = self.statFile()
             if s == self.old_logfile_stats:
@@ -119,10 +279,14 @@ class LogFileWatcher:
                 self.f.seek(s[2], 0)
             self.started = True
         self.f.seek(self.f.tell(), 0)
-        while True:
-            data = self.f.read(10000)
+        # read whatever has been written since last time, in as few reads
+        # as possible
+        available = os.fstat(self.f.fileno())[stat.ST_SIZE] - self.f.tell()
+        while available > 0:
+            data = self.f.read(min(available, self.MAX_READ))
             if not data:
                 return
+            available -= len(data)
             self.command.addLogfile(self.name, data)
 
 
@@ -212,10 +376,23 @@ class RunProcess:
     KILL = "KILL"
     CHUNK_LIMIT = 128*1024
 
-    # Don't send any data until at least BUFFER_SIZE bytes have been collected
-    # or BUFFER_TIMEOUT elapsed
+    # Output is buffered until bufferSize bytes have been collected or
+    # bufferTimeout has elapsed.  Both start at BUFFER_SIZE and
+    # BUFFER_TIMEOUT, and then adapt to the rate of output, between these
+    # limits, so that quiet (interactive) output is sent promptly while
+    # heavy output is sent in fewer, larger updates.
+    MIN_BUFFER_SIZE = 4*1024
     BUFFER_SIZE = 64*1024
+    MAX_BUFFER_SIZE = 512*1024
+    MIN_BUFFER_TIMEOUT = 0.2
     BUFFER_TIMEOUT = 5
+    MAX_BUFFER_TIMEOUT = 15
+
+    # the output rate, in bytes per second, which earns one second of
+    # bufferTimeout; from BUFFER_TIMEOUT * BUFFER_RATE_SCALE up, updates
+    # are never more frequent than with the fixed BUFFER_SIZE and
+    # BUFFER_TIMEOUT
+    BUFFER_RATE_SCALE = 1024
 
     # For sending elapsed time:
     startTime = None
@@ -235,7 +412,7 @@ class RunProcess:
                  timeout=None, maxTime=None, initialStdin=None,
                  keepStdout=False, keepStderr=False,
                  logEnviron=True, logfiles={}, usePTY="slave-config",
-                 useProcGroup=True):
+                 useProcGroup=True, logFilter=None):
         """
 
         @param keepStdout: if True, we keep a copy of all the stdout text
@@ -249,6 +426,9 @@ class RunProcess:
 
         @param useProcGroup: (default True) use a process group for non-PTY
             process invocations
+
+        @param logFilter: if given, a dictionary of rules for an
+            L{OutputFilter} which decides what stdout and stderr to send
         """
 
         self.builder = builder
@@ -318,9 +498,20 @@ class RunProcess:
         self.keepStdout = keepStdout
         self.keepStderr = keepStderr
 
+        self.outputFilter = None
+        if logFilter:
+            kwargs = dict([ (str(k), v) for k, v in logFilter.items() ])
+            self.outputFilter = OutputFilter(self.workdir, **kwargs)
+
         self.buffered = deque()
         self.buflen = 0
         self.buftimer = None
+        self.bufferSize = self.BUFFER_SIZE
+        self.bufferTimeout = self.BUFFER_TIMEOUT
+        self.outputRate = None # bytes per second, a moving average
+        self.lastFlush = None
+        self.bytesFlushed = 0
+        self.flushes = 0
 
         if usePTY == "slave-config":
             self.usePTY = self.builder.usePTY
@@ -345,6 +536,7 @@ class RunProcess:
         self.useProcGroup = useProcGroup
 
         self.logFileWatchers = []
+        self.onDemandLogfiles = {} # name : filename of logfiles kept here
         for name,filevalue in self.logfiles.items():
             filename = filevalue
             follow = False
@@ -354,6 +546,9 @@ class RunProcess:
             if type(filevalue) == dict:
                 filename = filevalue['filename']
                 follow = filevalue.get('follow', False)
+                if filevalue.get('onDemand'):
+                    self.onDemandLogfiles[name] = filename
+                    continue
 
             w = LogFileWatcher(self, name,
                                os.path.join(self.workdir, filename),
@@ -559,14 +754,56 @@ class RunProcess:
         self.buftimer = None
         self._sendBuffers()
 
+    def _adaptBuffering(self):
+        """
+        Update the moving average of the output rate with the output about
+        to be sent, and pick a buffer size and timeout to suit it: the
+        timeout grows with the rate, and the size is what that rate fills in
+        that time.
+        """
+        now = util.now(self._reactor)
+        elapsed = max(now - (self.lastFlush or now), 0.01)
+        rate = self.buflen / elapsed
+        if self.outputRate is None:
+            self.outputRate = rate
+        else:
+            self.outputRate = (self.outputRate + rate) / 2
+        self.lastFlush = now
+        self.bytesFlushed += self.buflen
+        self.flushes += 1
+
+        timeout = self.outputRate / self.BUFFER_RATE_SCALE
+        self.bufferTimeout = min(max(timeout, self.MIN_BUFFER_TIMEOUT),
+                                 self.MAX_BUFFER_TIMEOUT)
+        size = int(self.outputRate * self.bufferTimeout)
+        self.bufferSize = min(max(size, self.MIN_BUFFER_SIZE),
+                              self.MAX_BUFFER_SIZE)
+
+    def getBufferingStats(self):
+        """
+        Describe the effective buffering of the output so far, as reported to
+        the master in the 'buffering' update: the average output rate and the
+        number, average size and average interval of updates.
+        """
+        elapsed = 0
+        if self.startTime is not None:
+            elapsed = util.now(self._reactor) - self.startTime
+        elapsed = max(elapsed, 0.01)
+        flushes = max(self.flushes, 1)
+        return { 'rate' : self.bytesFlushed / elapsed,
+                 'flushes' : self.flushes,
+                 'size' : self.bytesFlushed / flushes,
+                 'interval' : elapsed / flushes }
+
     def _sendBuffers(self):
         """
         Send all the content in our buffers.
         """
-        msg = {}
-        msg_size = 0
+        if self.buffered:
+            self._adaptBuffering()
         lastlog = None
-        logdata = []
+        chunks = []
+        size = 0
         while self.buffered:
             # Grab the next bits from the buffer
             logname, data = self.buffered.popleft()
@@ -575,37 +812,31 @@ class RunProcess:
             # out the message so far.  This is because the message is
             # transferred as a dictionary, which makes the ordering of keys
             # unspecified, and makes it impossible to interleave data from
-            # different logs.  A future enhancement could be to change the
-            # master to support a list of (logname, data) tuples instead of a
-            # dictionary.
-            # On our first pass through this loop lastlog is None
-            if lastlog is None:
-                lastlog = logname
-            elif logname != lastlog:
-                self._sendMessage(msg)
-                msg = {}
-                msg_size = 0
+            # different logs.  When the master supports it, the SlaveBuilder
+            # sends all of these messages in one batch, as a list of
+            # (logname, data) entries, so the split costs nothing on the wire.
+            if logname != lastlog and chunks:
+                self._sendMessage({lastlog : chunks})
+                chunks = []
+                size = 0
             lastlog = logname
 
-            logdata = msg.setdefault(logname, [])
-
             # Chunkify the log data to make sure we're not sending more than
             # CHUNK_LIMIT at a time
             for chunk in self._chunkForSend(data):
                 if len(chunk) == 0: continue
-                logdata.append(chunk)
-                msg_size += len(chunk)
-                if msg_size >= self.CHUNK_LIMIT:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.CHUNK_LIMIT:
                     # We've gone beyond the chunk limit, so send out our
                     # message.  At worst this results in a message slightly
                     # larger than (2*CHUNK_LIMIT)-1
-                    self._sendMessage(msg)
-                    msg = {}
-                    logdata = msg.setdefault(logname, [])
-                    msg_size = 0
+                    self._sendMessage({logname : chunks})
+                    chunks = []
+                    size = 0
         self.buflen = 0
-        if logdata:
-            self._sendMessage(msg)
+        if chunks:
+            self._sendMessage({lastlog : chunks})
         if self.buftimer:
             if self.buftimer.active():
                 self.buftimer.cancel()
@@ -614,22 +845,32 @@ class RunProcess:
     def _addToBuffers(self, logname, data):
         """
         Add data to the buffer for logname
-        Start a timer to send the buffers if BUFFER_TIMEOUT elapses.
-        If adding data causes the buffer size to grow beyond BUFFER_SIZE, then
+        Start a timer to send the buffers if bufferTimeout elapses.
+        If adding data causes the buffer size to grow beyond bufferSize, then
         the buffers will be sent.
         """
         n = len(data)
 
+        if self.lastFlush is None:
+            self.lastFlush = util.now(self._reactor)
         self.buflen += n
         self.buffered.append((logname, data))
-        if self.buflen > self.BUFFER_SIZE:
+        if self.buflen > self.bufferSize:
             self._sendBuffers()
         elif not self.buftimer:
-            self.buftimer = self._reactor.callLater(self.BUFFER_TIMEOUT, self._bufferTimeout)
+            self.buftimer = self._reactor.callLater(self.bufferTimeout,
+                                                    self._bufferTimeout)
+
+    def _addFiltered(self, logname, data):
+        for logname, text in self.outputFilter.feed(logname, data):
+            self._addToBuffers(logname, text)
 
     def addStdout(self, data):
         if self.sendStdout:
-            self._addToBuffers('stdout', data)
+            if self.outputFilter:
+                self._addFiltered('stdout', data)
+            else:
+                self._addToBuffers('stdout', data)
 
         if self.keepStdout:
             self.stdout += data
@@ -638,7 +879,10 @@ class RunProcess:
 
     def addStderr(self, data):
         if self.sendStderr:
-            self._addToBuffers('stderr', data)
+            if self.outputFilter:
+                self._addFiltered('stderr', data)
+            else:
+                self._addToBuffers('stderr', data)
 
         if self.keepStderr:
             self.stderr += data
@@ -651,13 +895,61 @@ class RunProcess:
         if self.timer:
             self.timer.reset(self.timeout)
 
+    def _describeOnDemandLogfiles(self):
+        # runs in a thread: find the size and hash of each logfile kept on
+        # the slave, omitting those which do not exist
+        info = {}
+        for name, filename in self.onDemandLogfiles.items():
+            try:
+                f = open(os.path.join(self.workdir, filename), 'rb')
+            except IOError:
+                continue
+            h = sha1()
+            size = 0
+            try:
+                while True:
+                    data = f.read(64*1024)
+                    if not data:
+                        break
+                    h.update(data)
+                    size += len(data)
+            finally:
+                f.close()
+            info[name] = {'filename': filename, 'size': size,
+                          'sha1': h.hexdigest()}
+        return info
+
     def finished(self, sig, rc):
+        if not self.onDemandLogfiles:
+            return self._finished(sig, rc)
+        # report the logfiles kept on the slave before the exit code, so the
+        # master knows about them when the command completes
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.maxTimer:
+            self.maxTimer.cancel()
+            self.maxTimer = None
+        d = threads.deferToThread(self._describeOnDemandLogfiles)
+        def send(info):
+            self.sendStatus({'onDemandLogs': info})
+        d.addCallbacks(send, log.err)
+        d.addCallback(lambda _ : self._finished(sig, rc))
+
+    def _finished(self, sig, rc):
         self.elapsedTime = util.now(self._reactor) - self.startTime
         log.msg("command finished with signal %s, exit code %s, elapsedTime: %0.6f" % (sig,rc,self.elapsedTime))
         for w in self.logFileWatchers:
             # this will send the final updates
             w.stop()
+        if self.outputFilter:
+            for logname, text in self.outputFilter.finish():
+                self._addToBuffers(logname, text)
         self._sendBuffers()
+        if self.outputFilter:
+            self.sendStatus({'filter': self.outputFilter.getStats()})
+        if self.flushes:
+            self.sendStatus({'buffering': self.getBufferingStats()})
         if sig is not None:
             rc = -1
         if self.sendRC:
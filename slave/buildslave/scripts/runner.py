@@ -141,9 +141,16 @@ keepalive = %(keepalive)d
 usepty = %(usepty)d
 umask = %(umask)s
 maxdelay = %(maxdelay)d
+git_cache = %(git-cache)r
+git_cache_size = %(git-cache-size)s
+git_cache_max_age = %(git-cache-max-age)s
+min_free_space = %(min-free-space)s
 
 s = BuildSlave(buildmaster_host, port, slavename, passwd, basedir,
-               keepalive, usepty, umask=umask, maxdelay=maxdelay)
+               keepalive, usepty, umask=umask, maxdelay=maxdelay,
+               git_cache=git_cache, git_cache_size=git_cache_size,
+               git_cache_max_age=git_cache_max_age,
+               min_free_space=min_free_space)
 s.setServiceParent(application)
 
 """]
@@ -334,6 +341,14 @@ class SlaveOptions(MakerBase):
          "size at which to rotate twisted log files"],
         ["log-count", "l", "10",
          "limit the number of kept old twisted log files (None for unlimited)"],
+        ["git-cache", None, None,
+         "directory, relative to basedir, for git mirrors shared by builders"],
+        ["git-cache-size", None, "None",
+         "size in megabytes above which old git mirrors are evicted"],
+        ["git-cache-max-age", None, "None",
+         "age in days of last use after which git mirrors are evicted"],
+        ["min-free-space", None, "None",
+         "megabytes of free disk space below which builds are refused"],
         ]
     
     longdesc = """
@@ -374,6 +389,10 @@ class SlaveOptions(MakerBase):
                 self['log-count'] != 'None':
             raise usage.UsageError("log-count parameter needs to be an int "+
                                    " or None")
+        for opt in ('git-cache-size', 'git-cache-max-age', 'min-free-space'):
+            if not re.match('^\d+$', self[opt]) and self[opt] != 'None':
+                raise usage.UsageError("%s parameter needs to be an int "
+                                       "or None" % opt)
 
 class Options(usage.Options):
     synopsis = "Usage:    buildslave <command> [command options]"
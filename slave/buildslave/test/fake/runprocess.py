@@ -94,7 +94,8 @@ class FakeRunProcess:
                  sendStdout=True, sendStderr=True, sendRC=True,
                  timeout=None, maxTime=None, initialStdin=None,
                  keepStdout=False, keepStderr=False,
-                 logEnviron=True, logfiles={}, usePTY="slave-config")
+                 logEnviron=True, logfiles={}, usePTY="slave-config",
+                 logFilter=None)
 
         if not self._expectations:
             raise AssertionError("unexpected instantiation: %s" % (kwargs,))
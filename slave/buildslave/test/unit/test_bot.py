@@ -15,11 +15,13 @@
 
 import os
 import shutil
+import zlib
 import mock
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from twisted.python import failure, log
+from twisted.spread import pb
 
 from buildslave.test.util import command
 from buildslave.test.fake.remote import FakeRemote
@@ -178,6 +180,10 @@ class FakeStep(object):
     def remote_update(self, updates):
         self.actions.append(["update", updates])
 
+    def remote_updates(self, entries):
+        self.actions.append(["updates", entries])
+        return 1000
+
     def remote_complete(self, f):
         self.actions.append(["complete", f])
         self.finished_d.callback(None)
@@ -230,6 +236,12 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
     def test_startBuild(self):
         return self.sb.callRemote("startBuild")
 
+    def test_startBuild_low_disk_space(self):
+        self.bot.builders['sb'].trash = trash = mock.Mock()
+        trash.waitForSpace.return_value = defer.succeed(False)
+        d = self.sb.callRemote("startBuild")
+        return self.assertFailure(d, bot.LowDiskSpace)
+
     def test_startCommand(self):
         # set up a fake step to receive updates
         st = FakeStep()
@@ -260,6 +272,59 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_readFile(self):
+        workdir = os.path.join(self.basedir, 'sb', 'workdir')
+        os.makedirs(workdir)
+        open(os.path.join(workdir, 'test.log'), 'w').write('0123456789')
+        d = self.sb.callRemote("readFile", "workdir", "test.log", 3, 4)
+        d.addCallback(self.assertEqual, '3456')
+        d.addCallback(lambda _ : self.sb.callRemote("readFile", "workdir",
+                                                    "test.log", 10, 4))
+        d.addCallback(self.assertEqual, '')
+        return d
+
+    def test_hashFile(self):
+        workdir = os.path.join(self.basedir, 'sb', 'workdir')
+        os.makedirs(workdir)
+        open(os.path.join(workdir, 'test.log'), 'w').write('0123456789')
+        d = self.sb.callRemote("hashFile", "workdir", "test.log")
+        d.addCallback(self.assertEqual, { 'size' : 10,
+                        'sha1' : '87acec17cd9dcd20a716cc2cf67417b71c8a7016' })
+        d.addCallback(lambda _ : self.sb.callRemote("hashFile", "workdir",
+                                                    "no-such.log"))
+        d.addCallback(self.assertEqual, None)
+        return d
+
+    def test_startCommand_batchUpdates(self):
+        st = FakeStep()
+
+        self.patch_runprocess(
+            Expect([ 'echo', 'hello' ], os.path.join(self.basedir, 'sb', 'workdir'))
+            + { 'hdr' : 'headers' } + { 'stdout' : 'hello\n' }
+            + { 'stdout' : 'world\n' } + { 'rc' : 0 }
+            + 0,
+        )
+
+        d = defer.succeed(None)
+        def do_start(_):
+            return self.sb.callRemote("startCommand", FakeRemote(st),
+                                      "13", "shell", dict(
+                                                command=[ 'echo', 'hello' ],
+                                                workdir='workdir',
+                                                batchUpdates={'credit' : 1000},
+                                            ))
+        d.addCallback(do_start)
+        d.addCallback(lambda _ : st.wait_for_finish())
+        def check(_):
+            self.assertEqual(st.actions, [
+                         ['updates', [ ['status', {'hdr': 'headers'}],
+                                       ['stdout', 'hello\nworld\n'],
+                                       ['status', {'rc': 0}] ]],
+                         ['complete', None],
+                    ])
+        d.addCallback(check)
+        return d
+
     def test_startCommand_interruptCommand(self):
         # set up a fake step to receive updates
         st = FakeStep()
@@ -327,3 +392,109 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
             self.assertTrue(isinstance(st.actions[0][1], failure.Failure))
         d.addCallback(check)
         return d
+
+class TestUpdateQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.queue = bot.UpdateQueue(self, credit=100)
+        self.queue.maxBatchSize = 60
+
+    # fake remote step
+
+    def callRemote(self, method, entries):
+        d = defer.Deferred()
+        self.calls.append((entries, d))
+        return d
+
+    def flush(self):
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        return d
+
+    def test_batches(self):
+        for i in range(10):
+            self.queue.add({'stdout' : 'x' * 10})
+        self.queue.add({'log' : ('foo', 'y' * 10)})
+        self.queue.add({'rc' : 0})
+        d = self.flush()
+        def check(_):
+            # output is joined, up to maxBatchSize, and batches are sent
+            # until the credit is used up
+            self.assertEqual([ c[0] for c in self.calls ], [
+                [ ['stdout', 'x' * 60] ],
+                [ ['stdout', 'x' * 40], ['log', ('foo', 'y' * 10)] ],
+                ])
+            self.assertEqual(self.queue.inflight, 110)
+            # an acknowledgement sends the rest
+            self.calls[0][1].callback(100)
+            self.assertEqual(self.calls[2][0], [ ['status', {'rc' : 0}] ])
+            self.assertEqual(self.queue.queue, [])
+        d.addCallback(check)
+        return d
+
+    def test_credit(self):
+        self.queue.add({'stdout' : 'x' * 50})
+        self.queue.add({'stderr' : 'x' * 50})
+        self.queue.add({'stdout' : 'x' * 50})
+        d = self.flush()
+        def check(_):
+            self.assertEqual(len(self.calls), 2)
+            # the master can cut the credit down
+            self.calls[0][1].callback(10)
+            self.assertEqual(len(self.calls), 2)
+            self.calls[1][1].callback(10)
+            self.assertEqual(len(self.calls), 3)
+        d.addCallback(check)
+        return d
+
+    def test_waitUntilSent(self):
+        self.queue.credit = 10
+        self.queue.add({'stdout' : 'x' * 50})
+        self.queue.add({'stderr' : 'x' * 50})
+        sent = []
+        self.queue.waitUntilSent().addCallback(sent.append)
+        d = self.flush()
+        def check(_):
+            self.assertEqual(sent, [])
+            self.calls[0][1].callback(None)
+            self.assertEqual(sent, [ None ])
+        d.addCallback(check)
+        return d
+
+    def test_lost(self):
+        self.patch(log, "err", lambda f : None)
+        self.queue.credit = 10
+        self.queue.add({'stdout' : 'x' * 50})
+        self.queue.add({'stderr' : 'x' * 50})
+        sent = []
+        self.queue.waitUntilSent().addCallback(sent.append)
+        d = self.flush()
+        def check(_):
+            self.calls[0][1].errback(pb.PBConnectionLost())
+            self.assertEqual(len(self.calls), 1)
+            self.assertEqual(sent, [ None ])
+        d.addCallback(check)
+        return d
+
+    def test_compress(self):
+        self.queue.compress = True
+        self.queue.maxBatchSize = 4096
+        self.queue.credit = 10000
+        self.queue.add({'stdout' : 'short'})
+        self.queue.add({'rc' : 0})
+        self.queue.add({'log' : ('foo', 'y' * 1000)})
+        d = self.flush()
+        def check(_):
+            entries = self.calls[0][0]
+            self.assertEqual(entries[:2],
+                    [ ['stdout', 'short'], ['status', {'rc' : 0}] ])
+            key, update = entries[2]
+            self.assertEqual(key, 'status')
+            k, logname, zdata = update['compressed']
+            self.assertEqual((k, logname, zlib.decompress(zdata)),
+                             ('log', 'foo', 'y' * 1000))
+            self.assertEqual(self.queue.bytesCompressed, 1000)
+            self.assertEqual(self.queue.bytesSent, len(zdata))
+        d.addCallback(check)
+        return d
@@ -144,6 +144,19 @@ class TestBuildSlave(unittest.TestCase):
         self.assertEqual(open(os.path.join(self.basedir, "twistd.hostname")).read().strip(),
                          'test-hostname.domain.com')
 
+    def test_trash_dir(self):
+        # a builder may well be called 'trash'; its builddir is not emptied
+        trees = os.path.join(self.basedir, "trash", "build")
+        os.makedirs(trees)
+        self.buildslave = bot.BuildSlave("127.0.0.1", 9999,
+                "testy", "westy", self.basedir,
+                keepalive=0, usePTY=False, umask=022)
+        trash = self.buildslave.bot.trash
+        self.assertEqual(trash.basedir, os.path.join(self.basedir, ".trash"))
+        trash.start()
+        self.assertEqual(trash.pending, [])
+        self.failUnless(os.path.isdir(trees))
+
     def test_buildslave_graceful_shutdown(self):
         """Test that running the build slave's gracefulShutdown method results
         in a call to the master's shutdown method"""
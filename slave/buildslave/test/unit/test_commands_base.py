@@ -13,11 +13,14 @@
 #
 # Copyright Buildbot Team Members
 
+import os
+
 from twisted.trial import unittest
 from twisted.internet import defer
 
+from buildslave.test.fake.runprocess import Expect
 from buildslave.test.util.command import CommandTestMixin
-from buildslave.commands.base import Command
+from buildslave.commands.base import Command, SourceBaseCommand
 
 # set up a fake Command subclass to test the handling in Command.  Think of
 # this as testing Command's subclassability.
@@ -125,3 +128,90 @@ class TestDummyCommand(CommandTestMixin, unittest.TestCase):
             self.assertState(True, False, True, True, "finishes with interrupted set")
         d.addCallback(check)
         return d
+
+class TestSourceCopy(CommandTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpCommand()
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+    def make_copy_command(self, method):
+        cmd = self.make_command(SourceBaseCommand,
+                dict(workdir='workdir', mode='copy', timeout=10),
+                makedirs=True)
+        cmd.srcdir = 'source'
+        cmd.copyMethod = method
+        cmd.running = True
+        return cmd
+
+    def test_chooseCopyMethod_explicit(self):
+        cmd = self.make_command(SourceBaseCommand,
+                dict(workdir='workdir', copy_method='hardlink'))
+        self.assertEqual(cmd.chooseCopyMethod(), 'hardlink')
+
+    def test_copy_reflink(self):
+        cmd = self.make_copy_command('reflink')
+        self.patch_runprocess(
+            Expect([ 'cp', '-R', '-P', '-p', '--reflink=auto',
+                     self.basedir_source, self.basedir_workdir ],
+                   self.basedir, sendRC=False, timeout=10, usePTY=False)
+            + 0,
+        )
+        d = cmd.doCopy(None)
+        def check(rc):
+            self.assertEqual(rc, 0)
+            self.assertEqual([ u['copy']['method'] for u in self.get_updates()
+                               if 'copy' in u ], [ 'reflink' ])
+        d.addCallback(check)
+        return d
+
+    def test_copy_rsync(self):
+        cmd = self.make_copy_command('rsync')
+        self.patch_getCommand('rsync', 'path/to/rsync')
+        self.patch_runprocess(
+            Expect([ 'path/to/rsync', '-a', '--delete',
+                     self.basedir_source + os.sep,
+                     self.basedir_workdir + os.sep ],
+                   self.basedir, sendRC=False, timeout=10, usePTY=False)
+            + 0,
+        )
+        d = cmd.doCopy(None)
+        def check(rc):
+            self.assertEqual(rc, 0)
+            self.assertEqual([ u['copy']['method'] for u in self.get_updates()
+                               if 'copy' in u ], [ 'rsync' ])
+        d.addCallback(check)
+        return d
+
+    def test_copy_rsync_fails(self):
+        cmd = self.make_copy_command('rsync')
+        self.patch_getCommand('rsync', 'path/to/rsync')
+        self.patch_runprocess(
+            Expect([ 'path/to/rsync', '-a', '--delete',
+                     self.basedir_source + os.sep,
+                     self.basedir_workdir + os.sep ],
+                   self.basedir, sendRC=False, timeout=10, usePTY=False)
+            + 23,
+            Expect([ 'rm', '-rf', self.basedir_workdir ],
+                   self.basedir, sendRC=0, timeout=10, usePTY=False)
+            + 0,
+            Expect([ 'cp', '-R', '-P', '-p',
+                     self.basedir_source, self.basedir_workdir ],
+                   self.basedir, sendRC=False, timeout=10, usePTY=False)
+            + 0,
+        )
+        d = cmd.doCopy(None)
+        def check(rc):
+            self.assertEqual(rc, 0)
+            self.assertEqual(cmd.copyMethod, 'cp')
+            # the copy is reported once, by the fallback
+            updates = self.get_updates()
+            self.assertEqual([ u['copy']['method'] for u in updates
+                               if 'copy' in u ], [ 'cp' ])
+            self.assertEqual(len([ u for u in updates if 'header' in u
+                                   and u['header'].startswith('copied ') ]),
+                             1)
+        d.addCallback(check)
+        return d
@@ -14,11 +14,16 @@
 # Copyright Buildbot Team Members
 
 import os
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from twisted.trial import unittest
 
 from buildslave.test.util.command import CommandTestMixin
 from buildslave.commands import fs
+from buildslave.trash import Trash
 
 class TestRemoveDirectory(CommandTestMixin, unittest.TestCase):
 
@@ -42,6 +47,25 @@ class TestRemoveDirectory(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_trash(self):
+        self.make_command(fs.RemoveDirectory, dict(
+            dir='workdir',
+        ), True)
+        trash = self.builder.trash = Trash(os.path.join(self.basedir, 'trash'))
+        d = self.run_command()
+
+        def check(_):
+            self.assertFalse(os.path.exists(os.path.join(self.basedir, 'workdir')))
+            self.assertIn({'rc': 0},
+                    self.get_updates(),
+                    self.builder.show())
+            return trash.waitUntilEmpty()
+        d.addCallback(check)
+        def checkEmpty(_):
+            self.assertEqual(os.listdir(trash.basedir), [])
+        d.addCallback(checkEmpty)
+        return d
+
 class TestCopyDirectory(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -164,3 +188,86 @@ class TestStatFile(CommandTestMixin, unittest.TestCase):
                     self.builder.show())
         d.addCallback(check)
         return d
+
+class TestReadFile(CommandTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpCommand()
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+    def make_file(self):
+        self.data = ''.join([ "line %d\n" % i for i in range(1000) ])
+        open(os.path.join(self.basedir_workdir, 'test.log'), 'w').write(self.data)
+
+    def get_log(self):
+        return ''.join([ u['log'][1] for u in self.get_updates()
+                         if 'log' in u ])
+
+    def test_simple(self):
+        self.make_command(fs.ReadFile, dict(
+            workdir='workdir', filename='test.log', logname='test',
+        ), True)
+        self.make_file()
+        self.cmd.chunkSize = 1000
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_log(), self.data)
+            self.assertEqual(self.get_updates()[0]['log'][0], 'test')
+            self.assertIn({'rc': 0}, self.get_updates(), self.builder.show())
+        d.addCallback(check)
+        return d
+
+    def test_range(self):
+        self.make_command(fs.ReadFile, dict(
+            workdir='workdir', filename='test.log', logname='test',
+            offset=100, length=2500,
+        ), True)
+        self.make_file()
+        self.cmd.chunkSize = 1000
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_log(), self.data[100:2600])
+        d.addCallback(check)
+        return d
+
+    def test_missing(self):
+        self.make_command(fs.ReadFile, dict(
+            workdir='workdir', filename='no-such-file', logname='test',
+        ), True)
+        d = self.run_command()
+
+        def check(_):
+            self.assertIn({'rc': 1}, self.get_updates(), self.builder.show())
+        d.addCallback(check)
+        return d
+
+    def test_readFileRange_outside(self):
+        self.assertRaises(ValueError, fs.readFileRange, self.basedir,
+                          'workdir', '../../etc/passwd')
+
+    def test_hashFile(self):
+        os.makedirs(self.basedir_workdir)
+        self.make_file()
+        path = os.path.join(self.basedir_workdir, 'test.log')
+        expected = { 'size' : len(self.data),
+                     'sha1' : sha1(self.data).hexdigest() }
+        cache = {}
+        self.assertEqual(fs.hashFile(self.basedir, 'workdir', 'test.log',
+                                     cache), expected)
+        # the cached digest is used while the file is unchanged
+        cache[path] = (cache[path][0], 'cached')
+        self.assertEqual(fs.hashFile(self.basedir, 'workdir', 'test.log',
+                                     cache), 'cached')
+        open(path, 'a').write('more\n')
+        self.assertEqual(fs.hashFile(self.basedir, 'workdir', 'test.log',
+                                     cache)['size'], len(self.data) + 5)
+
+    def test_hashFile_missing(self):
+        self.assertEqual(fs.hashFile(self.basedir, 'workdir', 'nothing'),
+                         None)
+        self.assertRaises(ValueError, fs.hashFile, self.basedir,
+                          'workdir', '../../etc/passwd')
@@ -13,11 +13,14 @@
 #
 # Copyright Buildbot Team Members
 
+import os
+
 from twisted.trial import unittest
 
 from buildslave.test.fake.runprocess import Expect
 from buildslave.test.util.sourcecommand import SourceCommandTestMixin
 from buildslave.commands import git
+from buildslave import gitcache
 
 class TestGit(SourceCommandTestMixin, unittest.TestCase):
 
@@ -174,3 +177,168 @@ class TestGit(SourceCommandTestMixin, unittest.TestCase):
         d = self.run_command()
         return d
 
+
+    def test_mirror(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.clean_environ()
+        self.make_command(git.Git, dict(
+            workdir='workdir',
+            mode='update',
+            revision=None,
+            repourl='git://github.com/djmitche/buildbot.git',
+          ),
+            initial_sourcedata = "git://github.com/djmitche/buildbot.git master\n",
+        )
+        cache = self.builder.gitCache = gitcache.GitMirrorCache(
+                os.path.join(self.basedir, 'gitcache'))
+        self.cmd.setup(self.cmd.args)
+        mirror = self.cmd.mirror
+        self.assertEqual(mirror,
+                cache.getMirror('git://github.com/djmitche/buildbot.git'))
+        os.makedirs(os.path.join(mirror, 'objects'))
+        cache.touch(mirror)
+        os.makedirs(os.path.join(self.basedir_workdir, '.git', 'objects',
+                                 'info'))
+
+        expects = [
+            Expect([ 'path/to/git', 'fetch', '--prune', 'origin' ],
+                mirror,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'fetch', '-t', mirror, '+master' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStderr=True)
+                + { 'stderr' : '' }
+                + 0,
+            Expect(['path/to/git', 'reset', '--hard', 'FETCH_HEAD'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect(['path/to/git', 'branch', '-M', 'master'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'rev-parse', 'HEAD' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStdout=True)
+                + { 'stdout' : '4026d33b0532b11f36b0875f63699adfa8ee8662\n' }
+                + 0,
+        ]
+        self.patch_runprocess(*expects)
+
+        d = self.run_command()
+        def check(_):
+            alternates = open(os.path.join(self.basedir_workdir, '.git',
+                            'objects', 'info', 'alternates')).read()
+            self.assertEqual(alternates, os.path.join(mirror, 'objects') + '\n')
+            self.failIf(cache.locks[mirror].locked)
+            self.assertEqual(cache.users, {})
+        d.addCallback(check)
+        return d
+
+    def test_mirror_evicted(self):
+        self.make_command(git.Git, dict(
+            workdir='workdir',
+            mode='update',
+            revision=None,
+            repourl='git://github.com/djmitche/buildbot.git',
+        ))
+        info = os.path.join(self.basedir_workdir, '.git', 'objects', 'info')
+        os.makedirs(info)
+        self.cmd.srcdir = 'workdir'
+        self.failUnless(self.cmd.sourcedirIsUpdateable())
+        open(os.path.join(info, 'alternates'), 'w').write(
+                os.path.join(self.basedir, 'gone', 'objects') + '\n')
+        self.failIf(self.cmd.sourcedirIsUpdateable())
+
+    def test_sparse_paths_updateable(self):
+        self.make_command(git.Git, dict(
+            workdir='workdir',
+            mode='update',
+            revision=None,
+            repourl='git://github.com/djmitche/buildbot.git',
+            sparse_paths=('docs/ ', 'src/'),
+        ))
+        info = os.path.join(self.basedir_workdir, '.git', 'info')
+        os.makedirs(info)
+        self.cmd.srcdir = 'workdir'
+        self.failIf(self.cmd.sourcedirIsUpdateable())
+        open(os.path.join(info, 'sparse-checkout'), 'w').write(
+                'docs/\n  src/\r\n\n')
+        self.failUnless(self.cmd.sourcedirIsUpdateable())
+        open(os.path.join(info, 'sparse-checkout'), 'w').write('docs/\n')
+        self.failIf(self.cmd.sourcedirIsUpdateable())
+
+    def test_shallow_sparse_deepen(self):
+        self.patch_getCommand('git', 'path/to/git')
+        self.clean_environ()
+        self.make_command(git.Git, dict(
+            workdir='workdir',
+            mode='update',
+            revision='abcdef',
+            shallow=True,
+            sparse_paths=['docs/', 'src/'],
+            repourl='git://github.com/djmitche/buildbot.git',
+        ))
+
+        expects = [
+            Expect([ 'clobber', 'workdir' ],
+                self.basedir)
+                + 0,
+            Expect([ 'path/to/git', 'init'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'config', 'core.sparseCheckout', 'true'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'clean', '-f', '-d', '-x'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect(['path/to/git', 'reset', '--hard', 'abcdef'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 128,
+            Expect([ 'path/to/git', 'fetch', '--depth', '1', '-t',
+                     'git://github.com/djmitche/buildbot.git', '+master' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStderr=True)
+                + 0,
+            Expect(['path/to/git', 'reset', '--hard', 'abcdef'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 128,
+            Expect([ 'path/to/git', 'fetch', '--depth', '10', '-t',
+                     'git://github.com/djmitche/buildbot.git', '+master' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStderr=True)
+                + 0,
+            Expect(['path/to/git', 'reset', '--hard', 'abcdef'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect(['path/to/git', 'branch', '-M', 'master'],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False)
+                + 0,
+            Expect([ 'path/to/git', 'rev-parse', 'HEAD' ],
+                self.basedir_workdir,
+                sendRC=False, timeout=120, usePTY=False, keepStdout=True)
+                + { 'stdout' : 'abcdef0532b11f36b0875f63699adfa8ee866200\n' }
+                + 0,
+        ]
+        self.patch_runprocess(*expects)
+
+        d = self.run_command()
+        def check(_):
+            sparse = open(os.path.join(self.basedir_workdir, '.git', 'info',
+                                       'sparse-checkout')).read()
+            self.assertEqual(sparse, 'docs/\nsrc/\n')
+            fetch = [ u['fetch'] for u in self.get_updates() if 'fetch' in u ]
+            self.assertEqual(len(fetch), 1)
+            self.assertEqual((fetch[0]['fetches'], fetch[0]['depth'],
+                              fetch[0]['deepened']), (2, 10, 1))
+        d.addCallback(check)
+        return d
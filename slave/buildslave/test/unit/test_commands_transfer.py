@@ -18,6 +18,10 @@ import sys
 import shutil
 import tarfile
 import StringIO
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
@@ -46,6 +50,9 @@ class FakeMasterMethods(object):
         self.read = False
         self.data = ''
 
+        self.outstanding = 0
+        self.max_outstanding = 0
+
     def remote_write(self, data):
         if self.count_writes:
             self.add_update('write %d' % len(data))
@@ -57,7 +64,12 @@ class FakeMasterMethods(object):
             self.data += data
 
         if self.delay_write:
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding, self.outstanding)
             d = defer.Deferred()
+            def ack(_):
+                self.outstanding -= 1
+            d.addCallback(ack)
             reactor.callLater(0.01, d.callback, None)
             return d
 
@@ -153,6 +165,58 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_window_adaptive(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+        self.fakemaster.keep_data = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=16,
+            window=4,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            # fast acknowledgements grow the block size
+            self.assertEqual(self.get_updates(), [
+                    {'header': 'sending %s' % self.datafile},
+                    'write 16', 'write 32', 'write 64', 'write 64', 'write 4',
+                    'close',
+                    {'rc': 0}
+                ])
+            self.assertEqual(self.fakemaster.data,
+                             open(self.datafile, "rb").read())
+        d.addCallback(check)
+        return d
+
+    def test_window_pipelined(self):
+        self.fakemaster.delay_write = True
+        self.fakemaster.keep_data = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=16,
+            window=3,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.fakemaster.max_outstanding, 3)
+            self.assertEqual(self.fakemaster.data,
+                             open(self.datafile, "rb").read())
+            self.assertEqual(self.get_updates()[-2:], ['close', {'rc': 0}])
+        d.addCallback(check)
+        return d
+
     def test_missing(self):
         self.make_command(transfer.SlaveFileUploadCommand, dict(
             workdir='workdir',
@@ -275,6 +339,292 @@ class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
     # this is just a subclass of SlaveUpload, so the remaining permutations
     # are already tested
 
+class FakeContentWriter(object):
+    # a fake to represent a transfer._ContentWriter, which already has the
+    # contents in 'have'
+    def __init__(self, add_update, have=()):
+        self.add_update = add_update
+        self.have = set(have)
+        self.manifest = []
+        self.contents = {}
+        self.current = None
+
+    def remote_manifest(self, entries):
+        self.add_update('manifest %d' % len(entries))
+        self.manifest.extend(entries)
+        return [ e[2] for e in entries
+                 if e[0] == 'f' and e[2] not in self.have ]
+
+    def remote_open(self, digest):
+        self.add_update('open')
+        self.current = digest
+        self.contents[digest] = ''
+
+    def remote_write(self, data):
+        self.contents[self.current] += data
+
+    def remote_finish(self):
+        self.add_update('finish')
+        if sha1(self.contents[self.current]).hexdigest() != self.current:
+            raise ValueError("bad content")
+
+    def remote_close(self):
+        self.add_update('close')
+
+    def remote_abort(self):
+        self.add_update('abort')
+
+class TestSlaveContentUpload(CommandTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpCommand()
+
+        self.datadir = os.path.join(self.basedir, 'workdir', 'data')
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+        os.makedirs(os.path.join(self.datadir, 'sub'))
+        open(os.path.join(self.datadir, "aa"), "wb").write("lots of a" * 100)
+        open(os.path.join(self.datadir, "bb"), "wb").write("b" * 17)
+        open(os.path.join(self.datadir, "sub", "cc"), "wb").write("b" * 17)
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+
+    def run_upload(self, writer, slavesrc='data', maxsize=None):
+        self.make_command(transfer.SlaveContentUploadCommand, dict(
+            workdir='workdir',
+            slavesrc=slavesrc,
+            writer=FakeRemote(writer),
+            maxsize=maxsize,
+            blocksize=64,
+        ))
+        self.cmd.manifestBatch = 2
+        return self.run_command()
+
+    def test_directory(self):
+        writer = FakeContentWriter(self.add_update,
+                                   have=[ sha1("lots of a" * 100).hexdigest() ])
+        d = self.run_upload(writer)
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    {'header': 'sending %s' % self.datadir},
+                    'manifest 2', 'manifest 2', # 'sub', 'aa', 'bb', 'sub/cc'
+                    'open', 'finish', # 'bb' and 'sub/cc' are the same
+                    'close',
+                    {'rc': 0}
+                ])
+            self.assertEqual([ e[:2] for e in writer.manifest ],
+                    [ ('d', 'sub'), ('f', 'aa'), ('f', 'bb'), ('f', 'sub/cc') ])
+            self.assertEqual(writer.contents.values(), [ "b" * 17 ])
+        d.addCallback(check)
+        return d
+
+    def test_file(self):
+        writer = FakeContentWriter(self.add_update)
+        d = self.run_upload(writer, slavesrc=os.path.join('data', 'aa'))
+        def check(_):
+            self.assertEqual([ e[:2] for e in writer.manifest ], [ ('f', '') ])
+            self.assertEqual(writer.contents.values(), [ "lots of a" * 100 ])
+            self.assertEqual(self.get_updates()[-1], {'rc': 0})
+        d.addCallback(check)
+        return d
+
+    def test_truncated(self):
+        writer = FakeContentWriter(self.add_update)
+        d = self.run_upload(writer, maxsize=100)
+        def check(_):
+            updates = self.get_updates()
+            self.assertEqual(updates[-3:-1], [ 'finish', 'abort' ])
+            self.assertEqual(updates[-1]['rc'], 1)
+            self.assertTrue('Maximum filesize reached' in updates[-1]['stderr'])
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        d.addCallback(check)
+        return d
+
+    def test_missing(self):
+        writer = FakeContentWriter(self.add_update)
+        d = self.run_upload(writer, slavesrc='nosuch')
+        def check(_):
+            updates = self.get_updates()
+            self.assertEqual(updates[-2], 'abort')
+            self.assertEqual(updates[-1]['rc'], 1)
+            self.flushLoggedErrors()
+        d.addCallback(check)
+        return d
+
+class FakeMultipleFileHelper(object):
+    # a fake to represent a transfer._MultipleFileWriter or
+    # _MultipleFileReader, handing out a FakeMasterMethods per file
+    def __init__(self, add_update, data=None):
+        self.add_update = add_update
+        self.data = data or {}
+        self.files = {}
+        self.active = 0
+        self.max_active = 0
+
+    def remote_open(self, name):
+        if name == 'forbidden':
+            raise ValueError("not allowed")
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        fake = FakeMasterMethods(lambda upd : None)
+        fake.keep_data = True
+        fake.delay_write = fake.delay_read = True
+        fake.data = self.data.get(name, '')
+        def closed():
+            self.active -= 1
+        fake.remote_close = closed
+        self.files[name] = fake
+        return FakeRemote(fake)
+
+class TestMultipleFileUpload(CommandTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpCommand()
+        self.helper = FakeMultipleFileHelper(self.add_update)
+
+        self.datadir = os.path.join(self.basedir, 'workdir')
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+        os.makedirs(os.path.join(self.datadir, 'dist'))
+        for name in [ 'a.txt', 'b.txt', 'c.dat', 'dist/d.txt', 'dist/e.tgz' ]:
+            open(os.path.join(self.datadir, name), "wb").write(name * 50)
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+        if os.path.exists(self.datadir):
+            shutil.rmtree(self.datadir)
+
+    def run_upload(self, patterns, concurrency=2):
+        self.make_command(transfer.SlaveMultipleFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrcs=patterns,
+            writer=FakeRemote(self.helper),
+            maxsize=None,
+            blocksize=32,
+            concurrency=concurrency,
+        ))
+        return self.run_command()
+
+    def test_simple(self):
+        d = self.run_upload([ '*.txt', 'dist/*' ])
+        def check(_):
+            names = [ 'a.txt', 'b.txt', 'd.txt', 'e.tgz' ]
+            updates = self.get_updates()
+            self.assertEqual(updates[0], {'files': names})
+            self.assertEqual(sorted([ u['file'] for u in updates[1:-1] ]),
+                             names)
+            self.assertEqual(updates[-1], {'rc': 0})
+            self.assertEqual(self.helper.files['e.tgz'].data,
+                             'dist/e.tgz' * 50)
+            self.assertEqual(self.helper.max_active, 2)
+        d.addCallback(check)
+        return d
+
+    def test_nomatch(self):
+        d = self.run_upload([ '*.txt', '*.nosuch' ])
+        def check(_):
+            updates = self.get_updates()
+            self.assertEqual(updates[0], {'files': ['a.txt', 'b.txt']})
+            self.assertEqual(updates[-1]['rc'], 1)
+            self.assertEqual(updates[-1]['stderr'],
+                             "No files match '*.nosuch'")
+        d.addCallback(check)
+        return d
+
+    def test_open_failed(self):
+        open(os.path.join(self.datadir, 'forbidden'), "wb").write('x')
+        d = self.run_upload([ 'forbidden', 'c.dat' ])
+        def check(_):
+            updates = self.get_updates()
+            self.assertEqual(updates[1:3], [ {'file': 'forbidden', 'rc': 1},
+                                             {'file': 'c.dat', 'rc': 0} ])
+            self.assertEqual(updates[-1]['rc'], 1)
+            self.assertTrue('not allowed' in updates[-1]['stderr'])
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        d.addCallback(check)
+        return d
+
+class TestMultipleFileDownload(CommandTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpCommand()
+        self.helper = FakeMultipleFileHelper(self.add_update,
+                        data=dict(('f%d' % i, 'data %d\n' % i * 20)
+                                  for i in range(5)))
+
+    def tearDown(self):
+        self.tearDownCommand()
+
+    def test_simple(self):
+        self.make_command(transfer.SlaveMultipleFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='dest',
+            files=sorted(self.helper.data),
+            reader=FakeRemote(self.helper),
+            maxsize=None,
+            blocksize=32,
+            mode=0600,
+            concurrency=3,
+        ))
+        d = self.run_command()
+        def check(_):
+            self.assertEqual(self.get_updates()[-1], {'rc': 0})
+            for name, data in self.helper.data.items():
+                path = os.path.join(self.basedir, 'dest', name)
+                self.assertEqual(open(path).read(), data)
+                self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+            self.assertEqual(self.helper.max_active, 3)
+        d.addCallback(check)
+        return d
+
+class TestArchiveStream(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = os.path.abspath(self.mktemp())
+        os.makedirs(self.datadir)
+        open(os.path.join(self.datadir, "aa"), "wb").write(os.urandom(50000))
+
+    def readAll(self, stream):
+        data = []
+        def loop(_):
+            if not stream.available():
+                return stream.waitForData().addCallback(loop)
+            chunk = stream.read(1000)
+            if not chunk:
+                return ''.join(data)
+            data.append(chunk)
+            # the thread never gets more than maxBuffered ahead
+            self.failIf(stream.buffered > stream.maxBuffered + 10240)
+            return defer.succeed(None).addCallback(loop)
+        return loop(None)
+
+    def test_bounded(self):
+        stream = transfer.ArchiveStream(self.datadir, 'gz', maxBuffered=4096)
+        stream.start()
+        d = self.readAll(stream)
+        def check(data):
+            a = tarfile.open(fileobj=StringIO.StringIO(data), mode='r:gz')
+            self.assertEqual(a.extractfile('aa').read(),
+                    open(os.path.join(self.datadir, "aa"), "rb").read())
+        d.addCallback(check)
+        return d
+
+    def test_close(self):
+        stream = transfer.ArchiveStream(self.datadir, None, maxBuffered=1024)
+        stream.start()
+        d = stream.waitForData()
+        def close(_):
+            stream.close()
+            # the thread gives up rather than waiting for a reader
+            return self.readAll(stream)
+        d.addCallback(close)
+        return d
+
 class TestDownloadFile(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -322,6 +672,59 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_window(self):
+        self.fakemaster.delay_read = True
+        self.fakemaster.data = test_data = '1234' * 13
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=8,
+            mode=None,
+            window=3,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    'read(s)', 'close', {'rc': 0}
+                ])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+        d.addCallback(check)
+        return d
+
+    def test_window_truncated(self):
+        self.fakemaster.delay_read = True
+        self.fakemaster.data = test_data = '1234' * 13
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=20,
+            blocksize=8,
+            mode=None,
+            window=3,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(self.get_updates(), [
+                    'read(s)', 'close',
+                    {'rc': 1,
+                     'stderr': "Maximum filesize reached, truncating file '%s'"
+                                % os.path.join(self.basedir, '.', 'data')}
+                ])
+            self.assertEqual(open(datafile).read(), test_data[:20])
+        d.addCallback(check)
+        return d
+
     def test_mkdir(self):
         self.fakemaster.data = test_data = 'hi'
 
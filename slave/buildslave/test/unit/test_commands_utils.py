@@ -75,6 +75,34 @@ class GetCommand(unittest.TestCase):
         else:
             self.assertEqual(utils.getCommand('xeyes'), r'c:\program files\xeyes.com')
 
+class GetCopyMethod(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(utils, '_copyMethods', {})
+        self.probes = []
+        def probe(basedir):
+            self.probes.append(basedir)
+            return 'rsync'
+        self.patch(utils, '_probeCopyMethod', probe)
+
+    def test_cached(self):
+        self.assertEqual(utils.getCopyMethod('.'), 'rsync')
+        self.assertEqual(utils.getCopyMethod('.'), 'rsync')
+        self.assertEqual(self.probes, [ '.' ])
+
+    def test_missing(self):
+        self.assertEqual(utils.getCopyMethod('does-not-exist'), 'cp')
+        self.assertEqual(self.probes, [])
+
+class ProbeCopyMethod(unittest.TestCase):
+
+    def test_probe(self):
+        os.mkdir('probe')
+        self.assertIn(utils._probeCopyMethod('probe'),
+                      ('reflink', 'rsync', 'cp'))
+        # the probe cleans up after itself
+        self.assertEqual(os.listdir('probe'), [])
+
 class RmdirRecursive(unittest.TestCase):
 
     # this is more complicated than you'd think because Twisted doesn't
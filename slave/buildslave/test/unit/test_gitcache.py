@@ -0,0 +1,124 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from twisted.trial import unittest
+
+from buildslave import gitcache
+
+class TestGitMirrorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        self.cache = gitcache.GitMirrorCache(self.basedir)
+        self.cache.minIdle = 10
+
+    def makeMirror(self, repourl, size, lastUse):
+        mirror = self.cache.getMirror(repourl)
+        os.makedirs(os.path.join(mirror, 'objects'))
+        open(os.path.join(mirror, 'objects', 'pack'), 'w').write('x' * size)
+        self.cache.touch(mirror)
+        os.utime(os.path.join(mirror, self.cache.stampFile),
+                 (lastUse, lastUse))
+        return mirror
+
+    def test_getMirror(self):
+        m1 = self.cache.getMirror('git://example.com/proj.git')
+        m2 = self.cache.getMirror('ssh://other.example.com/proj')
+        self.assertEqual(os.path.dirname(m1), self.basedir)
+        self.failUnless(os.path.basename(m1).startswith('proj-'))
+        self.failUnless(os.path.basename(m2).startswith('proj-'))
+        self.assertNotEqual(m1, m2)
+        self.assertEqual(m1, self.cache.getMirror('git://example.com/proj.git'))
+
+    def test_lock(self):
+        mirror = self.cache.getMirror('git://example.com/proj.git')
+        releases = []
+        self.cache.lock(mirror).addCallback(releases.append)
+        self.cache.lock(mirror).addCallback(releases.append)
+        self.assertEqual(len(releases), 1)
+        releases[0]()
+        self.assertEqual(len(releases), 2)
+        releases[1]()
+        self.failIf(self.cache.locks[mirror].locked)
+
+    def test_evict_age(self):
+        self.cache.maxAge = 100
+        old = self.makeMirror('git://example.com/old', 10, 1000)
+        new = self.makeMirror('git://example.com/new', 10, 1950)
+        self.assertEqual(self.cache.evict(now=2000), [ old ])
+        self.failIf(os.path.exists(old))
+        self.failUnless(os.path.exists(new))
+
+    def test_evict_size(self):
+        self.cache.maxSize = 250
+        m1 = self.makeMirror('git://example.com/1', 100, 1000)
+        m2 = self.makeMirror('git://example.com/2', 100, 3000)
+        m3 = self.makeMirror('git://example.com/3', 100, 2000)
+        self.assertEqual(self.cache.evict(keep=m3, now=4000), [ m1 ])
+        self.failUnless(os.path.exists(m2))
+        self.failUnless(os.path.exists(m3))
+
+    def test_evict_skips_locked(self):
+        self.cache.maxAge = 100
+        old = self.makeMirror('git://example.com/old', 10, 1000)
+        releases = []
+        self.cache.lock(old).addCallback(releases.append)
+        self.assertEqual(self.cache.evict(now=2000), [])
+        releases[0]()
+        self.assertEqual(self.cache.evict(now=2000), [ old ])
+
+    def test_evict_skips_in_use(self):
+        self.cache.maxAge = 100
+        old = self.makeMirror('git://example.com/old', 10, 1000)
+        releases = []
+        self.cache.use(old).addCallback(releases.append)
+        self.cache.use(old).addCallback(releases.append)
+        self.assertEqual(len(releases), 2)
+        releases[0]()
+        self.assertEqual(self.cache.evict(now=2000), [])
+        releases[1]()
+        self.assertEqual(self.cache.users, {})
+        self.assertEqual(self.cache.evict(now=2000), [ old ])
+
+    def test_evict_skips_in_use_elsewhere(self):
+        if not fcntl:
+            raise unittest.SkipTest("no fcntl on this platform")
+        self.cache.maxAge = 100
+        old = self.makeMirror('git://example.com/old', 10, 1000)
+        # another buildslave sharing the cache holds the mirror in use
+        f = open(old + '.inuse', 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        self.assertEqual(self.cache.evict(now=2000), [])
+        f.close()
+        self.assertEqual(self.cache.evict(now=2000), [ old ])
+
+    def test_evict_size_skips_recent(self):
+        # a mirror updated moments ago may be borrowed by a running build,
+        # even if it is the least recently used one
+        self.cache.maxSize = 150
+        self.cache.minIdle = 500
+        m1 = self.makeMirror('git://example.com/1', 100, 1300)
+        m2 = self.makeMirror('git://example.com/2', 100, 1600)
+        self.assertEqual(self.cache.evict(now=1700), [])
+        self.assertEqual(self.cache.evict(now=1900), [ m1 ])
+        self.failUnless(os.path.exists(m2))
@@ -0,0 +1,123 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+
+import os
+import shutil
+from twisted.trial import unittest
+
+from buildslave.logfilter import OutputFilter
+
+class TestOutputFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath("test_logfilter")
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def lines(self, n):
+        return ''.join([ "line %d\n" % i for i in range(1, n+1) ])
+
+    def run_filter(self, data, **kwargs):
+        f = OutputFilter(self.basedir, **kwargs)
+        out = []
+        # feed the data in awkward pieces
+        for i in range(0, len(data), 7):
+            out.extend(f.feed('stdout', data[i:i+7]))
+        out.extend(f.finish())
+        # join adjacent output for easier comparison
+        joined = []
+        for stream, text in out:
+            if joined and joined[-1][0] == stream:
+                joined[-1] = (stream, joined[-1][1] + text)
+            else:
+                joined.append((stream, text))
+        return f, joined
+
+    def test_patterns(self):
+        f, out = self.run_filter(self.lines(20), patterns=['line 5$', 'ne 12'])
+        self.assertEqual(out, [
+            ('header', '[4 lines omitted]\n'),
+            ('stdout', 'line 5\n'),
+            ('header', '[6 lines omitted]\n'),
+            ('stdout', 'line 12\n'),
+            ('header', '[8 lines omitted]\n') ])
+        self.assertEqual(f.getStats()['linesSent'], 2)
+        self.assertEqual(f.getStats()['lines'], 20)
+
+    def test_context(self):
+        f, out = self.run_filter(self.lines(20), patterns=['line 10$'],
+                                 context=2)
+        self.assertEqual(out, [
+            ('header', '[7 lines omitted]\n'),
+            ('stdout', 'line 8\nline 9\nline 10\nline 11\nline 12\n'),
+            ('header', '[8 lines omitted]\n') ])
+
+    def test_head_tail(self):
+        f, out = self.run_filter(self.lines(20), patterns=['line 10$'],
+                                 head=2, tail=3)
+        self.assertEqual(out, [
+            ('stdout', 'line 1\nline 2\n'),
+            ('header', '[7 lines omitted]\n'),
+            ('stdout', 'line 10\n'),
+            ('header', '[7 lines omitted]\n'),
+            ('stdout', 'line 18\nline 19\nline 20\n') ])
+
+    def test_tail_after_match(self):
+        # lines of the tail which come before a line already sent are left
+        # out, rather than sent out of order
+        f, out = self.run_filter(self.lines(20), patterns=['line 19$'],
+                                 tail=3)
+        self.assertEqual(out, [
+            ('header', '[18 lines omitted]\n'),
+            ('stdout', 'line 19\nline 20\n') ])
+
+    def test_partial_last_line(self):
+        f, out = self.run_filter("one\ntwo", tail=1)
+        self.assertEqual(out, [
+            ('header', '[1 lines omitted]\n'),
+            ('stdout', 'two') ])
+
+    def test_long_line(self):
+        f = OutputFilter(self.basedir, patterns=['x'])
+        f.maxLineLength = 10
+        self.assertEqual(f.feed('stdout', 'x' * 25),
+                         [ ('stdout', 'x' * 20) ])
+        self.assertEqual(f.finish(), [ ('stdout', 'x' * 5) ])
+
+    def test_streams(self):
+        f = OutputFilter(self.basedir, patterns=['err'])
+        self.assertEqual(f.feed('stdout', 'out\n'), [])
+        self.assertEqual(f.feed('stderr', 'err\n'),
+                         [ ('header', '[1 lines omitted]\n'),
+                           ('stderr', 'err\n') ])
+
+    def test_counters_and_keep(self):
+        data = "warning: a\nok\nerror: b\nwarning: c\n"
+        f, out = self.run_filter(data, counters={'warnings' : '^warning',
+                                                 'errors' : '^error'},
+                                 keep='logs/full.log')
+        self.assertEqual(out, [ ('header', '[4 lines omitted]\n') ])
+        stats = f.getStats()
+        self.assertEqual(stats['counts'], {'warnings' : 2, 'errors' : 1})
+        self.assertEqual((stats['bytes'], stats['kept']),
+                         (len(data), 'logs/full.log'))
+        self.assertEqual(
+            open(os.path.join(self.basedir, 'logs', 'full.log')).read(), data)
@@ -69,6 +69,50 @@ class TestRunProcess(BasedirMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def testOnDemandLogfiles(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        os.makedirs(self.basedir)
+        open(os.path.join(self.basedir, 'kept.log'), 'w').write('kept\n')
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir,
+                        logfiles={'kept' : {'filename' : 'kept.log',
+                                            'onDemand' : True},
+                                  'missing' : {'filename' : 'missing.log',
+                                               'onDemand' : True}})
+        self.failUnlessEqual(s.logFileWatchers, [])
+
+        d = s.start()
+        def check(ign):
+            self.failIf([ u for u in b.updates if 'log' in u ], b.show())
+            info = [ u['onDemandLogs'] for u in b.updates
+                     if 'onDemandLogs' in u ]
+            self.failUnlessEqual(info, [{'kept' : {'filename' : 'kept.log',
+                    'size' : 5,
+                    'sha1' : 'fdb98803262dfdebee3e7522add2c16eda14ff37'}}])
+            self.failUnless({'rc': 0} in b.updates, b.show())
+        d.addCallback(check)
+        return d
+
+    def testLogFilter(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, stdoutCommand(r'ok\nFAIL: x\nok'),
+                                  self.basedir,
+                                  logFilter={'patterns' : ['^FAIL'],
+                                             'counters' : {'ok' : '^ok'},
+                                             'keep' : 'full.log'})
+
+        d = s.start()
+        def check(ign):
+            stdout = ''.join([ u['stdout'] for u in b.updates
+                               if 'stdout' in u ])
+            self.failUnlessEqual(stdout, nl('FAIL: x\n'), b.show())
+            stats = [ u['filter'] for u in b.updates if 'filter' in u ]
+            self.failUnlessEqual(stats[0]['counts'], {'ok' : 2})
+            self.failUnlessEqual(stats[0]['lines'], 3)
+            full = open(os.path.join(self.basedir, 'full.log')).read()
+            self.failUnlessEqual(full, nl('ok\nFAIL: x\nok\n'))
+        d.addCallback(check)
+        return d
+
     def testNoStdout(self):
         b = FakeSlaveBuilder(False, self.basedir)
         s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir, sendStdout=False)
@@ -512,6 +556,59 @@ class TestLogging(BasedirMixin, unittest.TestCase):
         s._addToBuffers('stdout', data)
         self.failUnlessEqual(len(b.updates), 1)
 
+    def testAdaptiveBuffering(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        clock = task.Clock()
+        s._reactor = clock
+        RP = runprocess.RunProcess
+        self.failUnlessEqual((s.bufferSize, s.bufferTimeout),
+                             (RP.BUFFER_SIZE, RP.BUFFER_TIMEOUT))
+
+        # heavy output raises the buffer size and timeout to their limits
+        for i in range(10):
+            clock.advance(0.05)
+            s._addToBuffers('stdout', 'x' * (s.bufferSize + 1))
+        self.failUnlessEqual((s.bufferSize, s.bufferTimeout),
+                             (RP.MAX_BUFFER_SIZE, RP.MAX_BUFFER_TIMEOUT))
+
+        # and a trickle brings them back down
+        for i in range(20):
+            s._addToBuffers('stdout', 'tick\n')
+            clock.advance(s.bufferTimeout)
+        self.failUnlessEqual((s.bufferSize, s.bufferTimeout),
+                             (RP.MIN_BUFFER_SIZE, RP.MIN_BUFFER_TIMEOUT))
+        self.failUnlessEqual(s.getBufferingStats()['flushes'], 30)
+
+    def countFlushes(self, adapt, rate, chunk, duration):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        clock = task.Clock()
+        s._reactor = clock
+        if not adapt:
+            # the fixed BUFFER_SIZE and BUFFER_TIMEOUT of older slaves
+            def fixed():
+                s.flushes += 1
+            s._adaptBuffering = fixed
+        interval = float(chunk) / rate
+        for i in range(int(duration / interval)):
+            s._addToBuffers('stdout', 'x' * chunk)
+            clock.advance(interval)
+        s._sendBuffers()
+        return s.getBufferingStats()['flushes']
+
+    def testAdaptiveBufferingHeavyOutput(self):
+        # a minute of 200kB/s, as from a parallel make
+        adaptive = self.countFlushes(True, 200*1024, 4096, 60)
+        fixed = self.countFlushes(False, 200*1024, 4096, 60)
+        self.failUnless(adaptive * 4 < fixed, (adaptive, fixed))
+
+    def testAdaptiveBufferingModerateOutput(self):
+        # 10kB/s is no more chatty than with fixed buffering
+        adaptive = self.countFlushes(True, 10*1024, 1024, 60)
+        fixed = self.countFlushes(False, 10*1024, 1024, 60)
+        self.failUnless(adaptive <= fixed, (adaptive, fixed))
+
 class TestLogFileWatcher(BasedirMixin, unittest.TestCase):
     def setUp(self):
         self.setUpBasedir()
@@ -538,3 +635,101 @@ class TestLogFileWatcher(BasedirMixin, unittest.TestCase):
         st = lf.statFile()
         self.assertEqual(st and st[2], 2, "statfile.log exists and size is correct")
         os.remove('statfile.log')
+
+class RecordingCommand:
+    def __init__(self):
+        self.logs = []
+        self.d = defer.Deferred()
+
+    def addLogfile(self, name, data):
+        self.logs.append((name, data))
+        if not self.d.called:
+            self.d.callback(None)
+
+class TestLogFileWatcherUpdates(BasedirMixin, unittest.TestCase):
+    def setUp(self):
+        self.setUpBasedir()
+        self.logdir = os.path.abspath(os.path.join(self.basedir, 'logs'))
+        self.logfile = os.path.join(self.logdir, 'test.log')
+        self.cmd = RecordingCommand()
+        self.watchers = []
+
+    def tearDown(self):
+        for w in self.watchers:
+            w.stop()
+        self.tearDownBasedir()
+
+    def makeWatcher(self):
+        w = runprocess.LogFileWatcher(self.cmd, 'test', self.logfile)
+        w.start()
+        self.watchers.append(w)
+        return w
+
+    def requireNotifier(self):
+        if not runprocess.getLogFileNotifier():
+            raise unittest.SkipTest("inotify is not available")
+
+    def test_notified(self):
+        self.requireNotifier()
+        os.makedirs(self.logdir)
+        w = self.makeWatcher()
+        self.assertTrue(w.notifier)
+        self.assertEqual(w.poller.interval, w.NOTIFIED_POLL_INTERVAL)
+        f = open(self.logfile, 'w')
+        for i in range(5):
+            f.write('line %d\n' % i)
+            f.flush()
+        f.close()
+        def check(_):
+            # the writes are read together, without waiting for a poll
+            self.assertEqual(self.cmd.logs, [('test', ''.join([
+                                'line %d\n' % i for i in range(5) ]))])
+        self.cmd.d.addCallback(check)
+        return self.cmd.d
+
+    def test_directory_created(self):
+        self.requireNotifier()
+        w = self.makeWatcher()
+        self.assertFalse(w.notifier)
+        self.assertEqual(w.poller.interval, w.POLL_INTERVAL)
+        os.makedirs(self.logdir)
+        w.poll()
+        self.assertTrue(w.notifier)
+        self.assertEqual(w.poller.interval, w.NOTIFIED_POLL_INTERVAL)
+
+    def test_no_notifier(self):
+        self.patch(runprocess, 'getLogFileNotifier', lambda : None)
+        os.makedirs(self.logdir)
+        w = self.makeWatcher()
+        self.assertFalse(w.notifier)
+        self.assertEqual(w.poller.interval, w.POLL_INTERVAL)
+        open(self.logfile, 'w').write('hello\n')
+        w.poll()
+        self.assertEqual(self.cmd.logs, [('test', 'hello\n')])
+
+    def test_batched_reads(self):
+        self.patch(runprocess, 'getLogFileNotifier', lambda : None)
+        os.makedirs(self.logdir)
+        w = self.makeWatcher()
+        w.MAX_READ = 10
+        open(self.logfile, 'w').write('x' * 25)
+        w.poll()
+        self.assertEqual([ len(data) for name, data in self.cmd.logs ],
+                         [10, 10, 5])
+
+    def test_directory_removed(self):
+        self.requireNotifier()
+        os.makedirs(self.logdir)
+        w = self.makeWatcher()
+        d = defer.Deferred()
+        notifierLost = w.notifierLost
+        def lost():
+            notifierLost()
+            d.callback(None)
+        w.notifierLost = lost
+        os.rmdir(self.logdir)
+        def check(_):
+            self.assertFalse(w.notifier)
+            self.assertEqual(w.poller.interval, w.POLL_INTERVAL)
+        d.addCallback(check)
+        return d
@@ -0,0 +1,125 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.python import runtime
+
+from buildslave import trash
+
+class TestTrash(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.makedirs(self.basedir)
+        self.trash = trash.Trash(os.path.join(self.basedir, 'trash'))
+
+    def makeTree(self, name):
+        path = os.path.join(self.basedir, name)
+        os.makedirs(os.path.join(path, 'sub', 'dir'))
+        for i in range(10):
+            open(os.path.join(path, 'sub', 'f%d' % i), 'w').write('x')
+        return path
+
+    def test_moveAside(self):
+        tree = self.makeTree('workdir')
+        self.failUnless(self.trash.moveAside(tree))
+        self.failIf(os.path.exists(tree))
+        d = self.trash.waitUntilEmpty()
+        def check(_):
+            self.assertEqual(os.listdir(self.trash.basedir), [])
+        d.addCallback(check)
+        return d
+
+    def test_moveAside_missing(self):
+        self.failUnless(self.trash.moveAside(
+                            os.path.join(self.basedir, 'nosuch')))
+        self.failUnless(self.trash.isEmpty())
+
+    def test_moveAside_fails(self):
+        # the trash is a file, so nothing can be moved into it
+        open(self.trash.basedir, 'w')
+        self.trash.basedir = os.path.join(self.trash.basedir, 'trash')
+        tree = self.makeTree('workdir')
+        self.failIf(self.trash.moveAside(tree))
+        self.failUnless(os.path.exists(tree))
+
+    def test_start_removes_leftovers(self):
+        os.makedirs(self.trash.basedir)
+        os.rename(self.makeTree('workdir'),
+                  os.path.join(self.trash.basedir, 'workdir.1.1'))
+        self.trash.start()
+        d = self.trash.waitUntilEmpty()
+        def check(_):
+            self.assertEqual(os.listdir(self.trash.basedir), [])
+        d.addCallback(check)
+        return d
+
+    def test_remove_unwritable(self):
+        if runtime.platformType != 'posix':
+            raise unittest.SkipTest("no permissions on this platform")
+        tree = self.makeTree('workdir')
+        os.chmod(os.path.join(tree, 'sub', 'dir'), 0)
+        os.chmod(os.path.join(tree, 'sub'), 0500)
+        self.trash.remove(tree)
+        self.failIf(os.path.exists(tree))
+
+    def test_remove_throttled(self):
+        sleeps = []
+        self.patch(trash.time, 'sleep', sleeps.append)
+        self.trash.batchSize = 4
+        self.trash.filesPerSecond = 1
+        self.trash.remove(self.makeTree('workdir'))
+        # 10 files and 3 directories, so three pauses of up to 4 seconds
+        self.assertEqual(len(sleeps), 3)
+        self.failUnless(3 < sleeps[0] <= 4)
+
+    def test_stop(self):
+        tree = self.makeTree('workdir')
+        self.trash.stop()
+        self.failUnless(self.trash.moveAside(tree))
+        self.assertEqual(len(os.listdir(self.trash.basedir)), 1)
+
+    def test_waitForSpace(self):
+        self.trash.minFreeSpace = 1000
+        self.trash.getFreeSpace = lambda : 2000
+        d = self.trash.waitForSpace()
+        d.addCallback(self.assertEqual, True)
+        return d
+
+    def test_waitForSpace_low(self):
+        clock = task.Clock()
+        self.patch(trash, 'reactor', clock)
+        self.trash.minFreeSpace = 1000
+        free = [ 500 ]
+        self.trash.getFreeSpace = lambda : free[0]
+        results = []
+        self.trash.waitForSpace().addCallback(results.append)
+        self.assertEqual(results, [])
+        free[0] = 1500
+        clock.advance(self.trash.lowSpaceDelay)
+        self.assertEqual(results, [ True ])
+
+    def test_waitForSpace_still_low(self):
+        clock = task.Clock()
+        self.patch(trash, 'reactor', clock)
+        self.trash.minFreeSpace = 1000
+        self.trash.getFreeSpace = lambda : 500
+        results = []
+        self.trash.waitForSpace().addCallback(results.append)
+        clock.advance(self.trash.lowSpaceDelay)
+        self.assertEqual(results, [ False ])
@@ -30,6 +30,7 @@ class SourceCommandTestMixin(command.CommandTestMixin):
         * readSourcedata - reads from self.sourcedata
         * doClobber - invokes RunProcess(['clobber', DIRECTORY])
         * doCopy - invokes RunProcess(['copy', cmd.srcdir, cmd.workdir])
+        * chooseCopyMethod - always returns 'cp'
         """
 
         cmd = command.CommandTestMixin.make_command(self, cmdclass, args, makedirs)
@@ -61,6 +62,9 @@ class SourceCommandTestMixin(command.CommandTestMixin):
             return r.start()
         cmd.doCopy = doCopy
 
+        # don't probe the filesystem for a copy method
+        cmd.chooseCopyMethod = lambda : 'cp'
+
     def check_sourcedata(self, _, expected_sourcedata):
         """
         Assert that the sourcedata (from the patched functions - see
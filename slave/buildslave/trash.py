@@ -0,0 +1,205 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import stat
+import time
+
+from twisted.internet import defer, task, reactor, threads
+from twisted.python import log
+
+class Trash:
+    """
+    I remove directory trees in the background, so that a clobber does not
+    have to wait for them.  A tree is renamed into my directory, which is
+    instant, and then removed by a thread, one tree at a time.  The thread
+    removes at most C{filesPerSecond} files a second, so that it does not
+    starve the build of disk bandwidth.
+
+    Trees left in my directory by an earlier run of the buildslave are
+    removed when I start.  If C{minFreeSpace} (in bytes) is given,
+    L{waitForSpace} can be used to find out whether there is room for a
+    new build, waiting for the trash to be emptied if that would help.
+    """
+
+    filesPerSecond = 2000
+    batchSize = 200 # files removed between pauses
+    lowSpaceDelay = 60 # seconds to wait for space before giving up
+
+    def __init__(self, basedir, minFreeSpace=None):
+        self.basedir = basedir
+        self.minFreeSpace = minFreeSpace
+        self.pending = [] # trees waiting to be removed
+        self.removing = None
+        self.emptyWaiters = []
+        self.serial = 0
+        self.stopped = False
+
+    def start(self):
+        """
+        Remove anything left over from an earlier run.
+        """
+        if not os.path.isdir(self.basedir):
+            return
+        for name in sorted(os.listdir(self.basedir)):
+            self._enqueue(os.path.join(self.basedir, name))
+
+    def stop(self):
+        """
+        Stop removing trees, so that the buildslave can exit; what is left
+        is removed when it next starts.
+        """
+        self.stopped = True
+
+    def moveAside(self, path):
+        """
+        Move the tree at C{path} into the trash, to be removed later.
+        Return False if it could not be moved (for example, if it is on
+        another filesystem), in which case the caller must remove it
+        itself.
+        """
+        if not os.path.lexists(path):
+            return True
+        self.serial += 1
+        dest = os.path.join(self.basedir, "%s.%d.%d"
+                % (os.path.basename(path.rstrip(os.sep)), int(time.time()),
+                   self.serial))
+        try:
+            if not os.path.isdir(self.basedir):
+                os.makedirs(self.basedir)
+            os.rename(path, dest)
+        except OSError, e:
+            log.msg("could not move %s to the trash: %s" % (path, e))
+            return False
+        self._enqueue(dest)
+        return True
+
+    def isEmpty(self):
+        return not self.pending and self.removing is None
+
+    def waitUntilEmpty(self):
+        """
+        Return a Deferred which fires when the trash is empty.
+        """
+        if self.isEmpty():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.emptyWaiters.append(d)
+        return d
+
+    def getFreeSpace(self):
+        """
+        Return the number of bytes free on the filesystem holding the trash,
+        or None if that cannot be found.
+        """
+        if not hasattr(os, 'statvfs'):
+            return None
+        try:
+            st = os.statvfs(os.path.dirname(self.basedir.rstrip(os.sep)))
+        except OSError:
+            return None
+        return st.f_bavail * st.f_frsize
+
+    def hasSpace(self):
+        if self.minFreeSpace is None:
+            return True
+        free = self.getFreeSpace()
+        return free is None or free >= self.minFreeSpace
+
+    def waitForSpace(self):
+        """
+        Return a Deferred which fires with True if there is at least
+        C{minFreeSpace} free.  If there is not, wait for the trash to be
+        emptied, and then for up to C{lowSpaceDelay} seconds longer, before
+        firing with False.
+        """
+        if self.hasSpace():
+            return defer.succeed(True)
+        log.msg("less than %d bytes free; waiting for the trash to be "
+                "emptied" % self.minFreeSpace)
+        d = self.waitUntilEmpty()
+        def check(_):
+            if self.hasSpace():
+                return True
+            return task.deferLater(reactor, self.lowSpaceDelay,
+                                   self.hasSpace)
+        d.addCallback(check)
+        return d
+
+    def _enqueue(self, path):
+        self.pending.append(path)
+        if self.removing is None and not self.stopped:
+            self._removeNext()
+
+    def _removeNext(self):
+        if not self.pending or self.stopped:
+            self.removing = None
+            waiters, self.emptyWaiters = self.emptyWaiters, []
+            for d in waiters:
+                d.callback(None)
+            return
+        self.removing = path = self.pending.pop(0)
+        d = threads.deferToThread(self.remove, path)
+        d.addErrback(log.err, 'while removing %s' % path)
+        d.addCallback(lambda _ : self._removeNext())
+
+    def remove(self, path):
+        """
+        Remove the tree at C{path}, pausing now and then so as to remove at
+        most C{filesPerSecond} files a second.  This blocks; it is run in a
+        thread.
+        """
+        started = time.time()
+        self._removed = 0
+        self._batchStarted = started
+        self._removeTree(path)
+        log.msg("removed %s (%d files) in %.1f secs"
+                % (path, self._removed, time.time() - started))
+
+    def _removeTree(self, path):
+        if not os.path.isdir(path) or os.path.islink(path):
+            self._unlink(path)
+            return
+        # a tree may contain directories the build made unwritable
+        mode = os.lstat(path).st_mode
+        if mode & 0700 != 0700:
+            os.chmod(path, stat.S_IMODE(mode) | 0700)
+        for name in os.listdir(path):
+            if self.stopped:
+                return
+            self._removeTree(os.path.join(path, name))
+        if self.stopped:
+            return
+        os.rmdir(path)
+        self._throttle()
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            # read-only files cannot be removed on Windows
+            os.chmod(path, 0700)
+            os.unlink(path)
+        self._throttle()
+
+    def _throttle(self):
+        self._removed += 1
+        if self._removed % self.batchSize:
+            return
+        elapsed = time.time() - self._batchStarted
+        wait = float(self.batchSize) / self.filesPerSecond - elapsed
+        if wait > 0:
+            time.sleep(wait)
+        self._batchStarted = time.time()